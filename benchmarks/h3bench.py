@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Loopback HTTP/3 load benchmarks with h3load.
+
+Runs fixed scenarios with h3load (benchmarks/h3load.c, MsQuic and nghttp3,
+no Python on the client side) against a local ASGIServer and Application
+and writes requests/s and latency percentiles as JSON:
+
+  * small    - GET of a short JSON body
+  * download - GET of a 1 MB body
+  * upload   - POST of a 1 MB body
+  * headers  - GET with 40 request and 20 response header fields
+
+    LD_LIBRARY_PATH=vendor/dist/lib python benchmarks/h3bench.py -o new.json
+    LD_LIBRARY_PATH=vendor/dist/lib python benchmarks/h3bench.py -o new.json --compare old.json
+
+Needs cert.pem/key.pem in the working directory and a built h3load, see the
+top of h3load.c. --compare exits with status 1 when a scenario lost more than
+--threshold percent of its requests/s or its p99 latency grew by as much.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+DOWNLOAD = b'x' * (1024 * 1024)
+
+REQUEST_HEADERS = ['x-trace-{:02}: {}'.format(i, 'v' * 48) for i in range(38)] \
+    + ['cookie: ' + '; '.join('c{}={}'.format(i, 'k' * 24) for i in range(24)),
+       'authorization: Bearer ' + 't' * 160]
+
+RESPONSE_HEADERS = [('x-meta-{:02}'.format(i), 'm' * 40) for i in range(20)]
+
+SCENARIOS = {
+    'small': dict(path='/small', requests=20000, streams=32),
+    'download': dict(path='/download', requests=200, streams=4,
+                     window=8 * 1024 * 1024),
+    'upload': dict(path='/upload', method='POST', upload=len(DOWNLOAD),
+                   requests=200, streams=4),
+    'headers': dict(path='/headers', requests=20000, streams=32,
+                    headers=REQUEST_HEADERS),
+}
+
+
+async def asgi_app(scope, receive, send):
+    size = 0
+    while True:
+        message = await receive()
+        size += len(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    headers = [(b'content-type', b'application/octet-stream')]
+    if scope['path'] == '/download':
+        body = DOWNLOAD
+    elif scope['path'] == '/upload':
+        body = str(size).encode()
+    elif scope['path'] == '/headers':
+        headers += [(n.encode(), v.encode()) for n, v in RESPONSE_HEADERS]
+        body = b'{"ok": true}'
+    else:
+        body = b'{"ok": true}'
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def serve_asgi(port):
+    from fpy3.asgi import ASGIServer
+
+    async def main():
+        server = ASGIServer(asgi_app)
+        server.start('127.0.0.1', port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def serve_native(port):
+    from fpy3 import Application
+
+    def small(request):
+        return request.Response(json={'ok': True})
+
+    def download(request):
+        return request.Response(body=DOWNLOAD)
+
+    def upload(request):
+        return request.Response(text=str(len(request.body or b'')))
+
+    def headers(request):
+        return request.Response(
+            json={'ok': True}, headers=dict(RESPONSE_HEADERS))
+
+    app = Application(enable_http3=True)
+    app.router.add_route('/small', small)
+    app.router.add_route('/download', download)
+    app.router.add_route('/upload', upload, method='POST')
+    app.router.add_route('/headers', headers)
+    app.run(host='127.0.0.1', port=port)
+
+
+SERVERS = {
+    'asgi': serve_asgi,
+    'native': serve_native,
+}
+
+
+def h3load(binary, port, scenario, connections, scale):
+    options = SCENARIOS[scenario]
+    requests = max(int(options['requests'] * scale), connections)
+    command = [
+        binary, '-c', str(connections), '-m', str(options['streams']),
+        '-n', str(requests), '-X', options.get('method', 'GET')]
+    if options.get('upload'):
+        command += ['-b', str(options['upload'])]
+    if options.get('window'):
+        command += ['-w', str(options['window'])]
+    for header in options.get('headers', ()):
+        command += ['-H', header]
+    command.append('https://127.0.0.1:{}{}'.format(port, options['path']))
+
+    result = subprocess.run(command, stdout=subprocess.PIPE, check=False)
+    if not result.stdout:
+        raise RuntimeError('h3load {} failed'.format(scenario))
+
+    return json.loads(result.stdout)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, threshold):
+    """Print the change of every scenario in both runs, return whether any
+    regressed by more than threshold percent."""
+    regressed = False
+    print()
+    print('{:<8} {:<10} {:>10} {:>10}'.format('server', 'scenario', 'req/s', 'p99'))
+    for server, scenarios in results.items():
+        for scenario, new in scenarios.items():
+            old = baseline.get(server, {}).get(scenario)
+            if not old or not old['rps'] or not old['latency_us']['p99']:
+                continue
+
+            rps = (new['rps'] / old['rps'] - 1) * 100
+            p99 = (new['latency_us']['p99'] / old['latency_us']['p99'] - 1) * 100
+            worse = rps < -threshold or p99 > threshold
+            regressed = regressed or worse
+
+            print('{:<8} {:<10} {:>+9.1f}% {:>+9.1f}%{}'.format(
+                server, scenario, rps, p99, '  regression' if worse else ''))
+
+    return regressed
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--port', type=int, default=4433)
+    argparser.add_argument('--h3load', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'h3load'))
+    argparser.add_argument('--connections', type=int, default=4)
+    argparser.add_argument('--scale', type=float, default=1.0,
+                           help='multiply the request count of every scenario')
+    argparser.add_argument('--servers', nargs='+', default=list(SERVERS),
+                           choices=SERVERS)
+    argparser.add_argument('-o', '--output', default='h3bench.json')
+    argparser.add_argument('--compare', metavar='BASELINE')
+    argparser.add_argument('--threshold', type=float, default=10.0)
+    argparser.add_argument('scenarios', nargs='*', default=list(SCENARIOS))
+    args = argparser.parse_args()
+
+    if not (os.path.exists('cert.pem') and os.path.exists('key.pem')):
+        argparser.error('cert.pem and key.pem must be in the working directory')
+    if not os.access(args.h3load, os.X_OK):
+        argparser.error('{} is not built, see h3load.c'.format(args.h3load))
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        argparser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+
+    results = {}
+    print('{:<8} {:<10} {:>10} {:>9} {:>9} {:>9} {:>7}'.format(
+        'server', 'scenario', 'req/s', 'p50 us', 'p99 us', 'p999 us', 'failed'))
+    for server in args.servers:
+        process = multiprocessing.Process(
+            target=SERVERS[server], args=(args.port,))
+        process.start()
+        time.sleep(1)
+
+        try:
+            for scenario in args.scenarios:
+                result = h3load(args.h3load, args.port, scenario,
+                                args.connections, args.scale)
+                results.setdefault(server, {})[scenario] = result
+                latency = result['latency_us']
+                print('{:<8} {:<10} {:>10.0f} {:>9} {:>9} {:>9} {:>7}'.format(
+                    server, scenario, result['rps'], latency['p50'],
+                    latency['p99'], latency['p999'], result['failed']))
+        finally:
+            process.terminate()
+            process.join()
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'connections': args.connections,
+            'scale': args.scale,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,636 @@
+/*
+ * h3load - HTTP/3 load generator on the vendored MsQuic and nghttp3.
+ *
+ * Opens -c connections, keeps -m requests in flight on each until -n
+ * requests completed, and prints one JSON object with throughput and
+ * latency percentiles. Certificates are not verified, it is meant for
+ * loopback runs against a local server (see h3bench.py).
+ *
+ *   cc -O2 -o benchmarks/h3load benchmarks/h3load.c -Ivendor/dist/include \
+ *      -Lvendor/dist/lib -Wl,-rpath,$PWD/vendor/dist/lib -lmsquic -lnghttp3 -lpthread
+ *
+ *   benchmarks/h3load -c 4 -m 32 -n 20000 https://127.0.0.1:4433/small
+ *
+ * MsQuic delivers every event of a connection and its streams on one worker
+ * thread, so per-connection state needs no lock; only the totals are shared.
+ */
+#define _GNU_SOURCE
+#include <ctype.h>
+#include <errno.h>
+#include <getopt.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include <msquic.h>
+#include <nghttp3/nghttp3.h>
+
+#define MAX_HEADERS 128
+#define UPLOAD_CHUNK (64 * 1024)
+
+enum { KIND_CTRL, KIND_PEER, KIND_REQUEST };
+
+typedef struct Connection_s Connection;
+
+typedef struct Stream_s {
+    Connection* conn;
+    HQUIC Stream;
+    int64_t id; // -1 until START_COMPLETE
+    int kind;
+    struct Stream_s* next;
+
+    // KIND_REQUEST
+    uint64_t start_ns;
+    uint64_t upload_left;
+    int status;
+    int done; // the whole response arrived
+} Stream;
+
+struct Connection_s {
+    HQUIC Connection;
+    nghttp3_conn* h3;
+    Stream* streams;
+    Stream* ctrl[3]; // control, QPACK encoder and decoder streams
+    int ctrl_started;
+    int ready;
+    int closing;
+};
+
+typedef struct {
+    QUIC_BUFFER Buffer;
+    int64_t stream_id;
+    uint8_t data[];
+} SendBuffer;
+
+// --- Options ---
+
+static const char* host = "127.0.0.1";
+static uint16_t port = 4433;
+static char authority[300];
+static const char* path = "/";
+static const char* method = "GET";
+static int connections = 1;
+static int concurrency = 1;
+static long total = 1000;
+static uint64_t upload = 0;
+static int timeout_s = 60;
+static uint32_t recv_window = 0;
+static nghttp3_nv extra_headers[MAX_HEADERS];
+static size_t extra_count = 0;
+
+// --- Totals ---
+
+static atomic_long issued;
+static atomic_long completed;
+static atomic_ullong bytes_received;
+static atomic_int alive; // connections not shut down yet
+static atomic_ullong first_start_ns;
+static atomic_ullong last_done_ns;
+static uint32_t* latencies; // microseconds, one per successful request
+static atomic_long latency_count;
+
+static pthread_mutex_t done_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t done_cond = PTHREAD_COND_INITIALIZER;
+
+static const QUIC_API_TABLE* MsQuic;
+static HQUIC Registration;
+static HQUIC Configuration;
+static uint8_t upload_data[UPLOAD_CHUNK];
+
+static uint64_t now_ns(void) {
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static void Signal(void) {
+    pthread_mutex_lock(&done_lock);
+    pthread_cond_signal(&done_cond);
+    pthread_mutex_unlock(&done_lock);
+}
+
+static void RequestFinished(Stream* st) {
+    uint64_t now = now_ns();
+
+    // failed requests only count as missing latencies
+    if (st->done && st->status >= 200 && st->status < 400) {
+        long i = atomic_fetch_add(&latency_count, 1);
+        if (i < total) latencies[i] = (uint32_t)((now - st->start_ns) / 1000);
+    }
+
+    atomic_store(&last_done_ns, now);
+    if (atomic_fetch_add(&completed, 1) + 1 == total) Signal();
+}
+
+static Stream* FindStream(Connection* conn, int64_t id) {
+    for (Stream* st = conn->streams; st; st = st->next) {
+        if (st->id == id) return st;
+    }
+    return NULL;
+}
+
+static void RemoveStream(Connection* conn, Stream* st) {
+    for (Stream** p = &conn->streams; *p; p = &(*p)->next) {
+        if (*p == st) {
+            *p = st->next;
+            return;
+        }
+    }
+}
+
+static Stream* AddStream(Connection* conn, int kind) {
+    Stream* st = calloc(1, sizeof(Stream));
+    if (!st) return NULL;
+    st->conn = conn;
+    st->id = -1;
+    st->kind = kind;
+    st->next = conn->streams;
+    conn->streams = st;
+    return st;
+}
+
+// --- HTTP/3 ---
+
+// Hand everything nghttp3 has to write to MsQuic
+static void Flush(Connection* conn) {
+    for (;;) {
+        int64_t id = -1;
+        int fin = 0;
+        nghttp3_vec vec[16];
+        nghttp3_ssize n = nghttp3_conn_writev_stream(conn->h3, &id, &fin, vec, 16);
+
+        if (n < 0) {
+            fprintf(stderr, "h3load: nghttp3_conn_writev_stream: %s\n", nghttp3_strerror((int)n));
+            MsQuic->ConnectionShutdown(conn->Connection, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, 0);
+            return;
+        }
+        if (id < 0) return;
+
+        size_t len = 0;
+        for (nghttp3_ssize i = 0; i < n; ++i) len += vec[i].len;
+
+        Stream* st = FindStream(conn, id);
+        if (!st) {
+            // already shut down, nothing more goes out on it
+            nghttp3_conn_block_stream(conn->h3, id);
+            continue;
+        }
+        if (!len && !fin) return;
+
+        SendBuffer* sb = malloc(sizeof(SendBuffer) + (len ? len : 1));
+        if (!sb) return;
+        size_t off = 0;
+        for (nghttp3_ssize i = 0; i < n; ++i) {
+            memcpy(sb->data + off, vec[i].base, vec[i].len);
+            off += vec[i].len;
+        }
+        sb->Buffer.Buffer = sb->data;
+        sb->Buffer.Length = (uint32_t)len;
+        sb->stream_id = id;
+
+        if (QUIC_FAILED(MsQuic->StreamSend(st->Stream, &sb->Buffer, 1,
+                fin ? QUIC_SEND_FLAG_FIN : QUIC_SEND_FLAG_NONE, sb))) {
+            free(sb);
+            nghttp3_conn_block_stream(conn->h3, id);
+            continue;
+        }
+        nghttp3_conn_add_write_offset(conn->h3, id, len);
+    }
+}
+
+static nghttp3_ssize ReadUpload(nghttp3_conn* h3, int64_t stream_id, nghttp3_vec* vec, size_t veccnt,
+                                uint32_t* pflags, void* conn_user_data, void* stream_user_data) {
+    Stream* st = stream_user_data;
+    size_t len = st->upload_left < UPLOAD_CHUNK ? st->upload_left : UPLOAD_CHUNK;
+
+    // upload_data never changes, nghttp3 may keep pointing into it
+    vec[0].base = upload_data;
+    vec[0].len = len;
+    st->upload_left -= len;
+    if (!st->upload_left) *pflags |= NGHTTP3_DATA_FLAG_EOF;
+    return 1;
+}
+
+static int RecvHeader(nghttp3_conn* h3, int64_t stream_id, int32_t token, nghttp3_rcbuf* name,
+                      nghttp3_rcbuf* value, uint8_t flags, void* conn_user_data, void* stream_user_data) {
+    Stream* st = stream_user_data;
+    if (st && token == NGHTTP3_QPACK_TOKEN__STATUS) {
+        nghttp3_vec v = nghttp3_rcbuf_get_buf(value);
+        st->status = 0;
+        for (size_t i = 0; i < v.len; ++i) st->status = st->status * 10 + (v.base[i] - '0');
+    }
+    return 0;
+}
+
+static int RecvData(nghttp3_conn* h3, int64_t stream_id, const uint8_t* data, size_t len,
+                    void* conn_user_data, void* stream_user_data) {
+    atomic_fetch_add(&bytes_received, len);
+    return 0;
+}
+
+static int EndStream(nghttp3_conn* h3, int64_t stream_id, void* conn_user_data, void* stream_user_data) {
+    Stream* st = stream_user_data;
+    if (st) st->done = 1;
+    return 0;
+}
+
+static const nghttp3_callbacks callbacks = {
+    .recv_header = RecvHeader,
+    .recv_data = RecvData,
+    .end_stream = EndStream,
+};
+
+// --- MsQuic ---
+
+static QUIC_STATUS QUIC_API StreamCallback(HQUIC Handle, void* Context, QUIC_STREAM_EVENT* Event);
+
+// Open one more request stream unless all requests were handed out
+static void StartRequest(Connection* conn) {
+    if (conn->closing || atomic_fetch_add(&issued, 1) >= total) return;
+
+    Stream* st = AddStream(conn, KIND_REQUEST);
+    if (!st) goto error;
+    st->start_ns = now_ns();
+    st->upload_left = upload;
+
+    unsigned long long zero = 0;
+    atomic_compare_exchange_strong(&first_start_ns, &zero, st->start_ns);
+
+    if (QUIC_FAILED(MsQuic->StreamOpen(conn->Connection, QUIC_STREAM_OPEN_FLAG_NONE, StreamCallback, st, &st->Stream)))
+        goto error;
+    if (QUIC_FAILED(MsQuic->StreamStart(st->Stream, QUIC_STREAM_START_FLAG_NONE))) {
+        MsQuic->StreamClose(st->Stream);
+        goto error;
+    }
+    return;
+
+error:
+    if (st) {
+        RemoveStream(conn, st);
+        RequestFinished(st);
+        free(st);
+    } else if (atomic_fetch_add(&completed, 1) + 1 == total) {
+        Signal();
+    }
+}
+
+static void SubmitRequest(Stream* st) {
+    Connection* conn = st->conn;
+    nghttp3_nv nva[MAX_HEADERS + 6];
+    size_t n = 0;
+    char length[32];
+    static const nghttp3_data_reader reader = {ReadUpload};
+
+#define NV(n_, v_) (nghttp3_nv){(uint8_t*)(n_), (uint8_t*)(v_), strlen(n_), strlen(v_), NGHTTP3_NV_FLAG_NONE}
+    nva[n++] = NV(":method", method);
+    nva[n++] = NV(":scheme", "https");
+    nva[n++] = NV(":authority", authority);
+    nva[n++] = NV(":path", path);
+    nva[n++] = NV("user-agent", "h3load");
+    if (upload) {
+        snprintf(length, sizeof(length), "%llu", (unsigned long long)upload);
+        nva[n++] = NV("content-length", length);
+    }
+#undef NV
+    for (size_t i = 0; i < extra_count; ++i) nva[n++] = extra_headers[i];
+
+    int rv = nghttp3_conn_submit_request(conn->h3, st->id, nva, n, upload ? &reader : NULL, st);
+    if (rv != 0) {
+        fprintf(stderr, "h3load: nghttp3_conn_submit_request: %s\n", nghttp3_strerror(rv));
+        MsQuic->StreamShutdown(st->Stream, QUIC_STREAM_SHUTDOWN_FLAG_ABORT, NGHTTP3_H3_INTERNAL_ERROR);
+        return;
+    }
+    Flush(conn);
+}
+
+static void ReadStream(Stream* st, const QUIC_BUFFER* Buffers, uint32_t count, int fin) {
+    Connection* conn = st->conn;
+
+    nghttp3_ssize rv = 0;
+
+    if (!count && fin) rv = nghttp3_conn_read_stream(conn->h3, st->id, NULL, 0, 1);
+    for (uint32_t i = 0; i < count && rv >= 0; ++i) {
+        rv = nghttp3_conn_read_stream(conn->h3, st->id, Buffers[i].Buffer, Buffers[i].Length,
+            fin && i == count - 1);
+    }
+
+    if (rv < 0) {
+        fprintf(stderr, "h3load: nghttp3_conn_read_stream: %s\n", nghttp3_strerror((int)rv));
+        MsQuic->ConnectionShutdown(conn->Connection, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, NGHTTP3_H3_GENERAL_PROTOCOL_ERROR);
+        return;
+    }
+    Flush(conn);
+}
+
+static QUIC_STATUS QUIC_API StreamCallback(HQUIC Handle, void* Context, QUIC_STREAM_EVENT* Event) {
+    Stream* st = Context;
+    Connection* conn = st->conn;
+
+    switch (Event->Type) {
+    case QUIC_STREAM_EVENT_START_COMPLETE:
+        if (QUIC_FAILED(Event->START_COMPLETE.Status)) break;
+        st->id = (int64_t)Event->START_COMPLETE.ID;
+        if (st->kind == KIND_REQUEST) {
+            SubmitRequest(st);
+        } else if (++conn->ctrl_started == 3) {
+            nghttp3_conn_bind_control_stream(conn->h3, conn->ctrl[0]->id);
+            nghttp3_conn_bind_qpack_streams(conn->h3, conn->ctrl[1]->id, conn->ctrl[2]->id);
+            conn->ready = 1;
+            for (int i = 0; i < concurrency; ++i) StartRequest(conn);
+            Flush(conn);
+        }
+        break;
+    case QUIC_STREAM_EVENT_RECEIVE:
+        if (conn->h3 && st->id >= 0)
+            ReadStream(st, Event->RECEIVE.Buffers, Event->RECEIVE.BufferCount,
+                (Event->RECEIVE.Flags & QUIC_RECEIVE_FLAG_FIN) != 0);
+        break;
+    case QUIC_STREAM_EVENT_SEND_COMPLETE:
+        {
+            SendBuffer* sb = Event->SEND_COMPLETE.ClientContext;
+            if (sb && !Event->SEND_COMPLETE.Canceled && conn->h3)
+                nghttp3_conn_add_ack_offset(conn->h3, sb->stream_id, sb->Buffer.Length);
+            free(sb);
+        }
+        break;
+    case QUIC_STREAM_EVENT_PEER_SEND_ABORTED:
+    case QUIC_STREAM_EVENT_PEER_RECEIVE_ABORTED:
+        MsQuic->StreamShutdown(Handle, QUIC_STREAM_SHUTDOWN_FLAG_ABORT, NGHTTP3_H3_NO_ERROR);
+        break;
+    case QUIC_STREAM_EVENT_SHUTDOWN_COMPLETE:
+        RemoveStream(conn, st);
+        if (conn->h3 && st->id >= 0)
+            nghttp3_conn_close_stream(conn->h3, st->id, NGHTTP3_H3_NO_ERROR);
+        MsQuic->StreamClose(Handle);
+        if (st->kind == KIND_REQUEST) {
+            RequestFinished(st);
+            StartRequest(conn);
+            if (conn->h3) Flush(conn);
+        }
+        free(st);
+        break;
+    default:
+        break;
+    }
+    return QUIC_STATUS_SUCCESS;
+}
+
+static int OpenControlStreams(Connection* conn) {
+    nghttp3_settings settings;
+    nghttp3_settings_default(&settings);
+    if (nghttp3_conn_client_new(&conn->h3, &callbacks, &settings, nghttp3_mem_default(), conn) != 0)
+        return -1;
+
+    for (int i = 0; i < 3; ++i) {
+        Stream* st = conn->ctrl[i] = AddStream(conn, KIND_CTRL);
+        if (!st) return -1;
+        if (QUIC_FAILED(MsQuic->StreamOpen(conn->Connection, QUIC_STREAM_OPEN_FLAG_UNIDIRECTIONAL, StreamCallback, st, &st->Stream))) {
+            RemoveStream(conn, st);
+            free(st);
+            conn->ctrl[i] = NULL;
+            return -1;
+        }
+        if (QUIC_FAILED(MsQuic->StreamStart(st->Stream, QUIC_STREAM_START_FLAG_NONE)))
+            return -1;
+    }
+    return 0;
+}
+
+static QUIC_STATUS QUIC_API ConnectionCallback(HQUIC Handle, void* Context, QUIC_CONNECTION_EVENT* Event) {
+    Connection* conn = Context;
+
+    switch (Event->Type) {
+    case QUIC_CONNECTION_EVENT_CONNECTED:
+        if (OpenControlStreams(conn) == -1) {
+            fprintf(stderr, "h3load: cannot set up HTTP/3\n");
+            MsQuic->ConnectionShutdown(Handle, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, NGHTTP3_H3_INTERNAL_ERROR);
+        }
+        break;
+    case QUIC_CONNECTION_EVENT_PEER_STREAM_STARTED:
+        {
+            Stream* st = AddStream(conn, KIND_PEER);
+            uint32_t len = sizeof(st->id);
+            if (!st) {
+                MsQuic->StreamShutdown(Event->PEER_STREAM_STARTED.Stream, QUIC_STREAM_SHUTDOWN_FLAG_ABORT, NGHTTP3_H3_INTERNAL_ERROR);
+                break;
+            }
+            st->Stream = Event->PEER_STREAM_STARTED.Stream;
+            MsQuic->GetParam(st->Stream, QUIC_PARAM_STREAM_ID, &len, &st->id);
+            MsQuic->SetCallbackHandler(st->Stream, (void*)StreamCallback, st);
+        }
+        break;
+    case QUIC_CONNECTION_EVENT_SHUTDOWN_INITIATED_BY_TRANSPORT:
+        if (!conn->closing)
+            fprintf(stderr, "h3load: connection closed by transport: 0x%x\n",
+                (unsigned)Event->SHUTDOWN_INITIATED_BY_TRANSPORT.Status);
+        conn->closing = 1;
+        break;
+    case QUIC_CONNECTION_EVENT_SHUTDOWN_INITIATED_BY_PEER:
+        conn->closing = 1;
+        break;
+    case QUIC_CONNECTION_EVENT_SHUTDOWN_COMPLETE:
+        conn->closing = 1;
+        if (conn->h3) {
+            nghttp3_conn_del(conn->h3);
+            conn->h3 = NULL;
+        }
+        if (atomic_fetch_sub(&alive, 1) == 1) Signal();
+        break;
+    default:
+        break;
+    }
+    return QUIC_STATUS_SUCCESS;
+}
+
+// --- Main ---
+
+static int Compare(const void* a, const void* b) {
+    uint32_t x = *(const uint32_t*)a, y = *(const uint32_t*)b;
+    return (x > y) - (x < y);
+}
+
+static uint32_t Percentile(const uint32_t* sorted, long n, double q) {
+    if (!n) return 0;
+    long i = (long)(q * n + 0.999999) - 1;
+    if (i < 0) i = 0;
+    if (i >= n) i = n - 1;
+    return sorted[i];
+}
+
+static int ParseUrl(const char* url) {
+    static char host_buf[256], path_buf[2048];
+    const char* p = url;
+
+    if (strncmp(p, "https://", 8) == 0) p += 8;
+
+    const char* slash = strchr(p, '/');
+    const char* end = slash ? slash : p + strlen(p);
+    const char* colon = NULL;
+    if (*p == '[') {
+        const char* close = memchr(p, ']', end - p);
+        if (!close) return -1;
+        colon = close + 1 < end && close[1] == ':' ? close + 1 : NULL;
+        if ((size_t)(close - p - 1) >= sizeof(host_buf)) return -1;
+        memcpy(host_buf, p + 1, close - p - 1);
+        host_buf[close - p - 1] = 0;
+    } else {
+        colon = memchr(p, ':', end - p);
+        const char* host_end = colon ? colon : end;
+        if ((size_t)(host_end - p) >= sizeof(host_buf)) return -1;
+        memcpy(host_buf, p, host_end - p);
+        host_buf[host_end - p] = 0;
+    }
+    if (colon) port = (uint16_t)atoi(colon + 1);
+    host = host_buf;
+
+    snprintf(path_buf, sizeof(path_buf), "%s", slash ? slash : "/");
+    path = path_buf;
+    snprintf(authority, sizeof(authority), "%.*s", (int)(end - p), p);
+    return 0;
+}
+
+static void Usage(void) {
+    fprintf(stderr,
+        "usage: h3load [-c connections] [-m streams] [-n requests] [-X method]\n"
+        "              [-b upload-bytes] [-H 'name: value']... [-w recv-window]\n"
+        "              [-t timeout-s] https://host:port/path\n");
+    exit(2);
+}
+
+static int AddHeader(char* header) {
+    char* colon = strchr(header, ':');
+    if (!colon || colon == header || extra_count == MAX_HEADERS) return -1;
+    *colon = 0;
+    char* value = colon + 1;
+    while (*value == ' ') value++;
+    for (char* c = header; *c; ++c) *c = (char)tolower((unsigned char)*c);
+
+    extra_headers[extra_count++] = (nghttp3_nv){
+        (uint8_t*)header, (uint8_t*)value, strlen(header), strlen(value), NGHTTP3_NV_FLAG_NONE};
+    return 0;
+}
+
+int main(int argc, char** argv) {
+    int opt;
+    QUIC_STATUS Status;
+
+    while ((opt = getopt(argc, argv, "c:m:n:X:b:H:w:t:")) != -1) {
+        switch (opt) {
+        case 'c': connections = atoi(optarg); break;
+        case 'm': concurrency = atoi(optarg); break;
+        case 'n': total = atol(optarg); break;
+        case 'X': method = optarg; break;
+        case 'b': upload = strtoull(optarg, NULL, 10); break;
+        case 'H': if (AddHeader(optarg) == -1) Usage(); break;
+        case 'w': recv_window = (uint32_t)strtoul(optarg, NULL, 10); break;
+        case 't': timeout_s = atoi(optarg); break;
+        default: Usage();
+        }
+    }
+    if (optind != argc - 1 || connections < 1 || concurrency < 1 || total < 1) Usage();
+    if (ParseUrl(argv[optind]) == -1) Usage();
+
+    memset(upload_data, 'x', sizeof(upload_data));
+    if (!(latencies = calloc(total, sizeof(uint32_t)))) return 1;
+
+    if (QUIC_FAILED(Status = MsQuicOpen2(&MsQuic))) {
+        fprintf(stderr, "h3load: MsQuicOpen2 failed: 0x%x\n", (unsigned)Status);
+        return 1;
+    }
+
+    const QUIC_REGISTRATION_CONFIG RegConfig = {"h3load", QUIC_EXECUTION_PROFILE_LOW_LATENCY};
+    if (QUIC_FAILED(Status = MsQuic->RegistrationOpen(&RegConfig, &Registration))) {
+        fprintf(stderr, "h3load: RegistrationOpen failed: 0x%x\n", (unsigned)Status);
+        return 1;
+    }
+
+    QUIC_SETTINGS Settings = {0};
+    Settings.IdleTimeoutMs = (uint64_t)timeout_s * 1000;
+    Settings.IsSet.IdleTimeoutMs = 1;
+    Settings.PeerUnidiStreamCount = 3;
+    Settings.IsSet.PeerUnidiStreamCount = 1;
+    if (recv_window) {
+        Settings.StreamRecvWindowDefault = recv_window;
+        Settings.IsSet.StreamRecvWindowDefault = 1;
+        Settings.ConnFlowControlWindow = recv_window * 4;
+        Settings.IsSet.ConnFlowControlWindow = 1;
+    }
+
+    const QUIC_BUFFER Alpn = {sizeof("h3") - 1, (uint8_t*)"h3"};
+    if (QUIC_FAILED(Status = MsQuic->ConfigurationOpen(Registration, &Alpn, 1, &Settings, sizeof(Settings), NULL, &Configuration))) {
+        fprintf(stderr, "h3load: ConfigurationOpen failed: 0x%x\n", (unsigned)Status);
+        return 1;
+    }
+
+    QUIC_CREDENTIAL_CONFIG Cred;
+    memset(&Cred, 0, sizeof(Cred));
+    Cred.Type = QUIC_CREDENTIAL_TYPE_NONE;
+    Cred.Flags = QUIC_CREDENTIAL_FLAG_CLIENT | QUIC_CREDENTIAL_FLAG_NO_CERTIFICATE_VALIDATION;
+    if (QUIC_FAILED(Status = MsQuic->ConfigurationLoadCredential(Configuration, &Cred))) {
+        fprintf(stderr, "h3load: ConfigurationLoadCredential failed: 0x%x\n", (unsigned)Status);
+        return 1;
+    }
+
+    Connection* conns = calloc(connections, sizeof(Connection));
+    if (!conns) return 1;
+
+    atomic_store(&alive, connections);
+    for (int i = 0; i < connections; ++i) {
+        if (QUIC_FAILED(Status = MsQuic->ConnectionOpen(Registration, ConnectionCallback, &conns[i], &conns[i].Connection))
+                || QUIC_FAILED(Status = MsQuic->ConnectionStart(conns[i].Connection, Configuration, QUIC_ADDRESS_FAMILY_UNSPEC, host, port))) {
+            fprintf(stderr, "h3load: cannot connect to %s:%u: 0x%x\n", host, port, (unsigned)Status);
+            return 1;
+        }
+    }
+
+    struct timespec deadline;
+    clock_gettime(CLOCK_REALTIME, &deadline);
+    deadline.tv_sec += timeout_s;
+
+    pthread_mutex_lock(&done_lock);
+    while (atomic_load(&completed) < total && atomic_load(&alive) > 0) {
+        if (pthread_cond_timedwait(&done_cond, &done_lock, &deadline) == ETIMEDOUT) {
+            fprintf(stderr, "h3load: timed out\n");
+            break;
+        }
+    }
+    pthread_mutex_unlock(&done_lock);
+
+    // freeze the results before shutdown aborts what is still running
+    long ok = atomic_load(&latency_count);
+    if (ok > total) ok = total;
+    long failed = total - ok;
+    uint64_t start = atomic_load(&first_start_ns), end = atomic_load(&last_done_ns);
+    double seconds = start && end > start ? (end - start) / 1e9 : 0;
+    unsigned long long received = atomic_load(&bytes_received);
+    uint32_t* sorted = malloc(ok * sizeof(uint32_t) + 1);
+    memcpy(sorted, latencies, ok * sizeof(uint32_t));
+
+    MsQuic->RegistrationShutdown(Registration, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, 0);
+    for (int i = 0; i < connections; ++i) MsQuic->ConnectionClose(conns[i].Connection);
+    MsQuic->ConfigurationClose(Configuration);
+    MsQuic->RegistrationClose(Registration);
+    MsQuicClose(MsQuic);
+
+    qsort(sorted, ok, sizeof(uint32_t), Compare);
+    double sum = 0;
+    for (long i = 0; i < ok; ++i) sum += sorted[i];
+
+    printf("{\"connections\": %d, \"streams\": %d, \"requests\": %ld, \"succeeded\": %ld, \"failed\": %ld, "
+           "\"seconds\": %.6f, \"rps\": %.1f, \"bytes_received\": %llu, \"mbps\": %.2f, "
+           "\"latency_us\": {\"mean\": %.1f, \"p50\": %u, \"p90\": %u, \"p99\": %u, \"p999\": %u, \"max\": %u}}\n",
+        connections, concurrency, total, ok, failed,
+        seconds, seconds ? ok / seconds : 0.0, received,
+        seconds ? received * 8 / seconds / 1e6 : 0.0,
+        ok ? sum / ok : 0.0,
+        Percentile(sorted, ok, .50), Percentile(sorted, ok, .90), Percentile(sorted, ok, .99),
+        Percentile(sorted, ok, .999), ok ? sorted[ok - 1] : 0);
+
+    free(sorted);
+    free(latencies);
+    free(conns);
+    return failed ? 1 : 0;
+}
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Response header bytes on the wire for repeated HTTP/3 API calls.
+
+Runs the same small JSON endpoint under each QPACK configuration and counts,
+with an aioquic client, every byte the server sends on request streams and
+its QPACK encoder stream except the response bodies. That is HEADERS frames,
+DATA frame headers and dynamic table inserts.
+
+    LD_LIBRARY_PATH=vendor/dist/lib python benchmarks/qpack_headers.py
+
+Needs aioquic and cert.pem/key.pem in the working directory.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import ssl
+import time
+
+from aioquic.asyncio import connect
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.events import DataReceived, HeadersReceived
+from aioquic.quic.events import StreamDataReceived
+from aioquic.quic.configuration import QuicConfiguration
+
+from fpy3 import Application
+from fpy3.protocol.quic import QuicSettings
+
+
+CONFIGS = {
+    'static': dict(qpack_encoder_max_dtable_capacity=0),
+    'dynamic': dict(
+        qpack_max_dtable_capacity=4096,
+        qpack_encoder_max_dtable_capacity=4096,
+        qpack_blocked_streams=16),
+    'try-index': dict(
+        qpack_max_dtable_capacity=4096,
+        qpack_encoder_max_dtable_capacity=4096,
+        qpack_blocked_streams=16,
+        qpack_try_index=True),
+}
+
+HEADERS = {
+    'Cache-Control': 'private, max-age=0, must-revalidate',
+    'Vary': 'Accept-Encoding, Authorization',
+    'X-Request-Id': '00000000-0000-0000-0000-000000000000',
+    'X-Api-Version': '2024-06-01',
+    'Strict-Transport-Security': 'max-age=63072000; includeSubDomains',
+}
+
+
+def serve(config, port):
+    def api(request):
+        return request.Response(json={'ok': True}, headers=HEADERS)
+
+    app = Application(
+        enable_http3=True, quic_settings=QuicSettings(**CONFIGS[config]))
+    app.router.add_route('/api', api)
+    app.run(host='127.0.0.1', port=port)
+
+
+class Client(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.h3 = H3Connection(self._quic)
+        self.waiters = {}
+        self.wire = 0
+        self.body = 0
+
+    def quic_event_received(self, event):
+        for h3_event in self.h3.handle_event(event):
+            if isinstance(h3_event, DataReceived):
+                self.body += len(h3_event.data)
+            elif not isinstance(h3_event, HeadersReceived):
+                continue
+
+            if h3_event.stream_ended:
+                self.waiters.pop(h3_event.stream_id).set_result(None)
+
+        # everything but the server control stream, which only carries
+        # SETTINGS, is known once the event has been handled
+        if isinstance(event, StreamDataReceived) \
+                and event.stream_id != self.h3._peer_control_stream_id:
+            self.wire += len(event.data)
+
+    async def get(self, path):
+        stream_id = self._quic.get_next_available_stream_id()
+        self.h3.send_headers(stream_id, [
+            (b':method', b'GET'),
+            (b':scheme', b'https'),
+            (b':authority', b'127.0.0.1'),
+            (b':path', path.encode()),
+        ], end_stream=True)
+        waiter = self.waiters[stream_id] = self._loop.create_future()
+        self.transmit()
+
+        await waiter
+
+
+async def measure(port, requests):
+    configuration = QuicConfiguration(is_client=True, alpn_protocols=H3_ALPN)
+    configuration.verify_mode = ssl.CERT_NONE
+
+    async with connect('127.0.0.1', port, configuration=configuration,
+                       create_protocol=Client) as client:
+        await client.get('/api')
+        first = client.wire - client.body
+
+        for _ in range(requests - 1):
+            await client.get('/api')
+
+        total = client.wire - client.body
+
+    return first, (total - first) / max(requests - 1, 1)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--port', type=int, default=4433)
+    argparser.add_argument('--requests', type=int, default=200)
+    argparser.add_argument('configs', nargs='*', default=list(CONFIGS))
+    args = argparser.parse_args()
+
+    if not (os.path.exists('cert.pem') and os.path.exists('key.pem')):
+        argparser.error('cert.pem and key.pem must be in the working directory')
+
+    print('{:<10} {:>14} {:>16}'.format('config', 'first request', 'per request after'))
+    for config in args.configs:
+        server = multiprocessing.Process(target=serve, args=(config, args.port))
+        server.start()
+        time.sleep(1)
+
+        try:
+            first, steady = asyncio.run(measure(args.port, args.requests))
+        finally:
+            server.terminate()
+            server.join()
+
+        print('{:<10} {:>12} B {:>14.1f} B'.format(config, first, steady))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""Loopback HTTP/3 throughput of the QuicSettings presets.
+
+Starts an fpy3 Application with enable_http3 once per preset and measures
+with an aioquic client:
+
+  * api  - concurrent small GET requests on one connection, requests/s
+  * bulk - sequential large downloads on one connection, MB/s
+
+    LD_LIBRARY_PATH=vendor/dist/lib python benchmarks/quic_presets.py
+
+Needs aioquic and cert.pem/key.pem in the working directory. Loopback has
+no loss and almost no delay, so BBR vs CUBIC differences mostly show up on
+real paths; the window and execution profile differences do show here.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import ssl
+import time
+
+from aioquic.asyncio import connect
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.events import DataReceived, HeadersReceived
+from aioquic.quic.configuration import QuicConfiguration
+
+from fpy3 import Application
+from fpy3.protocol.quic import QuicSettings
+
+
+PRESETS = {
+    'default': QuicSettings,
+    'api': QuicSettings.api,
+    'bulk': QuicSettings.bulk,
+}
+
+
+def serve(preset, port, bulk_size):
+    payload = b'x' * bulk_size
+
+    def small(request):
+        return request.Response(json={'ok': True})
+
+    def bulk(request):
+        return request.Response(body=payload)
+
+    app = Application(enable_http3=True, quic_settings=PRESETS[preset]())
+    app.router.add_route('/small', small)
+    app.router.add_route('/bulk', bulk)
+    app.run(host='127.0.0.1', port=port)
+
+
+class Client(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.h3 = H3Connection(self._quic)
+        self.waiters = {}
+        self.received = {}
+
+    def quic_event_received(self, event):
+        for h3_event in self.h3.handle_event(event):
+            if isinstance(h3_event, HeadersReceived):
+                self.received.setdefault(h3_event.stream_id, 0)
+            elif isinstance(h3_event, DataReceived):
+                self.received[h3_event.stream_id] = \
+                    self.received.get(h3_event.stream_id, 0) \
+                    + len(h3_event.data)
+            else:
+                continue
+
+            if h3_event.stream_ended:
+                waiter = self.waiters.pop(h3_event.stream_id)
+                waiter.set_result(self.received.pop(h3_event.stream_id))
+
+    async def get(self, path):
+        stream_id = self._quic.get_next_available_stream_id()
+        self.h3.send_headers(stream_id, [
+            (b':method', b'GET'),
+            (b':scheme', b'https'),
+            (b':authority', b'127.0.0.1'),
+            (b':path', path.encode()),
+        ], end_stream=True)
+        waiter = self.waiters[stream_id] = self._loop.create_future()
+        self.transmit()
+
+        return await waiter
+
+
+async def measure(port, requests, concurrency, downloads):
+    configuration = QuicConfiguration(is_client=True, alpn_protocols=H3_ALPN)
+    configuration.verify_mode = ssl.CERT_NONE
+    configuration.max_data = 64 * 1024 * 1024
+    configuration.max_stream_data = 16 * 1024 * 1024
+
+    async with connect('127.0.0.1', port, configuration=configuration,
+                       create_protocol=Client) as client:
+        await client.get('/small')
+
+        async def worker(count):
+            for _ in range(count):
+                await client.get('/small')
+
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(worker(requests // concurrency) for _ in range(concurrency)))
+        rps = requests // concurrency * concurrency \
+            / (time.perf_counter() - start)
+
+        total = 0
+        start = time.perf_counter()
+        for _ in range(downloads):
+            total += await client.get('/bulk')
+        mbps = total / (1024 * 1024) / (time.perf_counter() - start)
+
+    return rps, mbps
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    argparser.add_argument('--port', type=int, default=4433)
+    argparser.add_argument('--requests', type=int, default=10000)
+    argparser.add_argument('--concurrency', type=int, default=50)
+    argparser.add_argument('--downloads', type=int, default=20)
+    argparser.add_argument('--bulk-size', type=int, default=16 * 1024 * 1024)
+    argparser.add_argument('presets', nargs='*', default=list(PRESETS))
+    args = argparser.parse_args()
+
+    if not (os.path.exists('cert.pem') and os.path.exists('key.pem')):
+        argparser.error('cert.pem and key.pem must be in the working directory')
+
+    print('{:<10} {:>12} {:>12}'.format('preset', 'api req/s', 'bulk MB/s'))
+    for preset in args.presets:
+        server = multiprocessing.Process(
+            target=serve, args=(preset, args.port, args.bulk_size))
+        server.start()
+        time.sleep(1)
+
+        try:
+            rps, mbps = asyncio.run(measure(
+                args.port, args.requests, args.concurrency, args.downloads))
+        finally:
+            server.terminate()
+            server.join()
+
+        print('{:<10} {:>12.0f} {:>12.1f}'.format(preset, rps, mbps))
+
+
+if __name__ == '__main__':
+    main()
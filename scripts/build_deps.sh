@@ -49,7 +49,25 @@ else
     echo "[nghttp3] Already built."
 fi
 
-# 3. Build libwtf (dummy check as it seems to be part of the project structure already or expects to be built?)
+# 3. Build nghttp2 (optional: HTTP/2 of the ASGI TLS listener)
+if [ ! -d "$VENDOR_DIR/nghttp2" ]; then
+    echo "[nghttp2] Cloning..."
+    git clone https://github.com/nghttp2/nghttp2.git "$VENDOR_DIR/nghttp2"
+fi
+
+if [ ! -f "$DIST_DIR/lib/libnghttp2.so" ]; then
+    echo "[nghttp2] Building..."
+    cd "$VENDOR_DIR/nghttp2"
+    autoreconf -i
+    ./configure --enable-lib-only --prefix="$DIST_DIR"
+    make
+    make install
+    echo "[nghttp2] Done."
+else
+    echo "[nghttp2] Already built."
+fi
+
+# 4. Build libwtf (dummy check as it seems to be part of the project structure already or expects to be built?)
 # In meson.build: libwtf = cc.find_library('wtf', dirs: [meson.current_source_dir() + '/vendor/dist/lib'], required: true)
 # If libwtf is part of fpy repo, we assume it is already there? 
 # Wait, looking at file list from previous context, I don't see libwtf source. 
@@ -14,6 +14,16 @@ cd nghttp3
 cmake -S . -B build -DCMAKE_INSTALL_PREFIX="$VENDOR_DIR/dist" -DENABLE_LIB_ONLY=ON -DENABLE_STATIC_LIB=ON -DENABLE_SHARED_LIB=ON
 cmake --build build --target install
 
+# --- nghttp2, HTTP/2 of the ASGI TLS listener ---
+echo ">>> Building nghttp2..."
+cd "$VENDOR_DIR"
+if [ ! -d "nghttp2" ]; then
+    git clone --depth 1 -b v1.64.0 https://github.com/nghttp2/nghttp2
+fi
+cd nghttp2
+cmake -S . -B build -DCMAKE_INSTALL_PREFIX="$VENDOR_DIR/dist" -DENABLE_LIB_ONLY=ON -DENABLE_STATIC_LIB=OFF -DENABLE_SHARED_LIB=ON
+cmake --build build --target install
+
 # --- msquic ---
 echo ">>> Building msquic..."
 cd "$VENDOR_DIR"
@@ -12,9 +12,15 @@ import uvloop
 from fpy3.router import Router, RouteNotFoundException
 from fpy3.protocol.cprotocol import Protocol
 from fpy3.protocol.creaper import Reaper
+from fpy3.protocol.tls import TlsSettings
+from fpy3.protocol.broadcast import SSE, Broadcast, event_stream_head
+from fpy3.protocol.websocket import WebSocketSettings
 from fpy3.request import crequest
+from fpy3.response import cresponse
 try:
-    from fpy3.protocol.cquic import QuicServer
+    from fpy3.protocol.cquic import QuicServer, set_server_id
+    from fpy3.protocol import reuseport
+    from fpy3.protocol.quic import QuicStats
 except ImportError as e:
     import traceback
     traceback.print_exc()
@@ -35,9 +41,17 @@ signames = {
 class Application:
     def __init__(self, *, reaper_settings=None, log_request=None,
                  protocol_factory=None, debug=False, max_requests=1024,
-                 enable_http3=False):
+                 enable_http3=False, quic_settings=None, quic_stats=None,
+                 warmup=None, tls_settings=None, websocket_settings=None,
+                 broadcast_settings=None, max_fields=1000,
+                 max_form_size=2 * 1024 * 1024):
         crequest.configure_pool(max_size=max_requests)
+        crequest.configure_fields(max_fields=max_fields, max_size=max_form_size)
         self._enable_http3 = enable_http3
+        self._quic_settings = quic_settings
+        self._quic_server = None
+        self._quic_stats_settings = quic_stats
+        self._quic_stats = None
         self._router = None
         self._loop = None
         self._connections = set()
@@ -47,6 +61,15 @@ class Application:
         self._request_extensions = {}
         self._protocol_factory = protocol_factory or Protocol
         self._debug = debug
+        self._on_startup = []
+        self._on_shutdown = []
+        self._warmup = warmup or ()
+        # made here so that the workers share the session ticket keys
+        self._tls_settings = tls_settings or TlsSettings()
+        self._websocket_settings = websocket_settings or WebSocketSettings()
+        self._websockets = set() # upgraded connections, see Protocol.upgrade
+        self._broadcast_settings = broadcast_settings or {}
+        self._hub = None
 
     @property
     def loop(self):
@@ -55,6 +78,42 @@ class Application:
 
         return self._loop
 
+    @property
+    def quic_stats(self):
+        """QuicStats sampler of this worker when quic_stats was given."""
+        return self._quic_stats
+
+    @property
+    def hub(self):
+        """Broadcast channels of this worker, see fpy3.protocol.broadcast."""
+        if not self._hub:
+            self._hub = Broadcast(self.loop, **self._broadcast_settings)
+
+        return self._hub
+
+    def broadcast(self, channel, data, *, event=None, id=None):
+        """Send data to the event streams and WebSockets subscribed to
+        channel in this worker, return how many got it."""
+        if not self._hub:
+            return 0
+
+        return self._hub.publish(channel, data, event=event, id=id)
+
+    def subscribe(self, request, channel, *, headers=(), retry=None, coalesce=None):
+        """Answer request with a text/event-stream of the events broadcast
+        to channel. The connection leaves the pipeline: what the handler
+        returns afterwards is dropped, and the stream ends when the client
+        goes away, falls behind (unless coalesce) or the worker drains."""
+        transport = request.transport
+        if transport is None:
+            raise RuntimeError('event streams need an HTTP/1.1 connection')
+
+        subscriber = self.hub.subscribe(channel, transport, SSE, coalesce=coalesce)
+        transport.get_protocol().upgrade(subscriber)
+        transport.write(event_stream_head(headers, retry))
+
+        return subscriber
+
     @property
     def router(self):
         if not self._router:
@@ -90,9 +149,13 @@ class Application:
     def default_error_handler(self, request, exception):
         if isinstance(exception, RouteNotFoundException):
             return request.Response(code=404, text='Not Found')
+        if isinstance(exception, crequest.FieldsLimitError):
+            return request.Response(code=400, text=str(exception))
         if isinstance(exception, asyncio.CancelledError):
             return request.Response(code=503, text='Service unavailable')
 
+        tb = traceback.format_exception(
+            None, exception, exception.__traceback__)
         tb = ''.join(tb)
         logger.error(tb)
         return request.Response(
@@ -123,11 +186,26 @@ class Application:
             [c for c in self._connections if not c.pipeline_empty]
 
     async def drain(self):
+        # HTTP/3 connections first get GOAWAY, see QuicServer.shutdown
+        quic = self._quic_server
+        quic_busy = quic.shutdown() if quic else 0
+
+        # WebSockets get 1001 and end their handlers as the clients answer
+        websockets = list(self._websockets)
+        for ws in websockets:
+            ws.close_idle()
+
+        # event streams never finish, their clients reconnect elsewhere;
+        # the WebSockets among the subscribers were detached by their close
+        streams = len(self._hub) if self._hub else 0
+        if self._hub:
+            self._hub.close()
+
         idle, busy = self._get_idle_and_busy_connections()
         for c in idle:
             c.transport.close()
 
-        if idle or busy:
+        if idle or busy or quic_busy or websockets or streams:
             logger.info('Draining connections...')
         else:
             return
@@ -136,24 +214,112 @@ class Application:
             logger.info('{} idle connections closed immediately'.format(len(idle)))
         if busy:
             logger.info('{} connections busy, read-end closed'.format(len(busy)))
+        if quic_busy:
+            logger.info('{} HTTP/3 connections sent GOAWAY'.format(quic_busy))
+        if websockets:
+            logger.info('{} WebSockets closed'.format(len(websockets)))
+        if streams:
+            logger.info('{} event streams closed'.format(streams))
 
         for x in range(5, 0, -1):
             await asyncio.sleep(1)
             idle, busy = self._get_idle_and_busy_connections()
             for c in idle:
                 c.transport.close()
-            if not busy:
+            if quic:
+                quic_busy = quic.shutdown()
+            if not busy and not quic_busy and not self._websockets:
                 break
             else:
                 logger.info(
                     "{} seconds remaining, {} connections still busy"
-                    .format(x, len(busy)))
+                    .format(x, len(busy) + quic_busy + len(self._websockets)))
 
         _, busy = self._get_idle_and_busy_connections()
         if busy:
             logger.info('Forcefully killing {} connections'.format(len(busy)))
         for c in busy:
             c.pipeline_cancel()
+        for ws in list(self._websockets):
+            ws.transport.close()
+
+        if quic:
+            if quic_busy:
+                logger.info(
+                    'Forcefully closing {} HTTP/3 connections'.format(quic_busy))
+                quic.close()
+
+            # let MsQuic send CONNECTION_CLOSE before the process exits
+            for _ in range(20):
+                if not quic.connection_count():
+                    break
+                await asyncio.sleep(.05)
+
+    def on_startup(self, handler):
+        """Call handler(app) in every worker before it accepts connections.
+        Coroutine functions are awaited, an exception stops the worker."""
+        self._on_startup.append(handler)
+        return handler
+
+    def on_shutdown(self, handler):
+        """Call handler(app) in every worker after it drained."""
+        self._on_shutdown.append(handler)
+        return handler
+
+    async def startup(self):
+        for handler in self._on_startup:
+            result = handler(self)
+            if asyncio.iscoroutine(result):
+                await result
+
+        if self._warmup:
+            await self.warmup()
+
+    async def shutdown(self):
+        for handler in self._on_shutdown:
+            try:
+                result = handler(self)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    async def warmup(self, timeout=10):
+        """Replay the warmup requests on a loopback listener of their own,
+        through the same protocol, parser, matcher and handlers as the real
+        traffic, one connection each."""
+        server = await self.loop.create_server(
+            lambda: self._protocol_factory(self), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        count = 0
+        try:
+            for method, path, body in warmup_requests(self._warmup):
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+                writer.write(
+                    '{} {} HTTP/1.1\r\nHost: localhost\r\n'
+                    'Content-Length: {}\r\nConnection: close\r\n\r\n'
+                    .format(method, path, len(body)).encode() + body)
+                try:
+                    response = await asyncio.wait_for(reader.read(), timeout)
+                finally:
+                    writer.close()
+
+                status = response.split(b' ', 2)[1:2]
+                status = int(status[0]) if status else None
+                if status is None or status >= 500:
+                    logger.warning(
+                        'Warmup {} {} failed: {}'.format(method, path, status))
+                else:
+                    logger.debug(
+                        'Warmup {} {}: {}'.format(method, path, status))
+                count += 1
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        logger.info('Worker warmed up with {} requests'.format(count))
 
     def extend_request(self, handler, *, name=None, property=False):
         if not name:
@@ -161,24 +327,58 @@ class Application:
 
         self._request_extensions[name] = (handler, property)
 
-    def serve(self, *, sock, host, port, reloader_pid):
+    def ssl_context(self, ssl):
+        """The server SSLContext of the TCP listener for run(ssl=...): an
+        SSLContext as is, True for cert.pem and key.pem or a (certfile,
+        keyfile) pair with the TlsSettings of the application. ALPN offers
+        only http/1.1, the one protocol Protocol speaks."""
+        if ssl is True:
+            ssl = ('cert.pem', 'key.pem')
+        if isinstance(ssl, tuple):
+            ssl = self._tls_settings.context(*ssl)
+        ssl.set_alpn_protocols(['http/1.1'])
+
+        return ssl
+
+    def serve(self, *, sock, host, port, reloader_pid, worker_id=None,
+              ready=None, ssl=None):
         faulthandler.enable()
         self.__finalize()
 
         loop = self.loop
         asyncio.set_event_loop(loop)
 
+        # the listeners open once the worker is warm
+        loop.run_until_complete(self.startup())
+
         if self._enable_http3 and QuicServer:
             logger.info(f'Starting QUIC Listener on {host}:{port}')
-            self._quic_server = QuicServer(self, self.loop)
+            if worker_id is not None:
+                set_server_id(worker_id)
+            self._quic_server = QuicServer(
+                self, self.loop, settings=self._quic_settings)
             self._quic_server.start(host, port)
+            if ready:
+                ready.send(reuseport.bound_sockets(port))
+                ready.close()
+            if self._quic_stats_settings is not None:
+                self._quic_stats = QuicStats(
+                    self._quic_server, loop, **self._quic_stats_settings)
+                self._quic_stats.start()
         elif self._enable_http3 and not QuicServer:
              logger.warning('HTTP/3 enabled but cquic module not available.')
 
         server = None
         if sock:
+            if ssl:
+                ssl = self.ssl_context(ssl)
+                if self._quic_server:
+                    # pre-rendered into every HTTP/1.1 response by cresponse
+                    cresponse.set_default_headers(
+                        {'Alt-Svc': 'h3=":{}"; ma=3600'.format(port)})
             server_coro = loop.create_server(
-                lambda: self._protocol_factory(self), sock=sock)
+                lambda: self._protocol_factory(self), sock=sock,
+                ssl=ssl or None)
             server = loop.run_until_complete(server_coro)
 
         loop.add_signal_handler(signal.SIGTERM, loop.stop)
@@ -189,7 +389,8 @@ class Application:
             detector = ChangeDetector(loop)
             detector.start()
 
-        logger.info('Accepting connections on http://{}:{}'.format(host, port))
+        logger.info('Accepting connections on {}://{}:{}'.format(
+            'https' if ssl else 'http', host, port))
 
         try:
             loop.run_forever()
@@ -198,6 +399,9 @@ class Application:
                 server.close()
                 loop.run_until_complete(server.wait_closed())
             loop.run_until_complete(self.drain())
+            loop.run_until_complete(self.shutdown())
+            if self._quic_stats:
+                self._quic_stats.stop()
             self._reaper.stop()
             loop.close()
 
@@ -205,66 +409,29 @@ class Application:
             del self._matcher
 
     def _run(self, *, host, port, worker_num=None, reloader_pid=None,
-             debug=None):
+             debug=None, ssl=None):
         self._debug = debug or self._debug
         if self._debug and not self._log_request:
             self._log_request = self._debug
 
         sock = None
-        if not self._enable_http3:
+        # with TLS the TCP listener also serves Alt-Svc discovery of HTTP/3
+        if ssl or not self._enable_http3:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.bind((host, port))
             os.set_inheritable(sock.fileno(), True)
 
-        workers = set()
-
-        terminating = False
-
-        def stop(sig, frame):
-            nonlocal terminating
-            if reloader_pid and sig == signal.SIGHUP:
-                logger.info('Reload request received')
-            elif not terminating:
-                terminating = True
-                logger.info('Termination request received')
-            for worker in workers:
-                worker.terminate()
-
-        signal.signal(signal.SIGINT, stop)
-        signal.signal(signal.SIGTERM, stop)
-        signal.signal(signal.SIGHUP, stop)
-
-        for _ in range(worker_num or 1):
-            worker = multiprocessing.Process(
-                target=self.serve,
-                kwargs=dict(sock=sock, host=host, port=port,
-                            reloader_pid=reloader_pid))
-            worker.daemon = True
-            worker.start()
-            workers.add(worker)
-
-        # prevent further operations on socket in parent
-        if sock:
-            sock.close()
+        # QUIC workers share the UDP port through SO_REUSEPORT and get
+        # their packets steered by connection ID, see run_workers
+        steer = self._enable_http3 and QuicServer and (worker_num or 1) > 1
 
-        for worker in workers:
-            worker.join()
-
-            if worker.exitcode > 0:
-                logger.warning('Worker exited with code {}'.format(worker.exitcode))
-            elif worker.exitcode < 0:
-                try:
-                    signame = signames[-worker.exitcode]
-                except KeyError:
-                    logger.error(
-                        'Worker crashed with unknown code {}!'
-                        .format(worker.exitcode))
-                else:
-                    logger.error('Worker crashed on signal {}!'.format(signame))
+        run_workers(
+            self.serve, sock=sock, host=host, port=port, worker_num=worker_num,
+            reloader_pid=reloader_pid, steer=steer, ssl=ssl)
 
     def run(self, host='0.0.0.0', port=8080, *, worker_num=None, reload=False,
-            debug=False):
+            debug=False, ssl=None):
         if os.environ.get('_FPY_IGNORE_RUN'):
             return
 
@@ -278,4 +445,117 @@ class Application:
 
         self._run(
             host=host, port=port, worker_num=worker_num,
-            reloader_pid=reloader_pid, debug=debug)
+            reloader_pid=reloader_pid, debug=debug, ssl=ssl)
+
+
+def run_workers(serve, *, sock, port, worker_num=None, reloader_pid=None,
+                steer=False, **kwargs):
+    """Run serve in worker_num processes and wait for them.
+
+    serve is called with sock, port, reloader_pid, worker_id, ready and
+    kwargs. SIGINT and SIGTERM terminate the workers, which drain on their
+    own. With steer the workers get their index as worker_id and report the
+    UDP sockets they bound through ready, one after another, so that their
+    sockets take known slots in the SO_REUSEPORT group, see
+    fpy3.protocol.reuseport.
+    """
+    workers = set()
+
+    terminating = False
+
+    def stop(sig, frame):
+        nonlocal terminating
+        if reloader_pid and sig == signal.SIGHUP:
+            logger.info('Reload request received')
+        elif not terminating:
+            terminating = True
+            logger.info('Termination request received')
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, stop)
+
+    bound = []
+
+    for worker_id in range(worker_num or 1):
+        ready = reader = None
+        if steer:
+            reader, ready = multiprocessing.Pipe(duplex=False)
+
+        worker = multiprocessing.Process(
+            target=serve,
+            kwargs=dict(kwargs, sock=sock, port=port,
+                        reloader_pid=reloader_pid,
+                        worker_id=worker_id if steer else None,
+                        ready=ready))
+        worker.daemon = True
+        worker.start()
+        workers.add(worker)
+
+        if steer:
+            ready.close()
+            try:
+                bound.append(
+                    reader.recv() if reader.poll(10) else None)
+            except EOFError:
+                bound.append(None)
+            reader.close()
+
+    if steer:
+        _steer_quic(port, bound)
+
+    # prevent further operations on socket in parent
+    if sock:
+        sock.close()
+
+    for worker in workers:
+        worker.join()
+
+        if worker.exitcode > 0:
+            logger.warning('Worker exited with code {}'.format(worker.exitcode))
+        elif worker.exitcode < 0:
+            try:
+                signame = signames[-worker.exitcode]
+            except KeyError:
+                logger.error(
+                    'Worker crashed with unknown code {}!'
+                    .format(worker.exitcode))
+            else:
+                logger.error('Worker crashed on signal {}!'.format(signame))
+
+
+def warmup_requests(warmup):
+    """(method, path, body) of every warmup entry, a path or a
+    (method, path[, body]) tuple."""
+    for entry in warmup:
+        if isinstance(entry, str):
+            entry = ('GET', entry)
+        method, path, *body = entry
+        body = body[0] if body else b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        yield method.upper(), path, body
+
+
+def _steer_quic(port, bound):
+    counts = {len(sockets) if sockets else 0 for sockets in bound}
+    if len(counts) != 1 or 0 in counts:
+        logger.warning(
+            'QUIC workers bound unevenly ({}), connection ID steering '
+            'disabled'.format(
+                ', '.join(str(len(s) if s else 0) for s in bound)))
+        return
+
+    family, address = bound[0][0]
+    try:
+        reuseport.attach_steering(
+            family, address, port, len(bound), counts.pop())
+    except OSError as e:
+        logger.warning(
+            'Connection ID steering disabled: {}'.format(e))
+    else:
+        logger.info(
+            'Steering QUIC packets to {} workers by connection ID'
+            .format(len(bound)))
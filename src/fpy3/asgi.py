@@ -1,310 +1,1305 @@
 import asyncio
-import ssl
+import collections
+import functools
+import logging
+import socket
 import os
+from http import HTTPStatus
+from urllib.parse import unquote_to_bytes
+from fpy3.parser import cparser
 from fpy3.protocol import cquic
+from fpy3.protocol.tls import TlsSettings
+from fpy3.protocol.broadcast import SSE, Broadcast
+from fpy3.protocol.websocket import (
+    CLOSE_ABNORMAL, CLOSE_INTERNAL_ERROR, CLOSE_NORMAL, ConnectionClosed,
+    WebSocketProtocol, WebSocketSettings, accept, fields, handshake_key,
+    subprotocols)
+
+try:
+    from fpy3.protocol import ch2
+except ImportError: # built without nghttp2
+    ch2 = None
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    """A WebTransport session, the state of its CONNECT stream and of every
+    stream in it."""
+    __slots__ = ('queue', 'task', 'stream', 'streams', 'writable', 'accepted')
+
+    def __init__(self, stream):
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.stream = stream
+        self.streams = {} # stream ID -> Stream, for webtransport.stream.send
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.accepted = False
+
+    def close(self, notify=True):
+        if notify and self.stream.state is self:
+            self.queue.put_nowait({'type': 'webtransport.close'})
+        # drops the Stream -> _Session -> Stream cycles
+        for stream in self.streams.values():
+            stream.state = None
+        self.streams.clear()
+        self.stream.state = None
+        self.writable.set()
+
+
+class _Request:
+    """An HTTP/3 request the application is answering. Its body waits in
+    the C receive channel of the stream, see Stream.receive."""
+    __slots__ = ('readable', 'writable', 'task', 'disconnected',
+                 'subscribers', 'started')
+
+    def __init__(self):
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.task = None
+        self.disconnected = False
+        self.subscribers = [] # broadcast subscriptions, ended with the task
+        self.started = False # http.response.start was sent
+
+
+class _Lifespan:
+    """The lifespan task of the application and the answer it owes to the
+    last lifespan.startup or lifespan.shutdown."""
+    __slots__ = ('queue', 'task', 'reply')
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.reply = None # future of the lifespan.*.complete or .failed message
+
+
+# status line of every known status, as cresponse keeps them
+_STATUS_LINES = {
+    status.value: b'HTTP/1.1 %d %s\r\n' % (status.value, status.phrase.encode())
+    for status in HTTPStatus}
+
+# requests parsed ahead of the one running before reading pauses
+_PIPELINE_HIGH = 32
+_PIPELINE_LOW = 8
+
+_FRAMING_HEADERS = frozenset((b'content-length', b'transfer-encoding', b'connection'))
+
+_CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+# bytes read per write when a file goes out on the TLS listener
+_FILE_CHUNK = 256 * 1024
+
+_FILE_SENDS = ('http.response.pathsend', 'http.response.zerocopysend')
+
+
+def _file_region(message):
+    """(fd, offset, count, more_body) of an http.response.pathsend or
+    http.response.zerocopysend message. The fd of pathsend is opened here
+    and is the caller's to close."""
+    if message['type'] == 'http.response.pathsend':
+        fd = os.open(message['path'], os.O_RDONLY)
+        try:
+            return fd, 0, os.fstat(fd).st_size, False
+        except BaseException:
+            os.close(fd)
+            raise
+
+    file = message['file']
+    fd = file if isinstance(file, int) else file.fileno()
+    offset = message.get('offset')
+    if offset is None:
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+    count = message.get('count')
+    if count is None:
+        count = os.fstat(fd).st_size - offset
+    return fd, offset, count, message.get('more_body', False)
+
+
+def _content_length(headers):
+    for name, value in headers:
+        if name.lower() in (b'content-length', 'content-length'):
+            try:
+                length = int(value)
+            except ValueError:
+                return None
+            return length if length >= 0 else None
+    return None
+
+
+class _Http11Connection(asyncio.Protocol):
+    """An HTTP/1.1 connection of the TCP listener. Requests are parsed by
+    cparser, kept alive and pipelined, and answered one at a time in order.
+    Responses are written as the application sends them, chunked unless the
+    length is known, and every one advertises HTTP/3 with Alt-Svc. A
+    WebSocket handshake ends the pipeline, once accepted the connection is
+    handed to a WebSocketProtocol."""
+
+    def __init__(self, server, alt_svc):
+        self.server = server
+        self.alt_svc = alt_svc
+        self.loop = server._loop
+        self.parser = cparser.HttpRequestParser(
+            self.on_headers, self.on_body, self.on_error, asgi=True)
+        self.transport = None
+        self.sockname = None
+        self.peername = None
+        # (scope, body, keep_alive), None for a bad request; the body of a
+        # websocket scope is its (Sec-WebSocket-Key, fields)
+        self.pipeline = collections.deque()
+        self.request = None # (scope, keep_alive) of the request being parsed
+        self.task = None
+        # keep_alive_timeout while idle or reading the headers of a request
+        self.idle = None
+        self.expect_continue = False # 100 Continue owed after the pipeline
+        self.paused = False
+        self.closing = False
+        self.lost = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sockname = transport.get_extra_info('sockname')[:2]
+        self.peername = transport.get_extra_info('peername')[:2]
+        self.server._http11.add(self)
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.server.tls_handshakes += 1
+            if ssl_object.session_reused:
+                self.server.tls_resumed += 1
+            if ssl_object.selected_alpn_protocol() == 'h2':
+                self.server._http11.discard(self)
+                connection = _H2Connection(self.server)
+                transport.set_protocol(connection)
+                connection.connection_made(transport)
+                return
+        self.wait_idle()
+        if self.server.debug:
+            print(f"[DEBUG] TCP connection from {self.peername}")
+
+    def connection_lost(self, exc):
+        self.server._http11.discard(self)
+        self.lost.set()
+        self.writable.set()
+        self.pipeline.clear()
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def data_received(self, data):
+        # the idle timer keeps running until the headers are in, so that
+        # a client trickling them out still times out
+        self.parser.feed(data)
+
+    def eof_received(self):
+        self.parser.feed_disconnect()
+
+    def on_headers(self, method, path, minor_version, headers, keep_alive):
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+        path, _, query_string = path.partition(b'?')
+        if minor_version and method == b'GET' and \
+                any(name == b'upgrade' for name, _ in headers):
+            request_fields = fields(headers)
+            key = handshake_key('GET', request_fields)
+            if key is not None:
+                self.on_websocket(path, query_string, headers, key, request_fields)
+                return
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': '1.1' if minor_version else '1.0',
+            'server': self.sockname,
+            'client': self.peername,
+            'scheme': 'https',
+            'method': method.decode('latin-1'),
+            'path': unquote_to_bytes(path).decode('utf-8', 'replace'),
+            'raw_path': path,
+            'query_string': query_string,
+            'headers': headers,
+            'extensions': {
+                'http.response.pathsend': {},
+                'http.response.zerocopysend': {},
+            },
+        }
+        if self.server.state:
+            scope['state'] = self.server.state.copy()
+        self.request = (scope, keep_alive)
+
+        if minor_version and (b'expect', b'100-continue') in headers:
+            # not into the middle of a response still being written
+            if self.task is None:
+                self.transport.write(_CONTINUE)
+            else:
+                self.expect_continue = True
+
+    def on_websocket(self, path, query_string, headers, key, request_fields):
+        scope = {
+            'type': 'websocket',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': '1.1',
+            'server': self.sockname,
+            'client': self.peername,
+            'scheme': 'wss',
+            'path': unquote_to_bytes(path).decode('utf-8', 'replace'),
+            'raw_path': path,
+            'query_string': query_string,
+            'headers': headers,
+            'subprotocols': subprotocols(request_fields),
+            'extensions': {},
+        }
+        if self.server.state:
+            scope['state'] = self.server.state.copy()
+        self.request = (scope, (key, request_fields))
+        # what follows the handshake is frames, not requests
+        self.transport.pause_reading()
+
+    def on_body(self, body):
+        scope, keep_alive = self.request
+        self.request = None
+        # the client did not wait for it
+        self.expect_continue = False
+        if scope['type'] == 'websocket':
+            body, keep_alive = keep_alive, False
+        self.enqueue((scope, body, keep_alive))
+
+    def on_error(self, error):
+        if self.server.debug:
+            print(f"[DEBUG] HTTP/1.1 Parse Error: {error}")
+        self.request = None
+        self.expect_continue = False
+        self.enqueue(None)
+
+    def enqueue(self, request):
+        self.pipeline.append(request)
+        if len(self.pipeline) >= _PIPELINE_HIGH and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+            # drain waits for it with the HTTP/2 and HTTP/3 requests
+            self.server.tasks.add(self.task)
+            self.task.add_done_callback(self.server.tasks.discard)
+
+    def close_idle(self):
+        """Close now if no request is in flight, after the current
+        pipeline otherwise."""
+        self.closing = True
+        if self.task is None:
+            self.transport.close()
+
+    def wait_idle(self):
+        timeout = self.server.keep_alive_timeout
+        # not while a request body is being read
+        if timeout and self.request is None:
+            self.idle = self.loop.call_later(timeout, self.transport.close)
+
+    async def run(self):
+        try:
+            while self.pipeline and not self.lost.is_set():
+                request = self.pipeline.popleft()
+                if self.paused and len(self.pipeline) <= _PIPELINE_LOW:
+                    self.paused = False
+                    self.transport.resume_reading()
+
+                if request is None:
+                    self.transport.write(self.render(
+                        400, [], '1.1', False, b'content-length: 11\r\n'))
+                    self.transport.write(b'Bad Request')
+                    self.transport.close()
+                    return
+
+                if request[0]['type'] == 'websocket':
+                    await self.websocket(request[0], *request[1])
+                    return
+
+                if not await self.respond(*request) or self.closing:
+                    self.transport.close()
+                    return
+
+                # every response before it is out
+                if self.expect_continue and not self.pipeline:
+                    self.expect_continue = False
+                    self.transport.write(_CONTINUE)
+        finally:
+            self.task = None
+
+        if not self.lost.is_set():
+            self.wait_idle()
+
+    async def respond(self, scope, body, keep_alive):
+        """Run the application for one request and stream its response,
+        return whether the connection stays open."""
+        http_version = scope['http_version']
+        head_only = scope['method'] == 'HEAD'
+        request = {'type': 'http.request', 'body': body, 'more_body': False}
+        response = None # (status, headers) until the head is written
+        started = False
+        chunked = False
+        complete = False
+
+        async def receive():
+            nonlocal request
+            if request is not None:
+                message, request = request, None
+                return message
+            await self.lost.wait()
+            return {'type': 'http.disconnect'}
+
+        def write_head(framing):
+            nonlocal started, head_only, chunked
+            status, headers = response
+            if status == 204 or status == 304:
+                # never a body, nor a length
+                framing = b''
+                head_only = True
+                chunked = False
+            self.transport.write(self.render(
+                status, headers, http_version, keep_alive, framing))
+            started = True
+
+        def begin_body(length, more_body):
+            nonlocal chunked, keep_alive
+            if not more_body:
+                write_head(b'content-length: %d\r\n' % length)
+            elif http_version == '1.0':
+                # no chunked encoding, the end of the body is the close
+                keep_alive = False
+                write_head(b'')
+            else:
+                chunked = True
+                write_head(b'transfer-encoding: chunked\r\n')
+
+        async def send(message):
+            nonlocal response, complete
+            if complete or self.lost.is_set():
+                return
+
+            if message['type'] == 'http.response.start':
+                if response is not None:
+                    raise RuntimeError('http.response.start sent twice')
+                headers = message.get('headers', [])
+                response = (message['status'], headers)
+                # with a length from the application the head goes out now,
+                # otherwise the first body message decides the framing
+                length = _content_length(headers)
+                if length is not None:
+                    write_head(b'content-length: %d\r\n' % length)
+
+            elif message['type'] == 'http.response.body':
+                if response is None:
+                    raise RuntimeError('http.response.body before http.response.start')
+                data = message.get('body', b'')
+                more_body = message.get('more_body', False)
+
+                if not started:
+                    begin_body(len(data), more_body)
+
+                if head_only:
+                    pass
+                elif chunked:
+                    if data:
+                        self.transport.writelines(
+                            (b'%x\r\n' % len(data), data, b'\r\n'))
+                    if not more_body:
+                        self.transport.write(b'0\r\n\r\n')
+                elif data:
+                    self.transport.write(data)
+
+                if not more_body:
+                    complete = True
+
+                if not self.writable.is_set():
+                    await self.writable.wait()
+
+            elif message['type'] in _FILE_SENDS:
+                if response is None:
+                    raise RuntimeError(f"{message['type']} before http.response.start")
+                fd, offset, count, more_body = _file_region(message)
+                try:
+                    if not started:
+                        begin_body(count, more_body)
+
+                    if head_only:
+                        pass
+                    elif chunked:
+                        if count:
+                            self.transport.write(b'%x\r\n' % count)
+                            await self.send_file(fd, offset, count)
+                            self.transport.write(b'\r\n')
+                        if not more_body:
+                            self.transport.write(b'0\r\n\r\n')
+                    elif count:
+                        await self.send_file(fd, offset, count)
+                finally:
+                    if message['type'] == 'http.response.pathsend':
+                        os.close(fd)
+
+                if not more_body:
+                    complete = True
+
+        try:
+            await self.server.asgi_app(scope, receive, send)
+        except Exception:
+            logger.exception('ASGI application error (HTTP/1.1)')
+            if started:
+                # too late for a 500, a cut connection is all that is left
+                return False
+            response = None
+
+        if not started:
+            if response is None:
+                response = (500, [])
+                keep_alive = False
+                write_head(b'content-length: 21\r\n')
+                self.transport.write(b'Internal Server Error')
+            else:
+                write_head(b'content-length: 0\r\n')
+        elif not complete:
+            return False
+
+        if self.server.debug:
+            print(f"[DEBUG] TCP Sent HTTP/1.1 Response (status={response[0]})")
+
+        return keep_alive
+
+    async def websocket(self, scope, key, request_fields):
+        """Run the application for a WebSocket handshake. websocket.accept
+        answers 101 and hands the transport to a WebSocketProtocol, a close
+        before that, or an application that returns without accepting, is
+        answered 403 and closes the connection."""
+        settings = self.server.websocket_settings
+        connection = None # WebSocketProtocol once accepted
+        connecting = True # websocket.connect not received yet
+        denied = False
+
+        def subscribe(channel, coalesce=None):
+            if connection is None:
+                raise RuntimeError('subscribe before websocket.accept')
+            return connection.subscribe(self.server.hub, channel, coalesce)
+
+        scope['extensions']['fpy3.broadcast'] = {'subscribe': subscribe}
+
+        def deny():
+            nonlocal denied
+            denied = True
+            if not self.lost.is_set():
+                self.transport.write(self.render(
+                    403, [], '1.1', False, b'content-length: 0\r\n'))
+                self.transport.close()
+
+        async def receive():
+            nonlocal connecting
+            if connecting:
+                connecting = False
+                return {'type': 'websocket.connect'}
+            if connection is None:
+                await self.lost.wait()
+                return {'type': 'websocket.disconnect', 'code': CLOSE_ABNORMAL}
+
+            try:
+                data = await connection.receive()
+            except ConnectionClosed as e:
+                return {'type': 'websocket.disconnect',
+                        'code': e.code, 'reason': e.reason}
+            if isinstance(data, str):
+                return {'type': 'websocket.receive', 'text': data}
+            return {'type': 'websocket.receive', 'bytes': data}
+
+        async def send(message):
+            nonlocal connection
+            kind = message['type']
+            if connection is None:
+                if denied or self.lost.is_set():
+                    raise ConnectionClosed(CLOSE_ABNORMAL)
+                if kind == 'websocket.accept':
+                    response, codec = accept(
+                        key, request_fields, settings,
+                        message.get('subprotocol'), message.get('headers', ()))
+                    connection = WebSocketProtocol(
+                        codec, settings, self.loop, self.server._http11)
+                    self.server._http11.discard(self)
+                    self.transport.write(response)
+                    self.transport.set_protocol(connection)
+                    connection.connection_made(self.transport)
+                    self.transport.resume_reading()
+                elif kind == 'websocket.close':
+                    deny()
+                else:
+                    raise RuntimeError(f'{kind} before websocket.accept')
+
+            elif kind == 'websocket.send':
+                data = message.get('bytes')
+                await connection.send(data if data is not None else message['text'])
+
+            elif kind == 'websocket.close':
+                if connection.close_sent or connection.closed is not None:
+                    return
+                # the client answers to receive, the transport closes
+                # close_timeout later at the latest
+                connection.send_close(
+                    message.get('code', CLOSE_NORMAL), message.get('reason') or '')
+                self.loop.call_later(settings.close_timeout, self.transport.close)
+
+            else:
+                raise RuntimeError(f'{kind} after websocket.accept')
+
+        error = False
+        try:
+            await self.server.asgi_app(scope, receive, send)
+        except Exception:
+            logger.exception('ASGI application error (WebSocket)')
+            error = True
+
+        if connection is None:
+            if not denied:
+                deny()
+        elif not connection.close_sent and connection.closed is None:
+            connection.send_close(CLOSE_INTERNAL_ERROR if error else CLOSE_NORMAL)
+            self.loop.call_later(settings.close_timeout, self.transport.close)
+
+    async def send_file(self, fd, offset, count):
+        """Write count bytes of fd from offset as the socket takes them.
+        The listener is TLS, so the kernel cannot send the file by itself
+        and every chunk is read once, straight into the bytes handed to the
+        transport."""
+        while count and not self.lost.is_set():
+            data = os.pread(fd, min(count, _FILE_CHUNK), offset)
+            if not data:
+                raise RuntimeError('file ended {} bytes early'.format(count))
+            self.transport.write(data)
+            offset += len(data)
+            count -= len(data)
+            if not self.writable.is_set():
+                await self.writable.wait()
+
+    def render(self, status, headers, http_version, keep_alive, framing):
+        """The status line and headers of a response, framing is its
+        Content-Length or Transfer-Encoding line."""
+        status_line = _STATUS_LINES.get(status)
+        if status_line is None:
+            status_line = b'HTTP/1.1 %d Unknown\r\n' % status
+        response = [status_line, self.alt_svc, framing]
+        if not keep_alive:
+            response.append(b'connection: close\r\n')
+        elif http_version == '1.0':
+            response.append(b'connection: keep-alive\r\n')
+
+        content_type = False
+        for name, value in headers:
+            if isinstance(name, str):
+                name = name.encode('latin-1')
+            if isinstance(value, str):
+                value = value.encode('latin-1')
+            lower = name.lower()
+            # framing is ours
+            if lower in _FRAMING_HEADERS:
+                continue
+            if lower == b'content-type':
+                content_type = True
+            response += (name, b': ', value, b'\r\n')
+
+        if not content_type:
+            response.append(b'content-type: text/plain\r\n')
+        response.append(b'\r\n')
+
+        return b''.join(response)
+
+
+class _H2Connection(asyncio.Protocol):
+    """An HTTP/2 connection of the TCP listener, taken over from
+    _Http11Connection when ALPN picked h2. Framing, HPACK and flow control
+    are ch2's, its streams are served by the ASGIServer callbacks HTTP/3
+    streams go through."""
+
+    def __init__(self, server):
+        self.server = server
+        self.loop = server._loop
+        self.connection = None
+        self.transport = None
+        self.idle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sockname = transport.get_extra_info('sockname')[:2]
+        peername = transport.get_extra_info('peername')[:2]
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': '2',
+            'server': sockname,
+            'client': peername,
+            'scheme': 'https',
+            'root_path': '',
+            'query_string': b'',
+        }
+        self.connection = ch2.Connection(self.server, transport, scope)
+        self.server._http11.add(self)
+        self.wait_idle()
+        if self.server.debug:
+            print(f"[DEBUG] HTTP/2 connection from {peername}")
+
+    def connection_lost(self, exc):
+        self.server._http11.discard(self)
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+        self.connection.connection_lost()
+
+    def pause_writing(self):
+        self.connection.pause_writing()
+
+    def resume_writing(self):
+        self.connection.resume_writing()
+
+    def data_received(self, data):
+        self.connection.feed(data)
+        self.wait_idle()
+
+    def close_idle(self):
+        """GOAWAY: the open streams finish, ch2 closes the transport after
+        the last one."""
+        self.connection.shutdown()
+
+    def wait_idle(self):
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+        timeout = self.server.keep_alive_timeout
+        if timeout:
+            self.idle = self.loop.call_later(timeout, self.on_idle)
+
+    def on_idle(self):
+        self.idle = None
+        if self.connection.active:
+            self.wait_idle()
+        else:
+            self.connection.shutdown()
+
 
 class ASGIServer(cquic.QuicServer):
-    def __init__(self, app, loop=None, debug=False):
+    def __init__(self, app, loop=None, debug=False, settings=None,
+                 keep_alive_timeout=5.0, lifespan='auto', warmup=None,
+                 tls_settings=None, http2=True, websocket_settings=None,
+                 broadcast_settings=None):
         if loop is None:
             loop = asyncio.get_running_loop()
-        super().__init__(app, loop, debug=debug)
+        super().__init__(app, loop, debug=debug, settings=settings)
         self._loop = loop
         self.asgi_app = app
         self.debug = debug
-        self.streams = {} # handle -> { queue: asyncio.Queue, task: asyncio.Task, headers: list }
+        # running ASGI requests of every protocol, per stream state is in
+        # Stream.state, an HTTP/1.1 connection has one task for its pipeline
+        self.tasks = set()
+        self._tcp_server = None
+        self._http11 = set() # open _Http11Connection and _H2Connection
+        self.keep_alive_timeout = keep_alive_timeout
+        if lifespan not in ('auto', 'on', 'off'):
+            raise ValueError("lifespan must be 'auto', 'on' or 'off'")
+        self.lifespan = lifespan
+        self.warmup = warmup or ()
+        self.state = {} # lifespan state, copied into every request scope
+        self._lifespan = None
+        self.tls_settings = tls_settings or TlsSettings()
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        self._ssl_ctx = None
+        self.http2 = http2
+        self.websocket_settings = websocket_settings or WebSocketSettings()
+        self._broadcast_settings = broadcast_settings or {}
+        self._hub = None
 
-    def start(self, host, port):
+    def start(self, host, port, certfile="cert.pem", keyfile="key.pem", sni=None,
+              tcp_sock=None):
         # Start QUIC Listener (UDP)
-        super().start(host, port)
-        
-        # Start TCP/TLS Listener (for Alt-Svc discovery)
-        # Assuming cert.pem and key.pem exist (as QuicServer C-impl assumes hardcoded names too)
-        if os.path.exists("cert.pem") and os.path.exists("key.pem"):
+        address = super().start(host, port, certfile, keyfile, sni)
+        if address is not None:
+            port = address[1]
+
+        # Start TCP/TLS Listener (for Alt-Svc discovery) with the same certificates
+        if os.path.exists(certfile) and os.path.exists(keyfile):
             print(f"Starting TCP/TLS Listener on {host}:{port} for Alt-Svc discovery...")
-            self._loop.create_task(self._start_tcp(host, port))
+            self._loop.create_task(
+                self._start_tcp(host, port, certfile, keyfile, sni, tcp_sock))
         else:
-            print("Warning: cert.pem/key.pem not found. TCP Listener for Alt-Svc skipped.")
-
-    async def _start_tcp(self, host, port):
-        ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_ctx.load_cert_chain("cert.pem", "key.pem")
-        # Optimization: Use weak ciphers or fast setup if possible? No, browsers need valid TLS.
-        
-        server = await asyncio.start_server(
-            self._handle_tcp_client, host, port, ssl=ssl_ctx
-        )
-        await server.serve_forever()
+            print(f"Warning: {certfile}/{keyfile} not found. TCP Listener for Alt-Svc skipped.")
 
-    async def _handle_tcp_client(self, reader, writer):
-        try:
-            addr = writer.get_extra_info('peername')
-            if self.debug:
-                print(f"[DEBUG] TCP connection from {addr}")
+        return address
 
-            request_data = await self._read_http11_request(reader)
-            if not request_data:
-                return
-            
-            if self.debug:
-                print(f"[DEBUG] TCP Request data len={len(request_data)}")
+    async def _start_tcp(self, host, port, certfile, keyfile, sni=None, sock=None):
+        # resumption state (cache, ticket keys) belongs to this context,
+        # the SNI contexts only swap the certificate
+        ssl_ctx = self._tls_context(certfile, keyfile)
+        self._ssl_ctx = ssl_ctx
 
-            scope, body = self._parse_http11_request(request_data, writer)
-            if scope is None:
-                return
+        if sni:
+            contexts = {}
+            for name, (sni_certfile, sni_keyfile) in sni.items():
+                contexts[name.lower()] = self._tls_context(
+                    sni_certfile, sni_keyfile)
 
-            port = writer.get_extra_info('sockname')[1]
-            response_started = False
-            response_status = 200
-            response_headers = []
-            response_body_parts = []
+            def sni_callback(sslobj, server_name, _):
+                if not server_name:
+                    return None
+                server_name = server_name.lower()
+                ctx = contexts.get(server_name)
+                if ctx is None and "." in server_name:
+                    ctx = contexts.get("*." + server_name.split(".", 1)[1])
+                if ctx is not None:
+                    sslobj.context = ctx
+                return None
 
-            body_queue = asyncio.Queue()
-            body_queue.put_nowait({'type': 'http.request', 'body': body, 'more_body': False})
+            ssl_ctx.sni_callback = sni_callback
 
-            async def receive():
-                return await body_queue.get()
+        alt_svc = b'alt-svc: h3=":%d"; ma=3600\r\n' % port
+        if sock is not None:
+            server = await self._loop.create_server(
+                lambda: _Http11Connection(self, alt_svc), sock=sock, ssl=ssl_ctx
+            )
+        else:
+            server = await self._loop.create_server(
+                lambda: _Http11Connection(self, alt_svc), host or None, port, ssl=ssl_ctx
+            )
+        self._tcp_server = server
+        await server.serve_forever()
 
-            async def send(message):
-                nonlocal response_started, response_status, response_headers
-                if message['type'] == 'http.response.start':
-                    response_started = True
-                    response_status = message['status']
-                    response_headers = message.get('headers', [])
-                elif message['type'] == 'http.response.body':
-                    response_body_parts.append(message.get('body', b''))
+    def _tls_context(self, certfile, keyfile):
+        context = self.tls_settings.context(certfile, keyfile)
+        # ALPN is answered by the context SNI switched to
+        if self.http2 and ch2 is not None:
+            context.set_alpn_protocols(['h2', 'http/1.1'])
+        return context
+
+    def tls_stats(self):
+        """Handshake counters of the TCP/TLS listener: handshakes and
+        resumed (abbreviated) handshakes, counted per connection, and the
+        OpenSSL session statistics of the listener's context."""
+        stats = {
+            'handshakes': self.tls_handshakes,
+            'resumed': self.tls_resumed,
+            'resumption_ratio': self.tls_resumed / self.tls_handshakes
+                                if self.tls_handshakes else 0.0,
+        }
+        if self._ssl_ctx is not None:
+            stats['openssl'] = self._ssl_ctx.session_stats()
+
+        return stats
+
+    async def startup(self):
+        """Run lifespan.startup and the warmup requests, before start opens
+        the listeners.
+
+        With lifespan 'auto' an application that fails before it answers
+        lifespan.startup does not support the protocol and is served
+        without it, with 'on' that stops the server like
+        lifespan.startup.failed does.
+        """
+        if self.lifespan != 'off':
+            self._lifespan = _Lifespan()
+            scope = {
+                'type': 'lifespan',
+                'asgi': {'version': '3.0', 'spec_version': '2.0'},
+                'state': self.state,
+            }
+            self._lifespan.task = self._loop.create_task(self._run_lifespan(scope))
 
             try:
-                await self.asgi_app(scope, receive, send)
+                message = await self._lifespan_call('lifespan.startup')
             except Exception as e:
-                if self.debug:
-                    print(f"[DEBUG] ASGI App Error (HTTP/1.1): {e}")
-                response_status = 500
-                response_body_parts = [b"Internal Server Error"]
+                self._lifespan = None
+                if self.lifespan == 'on':
+                    raise RuntimeError('ASGI lifespan startup failed') from e
+                print(f"ASGI lifespan unsupported: {e!r}")
+            else:
+                if message['type'] == 'lifespan.startup.failed':
+                    self._lifespan = None
+                    raise RuntimeError(
+                        'ASGI lifespan startup failed: {}'.format(message.get('message', '')))
 
-            http_response = self._build_http11_response(
-                response_status, response_headers, response_body_parts, port
-            )
-            writer.write(http_response)
-            if self.debug:
-                print(f"[DEBUG] TCP Sent HTTP/1.1 Response (status={response_status})")
-            await writer.drain()
+        if self.warmup:
+            await self._warmup()
 
+    async def teardown(self):
+        """Run lifespan.shutdown, after drain."""
+        lifespan = self._lifespan
+        if lifespan is None or lifespan.task.done():
+            return
+        self._lifespan = None
+
+        try:
+            message = await self._lifespan_call('lifespan.shutdown', lifespan)
         except Exception as e:
-            if self.debug:
-                print(f"[DEBUG] TCP Handler Error: {e}")
-        finally:
-            writer.close()
-            try:
-                await writer.wait_closed()
-            except:
-                pass
-
-    async def _read_http11_request(self, reader) -> bytes:
-        data = b""
-        while True:
-            chunk = await reader.read(4096)
-            if not chunk:
-                break
-            data += chunk
-            if b"\r\n\r\n" in data:
-                header_end = data.index(b"\r\n\r\n") + 4
-                headers_part = data[:header_end]
-                content_length = 0
-                for line in headers_part.split(b"\r\n"):
-                    if line.lower().startswith(b"content-length:"):
-                        content_length = int(line.split(b":")[1].strip())
-                        break
-                body_received = len(data) - header_end
-                while body_received < content_length:
-                    chunk = await reader.read(min(4096, content_length - body_received))
-                    if not chunk:
-                        break
-                    data += chunk
-                    body_received += len(chunk)
-                break
-        return data
+            print(f"ASGI lifespan shutdown error: {e!r}")
+        else:
+            if message['type'] == 'lifespan.shutdown.failed':
+                print(f"ASGI lifespan shutdown failed: {message.get('message', '')}")
+
+        if not lifespan.task.done():
+            lifespan.task.cancel()
+            await asyncio.gather(lifespan.task, return_exceptions=True)
+
+    async def _lifespan_call(self, message_type, lifespan=None):
+        lifespan = lifespan or self._lifespan
+        lifespan.reply = self._loop.create_future()
+        lifespan.queue.put_nowait({'type': message_type})
+        return await lifespan.reply
+
+    async def _run_lifespan(self, scope):
+        lifespan = self._lifespan
+
+        async def send(message):
+            reply = lifespan.reply
+            if reply is None or reply.done():
+                raise RuntimeError(f"Unexpected ASGI message {message['type']!r}")
+            reply.set_result(message)
 
-    def _parse_http11_request(self, data: bytes, writer) -> tuple:
         try:
-            header_end = data.index(b"\r\n\r\n")
-            headers_part = data[:header_end]
-            body = data[header_end + 4:]
-
-            lines = headers_part.split(b"\r\n")
-            request_line = lines[0].decode('latin-1')
-            parts = request_line.split(" ")
-            method = parts[0]
-            full_path = parts[1] if len(parts) > 1 else "/"
-            
-            if "?" in full_path:
-                path, query_string = full_path.split("?", 1)
-            else:
-                path = full_path
-                query_string = ""
-
-            headers = []
-            host = ""
-            for line in lines[1:]:
-                if b":" in line:
-                    key, value = line.split(b":", 1)
-                    key = key.strip().lower()
-                    value = value.strip()
-                    headers.append((key, value))
-                    if key == b"host":
-                        host = value.decode('latin-1')
-
-            sockname = writer.get_extra_info('sockname')
-            peername = writer.get_extra_info('peername')
+            await self.asgi_app(scope, lifespan.queue.get, send)
+        except Exception as e:
+            error = e
+        else:
+            error = RuntimeError('ASGI application returned from lifespan')
+
+        if lifespan.reply is not None and not lifespan.reply.done():
+            lifespan.reply.set_exception(error)
+        elif self.debug:
+            print(f"[DEBUG] ASGI lifespan ended: {error!r}")
+
+    async def _warmup(self, timeout=10):
+        """Run the application for every warmup request, on a scope as
+        HTTP/3 requests get it, without a connection."""
+        from fpy3.app import warmup_requests
 
+        for method, path, body in warmup_requests(self.warmup):
+            raw_path, _, query_string = path.encode('latin-1').partition(b'?')
             scope = {
                 'type': 'http',
                 'asgi': {'version': '3.0', 'spec_version': '2.3'},
-                'http_version': '1.1',
-                'server': (sockname[0], sockname[1]) if sockname else ('127.0.0.1', 8080),
-                'client': (peername[0], peername[1]) if peername else ('127.0.0.1', 0),
+                'http_version': '3',
+                'server': ('127.0.0.1', 0),
+                'client': ('127.0.0.1', 0),
                 'scheme': 'https',
                 'method': method,
-                'path': path,
-                'raw_path': path.encode('latin-1'),
-                'query_string': query_string.encode('latin-1'),
-                'headers': headers,
+                'path': unquote_to_bytes(raw_path).decode('utf-8', 'replace'),
+                'raw_path': raw_path,
+                'query_string': query_string,
+                'headers': [(b'host', b'localhost'),
+                            (b'content-length', str(len(body)).encode())],
             }
-            return scope, body
-        except Exception as e:
-            if self.debug:
-                print(f"[DEBUG] HTTP/1.1 Parse Error: {e}")
-            return None, b""
-
-    def _build_http11_response(self, status: int, headers: list, body_parts: list, port: int) -> bytes:
-        body = b"".join(body_parts)
-        
-        status_text = {
-            200: "OK", 201: "Created", 204: "No Content",
-            301: "Moved Permanently", 302: "Found", 304: "Not Modified",
-            400: "Bad Request", 401: "Unauthorized", 403: "Forbidden",
-            404: "Not Found", 405: "Method Not Allowed",
-            500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable"
-        }.get(status, "OK")
-
-        response = f"HTTP/1.1 {status} {status_text}\r\n"
-        response += f"Alt-Svc: h3=\":{port}\"; ma=3600\r\n"
-        response += f"Content-Length: {len(body)}\r\n"
-        response += "Connection: close\r\n"
-        
-        has_content_type = False
-        for k, v in headers:
-            key = k.decode('latin-1') if isinstance(k, bytes) else k
-            val = v.decode('latin-1') if isinstance(v, bytes) else v
-            response += f"{key}: {val}\r\n"
-            if key.lower() == "content-type":
-                has_content_type = True
-        
-        if not has_content_type:
-            response += "Content-Type: text/plain\r\n"
-        
-        response += "\r\n"
-        return response.encode('latin-1') + body
-
-
-
-    def on_headers(self, stream_handle, headers):
-        # headers is list of (key, value) bytes
-        stream_id = self.get_stream_id(stream_handle)
-        scope = self._build_scope(headers)
-        
-        queue = asyncio.Queue()
-        
+            if self.state:
+                scope['state'] = self.state.copy()
+
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            disconnected = asyncio.Event()
+            status = None
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+
+            try:
+                await asyncio.wait_for(self.asgi_app(scope, receive, send), timeout)
+            except Exception as e:
+                print(f"Warmup {method} {path} failed: {e!r}")
+                continue
+            finally:
+                disconnected.set()
+
+            if status is None or status >= 500:
+                print(f"Warmup {method} {path} failed: {status}")
+            elif self.debug:
+                print(f"[DEBUG] Warmup {method} {path}: {status}")
+
+    @property
+    def hub(self):
+        """Broadcast channels of this worker, see fpy3.protocol.broadcast."""
+        if self._hub is None:
+            self._hub = Broadcast(self._loop, **self._broadcast_settings)
+        return self._hub
+
+    def broadcast(self, channel, data, *, event=None, id=None):
+        """Send data to the event streams and WebSockets subscribed to
+        channel with the fpy3.broadcast extension, return how many got it."""
+        if self._hub is None:
+            return 0
+        return self._hub.publish(channel, data, event=event, id=id)
+
+    async def drain(self, timeout=5):
+        """Stop accepting, let running requests finish for up to timeout
+        seconds, then close what is left."""
+        deadline = self._loop.time() + timeout
+
+        if self._tcp_server:
+            self._tcp_server.close()
+        for connection in list(self._http11):
+            connection.close_idle()
+        # after the WebSockets among the subscribers sent their close
+        if self._hub:
+            self._hub.close()
+
+        # HTTP/2 and HTTP/3 streams and HTTP/1.1 pipelines still running
+        while self.shutdown() or self.tasks:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                self.close()
+                for connection in list(self._http11):
+                    connection.transport.abort()
+                tasks = list(self.tasks)
+                for task in tasks:
+                    task.cancel()
+                # finished before the loop closes, not destroyed pending
+                await asyncio.gather(*tasks, return_exceptions=True)
+                break
+            if self.tasks:
+                await asyncio.wait(list(self.tasks), timeout=min(1, remaining))
+            else:
+                await asyncio.sleep(min(1, remaining))
+
+        # let MsQuic send CONNECTION_CLOSE
+        for _ in range(20):
+            if not self.connection_count():
+                break
+            await asyncio.sleep(.05)
+
+    def on_headers(self, stream, scope):
+        # scope is built by cquic, type 'webtransport' for extended CONNECT,
+        # or by ch2 for HTTP/2 streams of the TCP listener
+        if scope['http_version'] == '3':
+            scope['extensions'] = {'fpy3.quic_stats': stream.stats}
+        else:
+            scope['extensions'] = {}
+        if self.state:
+            scope['state'] = self.state.copy()
+
+        if scope['type'] == 'webtransport':
+            self._start_session(stream, scope)
+            return
+
+        scope['extensions']['http.response.pathsend'] = {}
+        scope['extensions']['http.response.zerocopysend'] = {}
+
+        request = _Request()
+
+        def subscribe(channel, coalesce=None):
+            # the response is the text/event-stream the application started
+            subscriber = self.hub.subscribe(channel, stream, SSE, coalesce=coalesce)
+            request.subscribers.append(subscriber)
+            return subscriber
+
+        scope['extensions']['fpy3.broadcast'] = {'subscribe': subscribe}
+
         async def receive():
-            item = await queue.get()
-            return item
-            
+            while not request.disconnected:
+                chunk = stream.receive()
+                if chunk is not None:
+                    body, more_body = chunk
+                    return {'type': 'http.request', 'body': body, 'more_body': more_body}
+                request.readable.clear()
+                await request.readable.wait()
+            return {'type': 'http.disconnect'}
+
         async def send(message):
-            await self._handle_asgi_send(stream_handle, message)
-            
-        task = self._loop.create_task(self._run_app(scope, receive, send, stream_handle))
-        self.streams[stream_id] = {'queue': queue, 'task': task}
-
-
-    def on_data(self, stream_handle, data):
-        stream_id = self.get_stream_id(stream_handle)
-        if stream_id in self.streams:
-            self.streams[stream_id]['queue'].put_nowait({
-                'type': 'http.request',
-                'body': data,
-                'more_body': True # We don't know if it's last until on_fin
-            })
-
-    def on_fin(self, stream_handle):
-        stream_id = self.get_stream_id(stream_handle)
-        if stream_id in self.streams:
-            # Send final empty chunk with more_body=False
-            self.streams[stream_id]['queue'].put_nowait({
-                'type': 'http.request',
-                'body': b'',
-                'more_body': False
-            })
-
-    async def _run_app(self, scope, receive, send, stream_handle):
-        stream_id = self.get_stream_id(stream_handle)
+            if message['type'] == 'http.response.start':
+                request.started = True
+            await self._handle_asgi_send(stream, message)
+
+        task = self._loop.create_task(self._run_app(scope, receive, send, stream))
+        # the loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        request.task = task
+        stream.state = request
+
+    def on_data(self, stream, data):
+        session = self._session_of(stream)
+        if session is not None:
+            # the CONNECT stream itself only carries capsules
+            if stream is not session.stream:
+                session.queue.put_nowait({
+                    'type': 'webtransport.stream.receive',
+                    'stream': stream.id,
+                    'data': data,
+                    'more_body': True})
+
+    def on_fin(self, stream):
+        session = self._session_of(stream)
+        if session is not None:
+            if stream is session.stream:
+                session.close()
+            else:
+                session.queue.put_nowait({
+                    'type': 'webtransport.stream.receive',
+                    'stream': stream.id,
+                    'data': b'',
+                    'more_body': False})
+
+    def on_body(self, stream):
+        if isinstance(stream.state, _Request):
+            stream.state.readable.set()
+
+    def on_datagrams(self, stream, datagrams):
+        if isinstance(stream.state, _Session):
+            for data in datagrams:
+                stream.state.queue.put_nowait({
+                    'type': 'webtransport.datagram.receive',
+                    'data': data})
+
+    def on_writable(self, stream):
+        if isinstance(stream.state, (_Session, _Request)):
+            stream.state.writable.set()
+
+    def on_started(self, stream):
+        waiter = stream.state
+        if isinstance(waiter, asyncio.Future) and not waiter.done():
+            waiter.set_result(stream.id)
+
+    def on_close(self, stream):
+        if isinstance(stream.state, _Session):
+            stream.state.close()
+        elif isinstance(stream.state, _Request):
+            stream.state.disconnected = True
+            stream.state.readable.set()
+            stream.state.writable.set()
+
+    def _session_of(self, stream):
+        """The _Session of a WebTransport stream, registering streams the
+        peer opened on their first data."""
+        if isinstance(stream.state, _Session):
+            return stream.state
+        if stream.state is not None:
+            return None
+
+        session_stream = stream.session
+        if session_stream is None or not isinstance(session_stream.state, _Session):
+            return None
+
+        session = stream.state = session_stream.state
+        session.streams[stream.id] = stream
+        return session
+
+    def _start_session(self, stream, scope):
+        session = stream.state = _Session(stream)
+        session.queue.put_nowait({'type': 'webtransport.connect'})
+
+        async def open_stream(bidirectional=False):
+            """Open a stream in the session and return its ID."""
+            new = stream.open_stream(bidirectional=bidirectional)
+            waiter = new.state = self._loop.create_future()
+            try:
+                stream_id = await waiter
+            finally:
+                new.state = None
+            if stream_id < 0 or stream.state is not session:
+                raise ConnectionError('WebTransport stream could not be opened')
+
+            new.state = session
+            session.streams[stream_id] = new
+            return stream_id
+
+        scope['extensions']['fpy3.webtransport'] = {'open_stream': open_stream}
+
+        async def send(message):
+            await self._handle_webtransport_send(session, message)
+
+        task = session.task = self._loop.create_task(
+            self._run_session(scope, session.queue.get, send, session))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_session(self, scope, receive, send, session):
         try:
             await self.asgi_app(scope, receive, send)
-        except Exception as e:
-            print(f"ASGI App Error: {e}")
-            # Ensure stream is closed?
-            # self.send_data(stream_handle, b"", True) 
+        except Exception:
+            logger.exception('ASGI application error (WebTransport)')
+        finally:
+            if session.stream.state is session:
+                await self._handle_webtransport_send(session, {'type': 'webtransport.close'})
+
+    async def _handle_webtransport_send(self, session, message):
+        stream = session.stream
+
+        if message['type'] == 'webtransport.accept':
+            headers = [(b':status', b'200')]
+            headers.extend(message.get('headers', []))
+            # Chromium still checks the draft it negotiated
+            headers.append((b'sec-webtransport-http3-draft', b'draft02'))
+            headers.append((b'server', b'fpy3'))
+            stream.send_headers(headers, False)
+            session.accepted = True
+
+        elif message['type'] == 'webtransport.close':
+            if stream.state is not session:
+                return
+            if session.accepted:
+                stream.send_data(b'', True)
+            else:
+                stream.send_headers([(b':status', b'403'), (b'server', b'fpy3')], True)
+            session.close(notify=False)
+
+        elif message['type'] == 'webtransport.datagram.send':
+            datagrams = message.get('datagrams')
+            if datagrams is None:
+                datagrams = [message['data']]
+            # unreliable: whatever does not fit is dropped
+            stream.send_datagrams(datagrams)
+
+        elif message['type'] == 'webtransport.stream.send':
+            target = session.streams.get(message['stream'])
+            if target is None:
+                raise ValueError('unknown WebTransport stream {}'.format(message['stream']))
+            if not target.send_data(message.get('data', b''), not message.get('more_body', False)):
+                session.writable.clear()
+                await session.writable.wait()
+
+    async def _run_app(self, scope, receive, send, stream):
+        try:
+            await self.asgi_app(scope, receive, send)
+        except Exception:
+            logger.exception('ASGI application error')
+            # as on HTTP/1.1: a 500 while nothing was sent, otherwise the
+            # stream is cut, either way it closes and stops counting as busy
+            request = stream.state
+            if isinstance(request, _Request) and request.started:
+                stream.reset()
+            else:
+                stream.send_headers([(b':status', b'500')], True)
         finally:
-            self.streams.pop(stream_id, None)
+            if isinstance(stream.state, _Request):
+                for subscriber in stream.state.subscribers:
+                    subscriber.close()
+            # drops the stream -> task -> coroutine -> stream cycle
+            stream.state = None
 
-    async def _handle_asgi_send(self, stream_handle, message):
+    async def _handle_asgi_send(self, stream, message):
         if message['type'] == 'http.response.start':
             status = message['status']
             headers = message.get('headers', [])
-            
+
             # Convert headers to list of (key, value) bytes
             # ASGI headers are list of [bytes, bytes]
-            
+
             resp_headers = [(b":status", str(status).encode())]
             for k, v in headers:
                 resp_headers.append((k, v))
-                
+
             resp_headers.append((b"server", b"fpy3"))
-            
-            self.send_headers(stream_handle, resp_headers, False)
-            
+
+            stream.send_headers(resp_headers, False)
+
         elif message['type'] == 'http.response.body':
             body = message.get('body', b'')
             more_body = message.get('more_body', False)
-            self.send_data(stream_handle, body, not more_body)
-
-    def _build_scope(self, headers):
-        # Build ASGI http scope
-        # headers is list of (name, value) bytes. value is bytes.
-        
-        # Need to extract :method, :path, :authority, :scheme
-        method = b"GET"
-        path = b"/"
-        scheme = b"https"
-        authority = b""
-        
-        clean_headers = []
-        for n, v in headers:
-            if n == b":method": method = v
-            elif n == b":path": path = v
-            elif n == b":scheme": scheme = v
-            elif n == b":authority": authority = v
-            elif n.startswith(b":"): continue
-            else: clean_headers.append((n, v))
-            
-        return {
-            'type': 'http',
-            'asgi': {'version': '3.0', 'spec_version': '2.3'},
-            'http_version': '3',
-            'server': ('127.0.0.1', 443), # TODO: Get actual binding
-            'client': ('127.0.0.1', 0), # TODO: Get peer address
-            'scheme': scheme.decode(),
-            'method': method.decode(),
-            'path': path.decode(),
-            'raw_path': path, # TODO: Handle query string separation
-            'query_string': b'', # TODO: extract from path
-            'headers': clean_headers,
-        }
+            # False once the stream has too much queued, as for
+            # webtransport.stream.send
+            if not stream.send_data(body, not more_body):
+                request = stream.state
+                if isinstance(request, _Request):
+                    request.writable.clear()
+                    await request.writable.wait()
+
+        elif message['type'] in _FILE_SENDS:
+            # mapped by cquic and passed to MsQuic without a copy
+            fd, offset, count, more_body = _file_region(message)
+            try:
+                stream.send_file(fd, offset, count, not more_body)
+            finally:
+                if message['type'] == 'http.response.pathsend':
+                    os.close(fd)
+
+
+def serve(app, *, sock, host, port, reloader_pid=None, worker_id=None,
+          ready=None, certfile='cert.pem', keyfile='key.pem', settings=None,
+          debug=False, lifespan='auto', warmup=None, tls_settings=None):
+    """One worker of run(): an ASGIServer on its own uvloop, started once
+    lifespan.startup and the warmup requests ran, until SIGINT or SIGTERM,
+    then drain and lifespan.shutdown."""
+    import signal
+    import uvloop
+
+    loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    if worker_id is not None:
+        cquic.set_server_id(worker_id)
+
+    server = ASGIServer(app, loop=loop, debug=debug, settings=settings,
+                        lifespan=lifespan, warmup=warmup,
+                        tls_settings=tls_settings)
+    loop.run_until_complete(server.startup())
+    server.start(host, port, certfile, keyfile, tcp_sock=sock)
+    if ready:
+        from fpy3.protocol import reuseport
+        ready.send(reuseport.bound_sockets(port))
+        ready.close()
+
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+
+    if reloader_pid:
+        from fpy3.reloader import ChangeDetector
+        ChangeDetector(loop).start()
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(server.drain())
+        loop.run_until_complete(server.teardown())
+        loop.close()
+
+
+def _tcp_socket(host, port):
+    if host in ('', '::'):
+        sock = socket.create_server(
+            ('', port), family=socket.AF_INET6, dualstack_ipv6=True)
+    else:
+        family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        sock = socket.create_server((host, port), family=family)
+    os.set_inheritable(sock.fileno(), True)
+    return sock
+
+
+def run(app, host='0.0.0.0', port=8080, *, worker_num=None,
+        certfile='cert.pem', keyfile='key.pem', settings=None, debug=False,
+        reloader_pid=None, lifespan='auto', warmup=None, tls_settings=None):
+    """Serve app in worker_num processes with the process management of
+    Application.run.
+
+    Every worker runs its own QUIC listener on the shared UDP port with
+    packets steered by connection ID, the HTTP/1.1 listener is one TCP
+    socket bound here and shared by all workers. The TLS settings are made
+    here too so that the workers share their session ticket keys.
+    """
+    from fpy3.app import run_workers
+
+    if tls_settings is None:
+        tls_settings = TlsSettings()
+
+    sock = None
+    if os.path.exists(certfile) and os.path.exists(keyfile):
+        sock = _tcp_socket(host, port)
+        # port 0: the workers take the port the TCP socket got
+        port = sock.getsockname()[1]
+
+    run_workers(
+        functools.partial(serve, app), sock=sock, host=host, port=port,
+        worker_num=worker_num, reloader_pid=reloader_pid,
+        steer=(worker_num or 1) > 1, certfile=certfile, keyfile=keyfile,
+        settings=settings, debug=debug, lifespan=lifespan, warmup=warmup,
+        tls_settings=tls_settings)
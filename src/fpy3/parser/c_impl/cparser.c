@@ -1,3 +1,6 @@
+#define PY_SSIZE_T_CLEAN
+#include <ctype.h>
+#include <errno.h>
 #include <strings.h>
 #include <sys/param.h>
 
@@ -53,6 +56,7 @@ Parser_new(Parser* self)
     self->on_headers = NULL;
     self->on_body = NULL;
     self->on_error = NULL;
+    self->asgi = 0;
 #endif
 
 #ifdef PARSER_STANDALONE
@@ -73,8 +77,10 @@ Parser_init(Parser* self, void* protocol)
 #ifdef DEBUG_PRINT
     printf("__init__\n");
 #endif
-    int result = PyArg_ParseTuple(
-      args, "OOO", &self->on_headers, &self->on_body, &self->on_error);
+    static char* kwlist[] = {"on_headers", "on_body", "on_error", "asgi", NULL};
+    int result = PyArg_ParseTupleAndKeywords(
+      args, kwds, "OOO|p", kwlist,
+      &self->on_headers, &self->on_body, &self->on_error, &self->asgi);
     if(!result)
       return -1;
     Py_INCREF(self->on_headers);
@@ -122,6 +128,37 @@ static int
   const char *, size_t, const char **, size_t *, const char **, size_t *,
   int *, struct phr_header *, size_t *, size_t);
 
+#ifdef PARSER_STANDALONE
+// [(name, value), ...] with lowercase names, as ASGI wants them
+static PyObject* _asgi_headers(struct phr_header* headers, size_t num_headers) {
+  PyObject* list = PyList_New(num_headers);
+  if(!list)
+    return NULL;
+
+  for(size_t i = 0; i < num_headers; i++) {
+    PyObject* name = PyBytes_FromStringAndSize(NULL, headers[i].name_len);
+    PyObject* value = PyBytes_FromStringAndSize(headers[i].value, headers[i].value_len);
+    PyObject* item;
+    if(!name || !value || !(item = PyTuple_Pack(2, name, value))) {
+      Py_XDECREF(name);
+      Py_XDECREF(value);
+      Py_DECREF(list);
+      return NULL;
+    }
+
+    char* lower = PyBytes_AS_STRING(name);
+    for(size_t j = 0; j < headers[i].name_len; j++)
+      lower[j] = tolower((unsigned char)headers[i].name[j]);
+
+    Py_DECREF(name);
+    Py_DECREF(value);
+    PyList_SET_ITEM(list, i, item);
+  }
+
+  return list;
+}
+#endif
+
 static int _parse_headers(Parser* self) {
 #ifdef PARSER_STANDALONE
   PyObject* method_view = NULL;
@@ -179,8 +216,54 @@ static int _parse_headers(Parser* self) {
       header < headers + num_headers;
       header++) {
 
+    if(header_name_equal("Transfer-Encoding")) {
+      if(header_value_equal("chunked"))
+        self->transfer = PARSER_CHUNKED;
+      else if(header_value_equal("identity"))
+        self->transfer = PARSER_IDENTITY;
+      else {
+        error = invalid_headers;
+        goto on_error;
+      }
+      continue;
+    }
+
+    if(header_name_equal("Content-Length")) {
+      if(!header->value_len || *header->value < '0' || *header->value > '9'
+         || self->content_length != CONTENT_LENGTH_UNSET) {
+        error = invalid_headers;
+        goto on_error;
+      }
+
+      char* endptr;
+      errno = 0;
+      self->content_length = strtoul(header->value, &endptr, 10);
+
+      if(errno || endptr != (char*)header->value + header->value_len
+         || self->content_length == CONTENT_LENGTH_UNSET) {
+        error = invalid_headers;
+        goto on_error;
+      }
+
+      continue;
     }
 
+    if(header_name_equal("Connection")) {
+      if(header_value_equal("close"))
+        self->connection = PARSER_CLOSE;
+      else if(header_value_equal("keep-alive"))
+        self->connection = PARSER_KEEP_ALIVE;
+      continue;
+    }
+  }
+
+  // a body framed both ways is a request smuggling attempt
+  if(self->transfer == PARSER_CHUNKED
+     && self->content_length != CONTENT_LENGTH_UNSET) {
+    error = invalid_headers;
+    goto on_error;
+  }
+
 #ifdef DEBUG_PRINT
   if(self->content_length != CONTENT_LENGTH_UNSET)
     printf("self->content_length: %ld\n", self->content_length);
@@ -191,13 +274,27 @@ static int _parse_headers(Parser* self) {
 #endif
 
 #ifdef PARSER_STANDALONE
-  method_view = PyMemoryView_FromMemory(method, method_len, PyBUF_READ);
-  path_view = PyMemoryView_FromMemory(path, path_len, PyBUF_READ);
-  minor_version_long = PyLong_FromLong(minor_version);
-  headers_view = PyMemoryView_FromMemory((char*)headers, sizeof(struct phr_header) * num_headers, PyBUF_READ);
-  // FIXME the functions above can fail
-  PyObject* on_headers_result = PyObject_CallFunctionObjArgs(
-    self->on_headers, method_view, path_view, minor_version_long, headers_view, NULL);
+  PyObject* on_headers_result;
+  if(self->asgi) {
+    // copies, the buffer is reused for the next request
+    method_view = PyBytes_FromStringAndSize(method, method_len);
+    path_view = PyBytes_FromStringAndSize(path, path_len);
+    minor_version_long = PyLong_FromLong(minor_version);
+    headers_view = _asgi_headers(headers, num_headers);
+    if(!method_view || !path_view || !minor_version_long || !headers_view)
+      goto error;
+    on_headers_result = PyObject_CallFunctionObjArgs(
+      self->on_headers, method_view, path_view, minor_version_long, headers_view,
+      self->connection == PARSER_KEEP_ALIVE ? Py_True : Py_False, NULL);
+  } else {
+    method_view = PyMemoryView_FromMemory(method, method_len, PyBUF_READ);
+    path_view = PyMemoryView_FromMemory(path, path_len, PyBUF_READ);
+    minor_version_long = PyLong_FromLong(minor_version);
+    headers_view = PyMemoryView_FromMemory((char*)headers, sizeof(struct phr_header) * num_headers, PyBUF_READ);
+    // FIXME the functions above can fail
+    on_headers_result = PyObject_CallFunctionObjArgs(
+      self->on_headers, method_view, path_view, minor_version_long, headers_view, NULL);
+  }
   if(!on_headers_result)
     goto error;
   Py_DECREF(on_headers_result);
@@ -330,7 +427,11 @@ static int _parse_body(Parser* self) {
   }
 
 #ifdef PARSER_STANDALONE
-  if(body) {
+  if(self->asgi) {
+    body_view = PyBytes_FromStringAndSize(body, body ? body_len : 0);
+    if(!body_view)
+      goto error;
+  } else if(body) {
     body_view = PyMemoryView_FromMemory(body, body_len, PyBUF_READ);
     if(!body_view)
       goto error;
@@ -399,7 +500,7 @@ Parser_feed(Parser* self, PyObject* py_data)
 #ifdef DEBUG_PRINT
   printf("feed\n");
 #endif
-  int data_len;
+  Py_ssize_t data_len;
   if(!PyArg_ParseTuple(args, "y#", &data, &data_len))
     goto error;
 #else
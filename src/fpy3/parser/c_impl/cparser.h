@@ -50,6 +50,7 @@ typedef struct {
     PyObject* on_headers;
     PyObject* on_body;
     PyObject* on_error;
+    int asgi; // bytes and ready made ASGI headers instead of memoryviews
 #else
     void* protocol;
 #endif
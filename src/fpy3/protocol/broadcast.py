@@ -0,0 +1,116 @@
+"""Fan-out of events to Server-Sent Events and WebSocket subscribers.
+
+An event is rendered once per framing by cbroadcast.Channel in C, a
+text/event-stream event for SSE subscribers and an unmasked WebSocket
+frame for WebSocket ones, and the same bytes object goes to every
+subscriber of the channel: transport.write for HTTP/1.1 connections,
+send_data for HTTP/2 and HTTP/3 streams.
+
+A subscriber whose connection has more than ``buffer_limit`` bytes waiting
+to be sent is a slow one. It is closed, or with ``coalesce`` only the
+newest event is kept for it and sent once it has caught up, which suits
+state updates where an old value is worthless.
+
+Subscribers live in the worker that accepted them: publish in every worker
+(for example from a message queue each worker listens to) to reach all of
+them.
+"""
+from fpy3.protocol import cbroadcast
+from fpy3.protocol.cbroadcast import SSE, WEBSOCKET, Subscriber
+
+# how often events coalesce held back are retried on streams, which have
+# no resume_writing to tell when they drained
+FLUSH_INTERVAL = 0.05
+
+
+class Broadcast:
+    """The channels of one worker, ``{name: cbroadcast.Channel}``."""
+
+    def __init__(self, loop, *, buffer_limit=256 * 1024, coalesce=False):
+        if buffer_limit <= 0:
+            raise ValueError('buffer_limit must be positive')
+
+        self.loop = loop
+        self.buffer_limit = buffer_limit
+        self.coalesce = coalesce
+        self.channels = {}
+        self._flush = None
+
+    def subscribe(self, channel, target, framing=SSE, *, coalesce=None):
+        """Add a transport or stream to channel. A transport's high-water
+        mark becomes buffer_limit so that it reports when it falls behind,
+        its protocol has to pass pause_writing and resume_writing on to the
+        returned Subscriber unless it is the Subscriber itself."""
+        if coalesce is None:
+            coalesce = self.coalesce
+        subscriber = Subscriber(target, framing, self.buffer_limit, coalesce)
+        if not hasattr(target, 'send_data'):
+            target.set_write_buffer_limits(high=self.buffer_limit)
+
+        subscribers = self.channels.get(channel)
+        if subscribers is None:
+            subscribers = self.channels[channel] = cbroadcast.Channel()
+        subscribers.add(subscriber)
+
+        return subscriber
+
+    def publish(self, channel, data, *, event=None, id=None):
+        """Send data (str, or bytes of UTF-8 text for SSE subscribers) to
+        every subscriber of channel, return how many it was written to.
+        event and id are the SSE event type and ID, WebSocket subscribers
+        get data alone, as a text message for str and binary for bytes."""
+        subscribers = self.channels.get(channel)
+        if subscribers is None:
+            return 0
+
+        written = subscribers.publish(data, event, id)
+        if not subscribers:
+            del self.channels[channel]
+        elif self._flush is None and subscribers.pending:
+            self._flush = self.loop.call_later(FLUSH_INTERVAL, self.flush)
+
+        return written
+
+    def flush(self):
+        self._flush = None
+        waiting = 0
+        for name, subscribers in list(self.channels.items()):
+            waiting += subscribers.flush()
+            if not subscribers:
+                del self.channels[name]
+
+        if waiting:
+            self._flush = self.loop.call_later(FLUSH_INTERVAL, self.flush)
+
+    def close(self):
+        """Close every subscriber, streams end and connections close."""
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        for subscribers in self.channels.values():
+            subscribers.close()
+        self.channels.clear()
+
+    def __len__(self):
+        return sum(len(subscribers) for subscribers in self.channels.values())
+
+
+def event_stream_head(headers=(), retry=None):
+    """The head of a close-delimited text/event-stream response, which every
+    framing of an event works with."""
+    head = [
+        b'HTTP/1.1 200 OK\r\n'
+        b'Content-Type: text/event-stream\r\n'
+        b'Cache-Control: no-cache\r\n'
+        b'Connection: close\r\n']
+    for name, value in headers:
+        if isinstance(name, str):
+            name = name.encode('latin-1')
+        if isinstance(value, str):
+            value = value.encode('latin-1')
+        head.append(name + b': ' + value + b'\r\n')
+    head.append(b'\r\n')
+    if retry is not None:
+        head.append(b'retry: %d\n\n' % retry)
+
+    return b''.join(head)
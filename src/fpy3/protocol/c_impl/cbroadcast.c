@@ -0,0 +1,606 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+// Fan-out of one event to the subscribers of a channel. Channel.publish
+// renders the event once per framing in use (a text/event-stream event,
+// an unmasked WebSocket frame) and hands the same bytes object to every
+// subscriber: transport.write for connections, send_data for HTTP/2 and
+// HTTP/3 streams. A subscriber over its buffer limit is closed, or with
+// coalesce keeps only the newest event until it drains. See
+// fpy3.protocol.broadcast.
+
+#define SSE 0
+#define WEBSOCKET 1
+
+#define OP_TEXT 1
+#define OP_BINARY 2
+
+static PyObject* str_buffered;
+static PyObject* str_close;
+static PyObject* str_send_data;
+static PyObject* str_write;
+static PyObject* empty_bytes;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject* target;   // transport or stream, NULL once closed
+    PyObject* write;    // target.write or target.send_data
+    PyObject* pending;  // newest event held back by coalesce
+    Py_ssize_t limit;
+    int framing;
+    int stream;         // target is a stream, its buffered tells the backlog
+    int coalesce;
+    int paused;         // transport above its high-water mark
+} Subscriber;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject* subscribers;  // list of Subscriber
+} Channel;
+
+static PyTypeObject SubscriberType;
+
+// --- Rendering ---
+
+// data as "data:" lines, a line break of any kind starts a new one
+static PyObject* RenderEvent(const char* data, Py_ssize_t len, PyObject* event, PyObject* id) {
+    const char* fields[2] = {NULL, NULL};
+    Py_ssize_t lengths[2] = {0, 0};
+    PyObject* values[2] = {event, id};
+    Py_ssize_t lines = 1, size = 1;
+    PyObject* result;
+    char* out;
+
+    for (int i = 0; i < 2; i++) {
+        if (values[i] == Py_None) continue;
+        if (!(fields[i] = PyUnicode_AsUTF8AndSize(values[i], &lengths[i]))) return NULL;
+        if (memchr(fields[i], '\n', lengths[i]) || memchr(fields[i], '\r', lengths[i])) {
+            PyErr_SetString(PyExc_ValueError, "event and id must be a single line");
+            return NULL;
+        }
+        size += (i ? 4 : 7) + lengths[i] + 1;
+    }
+
+    for (Py_ssize_t i = 0; i < len; i++) {
+        if (data[i] == '\n' || (data[i] == '\r' && (i + 1 == len || data[i + 1] != '\n'))) lines++;
+    }
+    size += lines * 7 + len;
+
+    if (!(result = PyBytes_FromStringAndSize(NULL, size))) return NULL;
+    out = PyBytes_AS_STRING(result);
+
+    if (fields[0]) {
+        memcpy(out, "event: ", 7);
+        memcpy(out + 7, fields[0], lengths[0]);
+        out += 7 + lengths[0];
+        *out++ = '\n';
+    }
+    if (fields[1]) {
+        memcpy(out, "id: ", 4);
+        memcpy(out + 4, fields[1], lengths[1]);
+        out += 4 + lengths[1];
+        *out++ = '\n';
+    }
+
+    memcpy(out, "data: ", 6);
+    out += 6;
+    for (Py_ssize_t i = 0; i < len; i++) {
+        if (data[i] == '\r' || data[i] == '\n') {
+            if (data[i] == '\r' && i + 1 < len && data[i + 1] == '\n') i++;
+            memcpy(out, "\ndata: ", 7);
+            out += 7;
+        } else {
+            *out++ = data[i];
+        }
+    }
+    *out++ = '\n';
+    *out++ = '\n';
+
+    // line breaks were counted in len too
+    _PyBytes_Resize(&result, out - PyBytes_AS_STRING(result));
+    return result;
+}
+
+// An unmasked, uncompressed frame: valid with or without permessage-deflate
+static PyObject* RenderFrame(int opcode, const char* data, Py_ssize_t len) {
+    uint8_t head[10];
+    size_t head_len;
+    PyObject* result;
+
+    head[0] = 0x80 | opcode;
+    if (len < 126) {
+        head[1] = (uint8_t)len;
+        head_len = 2;
+    } else if (len < 65536) {
+        head[1] = 126;
+        head[2] = (uint8_t)(len >> 8);
+        head[3] = (uint8_t)len;
+        head_len = 4;
+    } else {
+        head[1] = 127;
+        for (int i = 0; i < 8; i++) head[2 + i] = (uint8_t)((uint64_t)len >> (56 - 8 * i));
+        head_len = 10;
+    }
+
+    if (!(result = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)head_len + len))) return NULL;
+    memcpy(PyBytes_AS_STRING(result), head, head_len);
+    memcpy(PyBytes_AS_STRING(result) + head_len, data, len);
+    return result;
+}
+
+// --- Subscriber ---
+
+static void Subscriber_detach(Subscriber* self) {
+    Py_CLEAR(self->target);
+    Py_CLEAR(self->write);
+    Py_CLEAR(self->pending);
+}
+
+// 1 when the subscriber is behind by more than its limit, 0 when it is not,
+// -1 once its stream is gone (the subscriber is detached then)
+static int Subscriber_behind(Subscriber* self) {
+    PyObject* buffered;
+    Py_ssize_t n;
+
+    if (!self->stream) return self->paused;
+
+    if (!(buffered = PyObject_GetAttr(self->target, str_buffered))) return -2;
+    if (buffered == Py_None) {
+        Py_DECREF(buffered);
+        Subscriber_detach(self);
+        return -1;
+    }
+    n = PyLong_AsSsize_t(buffered);
+    Py_DECREF(buffered);
+    if (n == -1 && PyErr_Occurred()) return -2;
+
+    return n > self->limit;
+}
+
+// Write data, 0 on success and -1 with an exception set
+static int Subscriber_write(Subscriber* self, PyObject* data) {
+    PyObject* result;
+
+    if (self->stream)
+        result = PyObject_CallFunctionObjArgs(self->write, data, Py_False, NULL);
+    else
+        result = PyObject_CallOneArg(self->write, data);
+    if (!result) return -1;
+    Py_DECREF(result);
+    return 0;
+}
+
+// End the response or close the transport, once
+static int Subscriber_end(Subscriber* self) {
+    PyObject* result;
+    PyObject* target = self->target;
+
+    if (!target) return 0;
+    self->target = NULL;
+    Subscriber_detach(self);
+
+    if (self->stream)
+        result = PyObject_CallMethodObjArgs(target, str_send_data, empty_bytes, Py_True, NULL);
+    else
+        result = PyObject_CallMethodNoArgs(target, str_close);
+    Py_DECREF(target);
+    if (!result) return -1;
+    Py_DECREF(result);
+    return 0;
+}
+
+// Deliver one event: written, held back (coalesce) or the subscriber
+// dropped. Returns 1 when written, 0 otherwise; a subscriber whose write
+// fails is reported as unraisable and dropped so the others still get
+// the event.
+static int Subscriber_deliver(Subscriber* self, PyObject* data) {
+    int behind;
+
+    if (!self->target) return 0;
+
+    if ((behind = Subscriber_behind(self)) == -1) return 0;
+    if (behind == 1) {
+        if (self->coalesce) {
+            Py_INCREF(data);
+            Py_XSETREF(self->pending, data);
+            return 0;
+        }
+        if (Subscriber_end(self) == 0) return 0;
+    } else if (behind == 0) {
+        // the newest event supersedes the one held back
+        Py_CLEAR(self->pending);
+        if (Subscriber_write(self, data) == 0) return 1;
+    }
+
+    PyErr_WriteUnraisable((PyObject*)self);
+    Subscriber_detach(self);
+    return 0;
+}
+
+// Write the held back event if the subscriber caught up, 1 if one is
+// still waiting
+static int Subscriber_flush(Subscriber* self) {
+    PyObject* pending = self->pending;
+    int behind, rv;
+
+    if (!pending || !self->target) return 0;
+    if ((behind = Subscriber_behind(self)) == 1) return 1;
+    if (behind == -1) return 0;
+
+    if (behind == 0) {
+        self->pending = NULL;
+        rv = Subscriber_write(self, pending);
+        Py_DECREF(pending);
+        if (rv == 0) return 0;
+    }
+
+    PyErr_WriteUnraisable((PyObject*)self);
+    Subscriber_detach(self);
+    return 0;
+}
+
+static int Subscriber_init(Subscriber* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"target", "framing", "limit", "coalesce", NULL};
+    PyObject* target;
+    int framing = SSE, coalesce = 0;
+    Py_ssize_t limit = 256 * 1024;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|inp", kwlist, &target, &framing, &limit, &coalesce))
+        return -1;
+    if (framing != SSE && framing != WEBSOCKET) {
+        PyErr_SetString(PyExc_ValueError, "framing must be SSE or WEBSOCKET");
+        return -1;
+    }
+    if (limit < 0) {
+        PyErr_SetString(PyExc_ValueError, "limit must not be negative");
+        return -1;
+    }
+
+    Subscriber_detach(self);
+    self->stream = PyObject_HasAttr(target, str_send_data);
+    if (!(self->write = PyObject_GetAttr(target, self->stream ? str_send_data : str_write))) return -1;
+    Py_INCREF(target);
+    self->target = target;
+    self->framing = framing;
+    self->limit = limit;
+    self->coalesce = coalesce;
+    self->paused = 0;
+    return 0;
+}
+
+static int Subscriber_traverse(Subscriber* self, visitproc visit, void* arg) {
+    Py_VISIT(self->target);
+    Py_VISIT(self->write);
+    return 0;
+}
+
+static int Subscriber_clear(Subscriber* self) {
+    Subscriber_detach(self);
+    return 0;
+}
+
+static void Subscriber_dealloc(Subscriber* self) {
+    PyObject_GC_UnTrack(self);
+    Subscriber_detach(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// A Subscriber is also the protocol of a connection that only carries
+// events, see Application.subscribe
+
+static PyObject* Subscriber_connection_made(Subscriber* self, PyObject* transport) {
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_connection_lost(Subscriber* self, PyObject* exc) {
+    Subscriber_detach(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_data_received(Subscriber* self, PyObject* data) {
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_eof_received(Subscriber* self, PyObject* unused) {
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_pause_writing(Subscriber* self, PyObject* unused) {
+    self->paused = 1;
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_resume_writing(Subscriber* self, PyObject* unused) {
+    self->paused = 0;
+    Subscriber_flush(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_close(Subscriber* self, PyObject* unused) {
+    if (Subscriber_end(self) == -1) return NULL;
+    Py_RETURN_NONE;
+}
+
+// Stop delivering without touching the connection, which goes on
+static PyObject* Subscriber_detach_method(Subscriber* self, PyObject* unused) {
+    Subscriber_detach(self);
+    Py_RETURN_NONE;
+}
+
+static PyObject* Subscriber_get_closed(Subscriber* self, void* closure) {
+    return PyBool_FromLong(!self->target);
+}
+
+static PyObject* Subscriber_get_pending(Subscriber* self, void* closure) {
+    return PyBool_FromLong(self->pending != NULL);
+}
+
+static PyMethodDef Subscriber_methods[] = {
+    {"connection_made", (PyCFunction)Subscriber_connection_made, METH_O, ""},
+    {"connection_lost", (PyCFunction)Subscriber_connection_lost, METH_O, ""},
+    {"data_received", (PyCFunction)Subscriber_data_received, METH_O, ""},
+    {"eof_received", (PyCFunction)Subscriber_eof_received, METH_NOARGS, ""},
+    {"pause_writing", (PyCFunction)Subscriber_pause_writing, METH_NOARGS, ""},
+    {"resume_writing", (PyCFunction)Subscriber_resume_writing, METH_NOARGS, ""},
+    {"close", (PyCFunction)Subscriber_close, METH_NOARGS, ""},
+    {"detach", (PyCFunction)Subscriber_detach_method, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Subscriber_getset[] = {
+    {"closed", (getter)Subscriber_get_closed, NULL, "", NULL},
+    {"pending", (getter)Subscriber_get_pending, NULL, "", NULL},
+    {NULL}
+};
+
+static PyTypeObject SubscriberType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cbroadcast.Subscriber",
+    .tp_basicsize = sizeof(Subscriber),
+    .tp_dealloc = (destructor)Subscriber_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Subscriber",
+    .tp_traverse = (traverseproc)Subscriber_traverse,
+    .tp_clear = (inquiry)Subscriber_clear,
+    .tp_methods = Subscriber_methods,
+    .tp_getset = Subscriber_getset,
+    .tp_init = (initproc)Subscriber_init,
+    .tp_new = PyType_GenericNew,
+};
+
+// --- Channel ---
+
+// Drop the closed subscribers, -1 with an exception set
+static int Channel_compact(Channel* self) {
+    PyObject* open;
+
+    if (!(open = PyList_New(0))) return -1;
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->subscribers); i++) {
+        Subscriber* subscriber = (Subscriber*)PyList_GET_ITEM(self->subscribers, i);
+        if (subscriber->target && PyList_Append(open, (PyObject*)subscriber) == -1) {
+            Py_DECREF(open);
+            return -1;
+        }
+    }
+
+    Py_SETREF(self->subscribers, open);
+    return 0;
+}
+
+static PyObject* Channel_add(Channel* self, PyObject* subscriber) {
+    if (!PyObject_TypeCheck(subscriber, &SubscriberType)) {
+        PyErr_SetString(PyExc_TypeError, "not a Subscriber");
+        return NULL;
+    }
+    if (PyList_Append(self->subscribers, subscriber) == -1) return NULL;
+    Py_RETURN_NONE;
+}
+
+// Render data once per framing and deliver it to every subscriber, return
+// how many it was written to
+static PyObject* Channel_publish(Channel* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"data", "event", "id", NULL};
+    PyObject* data;
+    PyObject* event = Py_None;
+    PyObject* id = Py_None;
+    PyObject* rendered[2] = {NULL, NULL};
+    PyObject* subscribers = NULL;
+    PyObject* result = NULL;
+    const char* buf;
+    Py_ssize_t len;
+    Py_buffer view = {0};
+    int opcode;
+    long written = 0;
+    int closed = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OO", kwlist, &data, &event, &id)) return NULL;
+    if (event != Py_None && !PyUnicode_Check(event)) {
+        PyErr_SetString(PyExc_TypeError, "event must be str");
+        return NULL;
+    }
+    if (id != Py_None && !PyUnicode_Check(id)) {
+        PyErr_SetString(PyExc_TypeError, "id must be str");
+        return NULL;
+    }
+
+    if (PyUnicode_Check(data)) {
+        if (!(buf = PyUnicode_AsUTF8AndSize(data, &len))) return NULL;
+        opcode = OP_TEXT;
+    } else {
+        if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) == -1) return NULL;
+        buf = view.buf;
+        len = view.len;
+        opcode = OP_BINARY;
+    }
+
+    // a subscriber may add or close others while it is written to
+    if (!(subscribers = PyList_GetSlice(self->subscribers, 0, PyList_GET_SIZE(self->subscribers))))
+        goto finally;
+
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(subscribers); i++) {
+        Subscriber* subscriber = (Subscriber*)PyList_GET_ITEM(subscribers, i);
+        int framing = subscriber->framing;
+
+        if (!subscriber->target) {
+            closed = 1;
+            continue;
+        }
+        if (!rendered[framing]) {
+            if (framing == SSE)
+                rendered[framing] = RenderEvent(buf, len, event, id);
+            else
+                rendered[framing] = RenderFrame(opcode, buf, len);
+            if (!rendered[framing]) goto finally;
+        }
+
+        written += Subscriber_deliver(subscriber, rendered[framing]);
+        if (!subscriber->target) closed = 1;
+    }
+
+    if (closed && Channel_compact(self) == -1) goto finally;
+    result = PyLong_FromLong(written);
+
+    finally:
+    if (view.obj) PyBuffer_Release(&view);
+    Py_XDECREF(rendered[0]);
+    Py_XDECREF(rendered[1]);
+    Py_XDECREF(subscribers);
+    return result;
+}
+
+// Write the events coalesce held back to the subscribers that caught up,
+// return how many still wait
+static PyObject* Channel_flush(Channel* self, PyObject* unused) {
+    PyObject* subscribers;
+    long waiting = 0;
+
+    if (!(subscribers = PyList_GetSlice(self->subscribers, 0, PyList_GET_SIZE(self->subscribers))))
+        return NULL;
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(subscribers); i++)
+        waiting += Subscriber_flush((Subscriber*)PyList_GET_ITEM(subscribers, i));
+    Py_DECREF(subscribers);
+
+    if (Channel_compact(self) == -1) return NULL;
+    return PyLong_FromLong(waiting);
+}
+
+// Close every subscriber: streams end, connections close
+static PyObject* Channel_close(Channel* self, PyObject* unused) {
+    PyObject* subscribers = self->subscribers;
+
+    if (!(self->subscribers = PyList_New(0))) {
+        self->subscribers = subscribers;
+        return NULL;
+    }
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(subscribers); i++) {
+        if (Subscriber_end((Subscriber*)PyList_GET_ITEM(subscribers, i)) == -1)
+            PyErr_WriteUnraisable(PyList_GET_ITEM(subscribers, i));
+    }
+    Py_DECREF(subscribers);
+    Py_RETURN_NONE;
+}
+
+static PyObject* Channel_get_pending(Channel* self, void* closure) {
+    long pending = 0;
+
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->subscribers); i++)
+        pending += ((Subscriber*)PyList_GET_ITEM(self->subscribers, i))->pending != NULL;
+    return PyLong_FromLong(pending);
+}
+
+static Py_ssize_t Channel_len(Channel* self) {
+    Py_ssize_t open = 0;
+
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(self->subscribers); i++)
+        open += ((Subscriber*)PyList_GET_ITEM(self->subscribers, i))->target != NULL;
+    return open;
+}
+
+static int Channel_init(Channel* self, PyObject* args, PyObject* kwds) {
+    if (!PyArg_ParseTuple(args, "")) return -1;
+    Py_XSETREF(self->subscribers, PyList_New(0));
+    return self->subscribers ? 0 : -1;
+}
+
+static int Channel_traverse(Channel* self, visitproc visit, void* arg) {
+    Py_VISIT(self->subscribers);
+    return 0;
+}
+
+static int Channel_clear(Channel* self) {
+    Py_CLEAR(self->subscribers);
+    return 0;
+}
+
+static void Channel_dealloc(Channel* self) {
+    PyObject_GC_UnTrack(self);
+    Py_CLEAR(self->subscribers);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyMethodDef Channel_methods[] = {
+    {"add", (PyCFunction)Channel_add, METH_O, ""},
+    {"publish", (PyCFunction)Channel_publish, METH_VARARGS | METH_KEYWORDS, ""},
+    {"flush", (PyCFunction)Channel_flush, METH_NOARGS, ""},
+    {"close", (PyCFunction)Channel_close, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Channel_getset[] = {
+    {"pending", (getter)Channel_get_pending, NULL, "", NULL},
+    {NULL}
+};
+
+static PySequenceMethods Channel_as_sequence = {
+    .sq_length = (lenfunc)Channel_len,
+};
+
+static PyTypeObject ChannelType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cbroadcast.Channel",
+    .tp_basicsize = sizeof(Channel),
+    .tp_dealloc = (destructor)Channel_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Channel",
+    .tp_traverse = (traverseproc)Channel_traverse,
+    .tp_clear = (inquiry)Channel_clear,
+    .tp_methods = Channel_methods,
+    .tp_getset = Channel_getset,
+    .tp_as_sequence = &Channel_as_sequence,
+    .tp_init = (initproc)Channel_init,
+    .tp_new = PyType_GenericNew,
+};
+
+static PyModuleDef cbroadcast = { PyModuleDef_HEAD_INIT, "cbroadcast", "", -1, NULL, NULL, NULL, NULL, NULL };
+
+PyMODINIT_FUNC PyInit_cbroadcast(void) {
+    PyObject* m = NULL;
+
+    if (PyType_Ready(&SubscriberType) < 0) goto error;
+    if (PyType_Ready(&ChannelType) < 0) goto error;
+    if (!(m = PyModule_Create(&cbroadcast))) goto error;
+    Py_INCREF(&SubscriberType);
+    PyModule_AddObject(m, "Subscriber", (PyObject*)&SubscriberType);
+    Py_INCREF(&ChannelType);
+    PyModule_AddObject(m, "Channel", (PyObject*)&ChannelType);
+
+    if (!(str_buffered = PyUnicode_InternFromString("buffered"))) goto error;
+    if (!(str_close = PyUnicode_InternFromString("close"))) goto error;
+    if (!(str_send_data = PyUnicode_InternFromString("send_data"))) goto error;
+    if (!(str_write = PyUnicode_InternFromString("write"))) goto error;
+    if (!(empty_bytes = PyBytes_FromStringAndSize(NULL, 0))) goto error;
+
+    PyModule_AddIntConstant(m, "SSE", SSE);
+    PyModule_AddIntConstant(m, "WEBSOCKET", WEBSOCKET);
+
+    goto finally;
+
+    error:
+    Py_XDECREF(m);
+    m = NULL;
+
+    finally:
+    return m;
+}
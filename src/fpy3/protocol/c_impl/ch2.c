@@ -0,0 +1,1049 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <nghttp2/nghttp2.h>
+#include <ctype.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+// HTTP/2 connections of the TLS listener of ASGIServer, negotiated by ALPN.
+// A Connection owns a nghttp2 server session fed by the asyncio protocol,
+// its Streams look like cquic Streams (receive, send_headers, send_data,
+// send_file, state) and are handed to the same server callbacks: on_headers
+// with the request scope, on_body when body bytes wait, on_close when the
+// stream is gone. Everything runs on the event loop thread.
+
+#define RECV_CHUNK (64 * 1024)       // largest body handed out by one receive()
+#define STREAM_WINDOW (256 * 1024)   // per stream receive window, as the HTTP/3 receive buffer
+#define CONN_WINDOW (1024 * 1024)
+#define MAX_STREAMS 100
+#define WRITE_CHUNK (256 * 1024)     // frames gathered into one transport.write
+
+static PyObject* str_on_headers;
+static PyObject* str_on_body;
+static PyObject* str_on_close;
+static PyObject* str_write;
+static PyObject* str_close;
+static PyObject* str_method;
+static PyObject* str_path;
+static PyObject* str_raw_path;
+static PyObject* str_query_string;
+static PyObject* str_scheme;
+static PyObject* str_headers;
+
+static const char* Methods[] = {"GET", "POST", "PUT", "DELETE", "HEAD", "OPTIONS", "PATCH", "CONNECT"};
+static PyObject* MethodStrings[sizeof(Methods) / sizeof(Methods[0])];
+
+// Response data waiting for the data provider: bytes or a file range
+typedef struct Chunk_s {
+    struct Chunk_s* next;
+    PyObject* data;     // NULL for a file range
+    size_t offset;      // into data or the file
+    size_t len;         // bytes left
+    int fd;             // a dup of the caller's descriptor, -1 for bytes
+} Chunk;
+
+typedef struct Connection_s Connection;
+
+typedef struct {
+    PyObject_HEAD
+    Connection* conn;   // NULL once closed
+    int32_t id;
+    PyObject* state;
+
+    // request head, dropped once on_headers ran
+    PyObject* headers;
+    PyObject* method;
+    PyObject* target;
+    PyObject* scheme;
+    PyObject* authority;
+    int has_host;
+    int head;
+
+    // receive channel, bounded by the stream window
+    char* recv_buf;
+    size_t recv_off;
+    size_t recv_len;
+    size_t recv_cap;
+    int recv_fin;       // 1 END_STREAM seen, 2 reported to receive()
+    int recv_signaled;
+
+    Chunk* out_head;
+    Chunk* out_tail;
+    size_t out_len;     // bytes of the chunks not yet framed
+    int out_fin;
+    int deferred;
+    int responded;
+} Stream;
+
+struct Connection_s {
+    PyObject_HEAD
+    nghttp2_session* session;
+    PyObject* server;
+    PyObject* write;    // transport.write
+    PyObject* close;    // transport.close
+    PyObject* scope;    // template of every request scope
+    PyObject* streams;  // stream ID -> Stream
+    char* wbuf;
+    size_t wlen;
+    size_t wcap;
+    int paused;
+    int in_recv;
+    int lost;
+};
+
+static PyTypeObject StreamType;
+static PyTypeObject ConnectionType;
+
+static void FreeChunks(Stream* stream) {
+    Chunk* chunk = stream->out_head;
+    while (chunk) {
+        Chunk* next = chunk->next;
+        Py_XDECREF(chunk->data);
+        if (chunk->fd >= 0) close(chunk->fd);
+        free(chunk);
+        chunk = next;
+    }
+    stream->out_head = stream->out_tail = NULL;
+    stream->out_len = 0;
+}
+
+static void AppendChunk(Stream* stream, Chunk* chunk) {
+    chunk->next = NULL;
+    stream->out_len += chunk->len;
+    if (stream->out_tail) stream->out_tail->next = chunk;
+    else stream->out_head = chunk;
+    stream->out_tail = chunk;
+}
+
+// --- Output ---
+
+// Gather pending frames and write them, WRITE_CHUNK at a time, until the
+// session has nothing to send or the transport asks to pause. Closes the
+// transport once the session is done (GOAWAY sent or received and no
+// stream left). Returns -1 with an exception set.
+static int Flush(Connection* self) {
+    PyObject* result;
+
+    if (self->lost || self->in_recv) return 0;
+
+    while (!self->paused) {
+        const uint8_t* data;
+        ssize_t n = nghttp2_session_mem_send(self->session, &data);
+        if (n < 0) {
+            PyErr_Format(PyExc_RuntimeError, "nghttp2_session_mem_send: %s", nghttp2_strerror((int)n));
+            return -1;
+        }
+
+        if (n) {
+            if (self->wlen + (size_t)n > self->wcap) {
+                size_t cap = self->wcap ? self->wcap : 16 * 1024;
+                while (cap < self->wlen + (size_t)n) cap *= 2;
+                char* wbuf = realloc(self->wbuf, cap);
+                if (!wbuf) {
+                    PyErr_NoMemory();
+                    return -1;
+                }
+                self->wbuf = wbuf;
+                self->wcap = cap;
+            }
+            memcpy(self->wbuf + self->wlen, data, (size_t)n);
+            self->wlen += (size_t)n;
+            if (self->wlen < WRITE_CHUNK) continue;
+        }
+
+        if (!self->wlen) break;
+
+        // write may call pause_writing before it returns
+        PyObject* bytes = PyBytes_FromStringAndSize(self->wbuf, (Py_ssize_t)self->wlen);
+        self->wlen = 0;
+        if (!bytes) return -1;
+        result = PyObject_CallOneArg(self->write, bytes);
+        Py_DECREF(bytes);
+        if (!result) return -1;
+        Py_DECREF(result);
+
+        if (!n) break;
+    }
+
+    if (!nghttp2_session_want_read(self->session) && !nghttp2_session_want_write(self->session)) {
+        if (!(result = PyObject_CallNoArgs(self->close))) return -1;
+        Py_DECREF(result);
+    }
+
+    return 0;
+}
+
+static ssize_t ReadData(nghttp2_session* session, int32_t stream_id, uint8_t* buf, size_t length,
+        uint32_t* flags, nghttp2_data_source* source, void* user_data) {
+    Stream* stream = source->ptr;
+    size_t n = 0;
+
+    while (stream->out_head && n < length) {
+        Chunk* chunk = stream->out_head;
+        size_t take = chunk->len < length - n ? chunk->len : length - n;
+
+        if (chunk->fd >= 0) {
+            ssize_t r = pread(chunk->fd, buf + n, take, (off_t)chunk->offset);
+            // the file shrank under us
+            if (r <= 0) return NGHTTP2_ERR_TEMPORAL_CALLBACK_FAILURE;
+            take = (size_t)r;
+        } else {
+            memcpy(buf + n, PyBytes_AS_STRING(chunk->data) + chunk->offset, take);
+        }
+
+        chunk->offset += take;
+        chunk->len -= take;
+        stream->out_len -= take;
+        n += take;
+
+        if (!chunk->len) {
+            stream->out_head = chunk->next;
+            if (!stream->out_head) stream->out_tail = NULL;
+            Py_XDECREF(chunk->data);
+            if (chunk->fd >= 0) close(chunk->fd);
+            free(chunk);
+        }
+    }
+
+    if (!stream->out_head && stream->out_fin) {
+        *flags |= NGHTTP2_DATA_FLAG_EOF;
+    } else if (!n) {
+        // resumed by the next send_data or send_file
+        stream->deferred = 1;
+        return NGHTTP2_ERR_DEFERRED;
+    }
+
+    return (ssize_t)n;
+}
+
+// --- Streams ---
+
+static Stream* Stream_new(Connection* conn, int32_t id) {
+    Stream* self = PyObject_GC_New(Stream, &StreamType);
+    if (!self) return NULL;
+
+    self->conn = conn;
+    Py_INCREF(conn);
+    self->id = id;
+    self->state = Py_None;
+    Py_INCREF(Py_None);
+    self->headers = PyList_New(0);
+    self->method = self->target = self->scheme = self->authority = NULL;
+    self->has_host = self->head = 0;
+    self->recv_buf = NULL;
+    self->recv_off = self->recv_len = self->recv_cap = 0;
+    self->recv_fin = self->recv_signaled = 0;
+    self->out_head = self->out_tail = NULL;
+    self->out_len = 0;
+    self->out_fin = self->deferred = self->responded = 0;
+
+    PyObject_GC_Track(self);
+
+    if (!self->headers) {
+        Py_DECREF(self);
+        return NULL;
+    }
+
+    return self;
+}
+
+static void Stream_release_head(Stream* self) {
+    Py_CLEAR(self->headers);
+    Py_CLEAR(self->method);
+    Py_CLEAR(self->target);
+    Py_CLEAR(self->scheme);
+    Py_CLEAR(self->authority);
+}
+
+static int Stream_traverse(Stream* self, visitproc visit, void* arg) {
+    Py_VISIT(self->conn);
+    Py_VISIT(self->state);
+    return 0;
+}
+
+static int Stream_clear(Stream* self) {
+    Py_CLEAR(self->conn);
+    Py_CLEAR(self->state);
+    return 0;
+}
+
+static void Stream_dealloc(Stream* self) {
+    PyObject_GC_UnTrack(self);
+    Stream_clear(self);
+    Stream_release_head(self);
+    FreeChunks(self);
+    free(self->recv_buf);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// The stream of an open request, NULL when it is closed or its connection lost
+static Connection* Stream_connection(Stream* self) {
+    Connection* conn = self->conn;
+    return conn && !conn->lost ? conn : NULL;
+}
+
+static PyObject* Stream_send_headers(Stream* self, PyObject* args) {
+    PyObject* headers_list;
+    int fin;
+    PyObject* result = NULL;
+    nghttp2_nv* nva = NULL;
+    uint8_t* names = NULL;
+    size_t names_len = 0, count = 0;
+    Connection* conn;
+
+    if (!PyArg_ParseTuple(args, "O!p", &PyList_Type, &headers_list, &fin)) return NULL;
+    if (!(conn = Stream_connection(self)) || self->responded) Py_RETURN_NONE;
+
+    Py_ssize_t len = PyList_GET_SIZE(headers_list);
+    for (Py_ssize_t i = 0; i < len; ++i) {
+        PyObject* tuple = PyList_GET_ITEM(headers_list, i);
+        if (!PyTuple_Check(tuple) || PyTuple_GET_SIZE(tuple) != 2 || !PyBytes_Check(PyTuple_GET_ITEM(tuple, 0))) {
+            PyErr_SetString(PyExc_TypeError, "headers must be (bytes, bytes) tuples");
+            return NULL;
+        }
+        names_len += (size_t)PyBytes_GET_SIZE(PyTuple_GET_ITEM(tuple, 0));
+    }
+
+    if (!(nva = malloc(sizeof(nghttp2_nv) * (len ? len : 1))) || !(names = malloc(names_len ? names_len : 1))) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+
+    uint8_t* name_copy = names;
+    for (Py_ssize_t i = 0; i < len; ++i) {
+        PyObject* tuple = PyList_GET_ITEM(headers_list, i);
+        char *name, *value;
+        Py_ssize_t name_len, value_len;
+        if (!PyArg_ParseTuple(tuple, "y#y#", &name, &name_len, &value, &value_len)) goto finally;
+
+#define is(literal) ((size_t)name_len == sizeof(literal) - 1 && strncasecmp(name, literal, name_len) == 0)
+        // connection-specific fields are malformed in HTTP/2
+        if (is("connection") || is("keep-alive") || is("transfer-encoding") || is("upgrade") || is("proxy-connection"))
+            continue;
+#undef is
+
+        // and so are upper case names
+        for (Py_ssize_t j = 0; j < name_len; ++j) name_copy[j] = (uint8_t)tolower((unsigned char)name[j]);
+        nva[count].name = name_copy;
+        nva[count].namelen = (size_t)name_len;
+        nva[count].value = (uint8_t*)value;
+        nva[count].valuelen = (size_t)value_len;
+        nva[count].flags = NGHTTP2_NV_FLAG_NONE;
+        name_copy += name_len;
+        count++;
+    }
+
+    // no body for HEAD, whatever the application sends
+    if (self->head) fin = 1;
+
+    nghttp2_data_provider provider = {.source.ptr = self, .read_callback = ReadData};
+    int rv = nghttp2_submit_response(conn->session, self->id, nva, count, fin ? NULL : &provider);
+    if (rv != 0) {
+        PyErr_Format(PyExc_RuntimeError, "nghttp2_submit_response: %s", nghttp2_strerror(rv));
+        goto finally;
+    }
+    self->responded = 1;
+    self->out_fin = fin;
+
+    if (Flush(conn) == -1) goto finally;
+
+    result = Py_None;
+    Py_INCREF(result);
+
+    finally:
+    free(nva);
+    free(names);
+    return result;
+}
+
+static int Stream_resume(Stream* self, Connection* conn) {
+    if (self->deferred) {
+        self->deferred = 0;
+        nghttp2_session_resume_data(conn->session, self->id);
+    }
+    return Flush(conn);
+}
+
+static PyObject* Stream_send_data(Stream* self, PyObject* args) {
+    PyObject* data;
+    int fin;
+    Connection* conn;
+
+    if (!PyArg_ParseTuple(args, "Op", &data, &fin)) return NULL;
+    if (!(conn = Stream_connection(self)) || self->out_fin) Py_RETURN_TRUE;
+    if (!self->responded) {
+        PyErr_SetString(PyExc_RuntimeError, "send_data before send_headers");
+        return NULL;
+    }
+
+    if (!self->head) {
+        if (!(data = PyBytes_FromObject(data))) return NULL;
+        if (PyBytes_GET_SIZE(data)) {
+            Chunk* chunk = malloc(sizeof(Chunk));
+            if (!chunk) {
+                Py_DECREF(data);
+                return PyErr_NoMemory();
+            }
+            chunk->data = data;
+            chunk->offset = 0;
+            chunk->len = (size_t)PyBytes_GET_SIZE(data);
+            chunk->fd = -1;
+            AppendChunk(self, chunk);
+        } else {
+            Py_DECREF(data);
+        }
+    }
+
+    self->out_fin = fin;
+    if (Stream_resume(self, conn) == -1) return NULL;
+
+    Py_RETURN_TRUE;
+}
+
+// Abort the stream with RST_STREAM INTERNAL_ERROR, for a response that
+// was started and can not be finished
+static PyObject* Stream_reset(Stream* self, PyObject* unused) {
+    Connection* conn;
+    int rv;
+
+    if (!(conn = Stream_connection(self))) Py_RETURN_NONE;
+
+    self->out_fin = 1;
+    rv = nghttp2_submit_rst_stream(conn->session, NGHTTP2_FLAG_NONE, self->id, NGHTTP2_INTERNAL_ERROR);
+    if (rv != 0) {
+        PyErr_Format(PyExc_RuntimeError, "nghttp2_submit_rst_stream: %s", nghttp2_strerror(rv));
+        return NULL;
+    }
+    if (Flush(conn) == -1) return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// Send count bytes of fd from offset. The range is read into the DATA
+// frames as they go out, the caller may close fd once this returns.
+static PyObject* Stream_send_file(Stream* self, PyObject* args) {
+    int fd, fin;
+    long long offset;
+    Py_ssize_t count;
+    struct stat st;
+    Connection* conn;
+
+    if (!PyArg_ParseTuple(args, "iLnp", &fd, &offset, &count, &fin)) return NULL;
+    if (offset < 0 || count < 0) {
+        PyErr_SetString(PyExc_ValueError, "offset and count must not be negative");
+        return NULL;
+    }
+    if (!(conn = Stream_connection(self)) || self->out_fin) Py_RETURN_NONE;
+    if (!self->responded) {
+        PyErr_SetString(PyExc_RuntimeError, "send_file before send_headers");
+        return NULL;
+    }
+
+    if (fstat(fd, &st) == -1) return PyErr_SetFromErrno(PyExc_OSError);
+    if (offset + count > st.st_size) {
+        PyErr_SetString(PyExc_ValueError, "range past the end of the file");
+        return NULL;
+    }
+
+    if (count && !self->head) {
+        Chunk* chunk = malloc(sizeof(Chunk));
+        if (!chunk) return PyErr_NoMemory();
+        if ((chunk->fd = dup(fd)) == -1) {
+            free(chunk);
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+        chunk->data = NULL;
+        chunk->offset = (size_t)offset;
+        chunk->len = (size_t)count;
+        AppendChunk(self, chunk);
+    }
+
+    self->out_fin = fin;
+    if (Stream_resume(self, conn) == -1) return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// (body, more_body) of up to RECV_CHUNK bytes, None when nothing waits.
+// What is taken out is opened again in the stream and connection windows.
+static PyObject* Stream_receive(Stream* self, PyObject* args) {
+    PyObject* body;
+    int more_body = 1;
+    Connection* conn;
+
+    size_t n = self->recv_len - self->recv_off;
+    if (!n && self->recv_fin != 1) {
+        // the next arrival signals again
+        self->recv_signaled = 0;
+        Py_RETURN_NONE;
+    }
+
+    if (n > RECV_CHUNK) n = RECV_CHUNK;
+    if (!(body = PyBytes_FromStringAndSize(self->recv_buf + self->recv_off, (Py_ssize_t)n))) return NULL;
+
+    self->recv_off += n;
+    if (self->recv_off == self->recv_len) {
+        self->recv_off = self->recv_len = 0;
+        if (self->recv_fin) {
+            self->recv_fin = 2;
+            more_body = 0;
+        }
+    }
+
+    if (n && (conn = Stream_connection(self))) {
+        nghttp2_session_consume(conn->session, self->id, n);
+        if (Flush(conn) == -1) {
+            Py_DECREF(body);
+            return NULL;
+        }
+    }
+
+    return Py_BuildValue("(NO)", body, more_body ? Py_True : Py_False);
+}
+
+static PyObject* Stream_get_id(Stream* self, void* closure) {
+    return PyLong_FromLong(self->id);
+}
+
+// Response bytes send_data and send_file queued that flow control has not
+// let out yet, None once the response ended or the stream is closed
+static PyObject* Stream_get_buffered(Stream* self, void* closure) {
+    if (!Stream_connection(self) || self->out_fin) Py_RETURN_NONE;
+    return PyLong_FromSize_t(self->out_len);
+}
+
+static PyObject* Stream_get_state(Stream* self, void* closure) {
+    PyObject* state = self->state ? self->state : Py_None;
+    Py_INCREF(state);
+    return state;
+}
+
+static int Stream_set_state(Stream* self, PyObject* value, void* closure) {
+    PyObject* tmp = self->state;
+    if (!value) value = Py_None;
+    Py_INCREF(value);
+    self->state = value;
+    Py_XDECREF(tmp);
+    return 0;
+}
+
+static PyMethodDef Stream_methods[] = {
+    {"send_headers", (PyCFunction)Stream_send_headers, METH_VARARGS, ""},
+    {"send_data", (PyCFunction)Stream_send_data, METH_VARARGS, ""},
+    {"send_file", (PyCFunction)Stream_send_file, METH_VARARGS, ""},
+    {"receive", (PyCFunction)Stream_receive, METH_NOARGS, ""},
+    {"reset", (PyCFunction)Stream_reset, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Stream_getset[] = {
+    {"id", (getter)Stream_get_id, NULL, "", NULL},
+    {"buffered", (getter)Stream_get_buffered, NULL, "", NULL},
+    {"state", (getter)Stream_get_state, (setter)Stream_set_state, "", NULL},
+    {NULL}
+};
+
+static PyTypeObject StreamType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "ch2.Stream",
+    .tp_basicsize = sizeof(Stream),
+    .tp_dealloc = (destructor)Stream_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Stream",
+    .tp_traverse = (traverseproc)Stream_traverse,
+    .tp_clear = (inquiry)Stream_clear,
+    .tp_methods = Stream_methods,
+    .tp_getset = Stream_getset,
+};
+
+// --- Request scope ---
+
+static PyObject* MethodString(const uint8_t* method, size_t len) {
+    for (size_t i = 0; i < sizeof(Methods) / sizeof(Methods[0]); ++i) {
+        if (strlen(Methods[i]) == len && memcmp(Methods[i], method, len) == 0) {
+            Py_INCREF(MethodStrings[i]);
+            return MethodStrings[i];
+        }
+    }
+    return PyUnicode_DecodeLatin1((const char*)method, (Py_ssize_t)len, NULL);
+}
+
+static int HexDigit(char c) {
+    if (c >= '0' && c <= '9') return c - '0';
+    if (c >= 'a' && c <= 'f') return c - 'a' + 10;
+    if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+    return -1;
+}
+
+// The ASGI path: percent-decoded, then UTF-8 with bad sequences replaced
+static PyObject* DecodePath(const char* path, size_t len) {
+    if (!memchr(path, '%', len)) return PyUnicode_DecodeUTF8(path, (Py_ssize_t)len, "replace");
+
+    char* buf = malloc(len ? len : 1);
+    if (!buf) return PyErr_NoMemory();
+
+    size_t n = 0;
+    for (size_t i = 0; i < len; ++i) {
+        int hi, lo;
+        if (path[i] == '%' && i + 2 < len && (hi = HexDigit(path[i + 1])) >= 0
+                && (lo = HexDigit(path[i + 2])) >= 0) {
+            buf[n++] = (char)(hi << 4 | lo);
+            i += 2;
+        } else {
+            buf[n++] = path[i];
+        }
+    }
+
+    PyObject* result = PyUnicode_DecodeUTF8(buf, (Py_ssize_t)n, "replace");
+    free(buf);
+    return result;
+}
+
+// Pseudo-header fields go into the scope and out of its headers,
+// :authority becomes host when the request has none
+static PyObject* BuildScope(Connection* conn, Stream* stream) {
+    PyObject *scope = NULL, *value = NULL;
+
+    if (stream->authority && !stream->has_host) {
+        if (!(value = Py_BuildValue("(yO)", "host", stream->authority))) goto error;
+        if (PyList_Insert(stream->headers, 0, value) == -1) goto error;
+        Py_CLEAR(value);
+    }
+
+    if (!(scope = PyDict_Copy(conn->scope))) goto error;
+    if (PyDict_SetItem(scope, str_headers, stream->headers) == -1) goto error;
+    if (PyDict_SetItem(scope, str_method, stream->method ? stream->method : MethodStrings[0]) == -1) goto error;
+
+    const char* target = stream->target ? PyBytes_AS_STRING(stream->target) : "/";
+    size_t target_len = stream->target ? (size_t)PyBytes_GET_SIZE(stream->target) : 1;
+    const char* query = memchr(target, '?', target_len);
+    size_t path_len = query ? (size_t)(query - target) : target_len;
+
+    if (!(value = DecodePath(target, path_len)) || PyDict_SetItem(scope, str_path, value) == -1) goto error;
+    Py_CLEAR(value);
+    if (!(value = PyBytes_FromStringAndSize(target, (Py_ssize_t)path_len)) || PyDict_SetItem(scope, str_raw_path, value) == -1) goto error;
+    Py_CLEAR(value);
+    if (query) {
+        value = PyBytes_FromStringAndSize(query + 1, (Py_ssize_t)(target_len - path_len - 1));
+        if (!value || PyDict_SetItem(scope, str_query_string, value) == -1) goto error;
+        Py_CLEAR(value);
+    }
+    if (stream->scheme && PyDict_SetItem(scope, str_scheme, stream->scheme) == -1) goto error;
+
+    return scope;
+
+    error:
+    Py_XDECREF(value);
+    Py_XDECREF(scope);
+    return NULL;
+}
+
+// --- nghttp2 callbacks ---
+
+static Stream* FindStream(nghttp2_session* session, int32_t stream_id) {
+    return nghttp2_session_get_stream_user_data(session, stream_id);
+}
+
+// Call a server callback, an exception is printed and does not stop the
+// session
+static void Notify(Connection* conn, PyObject* name, Stream* stream, PyObject* scope) {
+    PyObject* result = scope
+        ? PyObject_CallMethodObjArgs(conn->server, name, (PyObject*)stream, scope, NULL)
+        : PyObject_CallMethodObjArgs(conn->server, name, (PyObject*)stream, NULL);
+    if (!result) PyErr_Print();
+    Py_XDECREF(result);
+}
+
+static int OnBeginHeaders(nghttp2_session* session, const nghttp2_frame* frame, void* user_data) {
+    Connection* conn = user_data;
+    Stream* stream;
+
+    if (frame->hd.type != NGHTTP2_HEADERS || frame->headers.cat != NGHTTP2_HCAT_REQUEST) return 0;
+
+    if (!(stream = Stream_new(conn, frame->hd.stream_id))) goto error;
+    PyObject* key = PyLong_FromLong(frame->hd.stream_id);
+    if (!key || PyDict_SetItem(conn->streams, key, (PyObject*)stream) == -1) {
+        Py_XDECREF(key);
+        Py_DECREF(stream);
+        goto error;
+    }
+    Py_DECREF(key);
+    // borrowed, conn->streams holds the stream until it closes
+    nghttp2_session_set_stream_user_data(session, frame->hd.stream_id, stream);
+    Py_DECREF(stream);
+    return 0;
+
+    error:
+    PyErr_Print();
+    return NGHTTP2_ERR_CALLBACK_FAILURE;
+}
+
+static int OnHeader(nghttp2_session* session, const nghttp2_frame* frame, const uint8_t* name, size_t namelen,
+        const uint8_t* value, size_t valuelen, uint8_t flags, void* user_data) {
+    Stream* stream = FindStream(session, frame->hd.stream_id);
+    PyObject** pseudo = NULL;
+    PyObject* field;
+
+    // trailers are not passed on
+    if (!stream || !stream->headers) return 0;
+
+#define is(literal) (namelen == sizeof(literal) - 1 && memcmp(name, literal, namelen) == 0)
+    if (namelen && name[0] == ':') {
+        if (is(":method")) {
+            Py_XSETREF(stream->method, MethodString(value, valuelen));
+            stream->head = valuelen == 4 && memcmp(value, "HEAD", 4) == 0;
+            if (!stream->method) goto error;
+            return 0;
+        }
+        if (is(":path")) pseudo = &stream->target;
+        else if (is(":authority")) pseudo = &stream->authority;
+        else if (is(":scheme")) {
+            if (valuelen == 5 && memcmp(value, "https", 5) == 0) return 0;
+            Py_XSETREF(stream->scheme, PyUnicode_DecodeLatin1((const char*)value, (Py_ssize_t)valuelen, NULL));
+            if (!stream->scheme) goto error;
+            return 0;
+        } else return 0;
+
+        Py_XSETREF(*pseudo, PyBytes_FromStringAndSize((const char*)value, (Py_ssize_t)valuelen));
+        if (!*pseudo) goto error;
+        return 0;
+    }
+    if (is("host")) stream->has_host = 1;
+#undef is
+
+    if (!(field = Py_BuildValue("(y#y#)", name, (Py_ssize_t)namelen, value, (Py_ssize_t)valuelen))) goto error;
+    if (PyList_Append(stream->headers, field) == -1) {
+        Py_DECREF(field);
+        goto error;
+    }
+    Py_DECREF(field);
+    return 0;
+
+    error:
+    PyErr_Print();
+    return NGHTTP2_ERR_TEMPORAL_CALLBACK_FAILURE;
+}
+
+static void Signal(Connection* conn, Stream* stream) {
+    if (stream->recv_signaled || stream->headers) return;
+    stream->recv_signaled = 1;
+    Notify(conn, str_on_body, stream, NULL);
+}
+
+static int OnFrameRecv(nghttp2_session* session, const nghttp2_frame* frame, void* user_data) {
+    Connection* conn = user_data;
+    Stream* stream;
+
+    if (frame->hd.type != NGHTTP2_HEADERS && frame->hd.type != NGHTTP2_DATA) return 0;
+    if (!(stream = FindStream(session, frame->hd.stream_id))) return 0;
+
+    if (frame->hd.flags & NGHTTP2_FLAG_END_STREAM) stream->recv_fin = 1;
+
+    if (frame->hd.type == NGHTTP2_HEADERS && stream->headers) {
+        PyObject* scope = BuildScope(conn, stream);
+        Stream_release_head(stream);
+        if (!scope) {
+            PyErr_Print();
+            nghttp2_submit_rst_stream(session, NGHTTP2_FLAG_NONE, frame->hd.stream_id, NGHTTP2_INTERNAL_ERROR);
+            return 0;
+        }
+        Py_INCREF(stream);
+        Notify(conn, str_on_headers, stream, scope);
+        Py_DECREF(scope);
+        Py_DECREF(stream);
+        return 0;
+    }
+
+    if (stream->recv_fin) Signal(conn, stream);
+    return 0;
+}
+
+static int OnDataChunkRecv(nghttp2_session* session, uint8_t flags, int32_t stream_id, const uint8_t* data,
+        size_t len, void* user_data) {
+    Connection* conn = user_data;
+    Stream* stream = FindStream(session, stream_id);
+
+    if (!stream || stream->recv_fin) {
+        nghttp2_session_consume(session, stream_id, len);
+        return 0;
+    }
+
+    if (stream->recv_len + len > stream->recv_cap) {
+        // compact before growing, receive() may have taken the front
+        if (stream->recv_off) {
+            memmove(stream->recv_buf, stream->recv_buf + stream->recv_off, stream->recv_len - stream->recv_off);
+            stream->recv_len -= stream->recv_off;
+            stream->recv_off = 0;
+        }
+        if (stream->recv_len + len > stream->recv_cap) {
+            size_t cap = stream->recv_cap ? stream->recv_cap : 16 * 1024;
+            while (cap < stream->recv_len + len) cap *= 2;
+            char* buf = realloc(stream->recv_buf, cap);
+            if (!buf) return NGHTTP2_ERR_CALLBACK_FAILURE;
+            stream->recv_buf = buf;
+            stream->recv_cap = cap;
+        }
+    }
+    memcpy(stream->recv_buf + stream->recv_len, data, len);
+    stream->recv_len += len;
+
+    Signal(conn, stream);
+    return 0;
+}
+
+static int OnStreamClose(nghttp2_session* session, int32_t stream_id, uint32_t error_code, void* user_data) {
+    Connection* conn = user_data;
+    Stream* stream = FindStream(session, stream_id);
+    PyObject* key;
+
+    if (!stream) return 0;
+
+    Py_INCREF(stream);
+    nghttp2_session_set_stream_user_data(session, stream_id, NULL);
+    // what the application never read still counts against the connection
+    size_t unread = stream->recv_len - stream->recv_off;
+    if (unread) nghttp2_session_consume_connection(session, unread);
+    FreeChunks(stream);
+    stream->out_fin = 1;
+
+    if ((key = PyLong_FromLong(stream_id))) {
+        if (PyDict_DelItem(conn->streams, key) == -1) PyErr_Clear();
+        Py_DECREF(key);
+    } else {
+        PyErr_Clear();
+    }
+
+    Notify(conn, str_on_close, stream, NULL);
+    Py_CLEAR(stream->conn);
+    Py_DECREF(stream);
+    return 0;
+}
+
+// --- Connection ---
+
+static int Connection_init(Connection* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"server", "transport", "scope", NULL};
+    PyObject *server, *transport, *scope;
+    nghttp2_session_callbacks* callbacks = NULL;
+    nghttp2_option* option = NULL;
+    int result = -1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO!", kwlist, &server, &transport, &PyDict_Type, &scope))
+        return -1;
+    if (self->session) {
+        PyErr_SetString(PyExc_RuntimeError, "Connection already initialized");
+        return -1;
+    }
+
+    Py_INCREF(server);
+    self->server = server;
+    if (!(self->scope = PyDict_Copy(scope))) goto finally;
+    if (!(self->streams = PyDict_New())) goto finally;
+    if (!(self->write = PyObject_GetAttr(transport, str_write))) goto finally;
+    if (!(self->close = PyObject_GetAttr(transport, str_close))) goto finally;
+
+    if (nghttp2_session_callbacks_new(&callbacks) != 0 || nghttp2_option_new(&option) != 0) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+    nghttp2_session_callbacks_set_on_begin_headers_callback(callbacks, OnBeginHeaders);
+    nghttp2_session_callbacks_set_on_header_callback(callbacks, OnHeader);
+    nghttp2_session_callbacks_set_on_frame_recv_callback(callbacks, OnFrameRecv);
+    nghttp2_session_callbacks_set_on_data_chunk_recv_callback(callbacks, OnDataChunkRecv);
+    nghttp2_session_callbacks_set_on_stream_close_callback(callbacks, OnStreamClose);
+    // windows open as receive() hands the body out, see Stream_receive
+    nghttp2_option_set_no_auto_window_update(option, 1);
+
+    if (nghttp2_session_server_new2(&self->session, callbacks, self, option) != 0) {
+        PyErr_NoMemory();
+        goto finally;
+    }
+
+    nghttp2_settings_entry settings[] = {
+        {NGHTTP2_SETTINGS_MAX_CONCURRENT_STREAMS, MAX_STREAMS},
+        {NGHTTP2_SETTINGS_INITIAL_WINDOW_SIZE, STREAM_WINDOW},
+    };
+    if (nghttp2_submit_settings(self->session, NGHTTP2_FLAG_NONE, settings, 2) != 0
+            || nghttp2_session_set_local_window_size(self->session, NGHTTP2_FLAG_NONE, 0, CONN_WINDOW) != 0) {
+        PyErr_SetString(PyExc_RuntimeError, "nghttp2 settings failed");
+        goto finally;
+    }
+
+    result = Flush(self);
+
+    finally:
+    nghttp2_session_callbacks_del(callbacks);
+    nghttp2_option_del(option);
+    return result;
+}
+
+static int Connection_traverse(Connection* self, visitproc visit, void* arg) {
+    Py_VISIT(self->server);
+    Py_VISIT(self->write);
+    Py_VISIT(self->close);
+    Py_VISIT(self->streams);
+    return 0;
+}
+
+static int Connection_clear(Connection* self) {
+    Py_CLEAR(self->server);
+    Py_CLEAR(self->write);
+    Py_CLEAR(self->close);
+    Py_CLEAR(self->streams);
+    return 0;
+}
+
+static void Connection_dealloc(Connection* self) {
+    PyObject_GC_UnTrack(self);
+    Connection_clear(self);
+    Py_CLEAR(self->scope);
+    nghttp2_session_del(self->session);
+    free(self->wbuf);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// Process bytes from the transport. Returns False once the connection is
+// done and the transport closed.
+static PyObject* Connection_feed(Connection* self, PyObject* arg) {
+    Py_buffer data;
+
+    if (!self->session || self->lost) Py_RETURN_FALSE;
+    if (PyObject_GetBuffer(arg, &data, PyBUF_SIMPLE) == -1) return NULL;
+
+    self->in_recv = 1;
+    ssize_t rv = nghttp2_session_mem_recv(self->session, data.buf, (size_t)data.len);
+    self->in_recv = 0;
+    PyBuffer_Release(&data);
+
+    if (rv < 0) {
+        // not HTTP/2 or a callback failed: tell the peer if possible
+        nghttp2_session_terminate_session(self->session, NGHTTP2_PROTOCOL_ERROR);
+    }
+
+    if (Flush(self) == -1) return NULL;
+
+    return PyBool_FromLong(nghttp2_session_want_read(self->session) || nghttp2_session_want_write(self->session));
+}
+
+static PyObject* Connection_pause_writing(Connection* self, PyObject* args) {
+    self->paused = 1;
+    Py_RETURN_NONE;
+}
+
+static PyObject* Connection_resume_writing(Connection* self, PyObject* args) {
+    self->paused = 0;
+    if (self->session && Flush(self) == -1) return NULL;
+    Py_RETURN_NONE;
+}
+
+// GOAWAY naming the last stream the client opened: those finish, new ones
+// are refused and the transport closes once the last one is done
+static PyObject* Connection_shutdown(Connection* self, PyObject* args) {
+    if (!self->session || self->lost) Py_RETURN_NONE;
+
+    int rv = nghttp2_submit_goaway(self->session, NGHTTP2_FLAG_NONE,
+        nghttp2_session_get_last_proc_stream_id(self->session), NGHTTP2_NO_ERROR, NULL, 0);
+    if (rv != 0) {
+        PyErr_Format(PyExc_RuntimeError, "nghttp2_submit_goaway: %s", nghttp2_strerror(rv));
+        return NULL;
+    }
+    if (Flush(self) == -1) return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// The transport is gone: every open stream is closed for the application
+static PyObject* Connection_connection_lost(Connection* self, PyObject* args) {
+    PyObject* streams;
+
+    if (self->lost || !self->streams) Py_RETURN_NONE;
+    self->lost = 1;
+
+    if (!(streams = PyDict_Values(self->streams))) return NULL;
+    PyDict_Clear(self->streams);
+
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(streams); ++i) {
+        Stream* stream = (Stream*)PyList_GET_ITEM(streams, i);
+        nghttp2_session_set_stream_user_data(self->session, stream->id, NULL);
+        FreeChunks(stream);
+        stream->out_fin = 1;
+        Notify(self, str_on_close, stream, NULL);
+        Py_CLEAR(stream->conn);
+    }
+    Py_DECREF(streams);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject* Connection_get_active(Connection* self, void* closure) {
+    return PyLong_FromSsize_t(self->streams ? PyDict_Size(self->streams) : 0);
+}
+
+static PyMethodDef Connection_methods[] = {
+    {"feed", (PyCFunction)Connection_feed, METH_O, ""},
+    {"pause_writing", (PyCFunction)Connection_pause_writing, METH_NOARGS, ""},
+    {"resume_writing", (PyCFunction)Connection_resume_writing, METH_NOARGS, ""},
+    {"shutdown", (PyCFunction)Connection_shutdown, METH_NOARGS, ""},
+    {"connection_lost", (PyCFunction)Connection_connection_lost, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Connection_getset[] = {
+    {"active", (getter)Connection_get_active, NULL, "open streams", NULL},
+    {NULL}
+};
+
+static PyTypeObject ConnectionType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "ch2.Connection",
+    .tp_basicsize = sizeof(Connection),
+    .tp_dealloc = (destructor)Connection_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Connection",
+    .tp_traverse = (traverseproc)Connection_traverse,
+    .tp_clear = (inquiry)Connection_clear,
+    .tp_methods = Connection_methods,
+    .tp_getset = Connection_getset,
+    .tp_init = (initproc)Connection_init,
+    .tp_new = PyType_GenericNew,
+};
+
+static PyModuleDef ch2 = { PyModuleDef_HEAD_INIT, "ch2", "", -1, NULL, NULL, NULL, NULL, NULL };
+
+PyMODINIT_FUNC PyInit_ch2(void) {
+    PyObject* m = NULL;
+
+    if (PyType_Ready(&ConnectionType) < 0) goto error;
+    if (PyType_Ready(&StreamType) < 0) goto error;
+    if (!(m = PyModule_Create(&ch2))) goto error;
+    Py_INCREF(&ConnectionType);
+    PyModule_AddObject(m, "Connection", (PyObject*)&ConnectionType);
+    Py_INCREF(&StreamType);
+    PyModule_AddObject(m, "Stream", (PyObject*)&StreamType);
+
+#define intern(var, literal) if (!(var = PyUnicode_InternFromString(literal))) goto error;
+    intern(str_on_headers, "on_headers")
+    intern(str_on_body, "on_body")
+    intern(str_on_close, "on_close")
+    intern(str_write, "write")
+    intern(str_close, "close")
+    intern(str_method, "method")
+    intern(str_path, "path")
+    intern(str_raw_path, "raw_path")
+    intern(str_query_string, "query_string")
+    intern(str_scheme, "scheme")
+    intern(str_headers, "headers")
+#undef intern
+
+    for (size_t i = 0; i < sizeof(Methods) / sizeof(Methods[0]); ++i)
+        if (!(MethodStrings[i] = PyUnicode_InternFromString(Methods[i]))) goto error;
+
+    goto finally;
+
+    error:
+    Py_XDECREF(m);
+    m = NULL;
+
+    finally:
+    return m;
+}
@@ -45,6 +45,8 @@ Protocol_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
   self->write = NULL;
   self->create_task = NULL;
   self->request_logger = NULL;
+  self->cookie_cache = NULL;
+  self->upgraded = false;
 
   self->gather.prev_buffer = NULL;
 
@@ -57,6 +59,7 @@ static void
 Protocol_dealloc(Protocol* self)
 {
   Py_XDECREF(self->gather.prev_buffer);
+  Py_XDECREF(self->cookie_cache);
   Py_XDECREF(self->request_logger);
   Py_XDECREF(self->create_task);
   Py_XDECREF(self->write);
@@ -616,7 +619,9 @@ static void* Protocol_pipeline_ready(PipelineEntry entry, PyObject* protocol)
     response = task;
   }
 
-  if(!self->closed) {
+  if(self->upgraded) {
+    // the handler ran the upgraded connection, what it returns is moot
+  } else if(!self->closed) {
     if(!Protocol_write_response_or_err(self, request, (Response*)response))
       goto error;
   } else {
@@ -687,6 +692,10 @@ Protocol_on_body(Protocol* self, char* body, size_t body_len, size_t tail_len)
 */
 #endif
 
+  // what follows an upgrade in the same read is not HTTP
+  if(self->upgraded)
+    goto finally;
+
   matcher_entry = matcher_capi->Matcher_match_request(
     (Matcher*)self->matcher, (PyObject*)&self->static_request,
     &entries, &entries_length);
@@ -711,6 +720,18 @@ Protocol_on_body(Protocol* self, char* body, size_t body_len, size_t tail_len)
   ((Request*)request)->transport = self->transport;
   Py_INCREF(self->transport);
 
+  // the Cookie header parsed for the connection's previous request
+  if(!self->cookie_cache) {
+    if(!(self->cookie_cache = PyList_New(2)))
+      goto error;
+    Py_INCREF(Py_None);
+    PyList_SET_ITEM(self->cookie_cache, 0, Py_None);
+    Py_INCREF(Py_None);
+    PyList_SET_ITEM(self->cookie_cache, 1, Py_None);
+  }
+  ((Request*)request)->cookie_cache = self->cookie_cache;
+  Py_INCREF(self->cookie_cache);
+
   ((Request*)request)->app = self->app;
   Py_INCREF(self->app);
 
@@ -747,6 +768,9 @@ Protocol_on_body(Protocol* self, char* body, size_t body_len, size_t tail_len)
     goto finally;
   }
 
+  if(self->upgraded)
+    goto finally;
+
   if(!Protocol_write_response_or_err(
       self, (PyObject*)&self->static_request, (Response*)handler_result))
     goto error;
@@ -809,6 +833,61 @@ Protocol_on_error(Protocol* self, PyObject* error)
 #endif
 
 
+// Hand the transport to protocol, e.g. after a WebSocket handshake. The
+// connection leaves app._connections, the reaper and drain are up to
+// protocol from now on. Responses gathered so far are written first, so
+// protocol's output follows them.
+static PyObject*
+Protocol_upgrade(Protocol* self, PyObject* protocol)
+{
+  PyObject* result = Py_None;
+  PyObject* connections = NULL;
+  PyObject* gather_buffer = NULL;
+  PyObject* tmp;
+
+  if(self->closed || self->upgraded) {
+    PyErr_SetString(PyExc_RuntimeError, "Connection closed or already upgraded");
+    goto error;
+  }
+
+  if(self->gather.len) {
+    if(!(gather_buffer = Gather_flush(&self->gather)))
+      goto error;
+
+    if(!(tmp = PyObject_CallFunctionObjArgs(self->write, gather_buffer, NULL)))
+      goto error;
+    Py_DECREF(tmp);
+  }
+
+  if(!(tmp = PyObject_CallMethod(self->transport, "set_protocol", "O", protocol)))
+    goto error;
+  Py_DECREF(tmp);
+
+  self->upgraded = true;
+
+  if(!(connections = PyObject_GetAttrString(self->app, "_connections")))
+    goto error;
+
+  if(PySet_Discard(connections, (PyObject*)self) == -1)
+    goto error;
+
+  if(!(tmp = PyObject_CallMethod(protocol, "connection_made", "O", self->transport)))
+    goto error;
+  Py_DECREF(tmp);
+
+  goto finally;
+
+  error:
+  result = NULL;
+
+  finally:
+  Py_XDECREF(gather_buffer);
+  Py_XDECREF(connections);
+  Py_XINCREF(result);
+  return result;
+}
+
+
 static PyObject*
 Protocol_pipeline_cancel(Protocol* self)
 {
@@ -824,6 +903,7 @@ static PyMethodDef Protocol_methods[] = {
   {"connection_lost", (PyCFunction)Protocol_connection_lost, METH_VARARGS, ""},
   {"data_received", (PyCFunction)Protocol_data_received, METH_O, ""},
   {"pipeline_cancel", (PyCFunction)Protocol_pipeline_cancel, METH_NOARGS, ""},
+  {"upgrade", (PyCFunction)Protocol_upgrade, METH_O, ""},
 #ifdef PARSER_STANDALONE
   {"on_headers", (PyCFunction)Protocol_on_headers, METH_VARARGS, ""},
   {"on_body", (PyCFunction)Protocol_on_body, METH_VARARGS, ""},
@@ -43,12 +43,14 @@ typedef struct {
   PyObject* writelines;
   PyObject* create_task;
   PyObject* request_logger;
+  PyObject* cookie_cache;
 #ifdef PROTOCOL_TRACK_REFCNT
   Py_ssize_t none_cnt;
   Py_ssize_t true_cnt;
   Py_ssize_t false_cnt;
 #endif
   bool closed;
+  bool upgraded;
   Gather gather;
 } Protocol;
 
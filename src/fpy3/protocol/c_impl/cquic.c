@@ -1,24 +1,85 @@
 #define _GNU_SOURCE
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <msquic.h>
 #include <nghttp3/nghttp3.h>
-#include <arpa/inet.h> 
+#include <arpa/inet.h>
+#include <netdb.h>
 #include <pthread.h>
+#include <strings.h>
+#include <sys/eventfd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "picohttpparser.h"
+#include "crequest.h"
+#include "cresponse.h"
+#include "cmatcher.h"
+#include "capsule.h"
 
 const QUIC_API_TABLE* MsQuic;
-HQUIC Registration;
-HQUIC Configuration;
 
-const QUIC_REGISTRATION_CONFIG RegConfig = { "fpy3", QUIC_EXECUTION_PROFILE_LOW_LATENCY };
-const QUIC_BUFFER AlpnBuffers[] = { 
+// One registration per execution profile, opened on first use
+#define EXECUTION_PROFILES (QUIC_EXECUTION_PROFILE_TYPE_REAL_TIME + 1)
+static HQUIC Registrations[EXECUTION_PROFILES];
+
+// Worker index embedded in connection IDs, -1 when load balancing is off
+static int64_t FixedServerId = -1;
+
+static Request_CAPI* request_capi;
+static Matcher_CAPI* matcher_capi;
+static Response_CAPI* response_capi;
+static PyObject* RouteNotFoundException;
+static PyObject* str_on_headers;
+static PyObject* str_on_data;
+static PyObject* str_on_fin;
+static PyObject* str_on_datagrams;
+static PyObject* str_on_writable;
+static PyObject* str_on_started;
+static PyObject* str_on_close;
+static PyObject* str_on_body;
+
+const QUIC_BUFFER AlpnBuffers[] = {
     { sizeof("h3") - 1, (uint8_t*)"h3" },
     { sizeof("h3-29") - 1, (uint8_t*)"h3-29" }
 };
 
 typedef struct StreamContext_s StreamContext;
+typedef struct ConnectionContext_s ConnectionContext;
+
+// --- Credentials ---
+
+// Loaded configurations, one per certificate/key pair and settings, shared
+// by all listeners in the process. Only touched with the GIL held.
+typedef struct Credential_s {
+    char* certfile;
+    char* keyfile;
+    QUIC_EXECUTION_PROFILE Profile;
+    QUIC_SETTINGS Settings;
+    HQUIC Configuration;
+    struct Credential_s* next;
+} Credential;
+
+static Credential* credentials;
+
+// Server name to configuration, consulted on MsQuic threads
+typedef struct SniEntry_s {
+    char* server_name; // lowercase, "*.example.com" matches one label
+    size_t server_name_len;
+    HQUIC Configuration;
+    struct SniEntry_s* next;
+} SniEntry;
 
 // --- Event System ---
-typedef enum { EVT_HEADERS, EVT_DATA, EVT_FIN } EventType;
+typedef enum {
+    EVT_HEADERS, EVT_DATA, EVT_FIN, EVT_REQUEST,
+    EVT_DATAGRAM, // an HTTP datagram for the stream
+    EVT_WRITABLE, // a WebTransport session or a response drained below its low water
+    EVT_STARTED, // a stream opened by open_stream started or failed
+    EVT_CLOSED, // a WebTransport session or an unanswered request stream is gone
+    EVT_BODY // request body bytes or its end wait in the stream's receive channel
+} EventType;
 
 typedef struct Header_s {
     char* name;
@@ -30,15 +91,15 @@ typedef struct Header_s {
 
 typedef struct PendingEvent_s {
     EventType type;
-    StreamContext* sctx;
-    
+    StreamContext* sctx; // the event holds a reference
+
     // For HEADERS
     Header* headers;
-    
+
     // For DATA
-    char* data; 
+    char* data;
     size_t len;
-    
+
     struct PendingEvent_s* next;
 } PendingEvent;
 
@@ -46,77 +107,256 @@ typedef struct ResponseChunk_s {
     char* data;
     size_t len;
     size_t sent;
+    // File chunks point into map, which stays mapped until the queue and
+    // every send referencing it let go, see MapFile and SendMapped
+    void* map;
+    size_t map_len;
+    int refs;
     struct ResponseChunk_s* next;
 } ResponseChunk;
 
+typedef struct QuicServer_s QuicServer;
+
+// --- WebTransport ---
+//
+// Sessions are extended CONNECT requests (:protocol webtransport) handled
+// by nghttp3 like any request. Their streams start with a signal value and
+// the session ID and never reach nghttp3, ReceiveStream tells them apart by
+// their first bytes. Datagrams are HTTP datagrams (RFC 9297): the quarter
+// stream ID of the request followed by the payload.
+
+#define WT_BIDI_STREAM 0x41
+#define WT_UNI_STREAM 0x54
+#define H3_SETTINGS_ENABLE_WEBTRANSPORT 0x2b603742
+#define H3_SETTINGS_WT_MAX_SESSIONS 0xc671706aULL
+
+enum { WT_NONE, WT_PENDING, WT_STREAM };
+
+// Session stream bytes queued in MsQuic before send_data reports the
+// session as not writable, and the level at which it becomes writable again
+#define WT_HIGH_WATER (1024 * 1024)
+#define WT_LOW_WATER (256 * 1024)
+
+// The same for the response body of a request stream, counted from what
+// nghttp3 has not read yet
+#define RESP_HIGH_WATER (1024 * 1024)
+#define RESP_LOW_WATER (256 * 1024)
+
+// Datagrams of one stream waiting in MsQuic, more are dropped
+#define DATAGRAM_QUEUE 64
+
 typedef struct {
-    PyObject_HEAD
+    StreamContext* sctx; // holds a reference
+    int queued; // still counted in sctx->dgram_queued
+    QUIC_BUFFER Buffer;
+    uint8_t data[];
+} DatagramContext;
+
+typedef struct {
+    QuicServer* server;
     HQUIC Listener;
+    HQUIC Configuration; // used when the client sent no known server name
+} ListenerContext;
+
+struct QuicServer_s {
+    PyObject_HEAD
+    ListenerContext** listeners;
+    size_t listeners_len;
+    pthread_mutex_t sni_lock;
+    SniEntry* sni;
+
+    // Live connections, for drain. Lock before any ConnectionContext lock.
+    pthread_mutex_t conns_lock;
+    ConnectionContext* conns;
+    int draining;
+
     PyObject* app;
     PyObject* loop;
-    
+    QUIC_EXECUTION_PROFILE Profile;
+    QUIC_SETTINGS Settings;
+    nghttp3_settings H3Settings;
+    int qpack_try_index; // let the encoder index any response field
+    uint64_t wt_max_sessions; // WebTransport is off when 0
+
+    // Native dispatch, set when app is an fpy3 Application
+    int native;
+    PyObject* matcher;
+    PyObject* error_handler;
+    PyObject* create_task;
+    PyObject* request_logger;
+
+    // MsQuic threads never take the GIL, they queue events and signal
+    // wakeup_fd which the event loop watches with add_reader
+    int wakeup_fd;
     pthread_mutex_t pending_lock;
     PendingEvent* pending_head;
-    PendingEvent* pending_tail; 
+    PendingEvent* pending_tail;
     int debug_mode;
-} QuicServer;
+};
 
-typedef struct {
+struct ConnectionContext_s {
+    int refs; // one for the MsQuic connection plus one per StreamContext
     QuicServer* server;
     nghttp3_conn* http3;
-    HQUIC Connection;
+    HQUIC Connection; // NULL once MsQuic shut the connection down
+    HQUIC Handle; // closed with the last reference, valid for GetParam until then
     HQUIC CtrlStream;
     HQUIC QEncStream;
     HQUIC QDecStream;
+    int64_t CtrlStreamId;
+    int64_t QEncStreamId;
+    int64_t QDecStreamId;
     int streams_started_count;
     int is_ready;
-    StreamContext* streams[64];
-    int stream_count;
+    StreamContext* streams; // peer streams, linked through prev/next
     pthread_mutex_t lock;
-} ConnectionContext;
+
+    // Graceful shutdown, see QuicServer_shutdown
+    ConnectionContext* prev;
+    ConnectionContext* next;
+    int64_t max_bidi_id; // highest peer request stream seen
+    int goaway; // 0 none, 1 notice sent, 2 final GOAWAY sent
+    int closing; // ConnectionShutdown called
+
+    // Bytes handed to MsQuic and not completed yet, see FlushConn
+    uint64_t inflight;
+    uint64_t send_window;
+    int settings_sent; // the SETTINGS frame went out, see ExtendSettings
+
+    uint16_t dgram_max_len; // 0 while the peer does not take datagrams
+
+    // for the ASGI scope, kept up to date by the address change events
+    QUIC_ADDR LocalAddress;
+    QUIC_ADDR RemoteAddress;
+};
 
 struct StreamContext_s {
+    int refs; // MsQuic stream, pending events and Python handles
     int64_t stream_id;
     ConnectionContext* conn_ctx;
     HQUIC Stream;
     int is_uni;
     int has_error; // Flag to indicate stream processing failed
-    
+    int closed; // MsQuic stream is gone, Stream must not be used
+
     // Request Headers Accumulation (Temporary before pushing EVT_HEADERS)
     Header* temp_headers_head;
     Header* temp_headers_tail;
-    
+
+    // Native request accumulation. Field names and values are gathered
+    // in head with offsets kept in fields, end_headers then lays them out
+    // the way Request_from_raw expects them: method, path, fields.
+    char* head;
+    size_t head_len;
+    size_t head_cap;
+    struct phr_header* fields;
+    size_t fields_len;
+    size_t fields_cap;
+    size_t method_off, method_len;
+    size_t path_off, path_len;
+    size_t authority_off, authority_len;
+    int has_host;
+    char* method;
+    char* path;
+    char* body;
+    size_t body_len;
+    size_t body_cap;
+
     // Response Streaming
     ResponseChunk* resp_head;
     ResponseChunk* resp_tail;
-    ResponseChunk* finished_head; // To hold chunks until FlushStream is done
+    ResponseChunk* finished_head; // To hold chunks until FlushConn has copied them
     int resp_fin; // If true, send EOF after chunks
-    
+    int resp_mapped; // a file chunk was queued, FlushConn looks for its slices
+    size_t resp_buffered; // bytes of resp_head to resp_tail nghttp3 has not read
+    int resp_blocked; // send_data saw resp_buffered above RESP_HIGH_WATER
+
+    // ASGI request body waiting for Stream.receive, bytes recv_off to
+    // recv_len of recv_buf
+    char* recv_buf;
+    size_t recv_off;
+    size_t recv_len;
+    size_t recv_cap;
+    int recv_fin; // 1 once the body ended, 2 once Stream.receive returned its end
+    int recv_paused; // receive disabled above RECV_HIGH_WATER
+    int recv_signaled; // EVT_BODY queued and the channel not found empty since
+
     int is_ctrl;
+
+    // WebTransport, see ReceiveStream
+    int wt; // WT_PENDING until the first bytes tell, then WT_NONE or WT_STREAM
+    uint8_t wt_prefix[16];
+    size_t wt_prefix_len;
+    int64_t session_id; // CONNECT stream of a WebTransport stream
+    int is_session; // extended CONNECT with :protocol webtransport
+    size_t wt_buffered; // session: bytes its streams have queued in MsQuic
+    int wt_blocked; // session: send_data saw wt_buffered above WT_HIGH_WATER
+    int dgram_queued; // datagrams handed to MsQuic and not sent yet
+
+    // Stream object Python holds, borrowed and only touched with the GIL
+    PyObject* handle;
+
+    StreamContext* prev;
+    StreamContext* next;
 };
 
 typedef struct {
     QUIC_BUFFER* Buffers;
     uint32_t BufferCount;
+    size_t Length;
+    ResponseChunk** Chunks; // mapped chunk of each buffer, NULL when all are owned
 } SendContext;
 
+// At least this much response data is queued in MsQuic per connection,
+// more when MsQuic reports a larger ideal send buffer for the path
+#define SEND_WINDOW (256 * 1024)
+
+// Largest DATA frame payload taken from a response chunk at once, so that
+// one big body cannot fill the send window by itself
+#define DATA_SLICE (64 * 1024)
+
+// Request body bytes an ASGI stream buffers before its receive is disabled,
+// the level at which Stream.receive enables it again, and the most one
+// http.request message carries. What arrives in between is merged.
+#define RECV_HIGH_WATER (256 * 1024)
+#define RECV_LOW_WATER (64 * 1024)
+#define RECV_CHUNK (64 * 1024)
+
 // --- Helpers ---
 
 void AddStreamContext(ConnectionContext* ctx, StreamContext* sctx) {
-    if (ctx->stream_count < 64) {
-        ctx->streams[ctx->stream_count++] = sctx;
-    }
+    sctx->prev = NULL;
+    sctx->next = ctx->streams;
+    if (ctx->streams) ctx->streams->prev = sctx;
+    ctx->streams = sctx;
+}
+
+void RemoveStreamContext(ConnectionContext* ctx, StreamContext* sctx) {
+    if (sctx->prev) sctx->prev->next = sctx->next;
+    else if (ctx->streams == sctx) ctx->streams = sctx->next;
+    else return;
+    if (sctx->next) sctx->next->prev = sctx->prev;
+    sctx->prev = sctx->next = NULL;
 }
 
 StreamContext* FindStreamContext(ConnectionContext* ctx, int64_t stream_id) {
-    for (int i = 0; i < ctx->stream_count; ++i) {
-        if (ctx->streams[i] && ctx->streams[i]->stream_id == stream_id) {
-            return ctx->streams[i];
+    for (StreamContext* sctx = ctx->streams; sctx; sctx = sctx->next) {
+        if (sctx->stream_id == stream_id) {
+            return sctx;
         }
     }
     return NULL;
 }
 
+// Request streams still running, the caller holds ctx->lock
+static int ActiveRequests(ConnectionContext* ctx) {
+    int count = 0;
+    for (StreamContext* sctx = ctx->streams; sctx; sctx = sctx->next) {
+        if (!sctx->is_uni && !sctx->closed) count++;
+    }
+    return count;
+}
+
 void FreeHeaders(Header* head) {
     while (head) {
         Header* next = head->next;
@@ -127,6 +367,34 @@ void FreeHeaders(Header* head) {
     }
 }
 
+static void ReleaseChunk(ResponseChunk* chunk) {
+    if (chunk->map) {
+        if (__atomic_sub_fetch(&chunk->refs, 1, __ATOMIC_ACQ_REL)) return;
+        munmap(chunk->map, chunk->map_len);
+    } else {
+        free(chunk->data);
+    }
+    free(chunk);
+}
+
+void FreeChunks(ResponseChunk* chunk) {
+    while (chunk) {
+        ResponseChunk* next = chunk->next;
+        ReleaseChunk(chunk);
+        chunk = next;
+    }
+}
+
+static void FreeSendContext(SendContext* sc) {
+    for (uint32_t i = 0; i < sc->BufferCount; ++i) {
+        if (sc->Chunks && sc->Chunks[i]) ReleaseChunk(sc->Chunks[i]);
+        else free(sc->Buffers[i].Buffer);
+    }
+    free(sc->Chunks);
+    free(sc->Buffers);
+    free(sc);
+}
+
 void AddTempHeader(StreamContext* sctx, uint8_t* name, size_t namelen, uint8_t* value, size_t valuelen) {
     Header* h = malloc(sizeof(Header));
     h->name = malloc(namelen + 1); memcpy(h->name, name, namelen); h->name[namelen] = 0;
@@ -134,7 +402,7 @@ void AddTempHeader(StreamContext* sctx, uint8_t* name, size_t namelen, uint8_t*
     h->value = malloc(valuelen + 1); memcpy(h->value, value, valuelen); h->value[valuelen] = 0;
     h->value_len = valuelen;
     h->next = NULL;
-    
+
     if (sctx->temp_headers_tail) {
         sctx->temp_headers_tail->next = h;
         sctx->temp_headers_tail = h;
@@ -143,9 +411,85 @@ void AddTempHeader(StreamContext* sctx, uint8_t* name, size_t namelen, uint8_t*
     }
 }
 
+static int GrowBuffer(void** buf, size_t* cap, size_t need, size_t item_size) {
+    if (need <= *cap) return 0;
+    size_t new_cap = *cap ? *cap * 2 : 16;
+    while (new_cap < need) new_cap *= 2;
+    void* new_buf = realloc(*buf, new_cap * item_size);
+    if (!new_buf) return -1;
+    *buf = new_buf;
+    *cap = new_cap;
+    return 0;
+}
+
+static int AppendBytes(char** buf, size_t* len, size_t* cap, const uint8_t* data, size_t data_len) {
+    if (GrowBuffer((void**)buf, cap, *len + data_len, 1) == -1) return -1;
+    memcpy(*buf + *len, data, data_len);
+    *len += data_len;
+    return 0;
+}
+
+// Free the native request state, the Request object keeps its own copy
+void FreeRequestData(StreamContext* sctx) {
+    free(sctx->head); sctx->head = NULL;
+    sctx->head_len = sctx->head_cap = 0;
+    free(sctx->fields); sctx->fields = NULL;
+    sctx->fields_len = sctx->fields_cap = 0;
+    free(sctx->body); sctx->body = NULL;
+    sctx->body_len = sctx->body_cap = 0;
+    sctx->method = sctx->path = NULL;
+}
+
+// --- Lifetimes ---
+//
+// Contexts are shared between MsQuic worker threads and the Python thread,
+// so they are reference counted. Once the MsQuic stream shuts down the
+// context is only marked closed, whoever drops the last reference frees it.
+
+static inline void ConnectionContext_incref(ConnectionContext* ctx) {
+    __atomic_add_fetch(&ctx->refs, 1, __ATOMIC_RELAXED);
+}
+
+static void ConnectionContext_decref(ConnectionContext* ctx) {
+    if (__atomic_sub_fetch(&ctx->refs, 1, __ATOMIC_ACQ_REL)) return;
+    // the last reference goes either in SHUTDOWN_COMPLETE or on the Python
+    // thread, both may close the handle
+    MsQuic->ConnectionClose(ctx->Handle);
+    pthread_mutex_destroy(&ctx->lock);
+    free(ctx);
+}
+
+static inline void StreamContext_incref(StreamContext* sctx) {
+    __atomic_add_fetch(&sctx->refs, 1, __ATOMIC_RELAXED);
+}
+
+static void StreamContext_decref(StreamContext* sctx) {
+    if (__atomic_sub_fetch(&sctx->refs, 1, __ATOMIC_ACQ_REL)) return;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    FreeHeaders(sctx->temp_headers_head);
+    FreeRequestData(sctx);
+    FreeChunks(sctx->resp_head);
+    FreeChunks(sctx->finished_head);
+    free(sctx->recv_buf);
+    free(sctx);
+    ConnectionContext_decref(ctx);
+}
+
+static StreamContext* StreamContext_new(ConnectionContext* ctx) {
+    StreamContext* sctx = calloc(1, sizeof(StreamContext));
+    if (!sctx) return NULL;
+    sctx->refs = 1;
+    sctx->conn_ctx = ctx;
+    ConnectionContext_incref(ctx);
+    return sctx;
+}
+
 // Push Event to Queue
 void PushEvent(QuicServer* server, PendingEvent* evt) {
+    StreamContext_incref(evt->sctx);
+
     pthread_mutex_lock(&server->pending_lock);
+    int was_empty = server->pending_head == NULL;
     if (server->pending_tail) {
         server->pending_tail->next = evt;
         server->pending_tail = evt;
@@ -153,22 +497,31 @@ void PushEvent(QuicServer* server, PendingEvent* evt) {
         server->pending_head = server->pending_tail = evt;
     }
     pthread_mutex_unlock(&server->pending_lock);
-    
-    // Wake up Python
-    PyGILState_STATE gstate = PyGILState_Ensure();
-    PyObject* method = PyObject_GetAttrString((PyObject*)server, "process_pending");
-    if (method) {
-        PyObject* res = PyObject_CallMethod(server->loop, "call_soon_threadsafe", "O", method);
-        if (res) {
-             Py_DECREF(res);
-        } else {
-             PyErr_Print();
+
+    // Wake up Python, once per batch
+    if (was_empty) {
+        uint64_t one = 1;
+        if (write(server->wakeup_fd, &one, sizeof(one)) != sizeof(one) && server->debug_mode) {
+            fprintf(stderr, "[DEBUG] wakeup write failed\n");
+            fflush(stderr);
         }
-        Py_DECREF(method);
-    } else {
-        PyErr_Print();
     }
-    PyGILState_Release(gstate);
+}
+
+static void PushSimpleEvent(StreamContext* sctx, EventType type) {
+    PendingEvent* evt = calloc(1, sizeof(PendingEvent));
+    if (!evt) return;
+    evt->type = type;
+    evt->sctx = sctx;
+    PushEvent(sctx->conn_ctx->server, evt);
+}
+
+// Wake Python once for whatever body arrives until Stream.receive finds the
+// channel empty. Called with ctx->lock held.
+static void SignalBody(StreamContext* sctx) {
+    if (sctx->recv_signaled) return;
+    sctx->recv_signaled = 1;
+    PushSimpleEvent(sctx, EVT_BODY);
 }
 
 // --- IO Logic ---
@@ -180,112 +533,282 @@ int64_t GetStreamID(HQUIC Stream) {
     return (int64_t)id;
 }
 
-void FlushConn(ConnectionContext* ctx) {
-    if (!ctx || !ctx->http3) return;
-    
-    HQUIC UniStreams[] = { ctx->CtrlStream, ctx->QEncStream, ctx->QDecStream };
-    
-    for (int i=0; i<3; ++i) {
-        if (!UniStreams[i]) continue;
-        int64_t sid = GetStreamID(UniStreams[i]);
-        
-        int loop_guard = 0;
-        for (;;) {
-            if (++loop_guard > 100) break;
-            nghttp3_vec vec[16];
-            int64_t id_out;
-            int fin_out;
-            nghttp3_ssize s = nghttp3_conn_writev_stream(ctx->http3, &id_out, &fin_out, vec, 16);
-            
-            if (s <= 0) break;
-            
-            HQUIC TargetStream = NULL;
-            if (id_out == GetStreamID(ctx->CtrlStream)) TargetStream = ctx->CtrlStream;
-            else if (id_out == GetStreamID(ctx->QEncStream)) TargetStream = ctx->QEncStream;
-            else if (id_out == GetStreamID(ctx->QDecStream)) TargetStream = ctx->QDecStream;
-            
-            if (TargetStream) {
-                QUIC_BUFFER* Buffers = malloc(sizeof(QUIC_BUFFER) * s);
-                size_t total_len = 0;
-                for(int j=0; j<s; ++j) {
-                     void* data = malloc(vec[j].len);
-                     memcpy(data, vec[j].base, vec[j].len);
-                     Buffers[j].Buffer = data;
-                     Buffers[j].Length = (uint32_t)vec[j].len;
-                     total_len += vec[j].len;
-                }
-                
-                if (total_len > 0) {
-                    nghttp3_conn_add_write_offset(ctx->http3, id_out, total_len);
-                    SendContext* sc = malloc(sizeof(SendContext));
-                    sc->Buffers = Buffers; sc->BufferCount = (uint32_t)s;
-                    MsQuic->StreamSend(TargetStream, Buffers, (uint32_t)s, QUIC_SEND_FLAG_NONE, sc);
-                } else {
-                    for(int j=0; j<s; ++j) free(Buffers[j].Buffer);
-                    free(Buffers);
-                }
-            }
+void FreeFinishedChunks(StreamContext* sctx) {
+    FreeChunks(sctx->finished_head);
+    sctx->finished_head = NULL;
+}
+
+// QUIC variable-length integers, RFC 9000 section 16. GetVarint returns 0
+// when len does not hold the whole integer.
+static size_t GetVarint(const uint8_t* p, size_t len, uint64_t* value) {
+    if (!len) return 0;
+    size_t n = (size_t)1 << (p[0] >> 6);
+    if (len < n) return 0;
+    uint64_t v = p[0] & 0x3f;
+    for (size_t i = 1; i < n; ++i) v = (v << 8) | p[i];
+    *value = v;
+    return n;
+}
+
+static size_t PutVarint(uint8_t* p, uint64_t v) {
+    if (v < 0x40) {
+        p[0] = (uint8_t)v;
+        return 1;
+    }
+    if (v < 0x4000) {
+        p[0] = 0x40 | (uint8_t)(v >> 8); p[1] = (uint8_t)v;
+        return 2;
+    }
+    if (v < 0x40000000) {
+        p[0] = 0x80 | (uint8_t)(v >> 24); p[1] = (uint8_t)(v >> 16);
+        p[2] = (uint8_t)(v >> 8); p[3] = (uint8_t)v;
+        return 4;
+    }
+    for (int i = 7; i >= 0; --i, v >>= 8) p[i] = (uint8_t)v;
+    p[0] |= 0xc0;
+    return 8;
+}
+
+// nghttp3 knows no WebTransport settings. Its first write on the control
+// stream is the stream type and the SETTINGS frame, which is rewritten here
+// with SETTINGS_WT_MAX_SESSIONS and the older SETTINGS_ENABLE_WEBTRANSPORT
+// added. Returns NULL to send the data unchanged.
+static uint8_t* ExtendSettings(const uint8_t* data, size_t len, uint64_t max_sessions, size_t* out_len) {
+    uint64_t stream_type, frame_type, frame_len;
+    size_t a, b, c;
+    uint8_t extra[32];
+    size_t extra_len = 0;
+
+    if (!(a = GetVarint(data, len, &stream_type)) || stream_type != 0x00) return NULL;
+    if (!(b = GetVarint(data + a, len - a, &frame_type)) || frame_type != 0x04) return NULL;
+    if (!(c = GetVarint(data + a + b, len - a - b, &frame_len))) return NULL;
+    size_t payload = a + b + c;
+    if (frame_len > len - payload) return NULL;
+
+    extra_len += PutVarint(extra + extra_len, H3_SETTINGS_WT_MAX_SESSIONS);
+    extra_len += PutVarint(extra + extra_len, max_sessions);
+    extra_len += PutVarint(extra + extra_len, H3_SETTINGS_ENABLE_WEBTRANSPORT);
+    extra_len += PutVarint(extra + extra_len, 1);
+
+    uint8_t* out = malloc(len + extra_len + 8);
+    if (!out) return NULL;
+
+    size_t off = a + b;
+    memcpy(out, data, off);
+    off += PutVarint(out + off, frame_len + extra_len);
+    memcpy(out + off, data + payload, frame_len);
+    off += frame_len;
+    memcpy(out + off, extra, extra_len);
+    off += extra_len;
+    memcpy(out + off, data + payload + frame_len, len - payload - frame_len);
+    off += len - payload - frame_len;
+
+    *out_len = off;
+    return out;
+}
+
+// File chunk of sctx whose data holds p, NULL when p is in owned memory.
+// Only chunks read_data took from are looked at: the one it is on and those
+// it finished, which are released after this flush.
+static ResponseChunk* MappedChunk(StreamContext* sctx, const uint8_t* p) {
+    ResponseChunk* lists[2] = { sctx->resp_head, sctx->finished_head };
+    for (int i = 0; i < 2; ++i) {
+        for (ResponseChunk* chunk = lists[i]; chunk; chunk = chunk->next) {
+            if (chunk->map && p >= (uint8_t*)chunk->data && p < (uint8_t*)chunk->data + chunk->len)
+                return chunk;
+            if (i == 0) break;
         }
     }
+    return NULL;
 }
 
-void FreeFinishedChunks(StreamContext* sctx) {
-    while (sctx->finished_head) {
-        ResponseChunk* next = sctx->finished_head->next;
-        free(sctx->finished_head->data);
-        free(sctx->finished_head);
-        sctx->finished_head = next;
-    }
-}
-
-void FlushStream(StreamContext* sctx) {
-     if (!sctx || !sctx->conn_ctx) return;
-     ConnectionContext* ctx = sctx->conn_ctx;
-     if (!ctx->http3) return;
-     
-     int loop_guard = 0;
-     for (;;) {
-        if (++loop_guard > 100) break;
+// Send what nghttp3 wrote for a request stream with the file slices in it
+// passed to MsQuic as they are, each buffer holding a reference to its
+// chunk until SEND_COMPLETE. The frame headers and other bytes between
+// them are copied, as FlushConn does for everything else. Returns -1 when
+// out of memory. Called with ctx->lock held.
+static int SendMapped(ConnectionContext* ctx, StreamContext* sctx, const nghttp3_vec* vec, size_t n, size_t total_len, int fin) {
+    SendContext* sc = calloc(1, sizeof(SendContext));
+    if (!sc) return -1;
+    sc->Buffers = calloc(n, sizeof(QUIC_BUFFER));
+    sc->Chunks = calloc(n, sizeof(ResponseChunk*));
+    if (!sc->Buffers || !sc->Chunks) goto error;
+
+    for (size_t j = 0; j < n;) {
+        uint32_t i = sc->BufferCount;
+        ResponseChunk* chunk = MappedChunk(sctx, vec[j].base);
+        if (chunk) {
+            __atomic_add_fetch(&chunk->refs, 1, __ATOMIC_RELAXED);
+            sc->Chunks[i] = chunk;
+            sc->Buffers[i].Buffer = vec[j].base;
+            sc->Buffers[i].Length = (uint32_t)vec[j].len;
+            sc->BufferCount++;
+            j++;
+            continue;
+        }
+
+        size_t end = j, len = 0;
+        while (end < n && (end == j || !MappedChunk(sctx, vec[end].base)))
+            len += vec[end++].len;
+        uint8_t* data = malloc(len ? len : 1);
+        if (!data) goto error;
+        sc->Buffers[i].Buffer = data;
+        sc->Buffers[i].Length = (uint32_t)len;
+        sc->BufferCount++;
+        for (; j < end; ++j) {
+            memcpy(data, vec[j].base, vec[j].len);
+            data += vec[j].len;
+        }
+    }
+    sc->Length = total_len;
+
+    ctx->inflight += total_len;
+    if (QUIC_FAILED(MsQuic->StreamSend(sctx->Stream, sc->Buffers, sc->BufferCount,
+            fin ? QUIC_SEND_FLAG_FIN : QUIC_SEND_FLAG_NONE, sc))) {
+        ctx->inflight -= total_len;
+        FreeSendContext(sc);
+    }
+    return 0;
+
+error:
+    FreeSendContext(sc);
+    return -1;
+}
+
+// Hand what nghttp3 has scheduled to MsQuic, in nghttp3's order: control
+// and QPACK streams first, then request streams by RFC 9218 urgency, round
+// robin between incremental streams of the same urgency. Only send_window
+// bytes are queued in MsQuic at a time, the rest stays in nghttp3 until
+// SEND_COMPLETE so a response that becomes ready later still overtakes a
+// large download. Called with ctx->lock held.
+void FlushConn(ConnectionContext* ctx) {
+    if (!ctx || !ctx->http3) return;
+
+    while (ctx->inflight < ctx->send_window) {
         nghttp3_vec vec[16];
         int64_t id_out;
         int fin_out;
         nghttp3_ssize s = nghttp3_conn_writev_stream(ctx->http3, &id_out, &fin_out, vec, 16);
-        if (s < 0) break;
+        if (s < 0 || id_out < 0) break;
         if (s == 0 && !fin_out) break;
-        
+
         HQUIC TargetStream = NULL;
-        if (id_out == sctx->stream_id) TargetStream = sctx->Stream;
-        else if (ctx->CtrlStream && id_out == GetStreamID(ctx->CtrlStream)) TargetStream = ctx->CtrlStream;
-        else if (ctx->QEncStream && id_out == GetStreamID(ctx->QEncStream)) TargetStream = ctx->QEncStream;
-        else if (ctx->QDecStream && id_out == GetStreamID(ctx->QDecStream)) TargetStream = ctx->QDecStream;
-        
-        if (TargetStream) {
-             QUIC_BUFFER* Buffers = malloc(sizeof(QUIC_BUFFER) * s);
-             size_t total_len = 0;
-             for(int j=0; j<s; ++j) {
-                 void* data = malloc(vec[j].len);
-                 memcpy(data, vec[j].base, vec[j].len);
-                 Buffers[j].Buffer = data;
-                 Buffers[j].Length = (uint32_t)vec[j].len;
-                 total_len += vec[j].len;
-             }
-             if (total_len > 0 || fin_out) {
-                 if (total_len > 0) nghttp3_conn_add_write_offset(ctx->http3, id_out, total_len);
-                 
-                 SendContext* sc = malloc(sizeof(SendContext));
-                 sc->Buffers = Buffers; sc->BufferCount = (uint32_t)s;
-                 MsQuic->StreamSend(TargetStream, Buffers, (uint32_t)s, (fin_out && TargetStream!=ctx->CtrlStream && TargetStream!=ctx->QEncStream && TargetStream!=ctx->QDecStream)?QUIC_SEND_FLAG_FIN:QUIC_SEND_FLAG_NONE, sc);
-             } else { 
-                 // s=0, fin_out=0 (already handled above), or total_len=0 but s>0?
-                 for(int j=0; j<s; ++j) free(Buffers[j].Buffer);
-                 free(Buffers); 
-             }
-        }
-        
-        // Clean up chunks that were consumed in this writev cycle
-        FreeFinishedChunks(sctx);
-     }
-     FreeFinishedChunks(sctx); // Ensure cleanup
+        StreamContext* sctx = NULL;
+        int is_uni = 1;
+        if (id_out == ctx->CtrlStreamId) TargetStream = ctx->CtrlStream;
+        else if (id_out == ctx->QEncStreamId) TargetStream = ctx->QEncStream;
+        else if (id_out == ctx->QDecStreamId) TargetStream = ctx->QDecStream;
+        else if ((sctx = FindStreamContext(ctx, id_out)) && !sctx->closed) {
+            TargetStream = sctx->Stream;
+            is_uni = 0;
+        }
+
+        size_t total_len = 0;
+        for (nghttp3_ssize j = 0; j < s; ++j) total_len += vec[j].len;
+
+        int mapped = 0;
+        if (TargetStream && sctx && sctx->resp_mapped) {
+            for (nghttp3_ssize j = 0; j < s && !mapped; ++j)
+                mapped = MappedChunk(sctx, vec[j].base) != NULL;
+        }
+
+        if (mapped) {
+            if (SendMapped(ctx, sctx, vec, (size_t)s, total_len, fin_out) == -1) break;
+        } else if (TargetStream && (total_len > 0 || fin_out)) {
+            SendContext* sc = malloc(sizeof(SendContext));
+            QUIC_BUFFER* Buffers = malloc(sizeof(QUIC_BUFFER));
+            uint8_t* data = malloc(total_len ? total_len : 1);
+            size_t send_len = total_len;
+            if (!sc || !Buffers || !data) {
+                free(sc); free(Buffers); free(data);
+                break;
+            }
+
+            // one allocation per send, Buffers[0] owns it
+            size_t offset = 0;
+            for (nghttp3_ssize j = 0; j < s; ++j) {
+                memcpy(data + offset, vec[j].base, vec[j].len);
+                offset += vec[j].len;
+            }
+
+            if (id_out == ctx->CtrlStreamId && !ctx->settings_sent) {
+                ctx->settings_sent = 1;
+                uint8_t* extended;
+                if (ctx->server->wt_max_sessions
+                        && (extended = ExtendSettings(data, total_len, ctx->server->wt_max_sessions, &send_len))) {
+                    free(data);
+                    data = extended;
+                }
+            }
+
+            Buffers[0].Buffer = data;
+            Buffers[0].Length = (uint32_t)send_len;
+            sc->Buffers = Buffers;
+            sc->BufferCount = 1;
+            sc->Length = send_len;
+            sc->Chunks = NULL;
+
+            ctx->inflight += send_len;
+            QUIC_STATUS Status = MsQuic->StreamSend(TargetStream, Buffers, 1,
+                (fin_out && !is_uni) ? QUIC_SEND_FLAG_FIN : QUIC_SEND_FLAG_NONE, sc);
+            if (QUIC_FAILED(Status)) {
+                ctx->inflight -= send_len;
+                free(data); free(Buffers); free(sc);
+            }
+        }
+
+        // data for a stream that is gone is dropped, nghttp3 still has to
+        // move past it
+        nghttp3_conn_add_write_offset(ctx->http3, id_out, total_len);
+        if (sctx) FreeFinishedChunks(sctx);
+    }
+}
+
+// Called with ctx->lock held
+static void AppendChunk(StreamContext* sctx, ResponseChunk* chunk) {
+    sctx->resp_buffered += chunk->len;
+    if (sctx->resp_tail) {
+        sctx->resp_tail->next = chunk;
+        sctx->resp_tail = chunk;
+    } else {
+        sctx->resp_head = sctx->resp_tail = chunk;
+    }
+}
+
+// Called with ctx->lock held
+int QueueChunk(StreamContext* sctx, const char* data, size_t len) {
+    ResponseChunk* chunk = calloc(1, sizeof(ResponseChunk));
+    if (!chunk) return -1;
+    chunk->data = malloc(len);
+    if (!chunk->data) { free(chunk); return -1; }
+    memcpy(chunk->data, data, len);
+    chunk->len = len;
+    AppendChunk(sctx, chunk);
+    return 0;
+}
+
+// A chunk of count bytes of fd from offset, mapped from the page cache
+// instead of read. NULL with errno set on failure.
+static ResponseChunk* MapFile(int fd, off_t offset, size_t count) {
+    static long page_size;
+    if (!page_size) page_size = sysconf(_SC_PAGESIZE);
+
+    ResponseChunk* chunk = calloc(1, sizeof(ResponseChunk));
+    if (!chunk) return NULL;
+
+    off_t start = offset - offset % page_size;
+    chunk->map_len = count + (size_t)(offset - start);
+    chunk->map = mmap(NULL, chunk->map_len, PROT_READ, MAP_SHARED, fd, start);
+    if (chunk->map == MAP_FAILED) {
+        free(chunk);
+        return NULL;
+    }
+    madvise(chunk->map, chunk->map_len, MADV_SEQUENTIAL);
+
+    chunk->data = (char*)chunk->map + (offset - start);
+    chunk->len = count;
+    chunk->refs = 1;
+    return chunk;
 }
 
 // --- nghttp3 Callbacks ---
@@ -294,33 +817,40 @@ nghttp3_ssize server_read_data(nghttp3_conn *conn, int64_t stream_id, nghttp3_ve
     ConnectionContext* ctx = (ConnectionContext*)user_data;
     StreamContext* sctx = stream_user_data ? (StreamContext*)stream_user_data : FindStreamContext(ctx, stream_id);
     if (!sctx) return NGHTTP3_ERR_CALLBACK_FAILURE;
-    
+
     if (veccnt < 1) return 0;
-    
+
     if (sctx->resp_head) {
         // We have data
         ResponseChunk* chunk = sctx->resp_head;
         size_t remaining = chunk->len - chunk->sent;
-        
+
+        if (remaining > DATA_SLICE) remaining = DATA_SLICE;
+
         vec[0].base = (uint8_t*)(chunk->data + chunk->sent);
         vec[0].len = remaining;
-        
+
         chunk->sent += remaining;
-        
+        sctx->resp_buffered -= remaining;
+        if (sctx->resp_blocked && sctx->resp_buffered <= RESP_LOW_WATER) {
+            sctx->resp_blocked = 0;
+            PushSimpleEvent(sctx, EVT_WRITABLE);
+        }
+
         if (chunk->sent >= chunk->len) {
             // Move to finished list instead of freeing immediately
             sctx->resp_head = chunk->next;
             if (!sctx->resp_head) sctx->resp_tail = NULL;
-            
+
             chunk->next = sctx->finished_head;
             sctx->finished_head = chunk;
         }
-        
+
         // If no more data AND fin is set
         if (!sctx->resp_head && sctx->resp_fin) {
              *pflags |= NGHTTP3_DATA_FLAG_EOF;
         }
-        
+
         return 1;
     } else {
         if (sctx->resp_fin) {
@@ -332,15 +862,108 @@ nghttp3_ssize server_read_data(nghttp3_conn *conn, int64_t stream_id, nghttp3_ve
     }
 }
 
+static int GatherField(StreamContext* sctx, int32_t token, nghttp3_vec n, nghttp3_vec v) {
+    size_t name_off = sctx->head_len;
+    if (AppendBytes(&sctx->head, &sctx->head_len, &sctx->head_cap, n.base, n.len) == -1) return -1;
+    size_t value_off = sctx->head_len;
+    if (AppendBytes(&sctx->head, &sctx->head_len, &sctx->head_cap, v.base, v.len) == -1) return -1;
+
+    switch (token) {
+    case NGHTTP3_QPACK_TOKEN__METHOD:
+        sctx->method_off = value_off; sctx->method_len = v.len;
+        return 0;
+    case NGHTTP3_QPACK_TOKEN__PATH:
+        sctx->path_off = value_off; sctx->path_len = v.len;
+        return 0;
+    case NGHTTP3_QPACK_TOKEN__AUTHORITY:
+        sctx->authority_off = value_off; sctx->authority_len = v.len;
+        return 0;
+    default:
+        if (n.len && n.base[0] == ':') return 0;
+        break;
+    }
+
+    if (n.len == 4 && strncasecmp((char*)n.base, "host", 4) == 0) sctx->has_host = 1;
+
+    if (GrowBuffer((void**)&sctx->fields, &sctx->fields_cap, sctx->fields_len + 2, sizeof(struct phr_header)) == -1) return -1;
+    // offsets for now, turned into pointers by ComposeRequest
+    struct phr_header* field = sctx->fields + sctx->fields_len++;
+    field->name = (const char*)(uintptr_t)name_off;
+    field->name_len = n.len;
+    field->value = (const char*)(uintptr_t)value_off;
+    field->value_len = v.len;
+    return 0;
+}
+
+// Lay out method, path and fields contiguously, :authority becomes Host
+static int ComposeRequest(StreamContext* sctx) {
+    if (!sctx->method_len || !sctx->path_len) return -1;
+
+    size_t total = sctx->method_len + sctx->path_len;
+    size_t num_fields = sctx->fields_len;
+    for (size_t i = 0; i < num_fields; ++i)
+        total += sctx->fields[i].name_len + sctx->fields[i].value_len;
+    int add_host = !sctx->has_host && sctx->authority_len;
+    if (add_host) {
+        total += 4 + sctx->authority_len;
+        if (GrowBuffer((void**)&sctx->fields, &sctx->fields_cap, num_fields + 1, sizeof(struct phr_header)) == -1) return -1;
+    }
+
+    char* buf = malloc(total ? total : 1);
+    if (!buf) return -1;
+    char* p = buf;
+
+#define put(off, len) memcpy(p, sctx->head + (off), len); p += len;
+
+    sctx->method = p; put(sctx->method_off, sctx->method_len)
+    sctx->path = p; put(sctx->path_off, sctx->path_len)
+
+    if (add_host) {
+        memmove(sctx->fields + 1, sctx->fields, num_fields * sizeof(struct phr_header));
+        sctx->fields[0].name = p;
+        sctx->fields[0].name_len = 4;
+        memcpy(p, "host", 4); p += 4;
+        sctx->fields[0].value = p;
+        sctx->fields[0].value_len = sctx->authority_len;
+        put(sctx->authority_off, sctx->authority_len)
+        sctx->fields_len = ++num_fields;
+    }
+
+    for (size_t i = add_host; i < num_fields; ++i) {
+        struct phr_header* field = sctx->fields + i;
+        size_t name_off = (size_t)(uintptr_t)field->name;
+        size_t value_off = (size_t)(uintptr_t)field->value;
+        field->name = p; put(name_off, field->name_len)
+        field->value = p; put(value_off, field->value_len)
+    }
+
+#undef put
+
+    free(sctx->head);
+    sctx->head = buf;
+    sctx->head_len = sctx->head_cap = total;
+    return 0;
+}
+
 int server_recv_header(nghttp3_conn *conn, int64_t stream_id, int32_t token, nghttp3_rcbuf *name, nghttp3_rcbuf *value, uint8_t flags, void *user_data, void *stream_user_data) {
     ConnectionContext* ctx = (ConnectionContext*)user_data;
     StreamContext* sctx = stream_user_data ? (StreamContext*)stream_user_data : FindStreamContext(ctx, stream_id);
     if (!sctx) return 0;
-    
+
     nghttp3_vec n = nghttp3_rcbuf_get_buf(name);
     nghttp3_vec v = nghttp3_rcbuf_get_buf(value);
+
+    if (token == NGHTTP3_QPACK_TOKEN__PROTOCOL && ctx->server->wt_max_sessions
+            && v.len == 12 && memcmp(v.base, "webtransport", 12) == 0)
+        sctx->is_session = 1;
+
+    if (ctx->server->native) {
+        if (GatherField(sctx, token, n, v) == -1) return NGHTTP3_ERR_CALLBACK_FAILURE;
+        return 0;
+    }
+
     AddTempHeader(sctx, n.base, n.len, v.base, v.len);
-    
+
     return 0;
 }
 
@@ -348,12 +971,17 @@ int server_recv_data(nghttp3_conn *conn, int64_t stream_id, const uint8_t *data,
     ConnectionContext* ctx = (ConnectionContext*)user_data;
     StreamContext* sctx = stream_user_data ? (StreamContext*)stream_user_data : FindStreamContext(ctx, stream_id);
     if (!sctx) return 0;
-    
-    // Check if we have pending headers first? 
-    // Usually headers come before data. 
-    // Assuming end_headers callback handles headers push. 
-    
-    if (datalen > 0) {
+
+    if (ctx->server->native) {
+        if (AppendBytes(&sctx->body, &sctx->body_len, &sctx->body_cap, data, datalen) == -1)
+            return NGHTTP3_ERR_CALLBACK_FAILURE;
+        return 0;
+    }
+
+    if (!datalen) return 0;
+
+    if (sctx->is_session) {
+        // capsules, Python ignores them
         PendingEvent* evt = calloc(1, sizeof(PendingEvent));
         evt->type = EVT_DATA;
         evt->sctx = sctx;
@@ -361,8 +989,25 @@ int server_recv_data(nghttp3_conn *conn, int64_t stream_id, const uint8_t *data,
         memcpy(evt->data, data, datalen);
         evt->len = datalen;
         PushEvent(ctx->server, evt);
+        return 0;
+    }
+
+    if (sctx->recv_off && sctx->recv_len + datalen > sctx->recv_cap) {
+        memmove(sctx->recv_buf, sctx->recv_buf + sctx->recv_off, sctx->recv_len - sctx->recv_off);
+        sctx->recv_len -= sctx->recv_off;
+        sctx->recv_off = 0;
+    }
+    if (AppendBytes(&sctx->recv_buf, &sctx->recv_len, &sctx->recv_cap, data, datalen) == -1)
+        return NGHTTP3_ERR_CALLBACK_FAILURE;
+
+    // MsQuic stops reading and with it the flow control credit of the
+    // stream, the peer is held back by what it may still send
+    if (!sctx->recv_paused && sctx->recv_len - sctx->recv_off >= RECV_HIGH_WATER) {
+        sctx->recv_paused = 1;
+        MsQuic->StreamReceiveSetEnabled(sctx->Stream, FALSE);
     }
-    
+
+    SignalBody(sctx);
     return 0;
 }
 
@@ -371,15 +1016,20 @@ int server_end_headers(nghttp3_conn *conn, int64_t stream_id, int fin, void *use
     StreamContext* sctx = stream_user_data ? (StreamContext*)stream_user_data : FindStreamContext(ctx, stream_id);
     if (!sctx) return 0;
 
+    if (ctx->server->native) {
+        if (ComposeRequest(sctx) == -1) return NGHTTP3_ERR_CALLBACK_FAILURE;
+        return 0;
+    }
+
     // Push HEADERS Event
     PendingEvent* evt = calloc(1, sizeof(PendingEvent));
     evt->type = EVT_HEADERS;
     evt->sctx = sctx;
     evt->headers = sctx->temp_headers_head;
-    
+
     // Clear temp pointers from sctx but Keep the list for the event
     sctx->temp_headers_head = sctx->temp_headers_tail = NULL;
-    
+
     PushEvent(ctx->server, evt);
     return 0;
 }
@@ -388,67 +1038,200 @@ int server_end_stream(nghttp3_conn *conn, int64_t stream_id, void *user_data, vo
     ConnectionContext* ctx = (ConnectionContext*)user_data;
     StreamContext* sctx = stream_user_data ? (StreamContext*)stream_user_data : FindStreamContext(ctx, stream_id);
     if (!sctx) return 0;
-    
+
+    if (ctx->server->native && !sctx->method) return 0;
+
+    if (!ctx->server->native && !sctx->is_session) {
+        sctx->recv_fin = 1;
+        SignalBody(sctx);
+        return 0;
+    }
+
     PendingEvent* evt = calloc(1, sizeof(PendingEvent));
-    evt->type = EVT_FIN;
+    evt->type = ctx->server->native ? EVT_REQUEST : EVT_FIN;
     evt->sctx = sctx;
     PushEvent(ctx->server, evt);
-    
+
     return 0;
 }
 
-const nghttp3_callbacks callbacks = { 
-    .recv_header = server_recv_header, 
+const nghttp3_callbacks callbacks = {
+    .recv_header = server_recv_header,
     .end_headers = server_end_headers,
     .recv_data = server_recv_data,
-    .end_stream = server_end_stream 
+    .end_stream = server_end_stream
 };
 
-// --- QUIC Callbacks (Same as before, simplified) ---
+// --- Receiving ---
 
-void FinalizeHttp3Setup(ConnectionContext* ctx) {
-    nghttp3_conn_bind_control_stream(ctx->http3, GetStreamID(ctx->CtrlStream));
-    nghttp3_conn_bind_qpack_streams(ctx->http3, GetStreamID(ctx->QEncStream), GetStreamID(ctx->QDecStream));
-    FlushConn(ctx);
-    ctx->is_ready = 1;
-    
-    // Re-enable receive on any streams that were deferred
-    for (int i = 0; i < ctx->stream_count; i++) {
-        if (ctx->streams[i]) {
-            MsQuic->StreamReceiveSetEnabled(ctx->streams[i]->Stream, TRUE);
+// Length of the WebTransport header a peer stream starts with (signal value
+// and session ID), 0 when more bytes are needed and -1 for HTTP/3 streams
+static int WebTransportHeader(const uint8_t* p, size_t len, int is_uni, int64_t* session_id) {
+    uint64_t type, id;
+    size_t n, m;
+
+    if (!(n = GetVarint(p, len, &type))) return 0;
+    if (type != (is_uni ? WT_UNI_STREAM : WT_BIDI_STREAM)) return -1;
+    if (!(m = GetVarint(p + n, len - n, &id))) return 0;
+
+    *session_id = (int64_t)id;
+    return (int)(n + m);
+}
+
+// WebTransport stream data goes to Python as one event per RECEIVE,
+// however MsQuic split it. skip bytes of Buffers[0] are already consumed.
+static void PushStreamData(StreamContext* sctx, const uint8_t* head, size_t head_len,
+                           const QUIC_BUFFER* Buffers, uint32_t BufferCount, size_t skip, int fin) {
+    size_t len = head_len - skip;
+    for (uint32_t i = 0; i < BufferCount; ++i) len += Buffers[i].Length;
+
+    if (len) {
+        PendingEvent* evt = calloc(1, sizeof(PendingEvent));
+        if (!evt || !(evt->data = malloc(len))) {
+            free(evt);
+            sctx->has_error = 1;
+            return;
         }
+        size_t off = 0;
+        if (head_len) {
+            memcpy(evt->data, head, head_len);
+            off = head_len;
+        }
+        for (uint32_t i = 0; i < BufferCount; ++i) {
+            size_t from = i ? 0 : skip;
+            memcpy(evt->data + off, Buffers[i].Buffer + from, Buffers[i].Length - from);
+            off += Buffers[i].Length - from;
+        }
+        evt->type = EVT_DATA;
+        evt->sctx = sctx;
+        evt->len = len;
+        PushEvent(sctx->conn_ctx->server, evt);
     }
+
+    if (fin) PushSimpleEvent(sctx, EVT_FIN);
 }
 
-_IRQL_requires_max_(DISPATCH_LEVEL)
-_Function_class_(QUIC_STREAM_CALLBACK)
-QUIC_STATUS QUIC_API ServerStreamCallback(_In_ HQUIC Stream, _In_opt_ void* Context, _Inout_ QUIC_STREAM_EVENT* Event) {
-    StreamContext* sctx = (StreamContext*)Context;
+static int ReadHttp3(StreamContext* sctx, const uint8_t* data, size_t len, int fin) {
     ConnectionContext* ctx = sctx->conn_ctx;
+    nghttp3_ssize rv = nghttp3_conn_read_stream(ctx->http3, sctx->stream_id, data, len, fin);
 
-    if (ctx->server->debug_mode) {
-        fprintf(stderr, "[DEBUG] Stream Event: Type=%d StreamID=%ld\n", Event->Type, (long)sctx->stream_id);
-        fflush(stderr);
+    if (rv < 0) {
+        if (ctx->server->debug_mode) {
+            fprintf(stderr, "[DEBUG] nghttp3_conn_read_stream error: %ld (stream=%ld). Stopping stream processing.\n",
+                (long)rv, (long)sctx->stream_id);
+            fflush(stderr);
+        }
+        // nghttp3 internal state for this stream is now undefined, stop
+        // processing it to prevent a crash
+        sctx->has_error = 1;
+        return -1;
     }
-    
-    switch (Event->Type) {
-    case QUIC_STREAM_EVENT_START_COMPLETE:
-        if (sctx->is_ctrl && QUIC_SUCCEEDED(Event->START_COMPLETE.Status)) {
-            pthread_mutex_lock(&ctx->lock);
-            ctx->streams_started_count++;
+
+    if (rv > 0 && sctx->stream_id % 4 == 0)
+        nghttp3_conn_set_stream_user_data(ctx->http3, sctx->stream_id, sctx);
+    return 0;
+}
+
+// Hand a RECEIVE event to nghttp3 or, for WebTransport streams, to Python.
+// Called with ctx->lock held.
+static void ReceiveStream(StreamContext* sctx, const QUIC_BUFFER* Buffers, uint32_t BufferCount, int fin) {
+    uint32_t i = 0;
+    size_t skip = 0; // bytes of Buffers[i] already consumed
+
+    if (sctx->wt == WT_PENDING) {
+        // gather the first bytes until they tell what the stream is
+        while (i < BufferCount && sctx->wt_prefix_len < sizeof(sctx->wt_prefix)) {
+            size_t n = Buffers[i].Length - skip;
+            size_t room = sizeof(sctx->wt_prefix) - sctx->wt_prefix_len;
+            if (n > room) n = room;
+            memcpy(sctx->wt_prefix + sctx->wt_prefix_len, Buffers[i].Buffer + skip, n);
+            sctx->wt_prefix_len += n;
+            skip += n;
+            if (skip == Buffers[i].Length) { i++; skip = 0; }
+        }
+
+        int64_t session_id = -1;
+        int header = WebTransportHeader(sctx->wt_prefix, sctx->wt_prefix_len, sctx->is_uni, &session_id);
+        if (header == 0 && !(fin && i == BufferCount)) return;
+
+        if (header > 0) {
+            sctx->wt = WT_STREAM;
+            sctx->session_id = session_id;
+            PushStreamData(sctx, sctx->wt_prefix + header, sctx->wt_prefix_len - header,
+                           Buffers + i, BufferCount - i, skip, fin);
+            return;
+        }
+
+        sctx->wt = WT_NONE;
+        if (ReadHttp3(sctx, sctx->wt_prefix, sctx->wt_prefix_len, fin && i == BufferCount) == -1) return;
+        if (i == BufferCount) return;
+    } else if (sctx->wt == WT_STREAM) {
+        PushStreamData(sctx, NULL, 0, Buffers, BufferCount, 0, fin);
+        return;
+    } else if (!BufferCount && fin) {
+        ReadHttp3(sctx, NULL, 0, 1);
+        return;
+    }
+
+    for (; i < BufferCount; ++i, skip = 0) {
+        int last = i == BufferCount - 1;
+        if (Buffers[i].Length == skip && !(last && fin)) continue;
+        if (ReadHttp3(sctx, Buffers[i].Buffer + skip, Buffers[i].Length - skip, last && fin) == -1) return;
+    }
+}
+
+// --- QUIC Callbacks (Same as before, simplified) ---
+
+void FinalizeHttp3Setup(ConnectionContext* ctx) {
+    ctx->CtrlStreamId = GetStreamID(ctx->CtrlStream);
+    ctx->QEncStreamId = GetStreamID(ctx->QEncStream);
+    ctx->QDecStreamId = GetStreamID(ctx->QDecStream);
+    nghttp3_conn_bind_control_stream(ctx->http3, ctx->CtrlStreamId);
+    nghttp3_conn_bind_qpack_streams(ctx->http3, ctx->QEncStreamId, ctx->QDecStreamId);
+    FlushConn(ctx);
+    ctx->is_ready = 1;
+
+    // Re-enable receive on any streams that were deferred
+    for (StreamContext* sctx = ctx->streams; sctx; sctx = sctx->next) {
+        MsQuic->StreamReceiveSetEnabled(sctx->Stream, TRUE);
+    }
+}
+
+_IRQL_requires_max_(DISPATCH_LEVEL)
+_Function_class_(QUIC_STREAM_CALLBACK)
+QUIC_STATUS QUIC_API ServerStreamCallback(_In_ HQUIC Stream, _In_opt_ void* Context, _Inout_ QUIC_STREAM_EVENT* Event) {
+    StreamContext* sctx = (StreamContext*)Context;
+    ConnectionContext* ctx = sctx->conn_ctx;
+
+    if (ctx->server->debug_mode) {
+        fprintf(stderr, "[DEBUG] Stream Event: Type=%d StreamID=%ld\n", Event->Type, (long)sctx->stream_id);
+        fflush(stderr);
+    }
+
+    switch (Event->Type) {
+    case QUIC_STREAM_EVENT_START_COMPLETE:
+        if (sctx->is_ctrl && QUIC_SUCCEEDED(Event->START_COMPLETE.Status)) {
+            pthread_mutex_lock(&ctx->lock);
+            ctx->streams_started_count++;
             if (ctx->streams_started_count == 3) FinalizeHttp3Setup(ctx);
             pthread_mutex_unlock(&ctx->lock);
+        } else if (sctx->wt == WT_STREAM) {
+            pthread_mutex_lock(&ctx->lock);
+            if (QUIC_SUCCEEDED(Event->START_COMPLETE.Status))
+                sctx->stream_id = (int64_t)Event->START_COMPLETE.ID;
+            pthread_mutex_unlock(&ctx->lock);
+            PushSimpleEvent(sctx, EVT_STARTED);
         }
         break;
     case QUIC_STREAM_EVENT_RECEIVE:
         pthread_mutex_lock(&ctx->lock);
         if (ctx->server->debug_mode) {
-            fprintf(stderr, "[DEBUG] Stream Receive: Len=%llu Flags=%08x Ready=%d StreamID=%ld\n", 
-                (unsigned long long)Event->RECEIVE.TotalBufferLength, 
+            fprintf(stderr, "[DEBUG] Stream Receive: Len=%llu Flags=%08x Ready=%d StreamID=%ld\n",
+                (unsigned long long)Event->RECEIVE.TotalBufferLength,
                 Event->RECEIVE.Flags, ctx->is_ready, (long)sctx->stream_id);
              fflush(stderr);
         }
-        
+
         // If stream already failed, ignore data
         if (sctx->has_error) {
             pthread_mutex_unlock(&ctx->lock);
@@ -456,50 +1239,10 @@ QUIC_STATUS QUIC_API ServerStreamCallback(_In_ HQUIC Stream, _In_opt_ void* Cont
         }
 
         if (ctx->is_ready && ctx->http3) {
-            int is_fin = (Event->RECEIVE.Flags & QUIC_RECEIVE_FLAG_FIN) ? 1 : 0;
-            int is_bidi = (sctx->stream_id % 4 == 0);
-            int first_read = 1;
-            
-            for(unsigned i=0; i<Event->RECEIVE.BufferCount; ++i) {
-                int last = (i == Event->RECEIVE.BufferCount - 1);
-                uint32_t buflen = Event->RECEIVE.Buffers[i].Length;
-                
-                // Skip zero-length buffers
-                if (buflen == 0) {
-                     // Check fin on zero-length last buffer
-                     if (last && is_fin) {
-                        nghttp3_conn_read_stream(ctx->http3, sctx->stream_id, NULL, 0, 1);
-                     }
-                     continue;
-                }
-                
-                int fin_flag = (last && is_fin) ? 1 : 0;
-                
-                nghttp3_ssize rv = nghttp3_conn_read_stream(ctx->http3, sctx->stream_id, 
-                    Event->RECEIVE.Buffers[i].Buffer, buflen, fin_flag);
-                
-                if (first_read && is_bidi && rv > 0) {
-                    nghttp3_conn_set_stream_user_data(ctx->http3, sctx->stream_id, sctx);
-                    first_read = 0;
-                }
-                
-                if (rv < 0) {
-                    if (ctx->server->debug_mode) {
-                        fprintf(stderr, "[DEBUG] nghttp3_conn_read_stream error: %ld (stream=%ld). Stopping stream processing.\n", 
-                            (long)rv, (long)sctx->stream_id);
-                        fflush(stderr);
-                    }
-                    // Mark stream as failed
-                    sctx->has_error = 1;
-                    
-                    // If it's the control stream, maybe we should close connection?
-                    // For now, just stop processing this stream to prevent crash.
-                    // nghttp3 internal state for this stream is now undefined.
-                    break;
-                }
-            }
+            ReceiveStream(sctx, Event->RECEIVE.Buffers, Event->RECEIVE.BufferCount,
+                (Event->RECEIVE.Flags & QUIC_RECEIVE_FLAG_FIN) != 0);
             if (!sctx->has_error) {
-                FlushStream(sctx);
+                FlushConn(ctx);
             }
         } else {
             // Not ready yet - tell MsQuic to hold the data and retry later
@@ -514,31 +1257,53 @@ QUIC_STATUS QUIC_API ServerStreamCallback(_In_ HQUIC Stream, _In_opt_ void* Cont
     case QUIC_STREAM_EVENT_SEND_COMPLETE:
         {
             SendContext* sc = (SendContext*)Event->SEND_COMPLETE.ClientContext;
-            if (sc) { 
-                for(uint32_t i=0; i<sc->BufferCount; ++i) free(sc->Buffers[i].Buffer);
-                free(sc->Buffers);
-                free(sc);
+            if (sc) {
+                // MsQuic never completes a send inside StreamSend, the lock
+                // is not held here
+                pthread_mutex_lock(&ctx->lock);
+                if (sctx->wt == WT_STREAM) {
+                    StreamContext* session = FindStreamContext(ctx, sctx->session_id);
+                    if (session) {
+                        session->wt_buffered -= sc->Length;
+                        if (session->wt_blocked && session->wt_buffered <= WT_LOW_WATER) {
+                            session->wt_blocked = 0;
+                            PushSimpleEvent(session, EVT_WRITABLE);
+                        }
+                    }
+                } else {
+                    int blocked = ctx->inflight >= ctx->send_window;
+                    ctx->inflight -= sc->Length;
+                    if (blocked && ctx->is_ready) FlushConn(ctx);
+                }
+                pthread_mutex_unlock(&ctx->lock);
+
+                FreeSendContext(sc);
             }
         }
         break;
+    case QUIC_STREAM_EVENT_IDEAL_SEND_BUFFER_SIZE:
+        pthread_mutex_lock(&ctx->lock);
+        if (Event->IDEAL_SEND_BUFFER_SIZE.ByteCount > ctx->send_window)
+            ctx->send_window = Event->IDEAL_SEND_BUFFER_SIZE.ByteCount;
+        pthread_mutex_unlock(&ctx->lock);
+        break;
     case QUIC_STREAM_EVENT_SHUTDOWN_COMPLETE:
-        FreeHeaders(sctx->temp_headers_head);
-        // Free Response Chunks
-        while(sctx->resp_head) {
-            ResponseChunk* next = sctx->resp_head->next;
-            free(sctx->resp_head->data);
-            free(sctx->resp_head);
-            sctx->resp_head = next;
-        }
-        // Free Finished Chunks
-        while(sctx->finished_head) {
-            ResponseChunk* next = sctx->finished_head->next;
-            free(sctx->finished_head->data);
-            free(sctx->finished_head);
-            sctx->finished_head = next;
-        }
-        free(sctx);
+        pthread_mutex_lock(&ctx->lock);
+        sctx->closed = 1;
+        RemoveStreamContext(ctx, sctx);
+        if (!sctx->is_ctrl && sctx->wt != WT_STREAM && sctx->stream_id % 4 == 0 && ctx->http3) {
+            nghttp3_conn_close_stream(ctx->http3, sctx->stream_id, NGHTTP3_H3_NO_ERROR);
+        }
+        FreeChunks(sctx->resp_head);
+        sctx->resp_head = sctx->resp_tail = NULL;
+        FreeFinishedChunks(sctx);
+        // an ASGI request still answering may wait for http.disconnect
+        int notify = sctx->is_session || (!ctx->server->native && !sctx->is_ctrl
+            && sctx->wt != WT_STREAM && sctx->stream_id % 4 == 0 && !sctx->resp_fin);
+        pthread_mutex_unlock(&ctx->lock);
+        if (notify) PushSimpleEvent(sctx, EVT_CLOSED);
         MsQuic->StreamClose(Stream);
+        StreamContext_decref(sctx);
         break;
     default: break;
     }
@@ -548,7 +1313,7 @@ QUIC_STATUS QUIC_API ServerStreamCallback(_In_ HQUIC Stream, _In_opt_ void* Cont
 _IRQL_requires_max_(DISPATCH_LEVEL)
 _Function_class_(QUIC_CONNECTION_CALLBACK)
 QUIC_STATUS QUIC_API ServerConnectionCallback(_In_ HQUIC Connection, _In_opt_ void* Context, _Inout_ QUIC_CONNECTION_EVENT* Event) {
-    ConnectionContext* ctx = (ConnectionContext*)Context; 
+    ConnectionContext* ctx = (ConnectionContext*)Context;
     if (ctx->server->debug_mode) {
         const char* type_str = "UNKNOWN";
         switch(Event->Type) {
@@ -562,10 +1327,10 @@ QUIC_STATUS QUIC_API ServerConnectionCallback(_In_ HQUIC Connection, _In_opt_ vo
             default: type_str = "OTHER"; break;
         }
         fprintf(stderr, "[DEBUG] Connection Event: %s (%d)\n", type_str, Event->Type);
-        
+
         if (Event->Type == QUIC_CONNECTION_EVENT_SHUTDOWN_INITIATED_BY_TRANSPORT) {
-             fprintf(stderr, "[DEBUG]   Status=0x%x ErrorCode=%llu\n", 
-                Event->SHUTDOWN_INITIATED_BY_TRANSPORT.Status, 
+             fprintf(stderr, "[DEBUG]   Status=0x%x ErrorCode=%llu\n",
+                Event->SHUTDOWN_INITIATED_BY_TRANSPORT.Status,
                 (unsigned long long)Event->SHUTDOWN_INITIATED_BY_TRANSPORT.ErrorCode);
         }
         fflush(stderr);
@@ -573,297 +1338,2073 @@ QUIC_STATUS QUIC_API ServerConnectionCallback(_In_ HQUIC Connection, _In_opt_ vo
     switch (Event->Type) {
     case QUIC_CONNECTION_EVENT_CONNECTED:
         pthread_mutex_lock(&ctx->lock);
-        nghttp3_settings settings; nghttp3_settings_default(&settings);
-        nghttp3_conn_server_new(&ctx->http3, &callbacks, &settings, nghttp3_mem_default(), ctx);
-        
-        StreamContext* ctrl = calloc(1, sizeof(StreamContext)); ctrl->conn_ctx = ctx; ctrl->is_ctrl = 1; ctrl->is_uni=1;
+        nghttp3_conn_server_new(&ctx->http3, &callbacks, &ctx->server->H3Settings, nghttp3_mem_default(), ctx);
+
+        StreamContext* ctrl = StreamContext_new(ctx); ctrl->is_ctrl = 1; ctrl->is_uni=1;
         MsQuic->StreamOpen(Connection, QUIC_STREAM_OPEN_FLAG_UNIDIRECTIONAL, ServerStreamCallback, ctrl, &ctx->CtrlStream);
         ctrl->Stream = ctx->CtrlStream;
         MsQuic->StreamStart(ctx->CtrlStream, QUIC_STREAM_START_FLAG_IMMEDIATE);
-        
-        StreamContext* enc = calloc(1, sizeof(StreamContext)); enc->conn_ctx = ctx; enc->is_ctrl = 1; enc->is_uni=1;
+
+        StreamContext* enc = StreamContext_new(ctx); enc->is_ctrl = 1; enc->is_uni=1;
         MsQuic->StreamOpen(Connection, QUIC_STREAM_OPEN_FLAG_UNIDIRECTIONAL, ServerStreamCallback, enc, &ctx->QEncStream);
         enc->Stream = ctx->QEncStream;
         MsQuic->StreamStart(ctx->QEncStream, QUIC_STREAM_START_FLAG_IMMEDIATE);
-        
-        StreamContext* dec = calloc(1, sizeof(StreamContext)); dec->conn_ctx = ctx; dec->is_ctrl = 1; dec->is_uni=1;
+
+        StreamContext* dec = StreamContext_new(ctx); dec->is_ctrl = 1; dec->is_uni=1;
         MsQuic->StreamOpen(Connection, QUIC_STREAM_OPEN_FLAG_UNIDIRECTIONAL, ServerStreamCallback, dec, &ctx->QDecStream);
         dec->Stream = ctx->QDecStream;
         MsQuic->StreamStart(ctx->QDecStream, QUIC_STREAM_START_FLAG_IMMEDIATE);
         pthread_mutex_unlock(&ctx->lock);
         break;
     case QUIC_CONNECTION_EVENT_SHUTDOWN_COMPLETE:
-        if (ctx) { 
-            if (ctx->http3) nghttp3_conn_del(ctx->http3); 
-            pthread_mutex_destroy(&ctx->lock);
-            free(ctx); 
-        }
-        MsQuic->ConnectionClose(Connection);
+        pthread_mutex_lock(&ctx->lock);
+        if (ctx->http3) nghttp3_conn_del(ctx->http3);
+        ctx->http3 = NULL;
+        ctx->Connection = NULL;
+        pthread_mutex_unlock(&ctx->lock);
+
+        pthread_mutex_lock(&ctx->server->conns_lock);
+        if (ctx->prev) ctx->prev->next = ctx->next;
+        else ctx->server->conns = ctx->next;
+        if (ctx->next) ctx->next->prev = ctx->prev;
+        pthread_mutex_unlock(&ctx->server->conns_lock);
+
+        ConnectionContext_decref(ctx);
         break;
     case QUIC_CONNECTION_EVENT_PEER_STREAM_STARTED:
         {
             int64_t id = 0;
             uint32_t len = sizeof(id);
             MsQuic->GetParam(Event->PEER_STREAM_STARTED.Stream, QUIC_PARAM_STREAM_ID, &len, &id);
-            
-            StreamContext* sctx = calloc(1, sizeof(StreamContext));
+
+            StreamContext* sctx = StreamContext_new(ctx);
             sctx->Stream = Event->PEER_STREAM_STARTED.Stream;
-            sctx->conn_ctx = ctx;
             sctx->stream_id = id;
-            
+            sctx->is_uni = (id & 0x2) != 0;
+            sctx->wt = ctx->server->wt_max_sessions && !ctx->server->native ? WT_PENDING : WT_NONE;
+
             pthread_mutex_lock(&ctx->lock);
             AddStreamContext(ctx, sctx);
+            // past the final GOAWAY the client retries elsewhere
+            int rejected = !sctx->is_uni && ctx->goaway == 2 && id > ctx->max_bidi_id;
+            if (!sctx->is_uni && !rejected && id > ctx->max_bidi_id) ctx->max_bidi_id = id;
+            if (rejected) sctx->has_error = 1;
             pthread_mutex_unlock(&ctx->lock);
-            
+
             MsQuic->SetCallbackHandler(Event->PEER_STREAM_STARTED.Stream, (void*)ServerStreamCallback, sctx);
+            if (rejected) {
+                MsQuic->StreamShutdown(Event->PEER_STREAM_STARTED.Stream,
+                    QUIC_STREAM_SHUTDOWN_FLAG_ABORT, NGHTTP3_H3_REQUEST_REJECTED);
+                break;
+            }
             MsQuic->StreamReceiveSetEnabled(Event->PEER_STREAM_STARTED.Stream, TRUE);
         }
         break;
+    case QUIC_CONNECTION_EVENT_LOCAL_ADDRESS_CHANGED:
+        pthread_mutex_lock(&ctx->lock);
+        ctx->LocalAddress = *Event->LOCAL_ADDRESS_CHANGED.Address;
+        pthread_mutex_unlock(&ctx->lock);
+        break;
+    case QUIC_CONNECTION_EVENT_PEER_ADDRESS_CHANGED:
+        pthread_mutex_lock(&ctx->lock);
+        ctx->RemoteAddress = *Event->PEER_ADDRESS_CHANGED.Address;
+        pthread_mutex_unlock(&ctx->lock);
+        break;
+    case QUIC_CONNECTION_EVENT_DATAGRAM_STATE_CHANGED:
+        pthread_mutex_lock(&ctx->lock);
+        ctx->dgram_max_len = Event->DATAGRAM_STATE_CHANGED.SendEnabled
+            ? Event->DATAGRAM_STATE_CHANGED.MaxSendLength : 0;
+        pthread_mutex_unlock(&ctx->lock);
+        break;
+    case QUIC_CONNECTION_EVENT_DATAGRAM_RECEIVED:
+        {
+            const QUIC_BUFFER* Buffer = Event->DATAGRAM_RECEIVED.Buffer;
+            uint64_t quarter_id;
+            size_t n = GetVarint(Buffer->Buffer, Buffer->Length, &quarter_id);
+            if (!n || ctx->server->native || quarter_id > INT64_MAX / 4) break;
+
+            pthread_mutex_lock(&ctx->lock);
+            StreamContext* sctx = FindStreamContext(ctx, (int64_t)quarter_id * 4);
+            PendingEvent* evt;
+            if (sctx && !sctx->closed && (evt = calloc(1, sizeof(PendingEvent)))) {
+                evt->type = EVT_DATAGRAM;
+                evt->sctx = sctx;
+                evt->len = Buffer->Length - n;
+                if ((evt->data = malloc(evt->len ? evt->len : 1))) {
+                    memcpy(evt->data, Buffer->Buffer + n, evt->len);
+                    PushEvent(ctx->server, evt);
+                } else {
+                    free(evt);
+                }
+            }
+            pthread_mutex_unlock(&ctx->lock);
+        }
+        break;
+    case QUIC_CONNECTION_EVENT_DATAGRAM_SEND_STATE_CHANGED:
+        {
+            DatagramContext* dc = (DatagramContext*)Event->DATAGRAM_SEND_STATE_CHANGED.ClientContext;
+            QUIC_DATAGRAM_SEND_STATE State = Event->DATAGRAM_SEND_STATE_CHANGED.State;
+            int final = QUIC_DATAGRAM_SEND_STATE_IS_FINAL(State);
+            if (!dc) break;
+
+            // the queue limit is about datagrams not on the wire yet
+            if (dc->queued && (State == QUIC_DATAGRAM_SEND_SENT || final)) {
+                pthread_mutex_lock(&ctx->lock);
+                dc->sctx->dgram_queued--;
+                dc->queued = 0;
+                pthread_mutex_unlock(&ctx->lock);
+            }
+            if (final) {
+                StreamContext_decref(dc->sctx);
+                free(dc);
+            }
+        }
+        break;
     default: break;
     }
     return QUIC_STATUS_SUCCESS;
 }
 
+static int SniMatch(SniEntry* entry, const char* name, size_t name_len) {
+    if (entry->server_name[0] == '*') {
+        // "*.example.com" matches "www.example.com" but not "example.com"
+        size_t suffix_len = entry->server_name_len - 1;
+        if (name_len <= suffix_len) return 0;
+        if (strncasecmp(name + name_len - suffix_len, entry->server_name + 1, suffix_len) != 0) return 0;
+        return memchr(name, '.', name_len - suffix_len) == NULL;
+    }
+    return entry->server_name_len == name_len && strncasecmp(name, entry->server_name, name_len) == 0;
+}
+
+static HQUIC SelectConfiguration(ListenerContext* lctx, const QUIC_NEW_CONNECTION_INFO* Info) {
+    QuicServer* server = lctx->server;
+    HQUIC Configuration = lctx->Configuration;
+
+    if (!Info->ServerName || !Info->ServerNameLength) return Configuration;
+
+    pthread_mutex_lock(&server->sni_lock);
+    for (SniEntry* entry = server->sni; entry; entry = entry->next) {
+        if (SniMatch(entry, Info->ServerName, Info->ServerNameLength)) {
+            Configuration = entry->Configuration;
+            // exact names win over wildcards
+            if (entry->server_name[0] != '*') break;
+        }
+    }
+    pthread_mutex_unlock(&server->sni_lock);
+
+    return Configuration;
+}
+
 QUIC_STATUS QUIC_API ServerListenerCallback(_In_ HQUIC Listener, _In_opt_ void* Context, _Inout_ QUIC_LISTENER_EVENT* Event) {
-    QuicServer* server = (QuicServer*)Context;
+    ListenerContext* lctx = (ListenerContext*)Context;
+    QuicServer* server = lctx->server;
     if (server->debug_mode) {
         fprintf(stderr, "[DEBUG] Listener Event: Type=%d\n", Event->Type);
         fflush(stderr);
     }
     if (Event->Type == QUIC_LISTENER_EVENT_NEW_CONNECTION) {
+        HQUIC Configuration = SelectConfiguration(lctx, Event->NEW_CONNECTION.Info);
+
         ConnectionContext* ctx = calloc(1, sizeof(ConnectionContext));
-        ctx->Connection = Event->NEW_CONNECTION.Connection;
+        if (!ctx) return QUIC_STATUS_OUT_OF_MEMORY;
+        ctx->refs = 1;
+        ctx->send_window = SEND_WINDOW;
+        ctx->Connection = ctx->Handle = Event->NEW_CONNECTION.Connection;
         ctx->server = server;
+        ctx->LocalAddress = *Event->NEW_CONNECTION.Info->LocalAddress;
+        ctx->RemoteAddress = *Event->NEW_CONNECTION.Info->RemoteAddress;
         pthread_mutex_init(&ctx->lock, NULL);
-        MsQuic->SetCallbackHandler(Event->NEW_CONNECTION.Connection, (void*)ServerConnectionCallback, ctx); 
-        MsQuic->ConnectionSetConfiguration(Event->NEW_CONNECTION.Connection, Configuration);
-        return QUIC_STATUS_SUCCESS;
+        MsQuic->SetCallbackHandler(Event->NEW_CONNECTION.Connection, (void*)ServerConnectionCallback, ctx);
+        QUIC_STATUS Status = MsQuic->ConnectionSetConfiguration(Event->NEW_CONNECTION.Connection, Configuration);
+        if (QUIC_FAILED(Status)) {
+            // rejected, MsQuic closes the connection without further events
+            pthread_mutex_destroy(&ctx->lock);
+            free(ctx);
+            return Status;
+        }
+
+        pthread_mutex_lock(&server->conns_lock);
+        ctx->next = server->conns;
+        if (server->conns) server->conns->prev = ctx;
+        server->conns = ctx;
+        pthread_mutex_unlock(&server->conns_lock);
+        return Status;
     }
     return QUIC_STATUS_SUCCESS;
 }
 
-// --- Python Methods ---
+// --- Stream handles ---
+//
+// Python only ever sees a StreamContext through a Stream which holds a
+// reference, so a handle outliving its stream is safe to use (sends are
+// dropped) and never dangles. The context points back at its Stream while
+// one is alive, every event of a request reuses the same object.
 
-static PyObject* QuicServer_process_pending(QuicServer* self, PyObject* args) {
-    pthread_mutex_lock(&self->pending_lock);
-    PendingEvent* head = self->pending_head;
-    self->pending_head = self->pending_tail = NULL;
-    pthread_mutex_unlock(&self->pending_lock);
-    
-    if (!head) return Py_None;
-    
-    while (head) {
-        PendingEvent* evt = head;
-        head = head->next;
-        
-        PyObject* stream_handle = PyCapsule_New(evt->sctx, "StreamContext", NULL);
-        
-        switch (evt->type) {
-        case EVT_HEADERS:
-            {
-                PyObject* headers_list = PyList_New(0);
-                Header* h = evt->headers;
-                while (h) {
-                    PyObject* tuple = PyTuple_New(2);
-                    PyTuple_SetItem(tuple, 0, PyBytes_FromStringAndSize(h->name, h->name_len));
-                    PyTuple_SetItem(tuple, 1, PyBytes_FromStringAndSize(h->value, h->value_len));
-                    PyList_Append(headers_list, tuple);
-                    Py_DECREF(tuple);
-                    h = h->next;
-                }
-                PyObject* res = PyObject_CallMethod((PyObject*)self, "on_headers", "OO", stream_handle, headers_list);
-                if (!res) PyErr_Print();
-                Py_XDECREF(res);
-                Py_DECREF(headers_list);
-                FreeHeaders(evt->headers);
-            }
-            break;
-        case EVT_DATA:
-            {
-                PyObject* data_obj = PyBytes_FromStringAndSize(evt->data, evt->len);
-                PyObject* res = PyObject_CallMethod((PyObject*)self, "on_data", "OO", stream_handle, data_obj);
-                if (!res) PyErr_Print();
-                Py_XDECREF(res);
-                Py_DECREF(data_obj);
-                free(evt->data);
-            }
-            break;
-        case EVT_FIN:
-            {
-                PyObject* res = PyObject_CallMethod((PyObject*)self, "on_fin", "O", stream_handle);
-                if (!res) PyErr_Print();
-                Py_XDECREF(res);
-            }
-            break;
-        }
-        Py_DECREF(stream_handle);
-        free(evt);
+typedef struct {
+    PyObject_HEAD
+    StreamContext* sctx;
+    PyObject* state; // whatever the server keeps per request
+} Stream;
+
+static PyTypeObject StreamType;
+
+static PyObject* Stream_new(StreamContext* sctx) {
+    Stream* self;
+
+    if (sctx->handle) {
+        Py_INCREF(sctx->handle);
+        return sctx->handle;
     }
-    Py_RETURN_NONE;
+
+    if (!(self = PyObject_GC_New(Stream, &StreamType)))
+        return NULL;
+
+    self->sctx = sctx;
+    StreamContext_incref(sctx);
+    self->state = Py_None;
+    Py_INCREF(Py_None);
+    sctx->handle = (PyObject*)self;
+
+    PyObject_GC_Track(self);
+    return (PyObject*)self;
 }
 
-static PyObject* QuicServer_send_headers(QuicServer* self, PyObject* args) {
-    PyObject* capsule;
-    PyObject* headers_list;
-    int fin;
-    if (!PyArg_ParseTuple(args, "OOp", &capsule, &headers_list, &fin)) return NULL;
-    
-    StreamContext* sctx = (StreamContext*)PyCapsule_GetPointer(capsule, "StreamContext");
-    if (!sctx) return NULL;
+static int Stream_traverse(Stream* self, visitproc visit, void* arg) {
+    Py_VISIT(self->state);
+    return 0;
+}
+
+static int Stream_clear(Stream* self) {
+    Py_CLEAR(self->state);
+    return 0;
+}
+
+static void Stream_dealloc(Stream* self) {
+    PyObject_GC_UnTrack(self);
+    self->sctx->handle = NULL;
+    Stream_clear(self);
+    StreamContext_decref(self->sctx);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// Credentials never go into the QPACK dynamic table where a later field
+// could probe them, everything else may when qpack_try_index is set
+static uint8_t NvFlags(QuicServer* server, const char* name, size_t name_len) {
+    if ((name_len == 10 && strncasecmp(name, "set-cookie", 10) == 0)
+        || (name_len == 13 && strncasecmp(name, "authorization", 13) == 0))
+        return NGHTTP3_NV_FLAG_NEVER_INDEX;
+
+#ifdef NGHTTP3_NV_FLAG_TRY_INDEX
+    if (server->qpack_try_index && name[0] != ':')
+        return NGHTTP3_NV_FLAG_TRY_INDEX;
+#endif
+
+    return NGHTTP3_NV_FLAG_NONE;
+}
+
+// A priority field in the response (RFC 9218 section 5) overrides what the
+// client asked for, parameters it leaves out keep the client's values.
+// Called with ctx->lock held.
+static void ApplyPriority(StreamContext* sctx, const nghttp3_nv* nva, size_t nvlen) {
     ConnectionContext* ctx = sctx->conn_ctx;
+    nghttp3_pri pri;
 
-    Py_BEGIN_ALLOW_THREADS
-    pthread_mutex_lock(&ctx->lock);
-    
-    Py_ssize_t len = PyList_Size(headers_list);
-    nghttp3_nv* nva = malloc(sizeof(nghttp3_nv) * len);
-    for (int i=0; i<len; ++i) {
-        PyObject* tuple = PyList_GetItem(headers_list, i);
-        nva[i].name = (uint8_t*)PyBytes_AsString(PyTuple_GetItem(tuple, 0));
-        nva[i].namelen = PyBytes_Size(PyTuple_GetItem(tuple, 0));
-        nva[i].value = (uint8_t*)PyBytes_AsString(PyTuple_GetItem(tuple, 1));
-        nva[i].valuelen = PyBytes_Size(PyTuple_GetItem(tuple, 1));
-        nva[i].flags = NGHTTP3_NV_FLAG_NONE;
-    }
-    
-    // Set response FIN if requested
-    if (fin) sctx->resp_fin = 1;
-    
-    nghttp3_data_reader dr; 
-    dr.read_data = server_read_data;
-    
-    nghttp3_conn_submit_response(ctx->http3, sctx->stream_id, nva, len, &dr);
-    free(nva);
-    FlushStream(sctx);
-    
-    pthread_mutex_unlock(&ctx->lock);
-    Py_END_ALLOW_THREADS
-    Py_RETURN_NONE;
+    for (size_t i = 0; i < nvlen; ++i) {
+        if (nva[i].namelen != 8 || strncasecmp((const char*)nva[i].name, "priority", 8) != 0)
+            continue;
+
+        if (nghttp3_conn_get_stream_priority(ctx->http3, &pri, sctx->stream_id) != 0)
+            return;
+        if (nghttp3_pri_parse_priority(&pri, nva[i].value, nva[i].valuelen) != 0)
+            return;
+
+        nghttp3_conn_set_server_stream_priority(ctx->http3, sctx->stream_id, &pri);
+        return;
+    }
 }
 
-static PyObject* QuicServer_send_data(QuicServer* self, PyObject* args) {
-    PyObject* capsule;
-    PyObject* data_obj;
-    int fin;
-    if (!PyArg_ParseTuple(args, "OOp", &capsule, &data_obj, &fin)) return NULL;
-    
-    StreamContext* sctx = (StreamContext*)PyCapsule_GetPointer(capsule, "StreamContext");
-    if (!sctx) return NULL;
+// Submit response HEADERS, an optional body and flush. Called with the GIL
+// held, MsQuic threads never wait for it so taking ctx->lock is safe.
+static int SubmitResponse(StreamContext* sctx, const nghttp3_nv* nva, size_t nvlen, const char* body, size_t body_len, int fin) {
     ConnectionContext* ctx = sctx->conn_ctx;
+    int rv = 0;
 
-    Py_BEGIN_ALLOW_THREADS
     pthread_mutex_lock(&ctx->lock);
+    if (sctx->closed || !ctx->http3) goto unlock; // peer is gone, response dropped
 
-    if (PyBytes_Check(data_obj)) {
-        char* buf; Py_ssize_t len;
-        PyBytes_AsStringAndSize(data_obj, &buf, &len);
-        if (len > 0) {
-            ResponseChunk* chunk = malloc(sizeof(ResponseChunk));
-            chunk->data = malloc(len);
-            memcpy(chunk->data, buf, len);
-            chunk->len = len;
-            chunk->sent = 0;
-            chunk->next = NULL;
-            
-            if (sctx->resp_tail) {
-                sctx->resp_tail->next = chunk;
-                sctx->resp_tail = chunk;
-            } else {
-                sctx->resp_head = sctx->resp_tail = chunk;
-            }
-        }
+    if (body_len && QueueChunk(sctx, body, body_len) == -1) {
+        rv = NGHTTP3_ERR_NOMEM;
+        goto unlock;
     }
-    
     if (fin) sctx->resp_fin = 1;
-    
-    nghttp3_conn_resume_stream(ctx->http3, sctx->stream_id);
-    FlushStream(sctx);
-    
+
+    ApplyPriority(sctx, nva, nvlen);
+
+    nghttp3_data_reader dr = { .read_data = server_read_data };
+    rv = nghttp3_conn_submit_response(ctx->http3, sctx->stream_id, nva, nvlen, (fin && !body_len) ? NULL : &dr);
+    if (rv == 0) FlushConn(ctx);
+
+    unlock:
     pthread_mutex_unlock(&ctx->lock);
-    Py_END_ALLOW_THREADS
-    Py_RETURN_NONE;
+    return rv;
 }
 
-static int QuicServer_init(QuicServer* self, PyObject* args, PyObject* kwds) {
-    PyObject *app, *loop;
-    int debug = 0;
-    static char *kwlist[] = {"app", "loop", "debug", NULL};
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|p", kwlist, &app, &loop, &debug)) return -1;
-    fprintf(stderr, "DEBUG: QuicServer_init debug=%d\n", debug); fflush(stderr);
-    Py_INCREF(app); self->app = app; 
-    Py_INCREF(loop); self->loop = loop;
-    self->debug_mode = debug;
-    self->Listener = NULL;
-    pthread_mutex_init(&self->pending_lock, NULL);
-    self->pending_head = self->pending_tail = NULL;
-    return 0;
+static void AbortStream(StreamContext* sctx, uint64_t error_code) {
+    ConnectionContext* ctx = sctx->conn_ctx;
+    pthread_mutex_lock(&ctx->lock);
+    if (!sctx->closed) MsQuic->StreamShutdown(sctx->Stream, QUIC_STREAM_SHUTDOWN_FLAG_ABORT, error_code);
+    pthread_mutex_unlock(&ctx->lock);
 }
 
-static void QuicServer_dealloc(QuicServer* self) {
-    if (self->Listener) { MsQuic->ListenerStop(self->Listener); MsQuic->ListenerClose(self->Listener); }
-    Py_XDECREF(self->app); Py_XDECREF(self->loop);
-    pthread_mutex_destroy(&self->pending_lock);
-    Py_TYPE(self)->tp_free((PyObject*)self);
+// --- Native dispatch ---
+
+#define Quic_catch_exception(request) \
+{ \
+    PyObject* etype; \
+    PyObject* evalue; \
+    PyObject* etraceback; \
+    \
+    PyErr_Fetch(&etype, &evalue, &etraceback); \
+    PyErr_NormalizeException(&etype, &evalue, &etraceback); \
+    if(etraceback) { \
+        PyException_SetTraceback(evalue, etraceback); \
+        Py_DECREF(etraceback); \
+    } \
+    Py_DECREF(etype); \
+    \
+    ((Request*)request)->exception = evalue; \
 }
 
-static PyObject* QuicServer_start(QuicServer* self, PyObject* args) {
-    char* host; int port;
-    if (!PyArg_ParseTuple(args, "si", &host, &port)) return NULL;
-    if (!MsQuic) {
-        MsQuicOpen2(&MsQuic);
-        MsQuic->RegistrationOpen(&RegConfig, &Registration);
-        QUIC_SETTINGS Settings = {0};
-        Settings.IdleTimeoutMs = 5000; Settings.IsSet.IdleTimeoutMs = TRUE;
-        Settings.IsSet.PeerBidiStreamCount = TRUE; Settings.PeerBidiStreamCount = 100;
-        Settings.IsSet.PeerUnidiStreamCount = TRUE; Settings.PeerUnidiStreamCount = 3;
-        MsQuic->ConfigurationOpen(Registration, AlpnBuffers, 2, &Settings, sizeof(Settings), NULL, &Configuration);
-        QUIC_CREDENTIAL_CONFIG CredConfig; memset(&CredConfig, 0, sizeof(CredConfig));
-        QUIC_CERTIFICATE_FILE CertFileParams = { .CertificateFile = "cert.pem", .PrivateKeyFile = "key.pem" };
-        CredConfig.Type = QUIC_CREDENTIAL_TYPE_CERTIFICATE_FILE; CredConfig.CertificateFile = &CertFileParams;
-        QUIC_STATUS Status = MsQuic->ConfigurationLoadCredential(Configuration, &CredConfig);
-        if (QUIC_FAILED(Status)) {
-            fprintf(stderr, "ERROR: ConfigurationLoadCredential failed: 0x%x\n", Status);
-            fflush(stderr);
+static QuicServer* QuicServer_write_response_or_err(QuicServer* self, StreamContext* sctx, PyObject* request, Response* response) {
+    QuicServer* result = self;
+    PyObject* error_result = NULL;
+    ResponseField* fields;
+    size_t fields_len;
+    const char* body;
+    size_t body_len;
+    nghttp3_nv inline_nva[32];
+    nghttp3_nv* nva = inline_nva;
+
+    if (response && Py_TYPE(response) != response_capi->ResponseType) {
+        PyErr_SetString(PyExc_ValueError, "View did not return Response instance");
+        Quic_catch_exception(request);
+        response = NULL;
+    }
+
+    if (!response) {
+        error_result = PyObject_CallFunctionObjArgs(
+            self->error_handler, request, ((Request*)request)->exception, NULL);
+        if (!error_result)
+            goto error;
+
+        ((Request*)request)->simple = false;
+        if (!QuicServer_write_response_or_err(self, sctx, request, (Response*)error_result))
+            goto error;
+
+        goto finally;
+    }
+
+    if (!(fields = response_capi->Response_render_fields(response, &fields_len, &body, &body_len)))
+        goto error;
+
+    PyObject* tmp;
+
+    PyObject* done_callbacks = ((Request*)request)->done_callbacks;
+    for (Py_ssize_t i = 0; done_callbacks && i < PyList_GET_SIZE(done_callbacks); i++) {
+        PyObject* callback = PyList_GET_ITEM(done_callbacks, i);
+
+        if (!(tmp = PyObject_CallFunctionObjArgs(callback, request, NULL)))
+            goto error;
+        Py_DECREF(tmp);
+    }
+
+    if (fields_len > sizeof(inline_nva) / sizeof(inline_nva[0])) {
+        if (!(nva = malloc(sizeof(nghttp3_nv) * fields_len))) {
+            PyErr_NoMemory();
+            goto error;
         }
     }
-    MsQuic->ListenerOpen(Registration, ServerListenerCallback, self, &self->Listener);
-    QUIC_ADDR Address = {0};
-    Address.Ipv4.sin_family = QUIC_ADDRESS_FAMILY_INET; 
-    Address.Ipv4.sin_port = htons(port);
-    Address.Ipv4.sin_addr.s_addr = htonl(INADDR_LOOPBACK);
-    MsQuic->ListenerStart(self->Listener, AlpnBuffers, 2, &Address);
-    Py_RETURN_NONE;
+
+    for (size_t i = 0; i < fields_len; ++i) {
+        nva[i].name = (const uint8_t*)fields[i].name;
+        nva[i].namelen = fields[i].name_len;
+        nva[i].value = (const uint8_t*)fields[i].value;
+        nva[i].valuelen = fields[i].value_len;
+        nva[i].flags = NvFlags(self, fields[i].name, fields[i].name_len);
+    }
+
+    int rv = SubmitResponse(sctx, nva, fields_len, body, body_len, 1);
+    if (rv != 0) {
+        PyErr_Format(PyExc_RuntimeError, "nghttp3_conn_submit_response: %s", nghttp3_strerror(rv));
+        goto error;
+    }
+
+    if (self->request_logger) {
+        if (!(tmp = PyObject_CallFunctionObjArgs(self->request_logger, request, NULL)))
+            goto error;
+        Py_DECREF(tmp);
+    }
+
+    goto finally;
+
+    error:
+    result = NULL;
+
+    finally:
+    if (nva != inline_nva)
+        free(nva);
+    Py_XDECREF(error_result);
+    return result;
 }
 
-static PyObject* QuicServer_get_stream_id(QuicServer* self, PyObject* args) {
-    PyObject* capsule;
-    if (!PyArg_ParseTuple(args, "O", &capsule)) return NULL;
-    StreamContext* sctx = (StreamContext*)PyCapsule_GetPointer(capsule, "StreamContext");
-    if (!sctx) return NULL;
-    return PyLong_FromLongLong(sctx->stream_id);
+static PyObject* QuicServer__task_done(PyObject* bound, PyObject* task) {
+    QuicServer* self = (QuicServer*)PyTuple_GET_ITEM(bound, 0);
+    PyObject* handle = PyTuple_GET_ITEM(bound, 1);
+    PyObject* request = PyTuple_GET_ITEM(bound, 2);
+    PyObject* get_result = NULL;
+    PyObject* response = NULL;
+
+    StreamContext* sctx = ((Stream*)handle)->sctx;
+
+    if (!(get_result = PyObject_GetAttrString(task, "result")))
+        goto error;
+
+    if (!(response = PyObject_CallFunctionObjArgs(get_result, NULL)))
+        Quic_catch_exception(request);
+
+    if (!QuicServer_write_response_or_err(self, sctx, request, (Response*)response))
+        goto error;
+
+    goto finally;
+
+    error:
+    PyErr_Print();
+    AbortStream(sctx, NGHTTP3_H3_INTERNAL_ERROR);
+
+    finally:
+    // important: this breaks a cycle in case of an exception
+    Py_CLEAR(((Request*)request)->exception);
+    Py_XDECREF(response);
+    Py_XDECREF(get_result);
+    Py_RETURN_NONE;
 }
 
-static PyMethodDef QuicServer_methods[] = { 
-    {"start", (PyCFunction)QuicServer_start, METH_VARARGS, ""}, 
-    {"get_stream_id", (PyCFunction)QuicServer_get_stream_id, METH_VARARGS, ""},
-    {"send_headers", (PyCFunction)QuicServer_send_headers, METH_VARARGS, ""},
-    {"send_data", (PyCFunction)QuicServer_send_data, METH_VARARGS, ""},
-    {"process_pending", (PyCFunction)QuicServer_process_pending, METH_VARARGS, ""},
-    {NULL} 
+static PyMethodDef QuicServer__task_done_def = {
+    "_task_done", (PyCFunction)QuicServer__task_done, METH_O, ""
 };
 
-static PyTypeObject QuicServerType = {
-    PyVarObject_HEAD_INIT(NULL, 0) "cquic.QuicServer", sizeof(QuicServer), 0, (destructor)QuicServer_dealloc,
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,"QuicServer",0,0,0,0,0,0,QuicServer_methods, 0,0,0,0,0,0,0, (initproc)QuicServer_init, 0, PyType_GenericNew,
-};
+static QuicServer* QuicServer_handle_coro(QuicServer* self, StreamContext* sctx, PyObject* request, PyObject* coro) {
+    QuicServer* result = self;
+    PyObject* task = NULL;
+    PyObject* handle = NULL;
+    PyObject* bound = NULL;
+    PyObject* done = NULL;
+    PyObject* tmp = NULL;
 
-static PyModuleDef cquic = { PyModuleDef_HEAD_INIT, "cquic", "", -1, NULL, NULL, NULL, NULL, NULL };
+    if (!(task = PyObject_CallFunctionObjArgs(self->create_task, coro, NULL)))
+        goto error;
 
-PyMODINIT_FUNC PyInit_cquic(void) {
-    PyObject* m;
-    if (PyType_Ready(&QuicServerType) < 0) return NULL;
-    m = PyModule_Create(&cquic);
-    Py_INCREF(&QuicServerType);
-    PyModule_AddObject(m, "QuicServer", (PyObject*)&QuicServerType);
+    if (!(handle = Stream_new(sctx)))
+        goto error;
+
+    if (!(bound = PyTuple_Pack(3, (PyObject*)self, handle, request)))
+        goto error;
+
+    if (!(done = PyCFunction_New(&QuicServer__task_done_def, bound)))
+        goto error;
+
+    if (!(tmp = PyObject_CallMethod(task, "add_done_callback", "O", done)))
+        goto error;
+
+    goto finally;
+
+    error:
+    result = NULL;
+
+    finally:
+    Py_XDECREF(tmp);
+    Py_XDECREF(done);
+    Py_XDECREF(bound);
+    Py_XDECREF(handle);
+    Py_XDECREF(task);
+    return result;
+}
+
+// Same flow as Protocol_on_body: match, call the handler, write the
+// response or hand the coroutine to a task that writes it when done.
+static void QuicServer_dispatch(QuicServer* self, StreamContext* sctx) {
+    PyObject* request = NULL;
+    PyObject* handler_result = NULL;
+    MatchDictEntry* entries;
+    MatcherEntry* matcher_entry;
+    size_t entries_length;
+
+    if (!(request = request_capi->RequestType->tp_new(request_capi->RequestType, NULL, NULL)))
+        goto error;
+
+    request_capi->Request_from_raw(
+        (Request*)request, sctx->method, sctx->method_len,
+        sctx->path, sctx->path_len, 1, sctx->fields, sctx->fields_len);
+
+    matcher_entry = matcher_capi->Matcher_match_request(
+        (Matcher*)self->matcher, request, &entries, &entries_length);
+
+    request_capi->Request_set_match_dict_entries(
+        (Request*)request, entries, entries_length);
+
+    request_capi->Request_set_body((Request*)request, sctx->body, sctx->body_len);
+
+    // the request holds its own copy now
+    FreeRequestData(sctx);
+
+    ((Request*)request)->simple = matcher_entry && matcher_entry->simple;
+
+    ((Request*)request)->transport = Py_None;
+    Py_INCREF(Py_None);
+
+    ((Request*)request)->app = self->app;
+    Py_INCREF(self->app);
+
+    ((Request*)request)->matcher_entry = matcher_entry;
+
+    if (!matcher_entry) {
+        if (!(((Request*)request)->exception = PyObject_CallFunctionObjArgs(
+            RouteNotFoundException, NULL)))
+            goto error;
+
+        goto write;
+    }
+
+    if (!(handler_result = PyObject_CallFunctionObjArgs(
+        matcher_entry->handler, request, NULL))) {
+        Quic_catch_exception(request);
+        goto write;
+    }
+
+    if (matcher_entry->coro_func) {
+        if (!QuicServer_handle_coro(self, sctx, request, handler_result))
+            goto error;
+
+        goto finally;
+    }
+
+    write:
+
+    if (!QuicServer_write_response_or_err(self, sctx, request, (Response*)handler_result))
+        goto error;
+
+    goto finally;
+
+    error:
+    PyErr_Print();
+    AbortStream(sctx, NGHTTP3_H3_INTERNAL_ERROR);
+
+    finally:
+    if (request)
+        Py_CLEAR(((Request*)request)->exception);
+    Py_XDECREF(handler_result);
+    Py_XDECREF(request);
+}
+
+// --- Python Methods ---
+
+// --- ASGI scope ---
+//
+// Scopes are copies of ScopeTemplate with the request filled in. Keys and
+// common methods are interned strings, common field names shared bytes
+// objects, so a request costs its values and little else.
+
+static PyObject* ScopeTemplate;
+static PyObject* str_type;
+static PyObject* str_webtransport;
+static PyObject* str_method;
+static PyObject* str_path;
+static PyObject* str_raw_path;
+static PyObject* str_query_string;
+static PyObject* str_scheme;
+static PyObject* str_headers;
+static PyObject* str_server;
+static PyObject* str_client;
+
+static const char* const Methods[] = {
+    "GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS", "CONNECT"
+};
+static PyObject* MethodStrings[sizeof(Methods) / sizeof(Methods[0])];
+
+static const char* const FieldNames[] = {
+    "accept", "accept-encoding", "accept-language", "authorization",
+    "cache-control", "content-encoding", "content-length", "content-type",
+    "cookie", "host", "if-match", "if-modified-since", "if-none-match",
+    "origin", "pragma", "priority", "range", "referer", "sec-fetch-dest",
+    "sec-fetch-mode", "sec-fetch-site", "sec-fetch-user", "sec-websocket-protocol",
+    "te", "upgrade-insecure-requests", "user-agent", "x-forwarded-for",
+    "x-forwarded-proto", "x-real-ip", "x-request-id"
+};
+
+// open addressing over FieldNames, never more than a quarter full
+#define FIELD_NAME_SLOTS 128
+static PyObject* FieldNameSlots[FIELD_NAME_SLOTS];
+
+static size_t FieldNameHash(const char* name, size_t len) {
+    uint32_t hash = 2166136261u;
+    for (size_t i = 0; i < len; ++i) hash = (hash ^ (uint8_t)name[i]) * 16777619u;
+    return hash & (FIELD_NAME_SLOTS - 1);
+}
+
+static PyObject* FieldName(const char* name, size_t len) {
+    for (size_t slot = FieldNameHash(name, len); FieldNameSlots[slot]; slot = (slot + 1) & (FIELD_NAME_SLOTS - 1)) {
+        PyObject* cached = FieldNameSlots[slot];
+        if ((size_t)PyBytes_GET_SIZE(cached) == len && memcmp(PyBytes_AS_STRING(cached), name, len) == 0) {
+            Py_INCREF(cached);
+            return cached;
+        }
+    }
+    return PyBytes_FromStringAndSize(name, len);
+}
+
+static PyObject* MethodString(const char* method, size_t len) {
+    for (size_t i = 0; i < sizeof(Methods) / sizeof(Methods[0]); ++i) {
+        if (strlen(Methods[i]) == len && memcmp(Methods[i], method, len) == 0) {
+            Py_INCREF(MethodStrings[i]);
+            return MethodStrings[i];
+        }
+    }
+    return PyUnicode_DecodeLatin1(method, len, NULL);
+}
+
+static int HexDigit(char c) {
+    if (c >= '0' && c <= '9') return c - '0';
+    if (c >= 'a' && c <= 'f') return c - 'a' + 10;
+    if (c >= 'A' && c <= 'F') return c - 'A' + 10;
+    return -1;
+}
+
+// The ASGI path: percent-decoded, then UTF-8 with bad sequences replaced
+static PyObject* DecodePath(const char* path, size_t len) {
+    if (!memchr(path, '%', len)) return PyUnicode_DecodeUTF8(path, len, "replace");
+
+    char* buf = malloc(len);
+    if (!buf) return PyErr_NoMemory();
+
+    size_t n = 0;
+    for (size_t i = 0; i < len; ++i) {
+        int hi, lo;
+        if (path[i] == '%' && i + 2 < len && (hi = HexDigit(path[i + 1])) >= 0
+                && (lo = HexDigit(path[i + 2])) >= 0) {
+            buf[n++] = (char)(hi << 4 | lo);
+            i += 2;
+        } else {
+            buf[n++] = path[i];
+        }
+    }
+
+    PyObject* result = PyUnicode_DecodeUTF8(buf, n, "replace");
+    free(buf);
+    return result;
+}
+
+static PyObject* AddressToTuple(const QUIC_ADDR* Address);
+
+#define FIELD_IS(h, literal) \
+    ((h)->name_len == sizeof(literal) - 1 && memcmp((h)->name, literal, sizeof(literal) - 1) == 0)
+
+// Pseudo-header fields go into the scope and out of its headers,
+// :authority becomes host when the request has none
+static PyObject* BuildScope(StreamContext* sctx, Header* fields) {
+    ConnectionContext* ctx = sctx->conn_ctx;
+    Header *method = NULL, *path = NULL, *scheme = NULL, *authority = NULL;
+    PyObject *scope = NULL, *headers = NULL, *value = NULL;
+    Py_ssize_t count = 0;
+    int has_host = 0;
+    QUIC_ADDR Local, Remote;
+
+    for (Header* h = fields; h; h = h->next) {
+        if (h->name_len && h->name[0] == ':') {
+            if (FIELD_IS(h, ":method")) method = h;
+            else if (FIELD_IS(h, ":path")) path = h;
+            else if (FIELD_IS(h, ":scheme")) scheme = h;
+            else if (FIELD_IS(h, ":authority")) authority = h;
+            continue;
+        }
+        if (FIELD_IS(h, "host")) has_host = 1;
+        count++;
+    }
+
+    int add_host = authority && !has_host;
+    if (!(headers = PyList_New(count + add_host))) goto error;
+    count = 0;
+    if (add_host) {
+        if (!(value = Py_BuildValue("(Ny#)", FieldName("host", 4), authority->value, (Py_ssize_t)authority->value_len))) goto error;
+        PyList_SET_ITEM(headers, count++, value);
+        value = NULL; // owned by headers now
+    }
+    for (Header* h = fields; h; h = h->next) {
+        if (h->name_len && h->name[0] == ':') continue;
+        if (!(value = Py_BuildValue("(Ny#)", FieldName(h->name, h->name_len), h->value, (Py_ssize_t)h->value_len))) goto error;
+        PyList_SET_ITEM(headers, count++, value);
+        value = NULL;
+    }
+
+    if (!(scope = PyDict_Copy(ScopeTemplate))) goto error;
+    if (PyDict_SetItem(scope, str_headers, headers) == -1) goto error;
+    if (sctx->is_session && PyDict_SetItem(scope, str_type, str_webtransport) == -1) goto error;
+
+    value = method ? MethodString(method->value, method->value_len) : MethodString("GET", 3);
+    if (!value || PyDict_SetItem(scope, str_method, value) == -1) goto error;
+    Py_CLEAR(value);
+
+    const char* target = path ? path->value : "/";
+    size_t target_len = path ? path->value_len : 1;
+    const char* query = memchr(target, '?', target_len);
+    size_t path_len = query ? (size_t)(query - target) : target_len;
+
+    if (!(value = DecodePath(target, path_len)) || PyDict_SetItem(scope, str_path, value) == -1) goto error;
+    Py_CLEAR(value);
+    if (!(value = PyBytes_FromStringAndSize(target, path_len)) || PyDict_SetItem(scope, str_raw_path, value) == -1) goto error;
+    Py_CLEAR(value);
+    if (query) {
+        value = PyBytes_FromStringAndSize(query + 1, target_len - path_len - 1);
+        if (!value || PyDict_SetItem(scope, str_query_string, value) == -1) goto error;
+        Py_CLEAR(value);
+    }
+
+    if (scheme && !(scheme->value_len == 5 && memcmp(scheme->value, "https", 5) == 0)) {
+        value = PyUnicode_DecodeLatin1(scheme->value, scheme->value_len, NULL);
+        if (!value || PyDict_SetItem(scope, str_scheme, value) == -1) goto error;
+        Py_CLEAR(value);
+    }
+
+    pthread_mutex_lock(&ctx->lock);
+    Local = ctx->LocalAddress;
+    Remote = ctx->RemoteAddress;
+    pthread_mutex_unlock(&ctx->lock);
+
+    if (!(value = AddressToTuple(&Local)) || PyDict_SetItem(scope, str_server, value) == -1) goto error;
+    Py_CLEAR(value);
+    if (!(value = AddressToTuple(&Remote)) || PyDict_SetItem(scope, str_client, value) == -1) goto error;
+    Py_CLEAR(value);
+
+    goto finally;
+
+    error:
+    Py_XDECREF(value);
+    Py_CLEAR(scope);
+
+    finally:
+    Py_XDECREF(headers);
+    return scope;
+}
+
+#undef FIELD_IS
+
+static int InitScope(void) {
+    size_t i;
+
+#define intern(var, literal) if (!(var = PyUnicode_InternFromString(literal))) return -1;
+    intern(str_type, "type")
+    intern(str_webtransport, "webtransport")
+    intern(str_method, "method")
+    intern(str_path, "path")
+    intern(str_raw_path, "raw_path")
+    intern(str_query_string, "query_string")
+    intern(str_scheme, "scheme")
+    intern(str_headers, "headers")
+    intern(str_server, "server")
+    intern(str_client, "client")
+#undef intern
+
+    for (i = 0; i < sizeof(Methods) / sizeof(Methods[0]); ++i)
+        if (!(MethodStrings[i] = PyUnicode_InternFromString(Methods[i]))) return -1;
+
+    for (i = 0; i < sizeof(FieldNames) / sizeof(FieldNames[0]); ++i) {
+        size_t len = strlen(FieldNames[i]);
+        size_t slot = FieldNameHash(FieldNames[i], len);
+        while (FieldNameSlots[slot]) slot = (slot + 1) & (FIELD_NAME_SLOTS - 1);
+        if (!(FieldNameSlots[slot] = PyBytes_FromStringAndSize(FieldNames[i], len))) return -1;
+    }
+
+    // the asgi dict is shared by every scope
+    ScopeTemplate = Py_BuildValue("{s:s,s:{s:s,s:s},s:s,s:s,s:s,s:y}",
+        "type", "http",
+        "asgi", "version", "3.0", "spec_version", "2.3",
+        "http_version", "3",
+        "scheme", "https",
+        "root_path", "",
+        "query_string", "");
+    return ScopeTemplate ? 0 : -1;
+}
+
+static PyObject* QuicServer_process_pending(QuicServer* self, PyObject* args) {
+    // Reset the eventfd before taking the batch, a push racing with us
+    // either lands in this batch or signals again
+    uint64_t value;
+    if (read(self->wakeup_fd, &value, sizeof(value)) == -1 && errno != EAGAIN) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        return NULL;
+    }
+
+    pthread_mutex_lock(&self->pending_lock);
+    PendingEvent* head = self->pending_head;
+    self->pending_head = self->pending_tail = NULL;
+    pthread_mutex_unlock(&self->pending_lock);
+
+    while (head) {
+        PendingEvent* evt = head;
+        head = head->next;
+
+        if (evt->type == EVT_REQUEST) {
+            QuicServer_dispatch(self, evt->sctx);
+            StreamContext_decref(evt->sctx);
+            free(evt);
+            continue;
+        }
+
+        PyObject* stream = Stream_new(evt->sctx);
+        if (!stream) {
+            PyErr_Print();
+            goto release;
+        }
+
+        switch (evt->type) {
+        case EVT_HEADERS:
+            {
+                PyObject* scope = BuildScope(evt->sctx, evt->headers);
+                PyObject* res = scope
+                    ? PyObject_CallMethodObjArgs((PyObject*)self, str_on_headers, stream, scope, NULL)
+                    : NULL;
+                if (!res) PyErr_Print();
+                Py_XDECREF(res);
+                Py_XDECREF(scope);
+            }
+            break;
+        case EVT_DATA:
+            {
+                PyObject* data_obj = PyBytes_FromStringAndSize(evt->data, evt->len);
+                PyObject* res = PyObject_CallMethodObjArgs((PyObject*)self, str_on_data, stream, data_obj, NULL);
+                if (!res) PyErr_Print();
+                Py_XDECREF(res);
+                Py_DECREF(data_obj);
+            }
+            break;
+        case EVT_FIN:
+            {
+                PyObject* res = PyObject_CallMethodObjArgs((PyObject*)self, str_on_fin, stream, NULL);
+                if (!res) PyErr_Print();
+                Py_XDECREF(res);
+            }
+            break;
+        case EVT_DATAGRAM:
+            {
+                // one call for every datagram of the stream in this batch
+                PyObject* datagrams = PyList_New(0);
+                PendingEvent* next = evt;
+                while (datagrams) {
+                    PyObject* data_obj = PyBytes_FromStringAndSize(next->data, next->len);
+                    if (!data_obj || PyList_Append(datagrams, data_obj) == -1) Py_CLEAR(datagrams);
+                    Py_XDECREF(data_obj);
+
+                    if (next != evt) {
+                        free(next->data);
+                        StreamContext_decref(next->sctx);
+                        free(next);
+                    }
+                    if (!head || head->type != EVT_DATAGRAM || head->sctx != evt->sctx) break;
+                    next = head;
+                    head = head->next;
+                }
+                PyObject* res = datagrams
+                    ? PyObject_CallMethodObjArgs((PyObject*)self, str_on_datagrams, stream, datagrams, NULL)
+                    : NULL;
+                if (!res) PyErr_Print();
+                Py_XDECREF(res);
+                Py_XDECREF(datagrams);
+            }
+            break;
+        case EVT_WRITABLE:
+        case EVT_STARTED:
+        case EVT_CLOSED:
+        case EVT_BODY:
+            {
+                PyObject* name = evt->type == EVT_WRITABLE ? str_on_writable
+                    : evt->type == EVT_STARTED ? str_on_started
+                    : evt->type == EVT_CLOSED ? str_on_close : str_on_body;
+                PyObject* res = PyObject_CallMethodObjArgs((PyObject*)self, name, stream, NULL);
+                if (!res) PyErr_Print();
+                Py_XDECREF(res);
+            }
+            break;
+        default: break;
+        }
+
+        release:
+        Py_XDECREF(stream);
+        FreeHeaders(evt->headers);
+        free(evt->data);
+        StreamContext_decref(evt->sctx);
+        free(evt);
+    }
+    Py_RETURN_NONE;
+}
+
+static int QuicServer_set_settings(QuicServer* self, PyObject* settings) {
+    PyObject* native = NULL;
+    PyObject* fields;
+    PyObject* h3_fields;
+    PyObject* value;
+    unsigned long long v;
+    int profile;
+    int result = 0;
+
+    memset(&self->Settings, 0, sizeof(QUIC_SETTINGS));
+    self->Profile = QUIC_EXECUTION_PROFILE_LOW_LATENCY;
+    nghttp3_settings_default(&self->H3Settings);
+    self->qpack_try_index = 0;
+    self->wt_max_sessions = 0;
+
+    if (settings == Py_None) {
+        self->Settings.IdleTimeoutMs = 5000; self->Settings.IsSet.IdleTimeoutMs = TRUE;
+        self->Settings.PeerBidiStreamCount = 100; self->Settings.IsSet.PeerBidiStreamCount = TRUE;
+        self->Settings.PeerUnidiStreamCount = 3; self->Settings.IsSet.PeerUnidiStreamCount = TRUE;
+        return 0;
+    }
+
+    if (!(native = PyObject_CallMethod(settings, "_native", NULL)))
+        goto error;
+
+    if (!PyArg_ParseTuple(native, "iO!O!", &profile, &PyDict_Type, &fields, &PyDict_Type, &h3_fields))
+        goto error;
+
+    if (profile < 0 || profile >= EXECUTION_PROFILES) {
+        PyErr_SetString(PyExc_ValueError, "unknown execution profile");
+        goto error;
+    }
+    self->Profile = profile;
+
+#define SETTING(field) \
+    if ((value = PyDict_GetItemString(fields, #field))) { \
+        if ((v = PyLong_AsUnsignedLongLong(value)) == (unsigned long long)-1 && PyErr_Occurred()) \
+            goto error; \
+        self->Settings.field = v; \
+        self->Settings.IsSet.field = TRUE; \
+    }
+
+    SETTING(IdleTimeoutMs)
+    SETTING(HandshakeIdleTimeoutMs)
+    SETTING(PeerBidiStreamCount)
+    SETTING(PeerUnidiStreamCount)
+    SETTING(StreamRecvWindowDefault)
+    SETTING(StreamRecvBufferDefault)
+    SETTING(ConnFlowControlWindow)
+    SETTING(InitialWindowPackets)
+    SETTING(InitialRttMs)
+    SETTING(MaxAckDelayMs)
+    SETTING(KeepAliveIntervalMs)
+    SETTING(MaxBytesPerKey)
+    SETTING(CongestionControlAlgorithm)
+    SETTING(ServerResumptionLevel)
+    SETTING(SendBufferingEnabled)
+    SETTING(PacingEnabled)
+    SETTING(HyStartEnabled)
+    SETTING(MigrationEnabled)
+    SETTING(EcnEnabled)
+    SETTING(DatagramReceiveEnabled)
+#undef SETTING
+
+#define H3_SETTING(field) \
+    if ((value = PyDict_GetItemString(h3_fields, #field))) { \
+        if ((v = PyLong_AsUnsignedLongLong(value)) == (unsigned long long)-1 && PyErr_Occurred()) \
+            goto error; \
+        self->H3Settings.field = v; \
+    }
+
+    H3_SETTING(max_field_section_size)
+    H3_SETTING(qpack_max_dtable_capacity)
+    H3_SETTING(qpack_encoder_max_dtable_capacity)
+    H3_SETTING(qpack_blocked_streams)
+    H3_SETTING(enable_connect_protocol)
+    H3_SETTING(h3_datagram)
+#undef H3_SETTING
+
+    if ((value = PyDict_GetItemString(h3_fields, "qpack_try_index"))) {
+        if ((self->qpack_try_index = PyObject_IsTrue(value)) == -1)
+            goto error;
+    }
+
+    if ((value = PyDict_GetItemString(h3_fields, "webtransport_max_sessions"))) {
+        if ((self->wt_max_sessions = PyLong_AsUnsignedLongLong(value)) == (unsigned long long)-1 && PyErr_Occurred())
+            goto error;
+    }
+
+    goto finally;
+
+    error:
+    result = -1;
+
+    finally:
+    Py_XDECREF(native);
+    return result;
+}
+
+static int QuicServer_init(QuicServer* self, PyObject* args, PyObject* kwds) {
+    PyObject *app, *loop;
+    PyObject* process_pending = NULL;
+    PyObject* log_request = NULL;
+    PyObject* tmp = NULL;
+    int result = 0;
+    int debug = 0;
+    PyObject* settings = Py_None;
+    static char *kwlist[] = {"app", "loop", "debug", "settings", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|pO", kwlist, &app, &loop, &debug, &settings)) return -1;
+    Py_INCREF(app); self->app = app;
+    Py_INCREF(loop); self->loop = loop;
+    self->debug_mode = debug;
+
+    if (QuicServer_set_settings(self, settings) == -1)
+        goto error;
+    pthread_mutex_init(&self->pending_lock, NULL);
+    self->pending_head = self->pending_tail = NULL;
+
+    // An fpy3 Application is served natively: requests go through its
+    // matcher and handlers without the on_headers/on_data/on_fin hooks
+    if (PyObject_HasAttrString(app, "_matcher")) {
+        self->native = 1;
+
+        if (!(self->matcher = PyObject_GetAttrString(app, "_matcher")))
+            goto error;
+
+        if (!(self->error_handler = PyObject_GetAttrString(app, "error_handler")))
+            goto error;
+
+        if (!(self->create_task = PyObject_GetAttrString(loop, "create_task")))
+            goto error;
+
+        if (!(log_request = PyObject_GetAttrString(app, "_log_request")))
+            goto error;
+
+        if (log_request == Py_True) {
+            if (!(self->request_logger = PyObject_GetAttrString(app, "default_request_logger")))
+                goto error;
+        }
+    }
+
+    if ((self->wakeup_fd = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC)) == -1) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        goto error;
+    }
+
+    if (!(process_pending = PyObject_GetAttrString((PyObject*)self, "process_pending")))
+        goto error;
+
+    if (!(tmp = PyObject_CallMethod(loop, "add_reader", "iO", self->wakeup_fd, process_pending)))
+        goto error;
+
+    goto finally;
+
+    error:
+    result = -1;
+
+    finally:
+    Py_XDECREF(tmp);
+    Py_XDECREF(process_pending);
+    Py_XDECREF(log_request);
+    return result;
+}
+
+static PyObject* QuicServer_new(PyTypeObject* type, PyObject* args, PyObject* kwds) {
+    QuicServer* self = (QuicServer*)PyType_GenericNew(type, args, kwds);
+    if (self) {
+        self->wakeup_fd = -1;
+        pthread_mutex_init(&self->sni_lock, NULL);
+        pthread_mutex_init(&self->conns_lock, NULL);
+    }
+    return (PyObject*)self;
+}
+
+static void QuicServer_dealloc(QuicServer* self) {
+    for (size_t i = 0; i < self->listeners_len; ++i) {
+        MsQuic->ListenerStop(self->listeners[i]->Listener);
+        MsQuic->ListenerClose(self->listeners[i]->Listener);
+        free(self->listeners[i]);
+    }
+    free(self->listeners);
+    while (self->sni) {
+        SniEntry* next = self->sni->next;
+        free(self->sni->server_name);
+        free(self->sni);
+        self->sni = next;
+    }
+    pthread_mutex_destroy(&self->sni_lock);
+    pthread_mutex_destroy(&self->conns_lock);
+    if (self->wakeup_fd != -1) close(self->wakeup_fd);
+    Py_XDECREF(self->request_logger);
+    Py_XDECREF(self->create_task);
+    Py_XDECREF(self->error_handler);
+    Py_XDECREF(self->matcher);
+    Py_XDECREF(self->app); Py_XDECREF(self->loop);
+    pthread_mutex_destroy(&self->pending_lock);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static void SetQuicError(const char* what, QUIC_STATUS Status) {
+    // on POSIX QUIC_STATUS values are errno codes
+    PyObject* args = Py_BuildValue("(is)", (int)Status, what);
+    if (args) {
+        PyErr_SetObject(PyExc_OSError, args);
+        Py_DECREF(args);
+    }
+}
+
+static HQUIC EnsureRegistration(QUIC_EXECUTION_PROFILE Profile) {
+    QUIC_STATUS Status;
+    QUIC_REGISTRATION_CONFIG RegConfig = { "fpy3", Profile };
+
+    if (!MsQuic) {
+        if (QUIC_FAILED(Status = MsQuicOpen2(&MsQuic))) {
+            MsQuic = NULL;
+            SetQuicError("MsQuicOpen2 failed", Status);
+            return NULL;
+        }
+
+        if (FixedServerId != -1) {
+            uint32_t ServerId = (uint32_t)FixedServerId;
+            uint16_t Mode = QUIC_LOAD_BALANCING_SERVER_ID_FIXED;
+
+            if (QUIC_FAILED(Status = MsQuic->SetParam(NULL, QUIC_PARAM_GLOBAL_FIXED_SERVER_ID, sizeof(ServerId), &ServerId))
+                || QUIC_FAILED(Status = MsQuic->SetParam(NULL, QUIC_PARAM_GLOBAL_LOAD_BALACING_MODE, sizeof(Mode), &Mode))) {
+                MsQuicClose(MsQuic);
+                MsQuic = NULL;
+                SetQuicError("load balancing setup failed", Status);
+                return NULL;
+            }
+        }
+    }
+
+    if (!Registrations[Profile]
+        && QUIC_FAILED(Status = MsQuic->RegistrationOpen(&RegConfig, &Registrations[Profile]))) {
+        Registrations[Profile] = NULL;
+        SetQuicError("RegistrationOpen failed", Status);
+        return NULL;
+    }
+
+    return Registrations[Profile];
+}
+
+// Return the configuration for a certificate/key pair under the server
+// settings, loading it once
+static HQUIC LoadConfiguration(QuicServer* self, const char* certfile, const char* keyfile) {
+    QUIC_STATUS Status;
+    HQUIC Configuration = NULL;
+    HQUIC Registration;
+    Credential* credential;
+
+    for (credential = credentials; credential; credential = credential->next) {
+        if (strcmp(credential->certfile, certfile) == 0 && strcmp(credential->keyfile, keyfile) == 0
+            && credential->Profile == self->Profile
+            && memcmp(&credential->Settings, &self->Settings, sizeof(QUIC_SETTINGS)) == 0)
+            return credential->Configuration;
+    }
+
+    if (!(Registration = EnsureRegistration(self->Profile)))
+        return NULL;
+
+    if (QUIC_FAILED(Status = MsQuic->ConfigurationOpen(Registration, AlpnBuffers, 2, &self->Settings, sizeof(QUIC_SETTINGS), NULL, &Configuration))) {
+        SetQuicError("ConfigurationOpen failed", Status);
+        return NULL;
+    }
+
+    QUIC_CREDENTIAL_CONFIG CredConfig; memset(&CredConfig, 0, sizeof(CredConfig));
+    QUIC_CERTIFICATE_FILE CertFileParams = { .CertificateFile = certfile, .PrivateKeyFile = keyfile };
+    CredConfig.Type = QUIC_CREDENTIAL_TYPE_CERTIFICATE_FILE; CredConfig.CertificateFile = &CertFileParams;
+    if (QUIC_FAILED(Status = MsQuic->ConfigurationLoadCredential(Configuration, &CredConfig))) {
+        char what[512];
+        snprintf(what, sizeof(what), "ConfigurationLoadCredential failed for %s, %s", certfile, keyfile);
+        MsQuic->ConfigurationClose(Configuration);
+        SetQuicError(what, Status);
+        return NULL;
+    }
+
+    if (!(credential = calloc(1, sizeof(Credential)))
+        || !(credential->certfile = strdup(certfile))
+        || !(credential->keyfile = strdup(keyfile))) {
+        if (credential) { free(credential->certfile); free(credential); }
+        MsQuic->ConfigurationClose(Configuration);
+        PyErr_NoMemory();
+        return NULL;
+    }
+    credential->Profile = self->Profile;
+    credential->Settings = self->Settings;
+    credential->Configuration = Configuration;
+    credential->next = credentials;
+    credentials = credential;
+
+    return Configuration;
+}
+
+// sni maps server names to (certfile, keyfile)
+static int QuicServer_add_sni(QuicServer* self, PyObject* sni) {
+    PyObject* items = NULL;
+    int result = 0;
+
+    if (!(items = PyMapping_Items(sni)))
+        goto error;
+
+    for (Py_ssize_t i = 0; i < PyList_GET_SIZE(items); ++i) {
+        const char *server_name, *certfile, *keyfile;
+        if (!PyArg_ParseTuple(PyList_GET_ITEM(items, i), "s(ss)", &server_name, &certfile, &keyfile))
+            goto error;
+
+        HQUIC Configuration = LoadConfiguration(self, certfile, keyfile);
+        if (!Configuration)
+            goto error;
+
+        SniEntry* entry = calloc(1, sizeof(SniEntry));
+        if (!entry || !(entry->server_name = strdup(server_name))) {
+            free(entry);
+            PyErr_NoMemory();
+            goto error;
+        }
+        entry->server_name_len = strlen(server_name);
+        for (char* c = entry->server_name; *c; c++)
+            if (*c >= 'A' && *c <= 'Z') *c |= 0x20;
+        entry->Configuration = Configuration;
+
+        pthread_mutex_lock(&self->sni_lock);
+        entry->next = self->sni;
+        self->sni = entry;
+        pthread_mutex_unlock(&self->sni_lock);
+    }
+
+    goto finally;
+
+    error:
+    result = -1;
+
+    finally:
+    Py_XDECREF(items);
+    return result;
+}
+
+// "" and "::" bind every interface on both IPv4 and IPv6
+static int ResolveAddress(const char* host, int port, QUIC_ADDR* Address) {
+    memset(Address, 0, sizeof(*Address));
+
+    if (port < 0 || port > 65535) {
+        PyErr_SetString(PyExc_ValueError, "port must be 0-65535");
+        return -1;
+    }
+
+    if (!host || !*host || strcmp(host, "::") == 0) {
+        Address->Ip.sa_family = QUIC_ADDRESS_FAMILY_UNSPEC;
+    } else if (inet_pton(AF_INET, host, &Address->Ipv4.sin_addr) == 1) {
+        Address->Ip.sa_family = QUIC_ADDRESS_FAMILY_INET;
+    } else if (inet_pton(AF_INET6, host, &Address->Ipv6.sin6_addr) == 1) {
+        Address->Ip.sa_family = QUIC_ADDRESS_FAMILY_INET6;
+    } else {
+        struct addrinfo hints = {0};
+        struct addrinfo* res = NULL;
+        int rv;
+        hints.ai_family = AF_UNSPEC;
+        hints.ai_socktype = SOCK_DGRAM;
+        hints.ai_flags = AI_PASSIVE | AI_ADDRCONFIG;
+
+        Py_BEGIN_ALLOW_THREADS
+        rv = getaddrinfo(host, NULL, &hints, &res);
+        Py_END_ALLOW_THREADS
+
+        if (rv != 0) {
+            PyErr_Format(PyExc_OSError, "%s: %s", host, gai_strerror(rv));
+            return -1;
+        }
+        memcpy(Address, res->ai_addr, res->ai_addrlen < sizeof(*Address) ? res->ai_addrlen : sizeof(*Address));
+        freeaddrinfo(res);
+    }
+
+    // sin_port and sin6_port share the offset
+    Address->Ipv4.sin_port = htons(port);
+    return 0;
+}
+
+static PyObject* AddressToTuple(const QUIC_ADDR* Address) {
+    char host[INET6_ADDRSTRLEN] = "";
+
+    if (Address->Ip.sa_family == AF_INET) {
+        inet_ntop(AF_INET, &Address->Ipv4.sin_addr, host, sizeof(host));
+        return Py_BuildValue("(si)", host, ntohs(Address->Ipv4.sin_port));
+    }
+
+    if (Address->Ip.sa_family == AF_INET6) {
+        inet_ntop(AF_INET6, &Address->Ipv6.sin6_addr, host, sizeof(host));
+        return Py_BuildValue("(si)", host, ntohs(Address->Ipv6.sin6_port));
+    }
+
+    return Py_BuildValue("(si)", "::", ntohs(Address->Ipv4.sin_port));
+}
+
+static PyObject* QuicServer_start(QuicServer* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"host", "port", "certfile", "keyfile", "sni", NULL};
+    const char* host;
+    int port;
+    const char* certfile = "cert.pem";
+    const char* keyfile = "key.pem";
+    PyObject* sni = NULL;
+    QUIC_STATUS Status;
+    QUIC_ADDR Address;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "zi|ssO", kwlist,
+                                     &host, &port, &certfile, &keyfile, &sni))
+        return NULL;
+
+    if (ResolveAddress(host, port, &Address) == -1)
+        return NULL;
+
+    HQUIC Configuration = LoadConfiguration(self, certfile, keyfile);
+    if (!Configuration)
+        return NULL;
+
+    if (sni && sni != Py_None && QuicServer_add_sni(self, sni) == -1)
+        return NULL;
+
+    ListenerContext** listeners = realloc(self->listeners, sizeof(ListenerContext*) * (self->listeners_len + 1));
+    if (!listeners)
+        return PyErr_NoMemory();
+    self->listeners = listeners;
+
+    ListenerContext* lctx = calloc(1, sizeof(ListenerContext));
+    if (!lctx)
+        return PyErr_NoMemory();
+    lctx->server = self;
+    lctx->Configuration = Configuration;
+
+    if (QUIC_FAILED(Status = MsQuic->ListenerOpen(Registrations[self->Profile], ServerListenerCallback, lctx, &lctx->Listener))) {
+        free(lctx);
+        SetQuicError("ListenerOpen failed", Status);
+        return NULL;
+    }
+
+    if (QUIC_FAILED(Status = MsQuic->ListenerStart(lctx->Listener, AlpnBuffers, 2, &Address))) {
+        MsQuic->ListenerClose(lctx->Listener);
+        free(lctx);
+        SetQuicError("ListenerStart failed", Status);
+        return NULL;
+    }
+
+    self->listeners[self->listeners_len++] = lctx;
+
+    uint32_t len = sizeof(Address);
+    if (QUIC_SUCCEEDED(MsQuic->GetParam(lctx->Listener, QUIC_PARAM_LISTENER_LOCAL_ADDRESS, &len, &Address)))
+        return AddressToTuple(&Address);
+
+    Py_RETURN_NONE;
+}
+
+static void QuicServer_stop_listeners(QuicServer* self) {
+    if (self->draining) return;
+    self->draining = 1;
+
+    for (size_t i = 0; i < self->listeners_len; ++i)
+        MsQuic->ListenerStop(self->listeners[i]->Listener);
+}
+
+// One step of a graceful shutdown, meant to be called about once a second
+// while draining. The first call stops accepting connections and sends a
+// GOAWAY notice, the second the final GOAWAY naming the last request that
+// will be served. From then on connections with no request left are
+// closed. Returns the number of connections still open for requests.
+static PyObject* QuicServer_shutdown(QuicServer* self, PyObject* args) {
+    long busy = 0;
+
+    QuicServer_stop_listeners(self);
+
+    pthread_mutex_lock(&self->conns_lock);
+    for (ConnectionContext* ctx = self->conns; ctx; ctx = ctx->next) {
+        pthread_mutex_lock(&ctx->lock);
+        if (ctx->closing || !ctx->Connection) {
+            pthread_mutex_unlock(&ctx->lock);
+            continue;
+        }
+
+        if (!ctx->http3 || !ctx->is_ready) {
+            ctx->goaway = 2;
+        } else if (ctx->goaway == 0) {
+            nghttp3_conn_submit_shutdown_notice(ctx->http3);
+            ctx->goaway = 1;
+            FlushConn(ctx);
+        } else if (ctx->goaway == 1) {
+            nghttp3_conn_shutdown(ctx->http3);
+            ctx->goaway = 2;
+            FlushConn(ctx);
+        }
+
+        if (ctx->goaway == 2 && !ActiveRequests(ctx)) {
+            ctx->closing = 1;
+            MsQuic->ConnectionShutdown(ctx->Connection, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, NGHTTP3_H3_NO_ERROR);
+        } else {
+            busy++;
+        }
+        pthread_mutex_unlock(&ctx->lock);
+    }
+    pthread_mutex_unlock(&self->conns_lock);
+
+    return PyLong_FromLong(busy);
+}
+
+// Close every connection now, requests still running are lost
+static PyObject* QuicServer_close(QuicServer* self, PyObject* args) {
+    QuicServer_stop_listeners(self);
+
+    pthread_mutex_lock(&self->conns_lock);
+    for (ConnectionContext* ctx = self->conns; ctx; ctx = ctx->next) {
+        pthread_mutex_lock(&ctx->lock);
+        if (!ctx->closing && ctx->Connection) {
+            ctx->closing = 1;
+            MsQuic->ConnectionShutdown(ctx->Connection, QUIC_CONNECTION_SHUTDOWN_FLAG_NONE, NGHTTP3_H3_NO_ERROR);
+        }
+        pthread_mutex_unlock(&ctx->lock);
+    }
+    pthread_mutex_unlock(&self->conns_lock);
+
+    Py_RETURN_NONE;
+}
+
+static int SetStat(PyObject* stats, const char* name, unsigned long long value) {
+    PyObject* item = PyLong_FromUnsignedLongLong(value);
+    if (!item) return -1;
+    int result = PyDict_SetItemString(stats, name, item);
+    Py_DECREF(item);
+    return result;
+}
+
+// Counters for one connection. ctx must be referenced but not locked:
+// GetParam from outside MsQuic waits for the connection's worker, which
+// may itself be waiting for ctx->lock.
+static PyObject* ConnectionStats(ConnectionContext* ctx) {
+    QUIC_STATISTICS_V2 Stats;
+    QUIC_ADDR Address;
+    QUIC_STATUS Status;
+    uint32_t len = sizeof(Stats);
+    PyObject* stats = NULL;
+    PyObject* remote = NULL;
+
+    memset(&Stats, 0, sizeof(Stats));
+    Py_BEGIN_ALLOW_THREADS
+    Status = MsQuic->GetParam(ctx->Handle, QUIC_PARAM_CONN_STATISTICS_V2, &len, &Stats);
+    Py_END_ALLOW_THREADS
+    if (QUIC_FAILED(Status)) {
+        SetQuicError("QUIC_PARAM_CONN_STATISTICS_V2 failed", Status);
+        return NULL;
+    }
+
+    if (!(stats = PyDict_New()))
+        goto error;
+
+    len = sizeof(Address);
+    if (QUIC_SUCCEEDED(MsQuic->GetParam(ctx->Handle, QUIC_PARAM_CONN_REMOTE_ADDRESS, &len, &Address))) {
+        if (!(remote = AddressToTuple(&Address)))
+            goto error;
+    } else {
+        Py_INCREF(Py_None);
+        remote = Py_None;
+    }
+    if (PyDict_SetItemString(stats, "remote", remote) == -1)
+        goto error;
+
+    if (PyDict_SetItemString(stats, "closed", ctx->Connection ? Py_False : Py_True) == -1)
+        goto error;
+
+#define STAT(name, value) if (SetStat(stats, name, value) == -1) goto error;
+    STAT("correlation_id", Stats.CorrelationId)
+    STAT("rtt_us", Stats.Rtt)
+    STAT("min_rtt_us", Stats.MinRtt)
+    STAT("max_rtt_us", Stats.MaxRtt)
+    STAT("handshake_us", Stats.TimingHandshakeFlightEnd > Stats.TimingStart
+         ? Stats.TimingHandshakeFlightEnd - Stats.TimingStart : 0)
+    STAT("cwnd", Stats.SendCongestionWindow)
+    STAT("path_mtu", Stats.SendPathMtu)
+    STAT("send_packets", Stats.SendTotalPackets)
+    STAT("send_bytes", Stats.SendTotalBytes)
+    STAT("send_stream_bytes", Stats.SendTotalStreamBytes)
+    STAT("lost_packets", Stats.SendSuspectedLostPackets)
+    STAT("spurious_lost_packets", Stats.SendSpuriousLostPackets)
+    STAT("congestion_events", Stats.SendCongestionCount)
+    STAT("persistent_congestion_events", Stats.SendPersistentCongestionCount)
+    STAT("ecn_congestion_events", Stats.SendEcnCongestionCount)
+    STAT("recv_packets", Stats.RecvTotalPackets)
+    STAT("recv_bytes", Stats.RecvTotalBytes)
+    STAT("recv_stream_bytes", Stats.RecvTotalStreamBytes)
+    STAT("recv_reordered_packets", Stats.RecvReorderedPackets)
+    STAT("recv_dropped_packets", Stats.RecvDroppedPackets)
+    STAT("recv_duplicate_packets", Stats.RecvDuplicatePackets)
+    STAT("recv_decryption_failures", Stats.RecvDecryptionFailures)
+    STAT("key_updates", Stats.KeyUpdateCount)
+    STAT("resumed", Stats.ResumptionSucceeded)
+    STAT("ecn_capable", Stats.EcnCapable)
+#undef STAT
+
+    goto finally;
+
+    error:
+    Py_CLEAR(stats);
+
+    finally:
+    Py_XDECREF(remote);
+    return stats;
+}
+
+// Statistics of every live connection
+static PyObject* QuicServer_connection_stats(QuicServer* self, PyObject* args) {
+    ConnectionContext** conns = NULL;
+    size_t conns_len = 0, i = 0;
+    PyObject* result = NULL;
+
+    pthread_mutex_lock(&self->conns_lock);
+    for (ConnectionContext* ctx = self->conns; ctx; ctx = ctx->next) conns_len++;
+    if (conns_len && !(conns = malloc(sizeof(ConnectionContext*) * conns_len))) {
+        pthread_mutex_unlock(&self->conns_lock);
+        return PyErr_NoMemory();
+    }
+    for (ConnectionContext* ctx = self->conns; ctx; ctx = ctx->next) {
+        ConnectionContext_incref(ctx);
+        conns[i++] = ctx;
+    }
+    pthread_mutex_unlock(&self->conns_lock);
+
+    if (!(result = PyList_New(0)))
+        goto finally;
+
+    for (i = 0; i < conns_len; ++i) {
+        PyObject* stats = ConnectionStats(conns[i]);
+        if (!stats || PyList_Append(result, stats) == -1) {
+            Py_XDECREF(stats);
+            Py_CLEAR(result);
+            goto finally;
+        }
+        Py_DECREF(stats);
+    }
+
+    finally:
+    for (i = 0; i < conns_len; ++i) ConnectionContext_decref(conns[i]);
+    free(conns);
+    return result;
+}
+
+// Connections MsQuic has not finished shutting down yet
+static PyObject* QuicServer_connection_count(QuicServer* self, PyObject* args) {
+    long count = 0;
+
+    pthread_mutex_lock(&self->conns_lock);
+    for (ConnectionContext* ctx = self->conns; ctx; ctx = ctx->next) count++;
+    pthread_mutex_unlock(&self->conns_lock);
+
+    return PyLong_FromLong(count);
+}
+
+// --- Stream methods ---
+
+static PyObject* Stream_send_headers(Stream* self, PyObject* args) {
+    StreamContext* sctx = self->sctx;
+    PyObject* headers_list;
+    int fin;
+    PyObject* result = NULL;
+    nghttp3_nv* nva = NULL;
+    if (!PyArg_ParseTuple(args, "O!p", &PyList_Type, &headers_list, &fin)) return NULL;
+
+    Py_ssize_t len = PyList_GET_SIZE(headers_list);
+    if (!(nva = malloc(sizeof(nghttp3_nv) * (len ? len : 1)))) return PyErr_NoMemory();
+
+    for (Py_ssize_t i=0; i<len; ++i) {
+        PyObject* tuple = PyList_GET_ITEM(headers_list, i);
+        char *name, *value;
+        Py_ssize_t name_len, value_len;
+        if (!PyArg_ParseTuple(tuple, "y#y#", &name, &name_len, &value, &value_len)) goto finally;
+        nva[i].name = (uint8_t*)name;
+        nva[i].namelen = name_len;
+        nva[i].value = (uint8_t*)value;
+        nva[i].valuelen = value_len;
+        nva[i].flags = NvFlags(sctx->conn_ctx->server, name, name_len);
+    }
+
+    int rv = SubmitResponse(sctx, nva, len, NULL, 0, fin);
+    if (rv != 0) {
+        PyErr_Format(PyExc_RuntimeError, "nghttp3_conn_submit_response: %s", nghttp3_strerror(rv));
+        goto finally;
+    }
+
+    result = Py_None;
+    Py_INCREF(result);
+
+    finally:
+    free(nva);
+    return result;
+}
+
+// Send on a WebTransport stream, bypassing nghttp3. Returns 0 once the
+// session has more than WT_HIGH_WATER queued, 1 otherwise and -1 when out
+// of memory. Called with ctx->lock held.
+static int SendWebTransport(StreamContext* sctx, const void* data, size_t len, int fin) {
+    ConnectionContext* ctx = sctx->conn_ctx;
+    StreamContext* session = FindStreamContext(ctx, sctx->session_id);
+
+    if (sctx->closed || (!len && !fin)) return 1;
+
+    SendContext* sc = malloc(sizeof(SendContext));
+    QUIC_BUFFER* Buffers = malloc(sizeof(QUIC_BUFFER));
+    uint8_t* copy = malloc(len ? len : 1);
+    if (!sc || !Buffers || !copy) {
+        free(sc); free(Buffers); free(copy);
+        return -1;
+    }
+    memcpy(copy, data, len);
+    Buffers[0].Buffer = copy;
+    Buffers[0].Length = (uint32_t)len;
+    sc->Buffers = Buffers;
+    sc->BufferCount = 1;
+    sc->Length = len;
+    sc->Chunks = NULL;
+
+    if (QUIC_FAILED(MsQuic->StreamSend(sctx->Stream, Buffers, 1, fin ? QUIC_SEND_FLAG_FIN : QUIC_SEND_FLAG_NONE, sc))) {
+        free(copy); free(Buffers); free(sc);
+        return 1;
+    }
+
+    if (!session) return 1;
+    session->wt_buffered += len;
+    if (session->wt_buffered < WT_HIGH_WATER) return 1;
+    session->wt_blocked = 1;
+    return 0;
+}
+
+static PyObject* Stream_send_data(Stream* self, PyObject* args) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    Py_buffer data;
+    int fin;
+    int rv = 0;
+    if (!PyArg_ParseTuple(args, "y*p", &data, &fin)) return NULL;
+
+    pthread_mutex_lock(&ctx->lock);
+    if (sctx->wt == WT_STREAM) {
+        rv = SendWebTransport(sctx, data.buf, data.len, fin);
+        pthread_mutex_unlock(&ctx->lock);
+        PyBuffer_Release(&data);
+        if (rv == -1) return PyErr_NoMemory();
+        return PyBool_FromLong(rv);
+    }
+    int writable = 1;
+    if (!sctx->closed && ctx->http3) {
+        if (data.len > 0) rv = QueueChunk(sctx, data.buf, data.len);
+        if (fin) sctx->resp_fin = 1;
+        nghttp3_conn_resume_stream(ctx->http3, sctx->stream_id);
+        FlushConn(ctx);
+        // the peer reads slower than the application writes, read_data
+        // sends EVT_WRITABLE once it took most of it
+        if (!sctx->closed && sctx->resp_buffered >= RESP_HIGH_WATER) {
+            sctx->resp_blocked = 1;
+            writable = 0;
+        }
+    }
+    pthread_mutex_unlock(&ctx->lock);
+
+    PyBuffer_Release(&data);
+    if (rv == -1) return PyErr_NoMemory();
+    return PyBool_FromLong(writable);
+}
+
+// Abort the stream with H3_INTERNAL_ERROR, for a response that was
+// started and can not be finished
+static PyObject* Stream_reset(Stream* self, PyObject* unused) {
+    AbortStream(self->sctx, NGHTTP3_H3_INTERNAL_ERROR);
+    Py_RETURN_NONE;
+}
+
+// Queue count bytes of the file fd from offset as the next part of the
+// response body. The bytes are mapped, not copied, see MapFile: fd can be
+// closed once this returns, but the file must not shrink until the
+// response is sent.
+static PyObject* Stream_send_file(Stream* self, PyObject* args) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    int fd;
+    long long offset;
+    Py_ssize_t count;
+    int fin;
+    ResponseChunk* chunk = NULL;
+    if (!PyArg_ParseTuple(args, "iLnp", &fd, &offset, &count, &fin)) return NULL;
+
+    if (sctx->wt == WT_STREAM) {
+        PyErr_SetString(PyExc_ValueError, "send_file on a WebTransport stream");
+        return NULL;
+    }
+    if (offset < 0 || count < 0) {
+        PyErr_SetString(PyExc_ValueError, "negative offset or count");
+        return NULL;
+    }
+
+    if (count > 0) {
+        struct stat st;
+        if (fstat(fd, &st) == -1) return PyErr_SetFromErrno(PyExc_OSError);
+        // touching a mapped page past the end of the file raises SIGBUS
+        if (offset + count > st.st_size) {
+            PyErr_SetString(PyExc_ValueError, "range past the end of the file");
+            return NULL;
+        }
+        if (!(chunk = MapFile(fd, (off_t)offset, (size_t)count)))
+            return PyErr_SetFromErrno(PyExc_OSError);
+    }
+
+    pthread_mutex_lock(&ctx->lock);
+    if (!sctx->closed && ctx->http3) {
+        if (chunk) {
+            AppendChunk(sctx, chunk);
+            sctx->resp_mapped = 1;
+            chunk = NULL;
+        }
+        if (fin) sctx->resp_fin = 1;
+        nghttp3_conn_resume_stream(ctx->http3, sctx->stream_id);
+        FlushConn(ctx);
+    }
+    pthread_mutex_unlock(&ctx->lock);
+
+    if (chunk) ReleaseChunk(chunk);
+    Py_RETURN_TRUE;
+}
+
+// Take up to RECV_CHUNK bytes of the request body as (body, more_body),
+// None while nothing new arrived. Receive is enabled again once the channel
+// is down to RECV_LOW_WATER.
+static PyObject* Stream_receive(Stream* self, PyObject* args) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    PyObject* body;
+    int more_body = 1;
+
+    pthread_mutex_lock(&ctx->lock);
+    size_t n = sctx->recv_len - sctx->recv_off;
+    if (!n && sctx->recv_fin != 1) {
+        // the next arrival signals again
+        sctx->recv_signaled = 0;
+        pthread_mutex_unlock(&ctx->lock);
+        Py_RETURN_NONE;
+    }
+
+    if (n > RECV_CHUNK) n = RECV_CHUNK;
+    if (!(body = PyBytes_FromStringAndSize(sctx->recv_buf + sctx->recv_off, n))) {
+        pthread_mutex_unlock(&ctx->lock);
+        return NULL;
+    }
+
+    sctx->recv_off += n;
+    if (sctx->recv_off == sctx->recv_len) {
+        sctx->recv_off = sctx->recv_len = 0;
+        if (sctx->recv_fin) {
+            sctx->recv_fin = 2;
+            more_body = 0;
+        }
+    }
+    if (sctx->recv_paused && sctx->recv_len - sctx->recv_off <= RECV_LOW_WATER) {
+        sctx->recv_paused = 0;
+        if (!sctx->closed) MsQuic->StreamReceiveSetEnabled(sctx->Stream, TRUE);
+    }
+    pthread_mutex_unlock(&ctx->lock);
+
+    return Py_BuildValue("(NO)", body, more_body ? Py_True : Py_False);
+}
+
+// Queue HTTP datagrams for the stream. Datagrams are unreliable, those that
+// do not fit the path or find DATAGRAM_QUEUE others waiting are dropped.
+// Returns how many were queued.
+static PyObject* Stream_send_datagrams(Stream* self, PyObject* datagrams) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    PyObject* items;
+    uint8_t header[8];
+    size_t header_len;
+    long queued = 0;
+
+    if (!(items = PySequence_Fast(datagrams, "datagrams must be a sequence")))
+        return NULL;
+
+    header_len = PutVarint(header, (uint64_t)sctx->stream_id / 4);
+
+    pthread_mutex_lock(&ctx->lock);
+    for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(items); ++i) {
+        PyObject* item = PySequence_Fast_GET_ITEM(items, i);
+        char* data;
+        Py_ssize_t len;
+
+        if (PyBytes_AsStringAndSize(item, &data, &len) == -1) {
+            pthread_mutex_unlock(&ctx->lock);
+            Py_DECREF(items);
+            return NULL;
+        }
+
+        if (sctx->closed || !ctx->Connection || sctx->dgram_queued >= DATAGRAM_QUEUE) break;
+        if (header_len + len > ctx->dgram_max_len) continue;
+
+        DatagramContext* dc = malloc(sizeof(DatagramContext) + header_len + len);
+        if (!dc) break;
+        memcpy(dc->data, header, header_len);
+        memcpy(dc->data + header_len, data, len);
+        dc->Buffer.Buffer = dc->data;
+        dc->Buffer.Length = (uint32_t)(header_len + len);
+        dc->sctx = sctx;
+        dc->queued = 1;
+
+        StreamContext_incref(sctx);
+        if (QUIC_FAILED(MsQuic->DatagramSend(ctx->Connection, &dc->Buffer, 1, QUIC_SEND_FLAG_NONE, dc))) {
+            StreamContext_decref(sctx);
+            free(dc);
+            break;
+        }
+        sctx->dgram_queued++;
+        queued++;
+    }
+    pthread_mutex_unlock(&ctx->lock);
+
+    Py_DECREF(items);
+    return PyLong_FromLong(queued);
+}
+
+// Open a WebTransport stream in the session this stream carries. The
+// Stream is returned at once, on_started reports when it got its ID.
+static PyObject* Stream_open_stream(Stream* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"bidirectional", NULL};
+    StreamContext* session = self->sctx;
+    ConnectionContext* ctx = session->conn_ctx;
+    StreamContext* sctx = NULL;
+    uint8_t header[16];
+    size_t header_len;
+    int bidirectional = 0;
+    QUIC_STATUS Status;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", kwlist, &bidirectional))
+        return NULL;
+
+    if (!session->is_session) {
+        PyErr_SetString(PyExc_ValueError, "not a WebTransport session");
+        return NULL;
+    }
+
+    header_len = PutVarint(header, bidirectional ? WT_BIDI_STREAM : WT_UNI_STREAM);
+    header_len += PutVarint(header + header_len, (uint64_t)session->stream_id);
+
+    pthread_mutex_lock(&ctx->lock);
+    if (session->closed || !ctx->Connection) {
+        pthread_mutex_unlock(&ctx->lock);
+        PyErr_SetString(PyExc_RuntimeError, "WebTransport session is closed");
+        return NULL;
+    }
+
+    if (!(sctx = StreamContext_new(ctx))) {
+        pthread_mutex_unlock(&ctx->lock);
+        return PyErr_NoMemory();
+    }
+    sctx->wt = WT_STREAM;
+    sctx->session_id = session->stream_id;
+    sctx->stream_id = -1;
+    sctx->is_uni = !bidirectional;
+
+    if (QUIC_FAILED(Status = MsQuic->StreamOpen(ctx->Connection,
+            bidirectional ? QUIC_STREAM_OPEN_FLAG_NONE : QUIC_STREAM_OPEN_FLAG_UNIDIRECTIONAL,
+            ServerStreamCallback, sctx, &sctx->Stream))) {
+        pthread_mutex_unlock(&ctx->lock);
+        StreamContext_decref(sctx);
+        SetQuicError("StreamOpen failed", Status);
+        return NULL;
+    }
+
+    if (QUIC_FAILED(Status = MsQuic->StreamStart(sctx->Stream, QUIC_STREAM_START_FLAG_NONE))) {
+        pthread_mutex_unlock(&ctx->lock);
+        MsQuic->StreamClose(sctx->Stream);
+        StreamContext_decref(sctx);
+        SetQuicError("StreamStart failed", Status);
+        return NULL;
+    }
+
+    AddStreamContext(ctx, sctx);
+    int rv = SendWebTransport(sctx, header, header_len, 0);
+    pthread_mutex_unlock(&ctx->lock);
+
+    if (rv == -1) return PyErr_NoMemory();
+    return Stream_new(sctx);
+}
+
+// Statistics of the connection carrying the stream
+static PyObject* Stream_stats(Stream* self, PyObject* args) {
+    return ConnectionStats(self->sctx->conn_ctx);
+}
+
+static PyObject* Stream_get_id(Stream* self, void* closure) {
+    return PyLong_FromLongLong(self->sctx->stream_id);
+}
+
+// The session of a WebTransport stream, None for other streams or when
+// the session is gone
+static PyObject* Stream_get_session(Stream* self, void* closure) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    StreamContext* session = NULL;
+    PyObject* result;
+
+    pthread_mutex_lock(&ctx->lock);
+    if (sctx->wt == WT_STREAM && (session = FindStreamContext(ctx, sctx->session_id)) && session->is_session)
+        StreamContext_incref(session);
+    else
+        session = NULL;
+    pthread_mutex_unlock(&ctx->lock);
+
+    if (!session) Py_RETURN_NONE;
+
+    result = Stream_new(session);
+    StreamContext_decref(session);
+    return result;
+}
+
+// Response bytes send_data and send_file queued that nghttp3 has not taken
+// yet, None once the response ended or the stream is closed
+static PyObject* Stream_get_buffered(Stream* self, void* closure) {
+    StreamContext* sctx = self->sctx;
+    ConnectionContext* ctx = sctx->conn_ctx;
+    size_t buffered;
+    int open;
+
+    pthread_mutex_lock(&ctx->lock);
+    open = !sctx->closed && !sctx->resp_fin;
+    buffered = sctx->resp_buffered;
+    pthread_mutex_unlock(&ctx->lock);
+
+    if (!open) Py_RETURN_NONE;
+    return PyLong_FromSize_t(buffered);
+}
+
+static PyObject* Stream_get_state(Stream* self, void* closure) {
+    Py_INCREF(self->state);
+    return self->state;
+}
+
+static int Stream_set_state(Stream* self, PyObject* value, void* closure) {
+    PyObject* tmp = self->state;
+    if (!value) value = Py_None;
+    Py_INCREF(value);
+    self->state = value;
+    Py_XDECREF(tmp);
+    return 0;
+}
+
+static PyMethodDef Stream_methods[] = {
+    {"send_headers", (PyCFunction)Stream_send_headers, METH_VARARGS, ""},
+    {"send_data", (PyCFunction)Stream_send_data, METH_VARARGS, ""},
+    {"send_file", (PyCFunction)Stream_send_file, METH_VARARGS, ""},
+    {"receive", (PyCFunction)Stream_receive, METH_NOARGS, ""},
+    {"reset", (PyCFunction)Stream_reset, METH_NOARGS, ""},
+    {"send_datagrams", (PyCFunction)Stream_send_datagrams, METH_O, ""},
+    {"open_stream", (PyCFunction)Stream_open_stream, METH_VARARGS | METH_KEYWORDS, ""},
+    {"stats", (PyCFunction)Stream_stats, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Stream_getset[] = {
+    {"id", (getter)Stream_get_id, NULL, "", NULL},
+    {"session", (getter)Stream_get_session, NULL, "", NULL},
+    {"buffered", (getter)Stream_get_buffered, NULL, "", NULL},
+    {"state", (getter)Stream_get_state, (setter)Stream_set_state, "", NULL},
+    {NULL}
+};
+
+static PyTypeObject StreamType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cquic.Stream",
+    .tp_basicsize = sizeof(Stream),
+    .tp_dealloc = (destructor)Stream_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_doc = "Stream",
+    .tp_traverse = (traverseproc)Stream_traverse,
+    .tp_clear = (inquiry)Stream_clear,
+    .tp_methods = Stream_methods,
+    .tp_getset = Stream_getset,
+};
+
+static PyMethodDef QuicServer_methods[] = {
+    {"start", (PyCFunction)QuicServer_start, METH_VARARGS | METH_KEYWORDS, ""},
+    {"process_pending", (PyCFunction)QuicServer_process_pending, METH_VARARGS, ""},
+    {"shutdown", (PyCFunction)QuicServer_shutdown, METH_NOARGS, ""},
+    {"close", (PyCFunction)QuicServer_close, METH_NOARGS, ""},
+    {"connection_count", (PyCFunction)QuicServer_connection_count, METH_NOARGS, ""},
+    {"connection_stats", (PyCFunction)QuicServer_connection_stats, METH_NOARGS, ""},
+    {NULL}
+};
+
+static PyTypeObject QuicServerType = {
+    PyVarObject_HEAD_INIT(NULL, 0) "cquic.QuicServer", sizeof(QuicServer), 0, (destructor)QuicServer_dealloc,
+    0,0,0,0,0,0,0,0,0,0,0,0,0,0,Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE,"QuicServer",0,0,0,0,0,0,QuicServer_methods, 0,0,0,0,0,0,0, (initproc)QuicServer_init, 0, QuicServer_new,
+};
+
+// Must run before the first listener starts, MsQuic only accepts the
+// load balancing mode before any binding exists
+static PyObject* cquic_set_server_id(PyObject* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"server_id", NULL};
+    long long server_id;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "L", kwlist, &server_id))
+        return NULL;
+
+    if (server_id < -1 || server_id > UINT32_MAX) {
+        PyErr_SetString(PyExc_ValueError, "server_id must be -1 or fit in 32 bits");
+        return NULL;
+    }
+
+    if (MsQuic) {
+        PyErr_SetString(PyExc_RuntimeError, "server_id must be set before a listener starts");
+        return NULL;
+    }
+
+    FixedServerId = server_id;
+
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef cquic_methods[] = {
+    {"set_server_id", (PyCFunction)cquic_set_server_id, METH_VARARGS | METH_KEYWORDS, ""},
+    {NULL}
+};
+
+static PyModuleDef cquic = { PyModuleDef_HEAD_INIT, "cquic", "", -1, cquic_methods, NULL, NULL, NULL, NULL };
+
+PyMODINIT_FUNC PyInit_cquic(void) {
+    PyObject* m = NULL;
+    PyObject* route = NULL;
+
+    if (PyType_Ready(&QuicServerType) < 0) goto error;
+    if (PyType_Ready(&StreamType) < 0) goto error;
+    if (!(m = PyModule_Create(&cquic))) goto error;
+    Py_INCREF(&QuicServerType);
+    PyModule_AddObject(m, "QuicServer", (PyObject*)&QuicServerType);
+    Py_INCREF(&StreamType);
+    PyModule_AddObject(m, "Stream", (PyObject*)&StreamType);
+
+    if (!(str_on_headers = PyUnicode_InternFromString("on_headers"))) goto error;
+    if (!(str_on_data = PyUnicode_InternFromString("on_data"))) goto error;
+    if (!(str_on_fin = PyUnicode_InternFromString("on_fin"))) goto error;
+    if (!(str_on_datagrams = PyUnicode_InternFromString("on_datagrams"))) goto error;
+    if (!(str_on_writable = PyUnicode_InternFromString("on_writable"))) goto error;
+    if (!(str_on_started = PyUnicode_InternFromString("on_started"))) goto error;
+    if (!(str_on_close = PyUnicode_InternFromString("on_close"))) goto error;
+    if (!(str_on_body = PyUnicode_InternFromString("on_body"))) goto error;
+    if (InitScope() == -1) goto error;
+
+    if (!(route = PyImport_ImportModule("fpy3.router.route"))) goto error;
+    if (!(RouteNotFoundException = PyObject_GetAttrString(route, "RouteNotFoundException"))) goto error;
+
+    if (!(request_capi = import_capi("fpy3.request.crequest"))) goto error;
+    if (!(matcher_capi = import_capi("fpy3.router.cmatcher"))) goto error;
+    if (!(response_capi = import_capi("fpy3.response.cresponse"))) goto error;
+
+    goto finally;
+
+    error:
+    Py_XDECREF(m);
+    m = NULL;
+
+    finally:
+    Py_XDECREF(route);
     return m;
 }
@@ -0,0 +1,582 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <zlib.h>
+
+// The server side of RFC 6455 framing: client frames are validated,
+// unmasked and reassembled into messages, server frames are built
+// unmasked. Messages are compressed with RFC 7692 permessage-deflate
+// when it was negotiated (see fpy3.protocol.websocket). A Codec belongs
+// to one connection and runs on its event loop.
+
+#define OP_CONTINUATION 0
+#define OP_TEXT 1
+#define OP_BINARY 2
+#define OP_CLOSE 8
+#define OP_PING 9
+#define OP_PONG 10
+
+#define CLOSE_PROTOCOL_ERROR 1002
+#define CLOSE_INVALID_DATA 1007
+#define CLOSE_TOO_BIG 1009
+
+#define KEEP_CAPACITY (64 * 1024)   // larger buffers are freed once empty
+
+static PyObject* ProtocolError;
+static PyObject* str_messages;
+
+typedef struct {
+    char* data;
+    size_t len;
+    size_t cap;
+} Buffer;
+
+static int Buffer_reserve(Buffer* buffer, size_t extra) {
+    if (buffer->len + extra <= buffer->cap) return 0;
+
+    size_t cap = buffer->cap ? buffer->cap : 4096;
+    while (cap < buffer->len + extra) cap *= 2;
+    char* data = realloc(buffer->data, cap);
+    if (!data) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    buffer->data = data;
+    buffer->cap = cap;
+    return 0;
+}
+
+static void Buffer_trim(Buffer* buffer) {
+    if (!buffer->len && buffer->cap > KEEP_CAPACITY) {
+        free(buffer->data);
+        buffer->data = NULL;
+        buffer->cap = 0;
+    }
+}
+
+typedef struct {
+    PyObject_HEAD
+    Buffer in;          // an incomplete frame
+    Buffer message;     // unmasked fragments of the message being received
+    Buffer scratch;     // inflated or deflated payloads
+    int opcode;         // of the message being received, 0 between messages
+    int compressed;
+    int failed;
+    size_t max_size;
+
+    int deflate;
+    int server_bits;
+    int client_bits;
+    int server_no_context_takeover;
+    int client_no_context_takeover;
+    size_t threshold;
+    int level;
+    z_stream inflater;
+    z_stream deflater;
+    int inflater_ready;
+    int deflater_ready;
+} Codec;
+
+static PyTypeObject CodecType;
+
+// XOR with the 4 byte key, 8 bytes at a time. dst may be src.
+static void Unmask(char* dst, const char* src, size_t len, const unsigned char* key) {
+    unsigned char key8[8] = {key[0], key[1], key[2], key[3], key[0], key[1], key[2], key[3]};
+    uint64_t key64;
+    size_t i = 0;
+
+    memcpy(&key64, key8, 8);
+    for (; i + 32 <= len; i += 32) {
+        uint64_t v[4];
+        memcpy(v, src + i, 32);
+        v[0] ^= key64;
+        v[1] ^= key64;
+        v[2] ^= key64;
+        v[3] ^= key64;
+        memcpy(dst + i, v, 32);
+    }
+    for (; i + 8 <= len; i += 8) {
+        uint64_t v;
+        memcpy(&v, src + i, 8);
+        v ^= key64;
+        memcpy(dst + i, &v, 8);
+    }
+    for (; i < len; ++i) dst[i] = src[i] ^ key[i & 3];
+}
+
+// Raise ProtocolError(code, reason), the connection is to be closed with code
+static void Fail(Codec* self, int code, const char* reason) {
+    self->failed = 1;
+    PyObject* args = Py_BuildValue("(is)", code, reason);
+    if (args) {
+        PyErr_SetObject(ProtocolError, args);
+        Py_DECREF(args);
+    }
+}
+
+// --- permessage-deflate ---
+
+// Inflate a message into scratch, at most max_size bytes
+static int Inflate(Codec* self, const char* data, size_t len) {
+    static const unsigned char tail[4] = {0x00, 0x00, 0xff, 0xff};
+    z_stream* z = &self->inflater;
+
+    if (!self->inflater_ready) {
+        memset(z, 0, sizeof(*z));
+        if (inflateInit2(z, -self->client_bits) != Z_OK) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->inflater_ready = 1;
+    }
+
+    self->scratch.len = 0;
+    for (int part = 0; part < 2; ++part) {
+        // the sender removed the tail of its sync flush
+        z->next_in = (Bytef*)(part ? (const char*)tail : data);
+        z->avail_in = (uInt)(part ? 4 : len);
+
+        for (;;) {
+            if (self->scratch.len == self->scratch.cap
+                    && Buffer_reserve(&self->scratch, self->scratch.cap ? self->scratch.cap : 16 * 1024) == -1)
+                return -1;
+            size_t room = self->scratch.cap - self->scratch.len;
+            // one byte past max_size tells a message that is too big
+            if (room > self->max_size + 1 - self->scratch.len) room = self->max_size + 1 - self->scratch.len;
+            z->next_out = (Bytef*)self->scratch.data + self->scratch.len;
+            z->avail_out = (uInt)room;
+
+            int rv = inflate(z, Z_SYNC_FLUSH);
+            self->scratch.len += room - z->avail_out;
+
+            if (self->scratch.len > self->max_size) {
+                Fail(self, CLOSE_TOO_BIG, "message too big");
+                return -1;
+            }
+            if (rv == Z_STREAM_END) {
+                // a final block ends the sender's context as well
+                inflateReset(z);
+                return 0;
+            }
+            if (rv != Z_OK && rv != Z_BUF_ERROR) {
+                Fail(self, CLOSE_INVALID_DATA, "invalid compressed data");
+                return -1;
+            }
+            // room left: the input is used up
+            if (z->avail_out) break;
+        }
+    }
+
+    if (self->client_no_context_takeover) inflateReset(z);
+    return 0;
+}
+
+// Deflate a message into scratch, without the sync flush tail
+static int Deflate(Codec* self, const char* data, size_t len) {
+    z_stream* z = &self->deflater;
+
+    if (!self->deflater_ready) {
+        memset(z, 0, sizeof(*z));
+        // zlib takes 8 for 9, so 8 is never negotiated
+        if (deflateInit2(z, self->level, Z_DEFLATED, -self->server_bits, 8, Z_DEFAULT_STRATEGY) != Z_OK) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        self->deflater_ready = 1;
+    }
+
+    self->scratch.len = 0;
+    z->next_in = (Bytef*)data;
+    z->avail_in = (uInt)len;
+    do {
+        if (Buffer_reserve(&self->scratch, len / 2 + 64) == -1) return -1;
+        size_t room = self->scratch.cap - self->scratch.len;
+        z->next_out = (Bytef*)self->scratch.data + self->scratch.len;
+        z->avail_out = (uInt)room;
+        if (deflate(z, Z_SYNC_FLUSH) == Z_STREAM_ERROR) {
+            PyErr_SetString(PyExc_RuntimeError, "deflate failed");
+            return -1;
+        }
+        self->scratch.len += room - z->avail_out;
+    } while (!z->avail_out);
+
+    if (self->scratch.len >= 4) self->scratch.len -= 4;
+    if (self->server_no_context_takeover) deflateReset(z);
+    return 0;
+}
+
+// --- Receiving ---
+
+static PyObject* MakeData(Codec* self, int opcode, const char* data, size_t len) {
+    if (opcode == OP_BINARY) return PyBytes_FromStringAndSize(data, (Py_ssize_t)len);
+
+    PyObject* text = PyUnicode_DecodeUTF8(data, (Py_ssize_t)len, NULL);
+    if (!text && PyErr_ExceptionMatches(PyExc_UnicodeDecodeError)) {
+        PyErr_Clear();
+        Fail(self, CLOSE_INVALID_DATA, "invalid UTF-8");
+    }
+    return text;
+}
+
+// An unfragmented, uncompressed message straight from the frame
+static PyObject* MakeDirect(Codec* self, int opcode, const char* payload, size_t len, const unsigned char* key) {
+    if (opcode == OP_BINARY) {
+        PyObject* bytes = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)len);
+        if (bytes) Unmask(PyBytes_AS_STRING(bytes), payload, len, key);
+        return bytes;
+    }
+
+    self->scratch.len = 0;
+    if (Buffer_reserve(&self->scratch, len) == -1) return NULL;
+    Unmask(self->scratch.data, payload, len, key);
+    return MakeData(self, opcode, self->scratch.data, len);
+}
+
+static PyObject* MakeControl(Codec* self, int opcode, const char* payload, size_t len, const unsigned char* key) {
+    char data[125];
+    Unmask(data, payload, len, key);
+
+    if (opcode != OP_CLOSE) return PyBytes_FromStringAndSize(data, (Py_ssize_t)len);
+
+    if (!len) return Py_BuildValue("(is)", 1005, "");
+    if (len == 1) {
+        Fail(self, CLOSE_PROTOCOL_ERROR, "invalid close frame");
+        return NULL;
+    }
+
+    int code = (unsigned char)data[0] << 8 | (unsigned char)data[1];
+    if (!((code >= 1000 && code <= 1003) || (code >= 1007 && code <= 1014) || (code >= 3000 && code <= 4999))) {
+        Fail(self, CLOSE_PROTOCOL_ERROR, "invalid close code");
+        return NULL;
+    }
+
+    PyObject* reason = MakeData(self, OP_TEXT, data + 2, len - 2);
+    if (!reason) return NULL;
+    return Py_BuildValue("(iN)", code, reason);
+}
+
+// [(opcode, data), ...] of the messages completed by data: str for text,
+// bytes for binary, ping and pong, (code, reason) for close. A protocol
+// violation raises ProtocolError(code, reason) with the messages before
+// it in its messages attribute.
+static PyObject* Codec_feed(Codec* self, PyObject* arg) {
+    Py_buffer view;
+    PyObject *messages = NULL, *message = NULL;
+    const unsigned char* data;
+    size_t len, pos = 0;
+
+    if (self->failed) return PyList_New(0);
+    if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) == -1) return NULL;
+    if (!(messages = PyList_New(0))) goto error;
+
+    if (self->in.len) {
+        if (Buffer_reserve(&self->in, (size_t)view.len) == -1) goto error;
+        memcpy(self->in.data + self->in.len, view.buf, (size_t)view.len);
+        self->in.len += (size_t)view.len;
+        data = (const unsigned char*)self->in.data;
+        len = self->in.len;
+    } else {
+        data = view.buf;
+        len = (size_t)view.len;
+    }
+
+    for (;;) {
+        const unsigned char* p = data + pos;
+        size_t avail = len - pos, head = 2;
+        uint64_t n;
+
+        if (avail < 2) break;
+        int fin = p[0] & 0x80, rsv1 = p[0] & 0x40, opcode = p[0] & 0x0f;
+        n = p[1] & 0x7f;
+        if (n == 126) {
+            if (avail < 4) break;
+            n = (uint64_t)p[2] << 8 | p[3];
+            head = 4;
+        } else if (n == 127) {
+            if (avail < 10) break;
+            n = 0;
+            for (int i = 2; i < 10; ++i) n = n << 8 | p[i];
+            head = 10;
+        }
+
+        // checked before the payload arrives, a frame too big is not buffered
+        if (!(p[1] & 0x80)) {
+            Fail(self, CLOSE_PROTOCOL_ERROR, "unmasked frame");
+            goto error;
+        }
+        if (p[0] & 0x30) {
+            Fail(self, CLOSE_PROTOCOL_ERROR, "reserved bits set");
+            goto error;
+        }
+        if (opcode >= OP_CLOSE) {
+            if (opcode > OP_PONG || !fin || n > 125 || rsv1) {
+                Fail(self, CLOSE_PROTOCOL_ERROR, "invalid control frame");
+                goto error;
+            }
+        } else {
+            if (opcode > OP_BINARY) {
+                Fail(self, CLOSE_PROTOCOL_ERROR, "unknown opcode");
+                goto error;
+            }
+            if (opcode == OP_CONTINUATION ? !self->opcode : self->opcode) {
+                Fail(self, CLOSE_PROTOCOL_ERROR, "unexpected continuation frame");
+                goto error;
+            }
+            if (rsv1 && (opcode == OP_CONTINUATION || !self->deflate)) {
+                Fail(self, CLOSE_PROTOCOL_ERROR, "unexpected compressed frame");
+                goto error;
+            }
+            if (n > self->max_size || self->message.len + n > self->max_size) {
+                Fail(self, CLOSE_TOO_BIG, "message too big");
+                goto error;
+            }
+        }
+
+        if (avail - head < 4 || avail - head - 4 < n) break;
+        const unsigned char* key = p + head;
+        const char* payload = (const char*)p + head + 4;
+        pos += head + 4 + (size_t)n;
+
+        if (opcode >= OP_CLOSE) {
+            if (!(message = MakeControl(self, opcode, payload, (size_t)n, key))) goto error;
+        } else {
+            if (opcode != OP_CONTINUATION) {
+                self->opcode = opcode;
+                self->compressed = rsv1 != 0;
+            }
+
+            if (fin && !self->message.len && !self->compressed) {
+                if (!(message = MakeDirect(self, self->opcode, payload, (size_t)n, key))) goto error;
+            } else {
+                if (Buffer_reserve(&self->message, (size_t)n) == -1) goto error;
+                Unmask(self->message.data + self->message.len, payload, (size_t)n, key);
+                self->message.len += (size_t)n;
+                if (!fin) continue;
+
+                if (self->compressed) {
+                    if (Inflate(self, self->message.data, self->message.len) == -1) goto error;
+                    message = MakeData(self, self->opcode, self->scratch.data, self->scratch.len);
+                } else {
+                    message = MakeData(self, self->opcode, self->message.data, self->message.len);
+                }
+                self->message.len = 0;
+                Buffer_trim(&self->message);
+                if (!message) goto error;
+            }
+
+            opcode = self->opcode;
+            self->opcode = 0;
+        }
+
+        PyObject* item = Py_BuildValue("(iN)", opcode, message);
+        message = NULL;
+        if (!item) goto error;
+        if (PyList_Append(messages, item) == -1) {
+            Py_DECREF(item);
+            goto error;
+        }
+        Py_DECREF(item);
+    }
+
+    // keep what is left of an incomplete frame
+    if (data == (const unsigned char*)self->in.data) {
+        memmove(self->in.data, self->in.data + pos, len - pos);
+        self->in.len = len - pos;
+    } else if (pos < len) {
+        if (Buffer_reserve(&self->in, len - pos) == -1) goto error;
+        memcpy(self->in.data, data + pos, len - pos);
+        self->in.len = len - pos;
+    }
+    self->scratch.len = 0;
+    Buffer_trim(&self->in);
+    Buffer_trim(&self->scratch);
+
+    PyBuffer_Release(&view);
+    return messages;
+
+    error:
+    PyBuffer_Release(&view);
+    if (messages && PyErr_ExceptionMatches(ProtocolError)) {
+        PyObject *type, *value, *traceback;
+        PyErr_Fetch(&type, &value, &traceback);
+        PyErr_NormalizeException(&type, &value, &traceback);
+        if (PyObject_SetAttr(value, str_messages, messages) == -1) PyErr_Clear();
+        PyErr_Restore(type, value, traceback);
+    }
+    Py_XDECREF(messages);
+    return NULL;
+}
+
+// --- Sending ---
+
+static PyObject* Frame(int opcode, int rsv1, const char* payload, size_t len) {
+    size_t head = len < 126 ? 2 : len <= 0xffff ? 4 : 10;
+    PyObject* frame = PyBytes_FromStringAndSize(NULL, (Py_ssize_t)(head + len));
+    if (!frame) return NULL;
+
+    unsigned char* p = (unsigned char*)PyBytes_AS_STRING(frame);
+    p[0] = 0x80 | (rsv1 ? 0x40 : 0) | opcode;
+    if (head == 2) {
+        p[1] = (unsigned char)len;
+    } else if (head == 4) {
+        p[1] = 126;
+        p[2] = (unsigned char)(len >> 8);
+        p[3] = (unsigned char)len;
+    } else {
+        p[1] = 127;
+        for (int i = 0; i < 8; ++i) p[2 + i] = (unsigned char)((uint64_t)len >> (56 - 8 * i));
+    }
+    memcpy(p + head, payload, len);
+
+    return frame;
+}
+
+// The frame of a text (str) or binary (bytes-like) message, compressed
+// when deflate was negotiated and the message is not below the threshold
+static PyObject* Codec_message(Codec* self, PyObject* arg) {
+    Py_buffer view;
+    const char* data;
+    Py_ssize_t len;
+    int opcode;
+    PyObject* result = NULL;
+
+    if (PyUnicode_Check(arg)) {
+        if (!(data = PyUnicode_AsUTF8AndSize(arg, &len))) return NULL;
+        opcode = OP_TEXT;
+        view.obj = NULL;
+    } else {
+        if (PyObject_GetBuffer(arg, &view, PyBUF_SIMPLE) == -1) return NULL;
+        data = view.buf;
+        len = view.len;
+        opcode = OP_BINARY;
+    }
+
+    if (self->deflate && (size_t)len >= self->threshold) {
+        if (Deflate(self, data, (size_t)len) == -1) goto finally;
+        result = Frame(opcode, 1, self->scratch.data, self->scratch.len);
+        self->scratch.len = 0;
+        Buffer_trim(&self->scratch);
+    } else {
+        result = Frame(opcode, 0, data, (size_t)len);
+    }
+
+    finally:
+    if (view.obj) PyBuffer_Release(&view);
+    return result;
+}
+
+// The frame of a close, ping or pong
+static PyObject* Codec_control(Codec* self, PyObject* args) {
+    int opcode;
+    const char* payload = "";
+    Py_ssize_t len = 0;
+
+    if (!PyArg_ParseTuple(args, "i|y#", &opcode, &payload, &len)) return NULL;
+    if (opcode < OP_CLOSE || opcode > OP_PONG) {
+        PyErr_SetString(PyExc_ValueError, "not a control opcode");
+        return NULL;
+    }
+    if (len > 125) {
+        PyErr_SetString(PyExc_ValueError, "control frame payload over 125 bytes");
+        return NULL;
+    }
+
+    return Frame(opcode, 0, payload, (size_t)len);
+}
+
+// --- Codec ---
+
+static int Codec_init(Codec* self, PyObject* args, PyObject* kwds) {
+    static char* kwlist[] = {"max_size", "deflate", "server_max_window_bits", "client_max_window_bits",
+        "server_no_context_takeover", "client_no_context_takeover", "threshold", "level", NULL};
+    Py_ssize_t max_size = 1 << 20, threshold = 0;
+
+    self->server_bits = self->client_bits = 15;
+    self->level = Z_DEFAULT_COMPRESSION;
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|npiippni", kwlist, &max_size, &self->deflate,
+            &self->server_bits, &self->client_bits, &self->server_no_context_takeover,
+            &self->client_no_context_takeover, &threshold, &self->level))
+        return -1;
+
+    if (max_size <= 0 || threshold < 0) {
+        PyErr_SetString(PyExc_ValueError, "max_size must be positive and threshold not negative");
+        return -1;
+    }
+    if (self->server_bits < 9 || self->server_bits > 15 || self->client_bits < 8 || self->client_bits > 15) {
+        PyErr_SetString(PyExc_ValueError, "window bits out of range");
+        return -1;
+    }
+    self->max_size = (size_t)max_size;
+    self->threshold = (size_t)threshold;
+
+    return 0;
+}
+
+static void Codec_dealloc(Codec* self) {
+    free(self->in.data);
+    free(self->message.data);
+    free(self->scratch.data);
+    if (self->inflater_ready) inflateEnd(&self->inflater);
+    if (self->deflater_ready) deflateEnd(&self->deflater);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject* Codec_get_deflate(Codec* self, void* closure) {
+    return PyBool_FromLong(self->deflate);
+}
+
+static PyMethodDef Codec_methods[] = {
+    {"feed", (PyCFunction)Codec_feed, METH_O, ""},
+    {"message", (PyCFunction)Codec_message, METH_O, ""},
+    {"control", (PyCFunction)Codec_control, METH_VARARGS, ""},
+    {NULL}
+};
+
+static PyGetSetDef Codec_getset[] = {
+    {"deflate", (getter)Codec_get_deflate, NULL, "permessage-deflate in use", NULL},
+    {NULL}
+};
+
+static PyTypeObject CodecType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "cwebsocket.Codec",
+    .tp_basicsize = sizeof(Codec),
+    .tp_dealloc = (destructor)Codec_dealloc,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Codec",
+    .tp_methods = Codec_methods,
+    .tp_getset = Codec_getset,
+    .tp_init = (initproc)Codec_init,
+    .tp_new = PyType_GenericNew,
+};
+
+static PyModuleDef cwebsocket = { PyModuleDef_HEAD_INIT, "cwebsocket", "", -1, NULL, NULL, NULL, NULL, NULL };
+
+PyMODINIT_FUNC PyInit_cwebsocket(void) {
+    PyObject* m = NULL;
+
+    if (PyType_Ready(&CodecType) < 0) goto error;
+    if (!(m = PyModule_Create(&cwebsocket))) goto error;
+    Py_INCREF(&CodecType);
+    PyModule_AddObject(m, "Codec", (PyObject*)&CodecType);
+
+    if (!(ProtocolError = PyErr_NewException("cwebsocket.ProtocolError", PyExc_ValueError, NULL))) goto error;
+    Py_INCREF(ProtocolError);
+    PyModule_AddObject(m, "ProtocolError", ProtocolError);
+    if (!(str_messages = PyUnicode_InternFromString("messages"))) goto error;
+
+    PyModule_AddIntConstant(m, "OP_TEXT", OP_TEXT);
+    PyModule_AddIntConstant(m, "OP_BINARY", OP_BINARY);
+    PyModule_AddIntConstant(m, "OP_CLOSE", OP_CLOSE);
+    PyModule_AddIntConstant(m, "OP_PING", OP_PING);
+    PyModule_AddIntConstant(m, "OP_PONG", OP_PONG);
+
+    goto finally;
+
+    error:
+    Py_XDECREF(m);
+    m = NULL;
+
+    finally:
+    return m;
+}
@@ -5,3 +5,4 @@ class Protocol:
     def connection_made(self, transport: Any) -> None: ...
     def data_received(self, data: bytes) -> None: ...
     def connection_lost(self, exc: Any) -> None: ...
+    def upgrade(self, protocol: Any) -> None: ...
@@ -0,0 +1,370 @@
+import json
+import os
+import time
+
+EXECUTION_PROFILES = {
+    'low_latency': 0,
+    'max_throughput': 1,
+    'scavenger': 2,
+    'real_time': 3,
+}
+
+CONGESTION_CONTROL = {
+    'cubic': 0,
+    'bbr': 1,
+}
+
+SERVER_RESUMPTION = {
+    'none': 0,
+    'resume': 1,
+    'zero_rtt': 2,
+}
+
+# attribute name -> QUIC_SETTINGS field, see QuicServer_set_settings
+_FIELDS = {
+    'idle_timeout_ms': 'IdleTimeoutMs',
+    'handshake_idle_timeout_ms': 'HandshakeIdleTimeoutMs',
+    'peer_bidi_stream_count': 'PeerBidiStreamCount',
+    'peer_unidi_stream_count': 'PeerUnidiStreamCount',
+    'stream_recv_window': 'StreamRecvWindowDefault',
+    'stream_recv_buffer': 'StreamRecvBufferDefault',
+    'conn_flow_control_window': 'ConnFlowControlWindow',
+    'initial_window_packets': 'InitialWindowPackets',
+    'initial_rtt_ms': 'InitialRttMs',
+    'max_ack_delay_ms': 'MaxAckDelayMs',
+    'keep_alive_interval_ms': 'KeepAliveIntervalMs',
+    'max_bytes_per_key': 'MaxBytesPerKey',
+    'send_buffering': 'SendBufferingEnabled',
+    'pacing': 'PacingEnabled',
+    'hystart': 'HyStartEnabled',
+    'migration': 'MigrationEnabled',
+    'ecn': 'EcnEnabled',
+    'datagrams': 'DatagramReceiveEnabled',
+}
+
+# attribute name -> nghttp3_settings field
+_H3_FIELDS = {
+    'max_field_section_size': 'max_field_section_size',
+    'qpack_max_dtable_capacity': 'qpack_max_dtable_capacity',
+    'qpack_encoder_max_dtable_capacity': 'qpack_encoder_max_dtable_capacity',
+    'qpack_blocked_streams': 'qpack_blocked_streams',
+    'qpack_try_index': 'qpack_try_index',
+    'webtransport_max_sessions': 'webtransport_max_sessions',
+}
+
+_POWER_OF_TWO = ('stream_recv_window', 'stream_recv_buffer')
+
+# the control and two QPACK streams of HTTP/3, and what the default
+# peer_unidi_stream_count adds for each WebTransport session
+_H3_UNIDI_STREAMS = 3
+_WEBTRANSPORT_UNIDI_STREAMS = 4
+
+
+class QuicSettings:
+    """MsQuic tuning for a QuicServer.
+
+    Every option left as None keeps the MsQuic (or, for the HTTP/3 and
+    QPACK options, nghttp3) default. ``datagrams`` turns on QUIC DATAGRAM
+    frames and HTTP datagrams, ``webtransport_max_sessions`` WebTransport
+    (and datagrams with it) for ASGIServer. Pass an instance as
+    ``QuicServer(app, loop, settings=...)`` or
+    ``Application(enable_http3=True, quic_settings=...)``.
+
+    ``peer_unidi_stream_count`` left as None is 3, the streams HTTP/3
+    itself opens, plus 4 for each WebTransport session.
+    """
+
+    def __init__(self, *, execution_profile='low_latency',
+                 congestion_control=None, idle_timeout_ms=5000,
+                 handshake_idle_timeout_ms=None, peer_bidi_stream_count=100,
+                 peer_unidi_stream_count=None, stream_recv_window=None,
+                 stream_recv_buffer=None, conn_flow_control_window=None,
+                 initial_window_packets=None, initial_rtt_ms=None,
+                 max_ack_delay_ms=None, keep_alive_interval_ms=None,
+                 max_bytes_per_key=None, send_buffering=None, pacing=None,
+                 hystart=None, migration=None, ecn=None,
+                 server_resumption=None, max_field_section_size=None,
+                 qpack_max_dtable_capacity=None,
+                 qpack_encoder_max_dtable_capacity=None,
+                 qpack_blocked_streams=None, qpack_try_index=None,
+                 datagrams=None, webtransport_max_sessions=None):
+        if execution_profile not in EXECUTION_PROFILES:
+            raise ValueError(
+                'execution_profile must be one of {}'
+                .format(', '.join(EXECUTION_PROFILES)))
+        if congestion_control is not None \
+                and congestion_control not in CONGESTION_CONTROL:
+            raise ValueError(
+                'congestion_control must be one of {}'
+                .format(', '.join(CONGESTION_CONTROL)))
+        if server_resumption is not None \
+                and server_resumption not in SERVER_RESUMPTION:
+            raise ValueError(
+                'server_resumption must be one of {}'
+                .format(', '.join(SERVER_RESUMPTION)))
+
+        self.execution_profile = execution_profile
+        self.congestion_control = congestion_control
+        self.server_resumption = server_resumption
+        self.idle_timeout_ms = idle_timeout_ms
+        self.handshake_idle_timeout_ms = handshake_idle_timeout_ms
+        self.peer_bidi_stream_count = peer_bidi_stream_count
+        self.peer_unidi_stream_count = peer_unidi_stream_count
+        self.stream_recv_window = stream_recv_window
+        self.stream_recv_buffer = stream_recv_buffer
+        self.conn_flow_control_window = conn_flow_control_window
+        self.initial_window_packets = initial_window_packets
+        self.initial_rtt_ms = initial_rtt_ms
+        self.max_ack_delay_ms = max_ack_delay_ms
+        self.keep_alive_interval_ms = keep_alive_interval_ms
+        self.max_bytes_per_key = max_bytes_per_key
+        self.send_buffering = send_buffering
+        self.pacing = pacing
+        self.hystart = hystart
+        self.migration = migration
+        self.ecn = ecn
+        self.max_field_section_size = max_field_section_size
+        self.qpack_max_dtable_capacity = qpack_max_dtable_capacity
+        self.qpack_encoder_max_dtable_capacity = \
+            qpack_encoder_max_dtable_capacity
+        self.qpack_blocked_streams = qpack_blocked_streams
+        self.qpack_try_index = qpack_try_index
+        self.datagrams = datagrams
+        self.webtransport_max_sessions = webtransport_max_sessions
+
+        for name in (*_FIELDS, *_H3_FIELDS):
+            value = getattr(self, name)
+            if value is None or isinstance(value, bool):
+                continue
+            if not isinstance(value, int) or value < 0:
+                raise ValueError(
+                    '{} must be a non-negative integer'.format(name))
+            if name in _POWER_OF_TWO and value & (value - 1):
+                raise ValueError('{} must be a power of two'.format(name))
+
+        if self.peer_unidi_stream_count is None:
+            self.peer_unidi_stream_count = _H3_UNIDI_STREAMS + \
+                _WEBTRANSPORT_UNIDI_STREAMS * int(webtransport_max_sessions or 0)
+
+    @classmethod
+    def api(cls, **kwargs):
+        """Many small requests: low latency workers, modest windows and
+        plenty of concurrent streams per connection."""
+        options = dict(
+            execution_profile='low_latency',
+            congestion_control='cubic',
+            idle_timeout_ms=30000,
+            peer_bidi_stream_count=256,
+            stream_recv_window=64 * 1024,
+            conn_flow_control_window=1024 * 1024,
+            send_buffering=True,
+            pacing=True,
+            server_resumption='resume',
+            qpack_max_dtable_capacity=4096,
+            qpack_encoder_max_dtable_capacity=4096,
+            qpack_blocked_streams=16,
+            qpack_try_index=True)
+        options.update(kwargs)
+
+        return cls(**options)
+
+    @classmethod
+    def bulk(cls, **kwargs):
+        """Large downloads: throughput workers, BBR and windows big enough
+        to keep a high bandwidth-delay product path full."""
+        options = dict(
+            execution_profile='max_throughput',
+            congestion_control='bbr',
+            idle_timeout_ms=30000,
+            peer_bidi_stream_count=32,
+            stream_recv_window=8 * 1024 * 1024,
+            conn_flow_control_window=32 * 1024 * 1024,
+            send_buffering=True,
+            pacing=True,
+            server_resumption='resume')
+        options.update(kwargs)
+
+        return cls(**options)
+
+    def _native(self):
+        fields = {}
+        for name, field in _FIELDS.items():
+            value = getattr(self, name)
+            if value is not None:
+                fields[field] = int(value)
+
+        if self.congestion_control is not None:
+            fields['CongestionControlAlgorithm'] = \
+                CONGESTION_CONTROL[self.congestion_control]
+        if self.server_resumption is not None:
+            fields['ServerResumptionLevel'] = \
+                SERVER_RESUMPTION[self.server_resumption]
+
+        h3_fields = {}
+        for name, field in _H3_FIELDS.items():
+            value = getattr(self, name)
+            if value is not None:
+                h3_fields[field] = int(value)
+
+        # WebTransport is extended CONNECT and needs HTTP datagrams
+        if self.webtransport_max_sessions:
+            fields['DatagramReceiveEnabled'] = 1
+            h3_fields['enable_connect_protocol'] = 1
+        if fields.get('DatagramReceiveEnabled'):
+            h3_fields['h3_datagram'] = 1
+
+        return EXECUTION_PROFILES[self.execution_profile], fields, h3_fields
+
+    def __repr__(self):
+        options = ('{}={!r}'.format(name, value)
+                   for name, value in vars(self).items()
+                   if value is not None)
+
+        return 'QuicSettings({})'.format(', '.join(options))
+
+
+class Histogram:
+    """Power of two buckets, bucket i counts values in [2**(i-1), 2**i)."""
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.buckets[min(int(value).bit_length(), 63)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile."""
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return (1 << i) - 1 if i else 0
+
+        return (1 << 63) - 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class QuicStats:
+    """Samples QuicServer.connection_stats() every interval seconds.
+
+    Keeps per-worker histograms of RTT, congestion window and loss and,
+    when qlog is a path, appends qlog style JSON-SEQ records to it. The path
+    may contain ``{pid}`` so that workers write separate files.
+    """
+
+    HISTOGRAMS = ('rtt_us', 'min_rtt_us', 'cwnd', 'loss_ppm', 'handshake_us')
+
+    def __init__(self, server, loop, *, interval=1.0, qlog=None):
+        self.server = server
+        self.loop = loop
+        self.interval = interval
+        self.histograms = {name: Histogram() for name in self.HISTOGRAMS}
+        self._seen = {}
+        self._handle = None
+        self._qlog = None
+        self._qlog_path = qlog.format(pid=os.getpid()) if qlog else None
+
+    def start(self):
+        if self._qlog_path:
+            self._qlog = open(self._qlog_path, 'a', buffering=1)
+            self._write({
+                'qlog_version': '0.3',
+                'qlog_format': 'JSON-SEQ',
+                'title': 'fpy3',
+                'trace': {
+                    'vantage_point': {'type': 'server'},
+                    'common_fields': {'time_format': 'absolute'},
+                },
+            })
+
+        self._handle = self.loop.call_later(self.interval, self._sample)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        if self._qlog:
+            self._qlog.close()
+            self._qlog = None
+
+    def snapshot(self):
+        return {name: histogram.snapshot()
+                for name, histogram in self.histograms.items()}
+
+    def _write(self, record):
+        self._qlog.write('\x1e' + json.dumps(record) + '\n')
+
+    def _event(self, now, name, group_id, data):
+        self._write({
+            'time': now * 1000,
+            'name': name,
+            'group_id': str(group_id),
+            'data': data,
+        })
+
+    def _sample(self):
+        self._handle = self.loop.call_later(self.interval, self._sample)
+
+        try:
+            connections = self.server.connection_stats()
+        except OSError:
+            return
+
+        now = time.time()
+        seen = {}
+        for stats in connections:
+            cid = stats['correlation_id']
+            seen[cid] = stats
+            previous = self._seen.get(cid)
+
+            if stats['rtt_us']:
+                self.histograms['rtt_us'].add(stats['rtt_us'])
+                self.histograms['min_rtt_us'].add(stats['min_rtt_us'])
+            self.histograms['cwnd'].add(stats['cwnd'])
+
+            sent = stats['send_packets'] - (previous['send_packets'] if previous else 0)
+            lost = stats['lost_packets'] - (previous['lost_packets'] if previous else 0)
+            if sent > 0:
+                self.histograms['loss_ppm'].add(lost * 1000000 // sent)
+
+            if previous is None and stats['handshake_us']:
+                self.histograms['handshake_us'].add(stats['handshake_us'])
+
+            if not self._qlog:
+                continue
+
+            if previous is None:
+                remote = stats['remote'] or ('', 0)
+                self._event(now, 'connectivity:connection_started', cid, {
+                    'dst_ip': remote[0], 'dst_port': remote[1]})
+
+            self._event(now, 'recovery:metrics_updated', cid, {
+                'min_rtt': stats['min_rtt_us'] / 1000,
+                'smoothed_rtt': stats['rtt_us'] / 1000,
+                'congestion_window': stats['cwnd'],
+                'packets_sent': stats['send_packets'],
+                'packets_lost': stats['lost_packets'],
+                'packets_received': stats['recv_packets'],
+                'congestion_events': stats['congestion_events'],
+            })
+
+        if self._qlog:
+            for cid in self._seen.keys() - seen.keys():
+                self._event(now, 'connectivity:connection_closed', cid, {})
+
+        self._seen = seen
@@ -0,0 +1,129 @@
+"""Connection ID based steering of QUIC packets between worker processes.
+
+Every worker listens on the same UDP port and the kernel spreads datagrams
+over the SO_REUSEPORT group by 4-tuple hash. That is fine until a client
+migrates or its NAT rebinds: the new 4-tuple hashes to another worker which
+knows nothing about the connection.
+
+Workers therefore run MsQuic with a fixed server ID equal to their index
+(``cquic.set_server_id``), which MsQuic embeds in every connection ID it
+issues: one random octet followed by the 32 bit server ID in host order.
+A classic BPF program attached to the reuseport group reads the server ID
+back from the destination connection ID of short header packets and picks
+one of that worker's sockets. Long header packets (handshakes) and anything
+the program does not recognise fall back to the kernel hash.
+
+The socket index within a group is the order in which sockets joined it, so
+workers must bind one after another and every worker must open the same
+number of sockets.
+"""
+import ctypes
+import os
+import socket
+import struct
+
+SO_ATTACH_REUSEPORT_CBPF = 51
+
+BPF_LD_B_ABS = 0x30
+BPF_JMP_JSET_K = 0x45
+BPF_JMP_JGE_K = 0x35
+BPF_ALU_MUL_K = 0x24
+BPF_ALU_MOD_K = 0x94
+BPF_ALU_ADD_X = 0x0c
+BPF_MISC_TAX = 0x07
+BPF_RET_A = 0x16
+BPF_RET_K = 0x06
+
+# returning an index past the group makes the kernel select by hash
+FALLBACK = 0xffffffff
+
+# UDP payload offsets: header form bit, server ID low octet, random CID octet
+HEADER_FORM = 0
+SERVER_ID = 2
+CID_RANDOM = 8
+
+
+def steering_program(workers, sockets_per_worker):
+    """Return the program as a list of (code, jt, jf, k) instructions."""
+    if not 0 < workers <= 256:
+        raise ValueError('workers must be 1-256')
+    if sockets_per_worker < 1:
+        raise ValueError('sockets_per_worker must be positive')
+
+    return [
+        (BPF_LD_B_ABS, 0, 0, HEADER_FORM),
+        (BPF_JMP_JSET_K, 8, 0, 0x80),       # long header -> fallback
+        (BPF_LD_B_ABS, 0, 0, SERVER_ID),
+        (BPF_JMP_JGE_K, 6, 0, workers),     # not one of ours -> fallback
+        (BPF_ALU_MUL_K, 0, 0, sockets_per_worker),
+        (BPF_MISC_TAX, 0, 0, 0),
+        (BPF_LD_B_ABS, 0, 0, CID_RANDOM),
+        (BPF_ALU_MOD_K, 0, 0, sockets_per_worker),
+        (BPF_ALU_ADD_X, 0, 0, 0),
+        (BPF_RET_A, 0, 0, 0),
+        (BPF_RET_K, 0, 0, FALLBACK),
+    ]
+
+
+def attach_steering(family, address, port, workers, sockets_per_worker):
+    """Attach the steering program to the reuseport group bound to
+    address:port.
+
+    Joins the group with a throwaway socket which is the last member and
+    leaves again without reordering the workers' sockets.
+    """
+    program = steering_program(workers, sockets_per_worker)
+    filters = ctypes.create_string_buffer(
+        b''.join(struct.pack('=HBBI', *insn) for insn in program))
+    fprog = struct.pack(
+        '=HxxxxxxQ' if struct.calcsize('P') == 8 else '=HxxI',
+        len(program), ctypes.addressof(filters))
+
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        sock.bind((address, port))
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+    finally:
+        sock.close()
+
+
+def _decode_address(family, value):
+    if family == socket.AF_INET:
+        return socket.inet_ntop(family, struct.pack('<I', int(value, 16)))
+
+    return socket.inet_ntop(family, b''.join(
+        struct.pack('<I', int(value[i:i + 8], 16)) for i in range(0, 32, 8)))
+
+
+def bound_sockets(port, pid='self'):
+    """Return (family, address) for every UDP socket of the process bound to
+    port, read from procfs."""
+    inodes = set()
+    fd_dir = '/proc/{}/fd'.format(pid)
+    for fd in os.listdir(fd_dir):
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+
+    sockets = []
+    for family, table in ((socket.AF_INET, '/proc/net/udp'),
+                          (socket.AF_INET6, '/proc/net/udp6')):
+        try:
+            with open(table) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+
+        for line in lines:
+            fields = line.split()
+            address, _, local_port = fields[1].partition(':')
+            if int(local_port, 16) == port and fields[9] in inodes:
+                sockets.append((family, _decode_address(family, address)))
+
+    return sockets
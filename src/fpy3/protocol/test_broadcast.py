@@ -0,0 +1,118 @@
+import pytest
+
+cbroadcast = pytest.importorskip('fpy3.protocol.cbroadcast')
+
+from fpy3.protocol.broadcast import (  # noqa: E402
+    SSE, WEBSOCKET, Broadcast, event_stream_head)
+
+
+class Transport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.limits = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def set_write_buffer_limits(self, high=None):
+        self.limits = high
+
+
+class Stream:
+    def __init__(self):
+        self.sent = []
+        self.buffered = 0
+
+    def send_data(self, data, end_stream):
+        self.sent.append((data, end_stream))
+
+
+class Loop:
+    def __init__(self):
+        self.scheduled = []
+
+    def call_later(self, delay, callback):
+        self.scheduled.append(callback)
+        return self
+
+
+def test_render():
+    hub = Broadcast(Loop())
+    sse, ws, stream = Transport(), Transport(), Stream()
+    hub.subscribe('news', sse)
+    hub.subscribe('news', ws, WEBSOCKET)
+    hub.subscribe('news', stream)
+
+    assert sse.limits == 256 * 1024
+    assert hub.publish('news', 'one\ntwo\r\nthree', event='e', id='7') == 3
+    assert sse.written == [b'event: e\nid: 7\ndata: one\ndata: two\ndata: three\n\n']
+    assert ws.written == [b'\x81\x0eone\ntwo\r\nthree']
+    # the same rendered bytes go to every subscriber of a framing
+    assert stream.sent[0][0] is sse.written[0]
+
+    hub.publish('news', b'\x00\x01')
+    assert ws.written[1] == b'\x82\x02\x00\x01'
+    assert hub.publish('other', 'x') == 0
+    with pytest.raises(ValueError):
+        hub.publish('news', 'x', id='1\n2')
+
+
+def test_slow():
+    loop = Loop()
+    hub = Broadcast(loop, buffer_limit=100)
+    transport, stream, latest = Transport(), Stream(), Stream()
+    subscriber = hub.subscribe('news', transport)
+    hub.subscribe('news', stream)
+    hub.subscribe('news', latest, coalesce=True)
+
+    subscriber.pause_writing()
+    stream.buffered = latest.buffered = 101
+    assert hub.publish('news', '1') == 0
+    assert transport.closed and stream.sent == [(b'', True)]
+    assert len(hub) == 1
+
+    hub.publish('news', '2')
+    assert latest.sent == [] and hub.channels['news'].pending
+    assert len(loop.scheduled) == 1
+
+    # only the newest event is sent once the stream caught up
+    latest.buffered = 0
+    loop.scheduled.pop()()
+    assert latest.sent == [(b'data: 2\n\n', False)]
+    assert loop.scheduled == []
+
+
+def test_gone():
+    hub = Broadcast(Loop())
+    stream, transport = Stream(), Transport()
+    hub.subscribe('news', stream)
+    subscriber = hub.subscribe('news', transport)
+
+    stream.buffered = None
+    subscriber.connection_lost(None)
+    assert hub.publish('news', 'x') == 0
+    assert hub.channels == {} and len(hub) == 0
+    assert stream.sent == [] and transport.written == [] and not transport.closed
+
+
+def test_close():
+    hub = Broadcast(Loop())
+    stream, transport = Stream(), Transport()
+    hub.subscribe('a', stream)
+    hub.subscribe('b', transport)
+
+    hub.close()
+    assert stream.sent == [(b'', True)] and transport.closed
+    assert len(hub) == 0
+
+
+def test_event_stream_head():
+    head = event_stream_head([('X-Id', '1')], retry=500)
+    assert head.startswith(b'HTTP/1.1 200 OK\r\n')
+    assert b'Content-Type: text/event-stream\r\n' in head
+    assert head.endswith(b'X-Id: 1\r\n\r\nretry: 500\n\n')
+    assert SSE != WEBSOCKET
@@ -0,0 +1,129 @@
+"""Loopback HTTP/3 smoke tests of cquic, built against MsQuic and nghttp3,
+with aioquic as the client."""
+import asyncio
+import os
+import ssl
+
+import pytest
+
+cquic = pytest.importorskip('fpy3.protocol.cquic')
+pytest.importorskip('aioquic')
+
+from aioquic.asyncio.client import connect  # noqa: E402
+from aioquic.asyncio.protocol import QuicConnectionProtocol  # noqa: E402
+from aioquic.h3.connection import H3_ALPN, H3Connection  # noqa: E402
+from aioquic.h3.events import DataReceived, HeadersReceived  # noqa: E402
+from aioquic.quic.configuration import QuicConfiguration  # noqa: E402
+
+from fpy3 import Application  # noqa: E402
+from fpy3.asgi import ASGIServer  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+CERTFILE = os.path.join(ROOT, 'cert.pem')
+KEYFILE = os.path.join(ROOT, 'key.pem')
+
+
+class Client(QuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.h3 = H3Connection(self._quic)
+        self.responses = {} # stream id -> (future, headers, body)
+
+    async def request(self, method, path, body=b''):
+        stream_id = self._quic.get_next_available_stream_id()
+        self.h3.send_headers(stream_id, [
+            (b':method', method), (b':scheme', b'https'),
+            (b':authority', b'localhost'), (b':path', path),
+        ], end_stream=not body)
+        if body:
+            self.h3.send_data(stream_id, body, end_stream=True)
+        future = self._loop.create_future()
+        self.responses[stream_id] = (future, {}, [])
+        self.transmit()
+
+        return await asyncio.wait_for(future, 5)
+
+    def quic_event_received(self, event):
+        for h3_event in self.h3.handle_event(event):
+            response = self.responses.get(getattr(h3_event, 'stream_id', None))
+            if response is None:
+                continue
+            future, headers, body = response
+            if isinstance(h3_event, HeadersReceived):
+                headers.update(h3_event.headers)
+            elif isinstance(h3_event, DataReceived):
+                body.append(h3_event.data)
+            if h3_event.stream_ended and not future.done():
+                future.set_result((headers, b''.join(body)))
+
+
+async def requests(port, *args):
+    configuration = QuicConfiguration(is_client=True, alpn_protocols=H3_ALPN)
+    configuration.verify_mode = ssl.CERT_NONE
+
+    async with connect('127.0.0.1', port, configuration=configuration,
+                       create_protocol=Client) as client:
+        return [await client.request(*request) for request in args]
+
+
+def test_native():
+    app = Application()
+
+    def hello(request):
+        return request.Response(text='hello ' + request.query.get('name', ''))
+
+    def empty(request):
+        return request.Response(code=204)
+
+    app.router.add_route('/hello', hello)
+    app.router.add_route('/empty', empty)
+    app._Application__finalize()
+    loop = app.loop
+
+    server = cquic.QuicServer(app, loop)
+    _, port = server.start('127.0.0.1', 0, CERTFILE, KEYFILE)
+    try:
+        (headers, body), (empty_headers, _), (missing, _) = \
+            loop.run_until_complete(requests(
+                port, (b'GET', b'/hello?name=h3'), (b'GET', b'/empty'),
+                (b'GET', b'/missing')))
+    finally:
+        server.close()
+        loop.close()
+
+    assert headers[b':status'] == b'200' and body == b'hello h3'
+    assert headers[b'content-length'] == b'8'
+    assert empty_headers[b':status'] == b'204'
+    assert b'content-length' not in empty_headers
+    assert missing[b':status'] == b'404'
+
+
+def test_asgi():
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'x-version', scope['http_version'].encode())]})
+        await send({'type': 'http.response.body',
+                    'body': scope['method'].encode() + b' ' + body})
+
+    async def main():
+        server = ASGIServer(app, lifespan='off')
+        _, port = server.start('127.0.0.1', 0, CERTFILE, KEYFILE)
+        try:
+            return await requests(
+                port, (b'POST', b'/', b'x' * 100000), (b'GET', b'/'))
+        finally:
+            await server.drain(1)
+
+    (headers, body), (_, get) = asyncio.run(main())
+
+    assert headers[b':status'] == b'200' and headers[b'x-version'] == b'3'
+    assert body == b'POST ' + b'x' * 100000
+    assert get == b'GET '
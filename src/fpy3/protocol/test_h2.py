@@ -0,0 +1,161 @@
+import struct
+
+import pytest
+
+ch2 = pytest.importorskip('fpy3.protocol.ch2')
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+
+def frame(kind, flags, stream_id, payload=b''):
+    return struct.pack('>I', len(payload))[1:] + bytes([kind, flags]) + \
+        struct.pack('>I', stream_id) + payload
+
+
+def literal(name, value):
+    # literal header field without indexing, new name, no Huffman coding
+    return b'\x00' + bytes([len(name)]) + name + bytes([len(value)]) + value
+
+
+def frames(data):
+    while data:
+        length = int.from_bytes(data[:3], 'big')
+        yield data[3], data[4], int.from_bytes(data[5:9], 'big') & 0x7fffffff, \
+            data[9:9 + length]
+        data = data[9 + length:]
+
+
+class Transport:
+    def __init__(self):
+        self.data = b''
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class Server:
+    def __init__(self):
+        self.requests = []
+        self.bodies = []
+        self.closed = []
+
+    def on_headers(self, stream, scope):
+        self.requests.append((stream, scope))
+
+    def on_body(self, stream):
+        self.bodies.append(stream.receive())
+
+    def on_close(self, stream):
+        self.closed.append(stream.id)
+
+
+@pytest.fixture
+def connection():
+    server, transport = Server(), Transport()
+    scope = {'type': 'http', 'http_version': '2', 'query_string': b''}
+    connection = ch2.Connection(server, transport, scope)
+    connection.feed(PREFACE + frame(4, 0, 0))
+    transport.data = b''
+
+    return connection, server, transport
+
+
+def request(method, path, end_stream=True, stream_id=1):
+    block = literal(b':method', method) + literal(b':scheme', b'https') + \
+        literal(b':path', path) + literal(b':authority', b'example.com') + \
+        literal(b'x-test', b'1')
+    # END_HEADERS, END_STREAM
+    return frame(1, 0x4 | (0x1 if end_stream else 0), stream_id, block)
+
+
+def test_request_scope(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'GET', b'/a%20b?x=1'))
+
+    [(stream, scope)] = server.requests
+    assert stream.id == 1
+    assert scope == {
+        'type': 'http', 'http_version': '2', 'method': 'GET',
+        'path': '/a b', 'raw_path': b'/a%20b', 'query_string': b'x=1',
+        'headers': [(b'host', b'example.com'), (b'x-test', b'1')]}
+    assert stream.receive() == (b'', False)
+    assert connection.active == 1
+
+
+def test_response(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'POST', b'/', end_stream=False))
+    connection.feed(frame(0, 0x1, 1, b'body'))
+
+    stream, _ = server.requests[0]
+    assert server.bodies == [(b'body', True)]
+    assert stream.receive() == (b'', False)
+    assert stream.receive() is None
+
+    stream.send_headers([(b':status', b'200'), (b'Connection', b'close')], False)
+    stream.send_data(b'hello', True)
+
+    sent = list(frames(transport.data))
+    assert [(kind, stream_id) for kind, _, stream_id, _ in sent
+            if kind in (0, 1)] == [(1, 1), (0, 1)]
+    assert sent[-1][1] & 0x1 and sent[-1][3] == b'hello'
+    # connection-specific fields are dropped
+    assert b'close' not in sent[-2][3]
+    assert server.closed == [1]
+    assert connection.active == 0
+
+
+def test_head_drops_body(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'HEAD', b'/'))
+
+    stream, _ = server.requests[0]
+    stream.send_headers([(b':status', b'200')], False)
+    stream.send_data(b'hello', True)
+
+    sent = [f for f in frames(transport.data) if f[0] in (0, 1)]
+    assert [(kind, flags & 0x1) for kind, flags, _, _ in sent] == [(1, 1)]
+
+
+def test_shutdown(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'GET', b'/'))
+    connection.shutdown()
+
+    assert [f[0] for f in frames(transport.data)] == [7]
+    assert not transport.closed
+
+    server.requests[0][0].send_headers([(b':status', b'204')], True)
+    assert transport.closed
+
+
+def test_connection_lost(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'GET', b'/'))
+    connection.connection_lost()
+
+    stream, _ = server.requests[0]
+    assert server.closed == [1]
+    assert stream.send_data(b'late', True)
+    assert connection.feed(request(b'GET', b'/', stream_id=3)) is False
+
+
+def test_reset(connection):
+    connection, server, transport = connection
+    connection.feed(request(b'GET', b'/'))
+
+    stream, _ = server.requests[0]
+    stream.send_headers([(b':status', b'200')], False)
+    stream.send_data(b'part', False)
+    stream.reset()
+
+    # RST_STREAM with INTERNAL_ERROR, and the stream no longer counts
+    kind, _, stream_id, payload = list(frames(transport.data))[-1]
+    assert (kind, stream_id, payload) == (3, 1, struct.pack('>I', 2))
+    assert server.closed == [1]
+    assert connection.active == 0
+    assert stream.send_data(b'late', True)
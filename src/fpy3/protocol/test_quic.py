@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from .quic import Histogram, QuicSettings, QuicStats
+
+
+def test_defaults():
+    profile, fields, h3_fields = QuicSettings()._native()
+
+    assert profile == 0
+    assert fields == {
+        'IdleTimeoutMs': 5000,
+        'PeerBidiStreamCount': 100,
+        'PeerUnidiStreamCount': 3}
+    assert h3_fields == {}
+
+
+@pytest.mark.parametrize('preset,profile,cc', [
+    (QuicSettings.api, 0, 0),
+    (QuicSettings.bulk, 1, 1),
+])
+def test_presets(preset, profile, cc):
+    native_profile, fields, _ = preset()._native()
+
+    assert native_profile == profile
+    assert fields['CongestionControlAlgorithm'] == cc
+    assert fields['SendBufferingEnabled'] == 1
+    assert fields['ServerResumptionLevel'] == 1
+
+
+def test_qpack():
+    _, _, h3_fields = QuicSettings.api(qpack_blocked_streams=0)._native()
+
+    assert h3_fields == {
+        'qpack_max_dtable_capacity': 4096,
+        'qpack_encoder_max_dtable_capacity': 4096,
+        'qpack_blocked_streams': 0,
+        'qpack_try_index': 1}
+
+
+def test_webtransport():
+    _, fields, h3_fields = QuicSettings(webtransport_max_sessions=4)._native()
+
+    assert fields['DatagramReceiveEnabled'] == 1
+    assert h3_fields == {
+        'webtransport_max_sessions': 4,
+        'enable_connect_protocol': 1,
+        'h3_datagram': 1}
+    # room for the streams of every session on top of HTTP/3's own three
+    assert fields['PeerUnidiStreamCount'] == 3 + 4 * 4
+
+    _, fields, _ = QuicSettings(
+        webtransport_max_sessions=4, peer_unidi_stream_count=8)._native()
+    assert fields['PeerUnidiStreamCount'] == 8
+
+    _, fields, h3_fields = QuicSettings(datagrams=True)._native()
+
+    assert fields['DatagramReceiveEnabled'] == 1
+    assert h3_fields == {'h3_datagram': 1}
+
+
+def test_preset_override():
+    settings = QuicSettings.bulk(congestion_control='cubic', pacing=False)
+    _, fields, _ = settings._native()
+
+    assert fields['CongestionControlAlgorithm'] == 0
+    assert fields['PacingEnabled'] == 0
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(execution_profile='fast'),
+    dict(congestion_control='reno'),
+    dict(server_resumption='always'),
+    dict(stream_recv_window=100000),
+    dict(conn_flow_control_window=-1),
+    dict(idle_timeout_ms='5s'),
+    dict(qpack_max_dtable_capacity=-4096),
+    dict(webtransport_max_sessions=-1),
+])
+def test_invalid(kwargs):
+    with pytest.raises(ValueError):
+        QuicSettings(**kwargs)
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in (0, 1, 3, 100, 1000, 1000):
+        histogram.add(value)
+
+    assert histogram.count == 6
+    assert histogram.percentile(0) == 0
+    assert histogram.percentile(50) == 3
+    assert histogram.percentile(99) == 1023
+    assert histogram.snapshot()['mean'] == 2104 / 6
+
+
+class FakeServer:
+    def __init__(self):
+        self.connections = []
+
+    def connection_stats(self):
+        return self.connections
+
+
+def stats(cid, sent, lost, rtt=20000):
+    return {
+        'correlation_id': cid, 'remote': ('127.0.0.1', 5000),
+        'rtt_us': rtt, 'min_rtt_us': rtt, 'cwnd': 12000,
+        'handshake_us': 3000, 'send_packets': sent, 'lost_packets': lost,
+        'recv_packets': sent, 'congestion_events': 0}
+
+
+def test_quic_stats(tmp_path):
+    loop = asyncio.new_event_loop()
+    server = FakeServer()
+    sampler = QuicStats(
+        server, loop, interval=60, qlog=str(tmp_path / 'trace-{pid}.qlog'))
+    sampler.start()
+
+    server.connections = [stats(1, 100, 0)]
+    sampler._sample()
+    server.connections = [stats(1, 200, 10)]
+    sampler._sample()
+    server.connections = []
+    sampler._sample()
+    sampler.stop()
+    loop.close()
+
+    snapshot = sampler.snapshot()
+    assert snapshot['rtt_us']['count'] == 2
+    assert snapshot['handshake_us']['count'] == 1
+    assert snapshot['loss_ppm']['count'] == 2
+
+    qlog, = tmp_path.iterdir()
+    assert qlog.name == 'trace-{}.qlog'.format(os.getpid())
+    records = [json.loads(r) for r in qlog.read_text().split('\x1e')[1:]]
+    assert records[0]['qlog_format'] == 'JSON-SEQ'
+    assert [r['name'] for r in records[1:]] == [
+        'connectivity:connection_started',
+        'recovery:metrics_updated',
+        'recovery:metrics_updated',
+        'connectivity:connection_closed']
+    assert records[3]['data']['packets_lost'] == 10
@@ -0,0 +1,74 @@
+import os
+import select
+import socket
+import sys
+
+import pytest
+
+from . import reuseport
+
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith('linux'), reason='SO_REUSEPORT BPF is Linux only')
+
+
+@pytest.fixture
+def group():
+    socks = []
+    port = 0
+    try:
+        for _ in range(6):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('127.0.0.1', port))
+            port = sock.getsockname()[1]
+            socks.append(sock)
+
+        yield socks, port
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+def receiver(socks, client, port, packet):
+    client.sendto(packet, ('127.0.0.1', port))
+    readable, _, _ = select.select(socks, [], [], 1)
+    assert readable
+    readable[0].recv(1500)
+
+    return socks.index(readable[0])
+
+
+def test_bound_sockets(group):
+    socks, port = group
+
+    assert reuseport.bound_sockets(port) == \
+        [(socket.AF_INET, '127.0.0.1')] * len(socks)
+
+
+def test_steering(group):
+    socks, port = group
+    reuseport.attach_steering(socket.AF_INET, '127.0.0.1', port, 3, 2)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        for worker in range(3):
+            for n in range(8):
+                packet = bytes([0x40, 0x11, worker, 0, 0, 0, 0, 0, n]) \
+                    + os.urandom(20)
+                index = receiver(socks, client, port, packet)
+
+                assert index == worker * 2 + n % 2
+
+        # long header and unknown server IDs still reach some socket
+        for first, server_id in ((0xc0, 0), (0x40, 200)):
+            packet = bytes([first, 0x11, server_id]) + os.urandom(30)
+            assert receiver(socks, client, port, packet) in range(6)
+
+
+def test_program_limits():
+    with pytest.raises(ValueError):
+        reuseport.steering_program(0, 1)
+    with pytest.raises(ValueError):
+        reuseport.steering_program(257, 1)
+    with pytest.raises(ValueError):
+        reuseport.steering_program(2, 0)
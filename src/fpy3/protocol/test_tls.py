@@ -0,0 +1,87 @@
+import pickle
+import ssl
+
+import pytest
+
+from .tls import TicketKeys, TlsSettings
+
+
+def test_ticket_keys_periods():
+    keys = TicketKeys(b's' * 32, rotation=60)
+    now = 6000
+    current = keys.period(now)
+
+    assert current == 100
+    for period in (current - 1, current, current + 1):
+        name = keys.key(period)[0]
+        assert keys.find(name, now) == (period, keys.key(period))
+
+    assert keys.find(keys.key(current - 2)[0], now) is None
+    assert keys.find(b'x' * 16, now) is None
+
+
+def test_ticket_keys_shared():
+    keys = TicketKeys(rotation=60)
+    copy = pickle.loads(pickle.dumps(keys))
+
+    assert copy.key(7)[:3] == keys.key(7)[:3]
+    assert TicketKeys(rotation=60).key(7)[0] != keys.key(7)[0]
+    assert keys.key(7)[1] != keys.key(8)[1]
+
+
+@pytest.mark.parametrize('options', [
+    dict(secret=b'short'),
+    dict(rotation=0),
+])
+def test_ticket_keys_invalid(options):
+    with pytest.raises(ValueError):
+        TicketKeys(**options)
+
+
+@pytest.mark.parametrize('options', [
+    dict(num_tickets=-1),
+    dict(session_cache_size=1.5),
+    dict(ticket_keys=b'secret'),
+    dict(curves=[]),
+])
+def test_settings_invalid(options):
+    with pytest.raises(ValueError):
+        TlsSettings(**options)
+
+
+def test_apply():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    TlsSettings(num_tickets=1, session_cache_size=64, session_timeout=600,
+                curves='X25519:P-256').apply(context)
+
+    assert context.num_tickets == 1
+    assert not context.options & ssl.OP_NO_TICKET
+    # the SSL_CTX was found and the shared ticket keys installed
+    assert context._fpy3_ticket_key_callback
+
+
+def test_no_tickets():
+    settings = TlsSettings(session_tickets=False)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    settings.apply(context)
+
+    assert settings.ticket_keys is None
+    assert context.options & ssl.OP_NO_TICKET
+
+
+def test_unknown_curve():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with pytest.raises(ssl.SSLError):
+        TlsSettings(curves=['X25519', 'nope']).apply(context)
+
+
+def test_foreign_layout(monkeypatch):
+    from . import tls
+
+    monkeypatch.setattr(tls, '_ssl_ctx', lambda context: None)
+    settings = TlsSettings(session_cache_size=64)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with pytest.warns(RuntimeWarning):
+        settings.apply(context)
+
+    assert not hasattr(context, '_fpy3_ticket_key_callback')
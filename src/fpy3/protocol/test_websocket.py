@@ -0,0 +1,139 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+cwebsocket = pytest.importorskip('fpy3.protocol.cwebsocket')
+
+from fpy3.protocol.websocket import (  # noqa: E402
+    WebSocketSettings, accept, fields, handshake_key)
+
+KEY = 'dGhlIHNhbXBsZSBub25jZQ=='
+
+
+def frame(opcode, payload, fin=True, rsv1=False, mask=True):
+    head = bytes([(0x80 if fin else 0) | (0x40 if rsv1 else 0) | opcode])
+    length = len(payload)
+    if length < 126:
+        head += bytes([(0x80 if mask else 0) | length])
+    elif length < 65536:
+        head += bytes([(0x80 if mask else 0) | 126]) + struct.pack('>H', length)
+    else:
+        head += bytes([(0x80 if mask else 0) | 127]) + struct.pack('>Q', length)
+    if mask:
+        key = os.urandom(4)
+        payload = bytes(b ^ key[i % 4] for i, b in enumerate(payload))
+        head += key
+
+    return head + payload
+
+
+def handshake(**extra):
+    headers = {
+        'Upgrade': 'websocket', 'Connection': 'keep-alive, Upgrade',
+        'Sec-WebSocket-Key': KEY, 'Sec-WebSocket-Version': '13'}
+    headers.update(extra)
+    return fields(headers.items())
+
+
+def test_handshake_key():
+    assert handshake_key('GET', handshake()) == KEY
+    assert handshake_key('POST', handshake()) is None
+    assert handshake_key('GET', handshake(**{'Sec-WebSocket-Version': '8'})) is None
+    assert handshake_key('GET', handshake(**{'Sec-WebSocket-Key': 'c2hvcnQ='})) is None
+    assert handshake_key('GET', fields([(b'upgrade', b'websocket')])) is None
+
+
+def test_accept():
+    response, codec = accept(KEY, handshake(), WebSocketSettings(), 'chat')
+
+    # the example of RFC 6455 section 1.3
+    assert b'Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n' in response
+    assert b'Sec-WebSocket-Protocol: chat\r\n' in response
+    assert b'Sec-WebSocket-Extensions' not in response
+    assert not codec.deflate
+
+
+@pytest.mark.parametrize('offer,response', [
+    ('permessage-deflate', 'permessage-deflate'),
+    ('permessage-deflate; client_max_window_bits',
+     'permessage-deflate; client_max_window_bits=12'),
+    ('permessage-deflate; server_max_window_bits=10; server_no_context_takeover',
+     'permessage-deflate; server_no_context_takeover; server_max_window_bits=10'),
+    ('permessage-deflate; server_max_window_bits=8, permessage-deflate',
+     'permessage-deflate'),
+    ('permessage-deflate; unknown', None),
+    ('x-webkit-deflate-frame', None),
+])
+def test_negotiate(offer, response):
+    settings = WebSocketSettings(client_max_window_bits=12)
+    assert settings.negotiate(offer)[0] == response
+
+
+def test_feed():
+    codec = cwebsocket.Codec()
+    data = frame(1, 'héllo'.encode()) + frame(2, b'\x00\x01') + \
+        frame(1, b'frag', fin=False) + frame(9, b'ping') + frame(0, b'ment') + \
+        frame(8, struct.pack('>H', 1000) + b'bye')
+
+    # any split of the stream parses the same
+    for split in (len(data), 1, 7):
+        codec = cwebsocket.Codec()
+        messages = []
+        for i in range(0, len(data), split):
+            messages += codec.feed(data[i:i + split])
+        assert messages == [
+            (cwebsocket.OP_TEXT, 'héllo'), (cwebsocket.OP_BINARY, b'\x00\x01'),
+            (cwebsocket.OP_PING, b'ping'), (cwebsocket.OP_TEXT, 'fragment'),
+            (cwebsocket.OP_CLOSE, (1000, 'bye'))]
+
+
+@pytest.mark.parametrize('data,code', [
+    (frame(1, b'x', mask=False), 1002),
+    (frame(1, b'\xff\xfe'), 1007),
+    (frame(9, b'x', fin=False), 1002),
+    (frame(0, b'x'), 1002),
+    (frame(1, b'x', rsv1=True), 1002),
+    (frame(2, b'x' * 2000), 1009),
+])
+def test_feed_errors(data, code):
+    codec = cwebsocket.Codec(max_size=1000)
+    with pytest.raises(cwebsocket.ProtocolError) as error:
+        codec.feed(frame(1, b'ok') + data)
+
+    assert error.value.args[0] == code
+    assert error.value.messages == [(cwebsocket.OP_TEXT, 'ok')]
+
+
+def test_deflate():
+    codec = cwebsocket.Codec(deflate=True, threshold=10)
+    compress = zlib.compressobj(wbits=-15)
+    for text in ('a' * 1000, 'b' * 1000):
+        payload = compress.compress(text.encode()) + compress.flush(zlib.Z_SYNC_FLUSH)
+        assert codec.feed(frame(1, payload[:-4], rsv1=True)) == \
+            [(cwebsocket.OP_TEXT, text)]
+
+    decompress = zlib.decompressobj(wbits=-15)
+    sent = codec.message('c' * 1000)
+    assert sent[0] == 0xc1 and sent[1] < 126
+    assert decompress.decompress(sent[2:] + b'\x00\x00\xff\xff') == b'c' * 1000
+    # under the threshold messages go out as they are
+    assert codec.message(b'short') == b'\x82\x05short'
+
+
+def test_deflate_limit():
+    codec = cwebsocket.Codec(deflate=True, max_size=1 << 16)
+    compress = zlib.compressobj(wbits=-15)
+    payload = compress.compress(bytes(1 << 20)) + compress.flush(zlib.Z_SYNC_FLUSH)
+    with pytest.raises(cwebsocket.ProtocolError) as error:
+        codec.feed(frame(2, payload[:-4], rsv1=True))
+
+    assert error.value.args[0] == 1009
+
+
+def test_control():
+    codec = cwebsocket.Codec()
+    assert codec.control(cwebsocket.OP_PONG, b'ping') == b'\x8a\x04ping'
+    with pytest.raises(ValueError):
+        codec.control(cwebsocket.OP_PING, b'x' * 126)
@@ -0,0 +1,355 @@
+"""Session resumption for the TCP/TLS listeners of ASGIServer and
+Application.
+
+The ssl module covers session tickets on or off, the number of TLS 1.3
+tickets and a single ECDHE curve. The rest is set on the OpenSSL SSL_CTX of
+an ssl.SSLContext through ctypes: the session cache size and timeout, the
+group list and a ticket key callback.
+
+OpenSSL encrypts tickets with a random key per SSL_CTX, so a ticket issued
+by one worker is useless to the others and a client that lands on another
+worker after a reconnect gets a full handshake. The callback derives the
+ticket keys from a secret shared by all workers (and hosts, if they are
+given the same one) and the current rotation period instead. Tickets of the
+previous and the next period are accepted as well, the former renewed, so
+that keys rotate without a burst of full handshakes and workers with a
+slightly different clock agree.
+"""
+import _ssl
+import ctypes
+import hashlib
+import hmac
+import os
+import ssl
+import time
+import warnings
+
+SSL_CTRL_SET_SESS_CACHE_SIZE = 42
+SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB = 72
+SSL_CTRL_SET_GROUPS_LIST = 92
+
+OSSL_PARAM_UTF8_STRING = 4
+OSSL_PARAM_OCTET_STRING = 5
+OSSL_PARAM_UNMODIFIED = ctypes.c_size_t(-1).value
+
+NAME_LEN = 16
+IV_LEN = 16
+
+
+class _OsslParam(ctypes.Structure):
+    _fields_ = [
+        ('key', ctypes.c_char_p),
+        ('data_type', ctypes.c_uint),
+        ('data', ctypes.c_void_p),
+        ('data_size', ctypes.c_size_t),
+        ('return_size', ctypes.c_size_t),
+    ]
+
+
+# (SSL *, key name, iv, EVP_CIPHER_CTX *, EVP_MAC_CTX * or HMAC_CTX *, enc)
+_TICKET_KEY_CB = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+    ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int)
+
+_SHA256 = b'SHA256'
+
+
+def _libssl():
+    # _ssl links libssl and libcrypto, its handle resolves both
+    lib = ctypes.CDLL(_ssl.__file__)
+
+    lib.SSL_CTX_ctrl.restype = ctypes.c_long
+    lib.SSL_CTX_ctrl.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_long, ctypes.c_void_p]
+    lib.SSL_CTX_callback_ctrl.restype = ctypes.c_long
+    lib.SSL_CTX_callback_ctrl.argtypes = [
+        ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+    # uint64_t since OpenSSL 3, unsigned long before
+    lib.SSL_CTX_get_options.restype = ctypes.c_uint64 \
+        if ssl.OPENSSL_VERSION_INFO >= (3,) else ctypes.c_ulong
+    lib.SSL_CTX_get_options.argtypes = [ctypes.c_void_p]
+    lib.SSL_CTX_set_timeout.restype = ctypes.c_long
+    lib.SSL_CTX_set_timeout.argtypes = [ctypes.c_void_p, ctypes.c_long]
+    lib.EVP_aes_256_cbc.restype = ctypes.c_void_p
+    lib.EVP_aes_256_cbc.argtypes = []
+    lib.EVP_sha256.restype = ctypes.c_void_p
+    lib.EVP_sha256.argtypes = []
+    for name in ('EVP_EncryptInit_ex', 'EVP_DecryptInit_ex'):
+        init = getattr(lib, name)
+        init.restype = ctypes.c_int
+        init.argtypes = [ctypes.c_void_p] * 5
+    lib.RAND_bytes.restype = ctypes.c_int
+    lib.RAND_bytes.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+    if hasattr(lib, 'SSL_CTX_set_tlsext_ticket_key_evp_cb'):
+        # OpenSSL 3
+        lib.SSL_CTX_set_tlsext_ticket_key_evp_cb.restype = ctypes.c_int
+        lib.SSL_CTX_set_tlsext_ticket_key_evp_cb.argtypes = [
+            ctypes.c_void_p, _TICKET_KEY_CB]
+        lib.EVP_MAC_CTX_set_params.restype = ctypes.c_int
+        lib.EVP_MAC_CTX_set_params.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(_OsslParam)]
+    else:
+        lib.HMAC_Init_ex.restype = ctypes.c_int
+        lib.HMAC_Init_ex.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_void_p]
+
+    return lib
+
+
+_lib = None
+
+
+def _ssl_ctx(context):
+    """The SSL_CTX pointer of context, the first field after PyObject_HEAD
+    of PySSLContext, or None if the options OpenSSL reports for it are not
+    those of context, that is the layout is not the expected one."""
+    ctx = ctypes.c_void_p.from_address(
+        id(context) + object.__basicsize__).value
+    if not ctx or _lib.SSL_CTX_get_options(ctx) != int(context.options):
+        return None
+
+    return ctx
+
+
+class TicketKeys:
+    """Session ticket keys derived from secret for every rotation period
+    of rotation seconds.
+
+    Pass to TlsSettings(ticket_keys=...) to share keys beyond the workers
+    of one run(): every process given the same secret and rotation accepts
+    the others' tickets.
+    """
+
+    def __init__(self, secret=None, rotation=3600):
+        if secret is None:
+            secret = os.urandom(32)
+        if not isinstance(secret, bytes) or len(secret) < 16:
+            raise ValueError('secret must be at least 16 bytes')
+        if not isinstance(rotation, int) or rotation <= 0:
+            raise ValueError('rotation must be a positive integer')
+
+        self.secret = secret
+        self.rotation = rotation
+        self._keys = {} # period -> (name, aes key, hmac key, params)
+
+    def __getstate__(self):
+        return {'secret': self.secret, 'rotation': self.rotation}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def period(self, now=None):
+        return int(time.time() if now is None else now) // self.rotation
+
+    def _derive(self, label, period):
+        return hmac.new(
+            self.secret, b'fpy3 ticket %s %d' % (label, period),
+            hashlib.sha256).digest()
+
+    def key(self, period):
+        """Return (name, aes key, hmac key, OSSL_PARAM array of the hmac
+        key) of period."""
+        key = self._keys.get(period)
+        if key is None:
+            name = self._derive(b'name', period)[:NAME_LEN]
+            aes_key = self._derive(b'aes', period)
+            hmac_key = self._derive(b'hmac', period)
+            params = (_OsslParam * 3)(
+                _OsslParam(b'key', OSSL_PARAM_OCTET_STRING,
+                           ctypes.cast(ctypes.c_char_p(hmac_key),
+                                       ctypes.c_void_p),
+                           len(hmac_key), OSSL_PARAM_UNMODIFIED),
+                _OsslParam(b'digest', OSSL_PARAM_UTF8_STRING,
+                           ctypes.cast(ctypes.c_char_p(_SHA256),
+                                       ctypes.c_void_p),
+                           len(_SHA256), OSSL_PARAM_UNMODIFIED),
+                _OsslParam())
+            key = (name, aes_key, hmac_key, params)
+
+            for stale in [p for p in self._keys if p < period - 2]:
+                del self._keys[stale]
+            self._keys[period] = key
+
+        return key
+
+    def find(self, name, now=None):
+        """Return (period, key) for the key called name if it is the key
+        of the current, the previous or the next period."""
+        current = self.period(now)
+        for period in (current, current - 1, current + 1):
+            key = self.key(period)
+            if hmac.compare_digest(key[0], name):
+                return period, key
+
+        return None
+
+    def __repr__(self):
+        # the secret stays out of logs
+        return 'TicketKeys(rotation={!r})'.format(self.rotation)
+
+
+class _TicketKeyHandler:
+    """The ticket key callback of one SSL_CTX, kept alive by its
+    SSLContext."""
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.cipher = _lib.EVP_aes_256_cbc()
+        # OpenSSL 3 passes an EVP_MAC_CTX, 1.1 an HMAC_CTX
+        self.evp = hasattr(_lib, 'SSL_CTX_set_tlsext_ticket_key_evp_cb')
+        self.native = _TICKET_KEY_CB(self.callback)
+
+    def install(self, ctx):
+        if self.evp:
+            return _lib.SSL_CTX_set_tlsext_ticket_key_evp_cb(ctx, self.native)
+
+        return _lib.SSL_CTX_callback_ctrl(
+            ctx, SSL_CTRL_SET_TLSEXT_TICKET_KEY_CB,
+            ctypes.cast(self.native, ctypes.c_void_p))
+
+    def init_mac(self, mac_ctx, key):
+        _, _, hmac_key, params = key
+        if self.evp:
+            return _lib.EVP_MAC_CTX_set_params(mac_ctx, params)
+
+        return _lib.HMAC_Init_ex(
+            mac_ctx, hmac_key, len(hmac_key), _lib.EVP_sha256(), None)
+
+    def callback(self, ssl_object, key_name, iv, cipher_ctx, mac_ctx, enc):
+        # 1: ticket ok, 2: ok but issue a new one, 0: unknown key, full
+        # handshake, -1: error
+        try:
+            current = self.keys.period()
+            if enc:
+                key = self.keys.key(current)
+                ctypes.memmove(key_name, key[0], NAME_LEN)
+                if _lib.RAND_bytes(iv, IV_LEN) != 1:
+                    return -1
+                init, result = _lib.EVP_EncryptInit_ex, 1
+            else:
+                found = self.keys.find(ctypes.string_at(key_name, NAME_LEN))
+                if found is None:
+                    return 0
+                period, key = found
+                init = _lib.EVP_DecryptInit_ex
+                result = 2 if period < current else 1
+
+            if init(cipher_ctx, self.cipher, None, key[1], iv) != 1 \
+                    or self.init_mac(mac_ctx, key) != 1:
+                return -1
+
+            return result
+        except Exception:
+            return -1
+
+
+class TlsSettings:
+    """TLS tuning of the TCP/TLS listener.
+
+    ``session_tickets`` turns stateless resumption on or off and
+    ``num_tickets`` is the number of TLS 1.3 tickets sent after a full
+    handshake. ``ticket_keys`` is a TicketKeys, by default one with a random
+    secret made here, so that the workers of run() which inherit this
+    instance share it; None keeps OpenSSL's own key per worker.
+    ``session_cache_size`` and ``session_timeout`` (seconds, also the
+    ticket lifetime) size the per worker cache of TLS 1.2 session IDs.
+    ``curves`` is a list of ECDHE groups in order of preference, for
+    example ``['X25519', 'P-256']``.
+
+    Every option left as None keeps the OpenSSL default. Pass an instance
+    as ``ASGIServer(app, tls_settings=...)``,
+    ``asgi.run(app, tls_settings=...)`` or
+    ``Application(tls_settings=...)``.
+    """
+
+    def __init__(self, *, session_tickets=True, num_tickets=None,
+                 ticket_keys=True, session_cache_size=None,
+                 session_timeout=None, curves=None):
+        for name, value in (('num_tickets', num_tickets),
+                            ('session_cache_size', session_cache_size),
+                            ('session_timeout', session_timeout)):
+            if value is not None and (
+                    not isinstance(value, int) or isinstance(value, bool)
+                    or value < 0):
+                raise ValueError(
+                    '{} must be a non-negative integer'.format(name))
+        if ticket_keys is True:
+            ticket_keys = TicketKeys() if session_tickets else None
+        if ticket_keys is not None and not isinstance(ticket_keys, TicketKeys):
+            raise ValueError('ticket_keys must be a TicketKeys')
+        if isinstance(curves, str):
+            curves = curves.split(':')
+        if curves is not None and not curves:
+            raise ValueError('curves must not be empty')
+
+        self.session_tickets = session_tickets
+        self.num_tickets = num_tickets
+        self.ticket_keys = ticket_keys
+        self.session_cache_size = session_cache_size
+        self.session_timeout = session_timeout
+        self.curves = list(curves) if curves is not None else None
+
+    def context(self, certfile, keyfile):
+        """A server SSLContext for certfile and keyfile with these
+        settings."""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        self.apply(context)
+
+        return context
+
+    def apply(self, context):
+        global _lib
+
+        if not self.session_tickets:
+            context.options |= ssl.OP_NO_TICKET
+        elif self.num_tickets is not None:
+            context.num_tickets = self.num_tickets
+
+        if self.curves is not None and len(self.curves) == 1:
+            context.set_ecdh_curve(self.curves[0])
+
+        native = self.session_cache_size is not None \
+            or self.session_timeout is not None \
+            or (self.curves is not None and len(self.curves) > 1) \
+            or (self.session_tickets and self.ticket_keys is not None)
+        if not native:
+            return
+
+        if _lib is None:
+            _lib = _libssl()
+        ctx = _ssl_ctx(context)
+        if ctx is None:
+            warnings.warn(
+                'cannot find the SSL_CTX of the SSLContext, session cache, '
+                'curves and shared ticket keys are left to OpenSSL',
+                RuntimeWarning)
+            return
+
+        if self.session_cache_size is not None:
+            _lib.SSL_CTX_ctrl(
+                ctx, SSL_CTRL_SET_SESS_CACHE_SIZE, self.session_cache_size,
+                None)
+        if self.session_timeout is not None:
+            _lib.SSL_CTX_set_timeout(ctx, self.session_timeout)
+        if self.curves is not None and len(self.curves) > 1:
+            groups = ':'.join(self.curves).encode('ascii')
+            if _lib.SSL_CTX_ctrl(
+                    ctx, SSL_CTRL_SET_GROUPS_LIST, 0, groups) != 1:
+                raise ssl.SSLError(
+                    'unsupported curves {}'.format(':'.join(self.curves)))
+        if self.session_tickets and self.ticket_keys is not None:
+            callback = _TicketKeyHandler(self.ticket_keys)
+            if callback.install(ctx) != 1:
+                raise ssl.SSLError('cannot set the ticket key callback')
+            # OpenSSL calls back for as long as the SSL_CTX lives
+            context._fpy3_ticket_key_callback = callback
+
+    def __repr__(self):
+        options = ('{}={!r}'.format(name, value)
+                   for name, value in vars(self).items()
+                   if value is not None)
+
+        return 'TlsSettings({})'.format(', '.join(options))
@@ -0,0 +1,509 @@
+"""WebSocket (RFC 6455) for the HTTP/1.1 listeners of Application and
+ASGIServer, with RFC 7692 permessage-deflate.
+
+Frames are validated, unmasked, reassembled and built by cwebsocket.Codec in
+C. This module checks the opening handshake, negotiates the extension and
+runs the upgraded connection as an asyncio protocol: pings are answered,
+the close handshake is completed, and reading stops while too many
+messages wait for the application.
+
+Compression with context takeover keeps a zlib window per connection and
+direction (about 300 KB with the default 15 window bits), which is what
+the no_context_takeover and max_window_bits settings trade compression
+ratio for.
+"""
+import asyncio
+import base64
+import collections
+import hashlib
+import logging
+
+from fpy3.protocol import cwebsocket
+from fpy3.protocol.broadcast import WEBSOCKET
+from fpy3.protocol.cwebsocket import OP_CLOSE, OP_PING, OP_PONG, ProtocolError
+
+logger = logging.getLogger(__name__)
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_NO_STATUS = 1005
+CLOSE_ABNORMAL = 1006
+CLOSE_INTERNAL_ERROR = 1011
+
+
+class ConnectionClosed(Exception):
+    """Raised by receive and send once the connection is closed, with the
+    close code and reason."""
+
+    def __init__(self, code, reason=''):
+        super().__init__(code, reason)
+        self.code = code
+        self.reason = reason
+
+
+class WebSocketSettings:
+    """WebSocket tuning of the HTTP/1.1 listener.
+
+    ``max_message_size`` caps a message after decompression, bigger ones
+    close the connection with 1009. Once ``max_queue`` received messages
+    wait for the application the connection stops reading. ``deflate``
+    accepts permessage-deflate when the client offers it, for messages of
+    at least ``compress_threshold`` bytes compressed at ``compress_level``.
+    ``server_no_context_takeover`` and ``client_no_context_takeover`` reset
+    the compression context after every message in that direction, and
+    ``server_max_window_bits`` and ``client_max_window_bits`` (9 to 15)
+    bound the windows, both at the cost of compression ratio. The client's
+    offer can only lower them. ``close_timeout`` is how long a close waits
+    for the client's answer.
+
+    Pass an instance as ``Application(websocket_settings=...)`` or
+    ``ASGIServer(app, websocket_settings=...)``.
+    """
+
+    def __init__(self, *, max_message_size=1 << 20, max_queue=16,
+                 deflate=True, compress_threshold=128, compress_level=6,
+                 server_no_context_takeover=False,
+                 client_no_context_takeover=False,
+                 server_max_window_bits=15, client_max_window_bits=15,
+                 close_timeout=5.0):
+        if max_message_size <= 0 or max_queue <= 0:
+            raise ValueError('max_message_size and max_queue must be positive')
+        for name, value in (('server_max_window_bits', server_max_window_bits),
+                            ('client_max_window_bits', client_max_window_bits)):
+            if not 9 <= value <= 15:
+                raise ValueError('{} must be between 9 and 15'.format(name))
+
+        self.max_message_size = max_message_size
+        self.max_queue = max_queue
+        self.deflate = deflate
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.close_timeout = close_timeout
+
+    def negotiate(self, extensions):
+        """The Sec-WebSocket-Extensions response (None if nothing is
+        accepted) and the Codec arguments for the request's
+        Sec-WebSocket-Extensions. The first permessage-deflate offer that
+        is valid and can be met is accepted."""
+        codec = {'max_size': self.max_message_size}
+        if not self.deflate or not extensions:
+            return None, codec
+
+        for offer in extensions.split(','):
+            name, *params = [part.strip() for part in offer.split(';')]
+            if name.lower() != 'permessage-deflate':
+                continue
+            params = _deflate_params(params)
+            if params is None:
+                continue
+
+            server_bits = self.server_max_window_bits
+            if 'server_max_window_bits' in params:
+                server_bits = min(server_bits, params['server_max_window_bits'])
+            if server_bits < 9:
+                # zlib deflates with 9 when asked for 8
+                continue
+            client_bits = 15
+            if 'client_max_window_bits' in params:
+                client_bits = min(
+                    self.client_max_window_bits,
+                    params['client_max_window_bits'] or 15)
+            server_no_context_takeover = self.server_no_context_takeover or \
+                'server_no_context_takeover' in params
+            client_no_context_takeover = self.client_no_context_takeover or \
+                'client_no_context_takeover' in params
+
+            response = ['permessage-deflate']
+            if server_no_context_takeover:
+                response.append('server_no_context_takeover')
+            if client_no_context_takeover:
+                response.append('client_no_context_takeover')
+            if server_bits < 15 or 'server_max_window_bits' in params:
+                response.append('server_max_window_bits={}'.format(server_bits))
+            if client_bits < 15:
+                response.append('client_max_window_bits={}'.format(client_bits))
+
+            codec.update(
+                deflate=True, server_max_window_bits=server_bits,
+                client_max_window_bits=client_bits,
+                server_no_context_takeover=server_no_context_takeover,
+                client_no_context_takeover=client_no_context_takeover,
+                threshold=self.compress_threshold, level=self.compress_level)
+            return '; '.join(response), codec
+
+        return None, codec
+
+    def __repr__(self):
+        return ('WebSocketSettings(max_message_size={0.max_message_size}, '
+                'max_queue={0.max_queue}, deflate={0.deflate}, '
+                'compress_threshold={0.compress_threshold}, '
+                'server_no_context_takeover={0.server_no_context_takeover}, '
+                'client_no_context_takeover={0.client_no_context_takeover}, '
+                'server_max_window_bits={0.server_max_window_bits}, '
+                'client_max_window_bits={0.client_max_window_bits})'
+                .format(self))
+
+
+def _deflate_params(params):
+    """The parameters of a permessage-deflate offer, None if it is invalid."""
+    result = {}
+    for param in params:
+        name, eq, value = param.partition('=')
+        name = name.strip().lower()
+        value = value.strip().strip('"')
+        if name in result:
+            return None
+
+        if name in ('server_no_context_takeover', 'client_no_context_takeover'):
+            if eq:
+                return None
+            result[name] = True
+        elif name in ('server_max_window_bits', 'client_max_window_bits'):
+            if not eq and name == 'client_max_window_bits':
+                result[name] = None
+                continue
+            if not value.isdigit() or not 8 <= int(value) <= 15:
+                return None
+            result[name] = int(value)
+        else:
+            return None
+
+    return result
+
+
+def fields(headers):
+    """{lowercase name: value} of str or bytes header pairs, repeated fields
+    joined with a comma."""
+    result = {}
+    for name, value in headers:
+        if isinstance(name, bytes):
+            name = name.decode('latin-1')
+            value = value.decode('latin-1')
+        name = name.lower()
+        result[name] = result[name] + ', ' + value if name in result else value
+
+    return result
+
+
+def _tokens(value):
+    return {token.strip().lower() for token in value.split(',')}
+
+
+def handshake_key(method, fields):
+    """The Sec-WebSocket-Key of a valid opening handshake, None when the
+    request is not one."""
+    if method != 'GET' or 'websocket' not in _tokens(fields.get('upgrade', '')):
+        return None
+    if 'upgrade' not in _tokens(fields.get('connection', '')):
+        return None
+    if fields.get('sec-websocket-version', '').strip() != '13':
+        return None
+
+    key = fields.get('sec-websocket-key', '').strip()
+    try:
+        if len(base64.b64decode(key, validate=True)) != 16:
+            return None
+    except ValueError:
+        return None
+
+    return key
+
+
+def subprotocols(fields):
+    value = fields.get('sec-websocket-protocol')
+    if not value:
+        return []
+
+    return [protocol.strip() for protocol in value.split(',') if protocol.strip()]
+
+
+def accept(key, fields, settings, subprotocol=None, headers=()):
+    """The 101 response for a handshake and the Codec of the connection."""
+    extensions, codec = settings.negotiate(fields.get('sec-websocket-extensions'))
+    accept_key = base64.b64encode(hashlib.sha1(key.encode() + GUID).digest())
+
+    response = [
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Upgrade: websocket\r\n'
+        b'Connection: Upgrade\r\n'
+        b'Sec-WebSocket-Accept: ' + accept_key + b'\r\n']
+    if subprotocol:
+        response.append(b'Sec-WebSocket-Protocol: %s\r\n' % subprotocol.encode())
+    if extensions:
+        response.append(b'Sec-WebSocket-Extensions: %s\r\n' % extensions.encode())
+    for name, value in headers:
+        if isinstance(name, str):
+            name = name.encode('latin-1')
+        if isinstance(value, str):
+            value = value.encode('latin-1')
+        response.append(name + b': ' + value + b'\r\n')
+    response.append(b'\r\n')
+
+    return b''.join(response), cwebsocket.Codec(**codec)
+
+
+class WebSocketProtocol(asyncio.Protocol):
+    """An upgraded connection. Received messages (str or bytes) queue up for
+    receive, send writes one message and waits while the transport's write
+    buffer is full. The open connection is kept in connections, where drain
+    finds it to call close_idle. Broadcast subscriptions of the connection
+    are told when it pauses, resumes and closes."""
+
+    def __init__(self, codec, settings, loop, connections=None):
+        self.codec = codec
+        self.settings = settings
+        self.loop = loop
+        self.connections = connections
+        self.transport = None
+        self.messages = collections.deque()
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.lost = asyncio.Event()
+        self.paused = False
+        self.close_sent = False
+        self.closed = None # (code, reason) once closed
+        self.subscribers = [] # cbroadcast.Subscriber of each subscription
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.connections is not None:
+            self.connections.add(self)
+
+    def connection_lost(self, exc):
+        if self.closed is None:
+            self.closed = (CLOSE_ABNORMAL, '')
+        if self.connections is not None:
+            self.connections.discard(self)
+        for subscriber in self.subscribers:
+            subscriber.detach()
+        self.lost.set()
+        self.readable.set()
+        self.writable.set()
+
+    def pause_writing(self):
+        self.writable.clear()
+        for subscriber in self.subscribers:
+            subscriber.pause_writing()
+
+    def resume_writing(self):
+        self.writable.set()
+        for subscriber in self.subscribers:
+            subscriber.resume_writing()
+
+    def data_received(self, data):
+        try:
+            messages = self.codec.feed(data)
+        except ProtocolError as e:
+            self.on_messages(getattr(e, 'messages', ()))
+            code, reason = e.args
+            self.fail(code, reason)
+            return
+
+        self.on_messages(messages)
+
+    def on_messages(self, messages):
+        for opcode, data in messages:
+            if self.closed is not None:
+                return
+            if opcode == OP_PING:
+                self.transport.write(self.codec.control(OP_PONG, data))
+            elif opcode == OP_CLOSE:
+                code, reason = data
+                if not self.close_sent:
+                    self.send_close(code if code != CLOSE_NO_STATUS else None)
+                self.closed = (code, reason)
+                # the server closes TCP first
+                self.transport.close()
+                self.readable.set()
+            elif opcode != OP_PONG:
+                self.messages.append(data)
+                self.readable.set()
+
+        if len(self.messages) >= self.settings.max_queue and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+
+    def fail(self, code, reason=''):
+        if not self.close_sent:
+            self.send_close(code, reason)
+        if self.closed is None:
+            self.closed = (code, reason)
+        self.transport.close()
+        self.readable.set()
+
+    def send_close(self, code=CLOSE_NORMAL, reason=''):
+        payload = b''
+        if code is not None:
+            payload = code.to_bytes(2, 'big') + reason.encode()[:123]
+        self.transport.write(self.codec.control(OP_CLOSE, payload))
+        self.close_sent = True
+        # no message may follow the close
+        for subscriber in self.subscribers:
+            subscriber.detach()
+
+    def subscribe(self, broadcast, channel, coalesce=None):
+        """Receive the events broadcast publishes to channel as messages."""
+        if self.close_sent or self.closed is not None:
+            raise ConnectionClosed(*(self.closed or (CLOSE_NORMAL, '')))
+
+        subscriber = broadcast.subscribe(
+            channel, self.transport, WEBSOCKET, coalesce=coalesce)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    async def receive(self):
+        """The next message, ConnectionClosed once the connection is closed
+        and every message before that was received."""
+        while not self.messages:
+            if self.closed is not None:
+                raise ConnectionClosed(*self.closed)
+            self.readable.clear()
+            await self.readable.wait()
+
+        message = self.messages.popleft()
+        if self.paused and len(self.messages) <= self.settings.max_queue // 2:
+            self.paused = False
+            self.transport.resume_reading()
+
+        return message
+
+    async def send(self, data):
+        """Send a text (str) or binary (bytes) message."""
+        if self.close_sent or self.closed is not None:
+            raise ConnectionClosed(*(self.closed or (CLOSE_NORMAL, '')))
+
+        self.transport.write(self.codec.message(data))
+        if not self.writable.is_set():
+            await self.writable.wait()
+
+    async def ping(self, data=b''):
+        if not self.close_sent and self.closed is None:
+            self.transport.write(self.codec.control(OP_PING, data))
+
+    async def close(self, code=CLOSE_NORMAL, reason=''):
+        """Start the close handshake and wait up to close_timeout for the
+        client to answer."""
+        if not self.close_sent and self.closed is None:
+            self.send_close(code, reason)
+            try:
+                await asyncio.wait_for(self.lost.wait(), self.settings.close_timeout)
+            except asyncio.TimeoutError:
+                pass
+        if self.closed is None:
+            self.closed = (code, reason)
+        self.transport.close()
+
+    def close_idle(self):
+        """Going away: the close handshake without waiting for it, the
+        transport closes close_timeout later at the latest."""
+        if not self.close_sent and self.closed is None:
+            self.send_close(CLOSE_GOING_AWAY)
+            self.loop.call_later(self.settings.close_timeout, self.transport.close)
+
+    def finish(self, task):
+        """Done callback of the task that ran the connection: close it if
+        the task left it open, with 1011 after an error."""
+        if task.cancelled():
+            error = None
+        else:
+            error = task.exception()
+        if error is not None:
+            logger.error('WebSocket handler failed', exc_info=error)
+
+        if not self.close_sent and self.closed is None:
+            self.send_close(CLOSE_INTERNAL_ERROR if error else CLOSE_NORMAL)
+            self.loop.call_later(self.settings.close_timeout, self.transport.close)
+
+
+class WebSocket:
+    """``request.websocket`` of an Application handler, for a request that
+    is a valid opening handshake (None otherwise).
+
+    The handler must be a coroutine. Until accept it may still return any
+    Response, for example 403. After accept the connection belongs to the
+    WebSocket and what the handler returns is dropped. The connection is
+    closed with 1000 when the handler returns, 1011 if it raises::
+
+        async def echo(request):
+            ws = request.websocket
+            if ws is None:
+                return request.Response(code=400)
+            await ws.accept()
+            async for message in ws:
+                await ws.send(message)
+    """
+
+    def __init__(self, request, key, fields):
+        self.request = request
+        self.subprotocols = subprotocols(fields)
+        self._key = key
+        self._fields = fields
+        self._connection = None
+
+    @classmethod
+    def from_request(cls, request):
+        request_fields = fields(request.headers.items())
+        key = handshake_key(request.method, request_fields)
+        if key is None:
+            return None
+
+        return cls(request, key, request_fields)
+
+    async def accept(self, subprotocol=None, headers=()):
+        """Answer 101, with one of subprotocols and extra headers, and
+        take over the connection."""
+        if self._connection is not None:
+            raise RuntimeError('WebSocket already accepted')
+
+        app = self.request.app
+        response, codec = accept(
+            self._key, self._fields, app._websocket_settings, subprotocol, headers)
+        connection = WebSocketProtocol(
+            codec, app._websocket_settings, app.loop, app._websockets)
+
+        transport = self.request.transport
+        transport.get_protocol().upgrade(connection)
+        transport.write(response)
+        asyncio.current_task().add_done_callback(connection.finish)
+        self._connection = connection
+
+    async def receive(self):
+        return await self._connection.receive()
+
+    async def send(self, data):
+        await self._connection.send(data)
+
+    async def ping(self, data=b''):
+        await self._connection.ping(data)
+
+    def subscribe(self, channel, *, coalesce=None):
+        """Send the events app.broadcast publishes to channel to this
+        connection as well, see Application.subscribe."""
+        if self._connection is None:
+            raise RuntimeError('subscribe before accept')
+        return self._connection.subscribe(self.request.app.hub, channel, coalesce)
+
+    async def close(self, code=CLOSE_NORMAL, reason=''):
+        await self._connection.close(code, reason)
+
+    @property
+    def close_code(self):
+        """The close code once closed, None while open."""
+        closed = self._connection and self._connection.closed
+        return closed[0] if closed else None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._connection.receive()
+        except ConnectionClosed:
+            raise StopAsyncIteration
@@ -5,6 +5,9 @@ import encodings.idna
 import collections
 from http.cookies import _unquote as unquote_cookie
 
+from fpy3.protocol.websocket import WebSocket
+from fpy3.request.crequest import FieldsLimitError, QueryDict  # noqa: F401
+
 
 class HttpRequest(object):
     __slots__ = ('path', 'method', 'version', 'headers', 'body')
@@ -61,14 +64,6 @@ def json(request):
     return json_loads(request.text)
 
 
-@memoize
-def query(request):
-    qs = request.query_string
-    if not qs:
-        return {}
-    return dict(urllib.parse.parse_qsl(qs))
-
-
 def remote_addr(request):
     return request.transport.get_extra_info('peername')[0]
 
@@ -93,7 +88,7 @@ def encoding(request):
 @memoize
 def parsed_form_and_files(request):
     if request.mime_type == 'application/x-www-form-urlencoded':
-        return dict(urllib.parse.parse_qsl(request.text)), None
+        return QueryDict(request.body or b'', request.encoding), None
     elif request.mime_type == 'multipart/form-data':
         boundary = parsed_content_type(request)[1]['boundary'].encode('utf-8')
         return parse_multipart_form(request.body, boundary)
@@ -151,17 +146,15 @@ def parse_cookie(cookie):
     return cookiedict
 
 
-@memoize
-def cookies(request):
-    if 'Cookie' not in request.headers:
-        return {}
+def decode_cookie(value):
+    """The value of a cookie as parse_cookie and cookies leave it: quotes
+    and backslash escapes removed, then percent-decoded."""
+    return urllib.parse.unquote(unquote_cookie(value))
 
-    try:
-        cookies = parse_cookie(request.headers['Cookie'])
-    except Exception:
-        return {}
 
-    return {k: urllib.parse.unquote(v) for k, v in cookies.items()}
+@memoize
+def websocket(request):
+    return WebSocket.from_request(request)
 
 
 File = collections.namedtuple('File', ['type', 'body', 'name'])
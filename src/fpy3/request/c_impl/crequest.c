@@ -1,4 +1,5 @@
 #define _GNU_SOURCE
+#include <ctype.h>
 #include <stddef.h>
 #include <sys/param.h>
 #include <strings.h>
@@ -70,6 +71,33 @@ Request_configure_pool(PyObject* self, PyObject* args, PyObject* kwds)
 }
 #endif
 
+#ifdef REQUEST_OPAQUE
+// limits of request.query and request.form, see QueryDict_parse
+static Py_ssize_t fields_max = 1000;
+static Py_ssize_t fields_max_size = 2 * 1024 * 1024;
+static PyObject* FieldsLimitError;
+
+static PyObject*
+Request_configure_fields(PyObject* self, PyObject* args, PyObject* kwds)
+{
+    Py_ssize_t max_fields = fields_max, max_size = fields_max_size;
+    static char *kwlist[] = {"max_fields", "max_size", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|nn", kwlist, &max_fields, &max_size))
+        return NULL;
+
+    if (max_fields < 0 || max_size < 0) {
+        PyErr_SetString(PyExc_ValueError, "max_fields and max_size must not be negative");
+        return NULL;
+    }
+
+    fields_max = max_fields;
+    fields_max_size = max_size;
+
+    Py_RETURN_NONE;
+}
+#endif
+
 #ifdef REQUEST_OPAQUE
 static PyObject*
 Request_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
@@ -100,12 +128,15 @@ Request_new(PyTypeObject* type, Request* self)
   self->app = NULL;
 
   self->transport = NULL;
+  self->cookie_cache = NULL;
   self->py_method = NULL;
   self->py_path = NULL;
   self->py_qs = NULL;
+  self->py_query = NULL;
   self->py_headers = NULL;
   self->py_match_dict = NULL;
   self->py_body = NULL;
+  self->py_cookies = NULL;
   self->extra = NULL;
   self->done_callbacks = NULL;
 
@@ -134,12 +165,15 @@ Request_dealloc(Request* self)
   Py_XDECREF(self->app);
   Py_XDECREF(self->done_callbacks);
   Py_XDECREF(self->extra);
+  Py_XDECREF(self->py_cookies);
   Py_XDECREF(self->py_body);
   Py_XDECREF(self->py_match_dict);
   Py_XDECREF(self->py_headers);
+  Py_XDECREF(self->py_query);
   Py_XDECREF(self->py_qs);
   Py_XDECREF(self->py_path);
   Py_XDECREF(self->py_method);
+  Py_XDECREF(self->cookie_cache);
   Py_XDECREF(self->transport);
 
   Py_XDECREF(self->exception);
@@ -408,7 +442,6 @@ Request_from_raw(Request* self, char* method, size_t method_len, char* path, siz
   self->path_decoded = false;
   self->path_len = path_len;
   self->qs_len = 0;
-  self->qs_decoded = false;
   self->minor_version = minor_version;
   self->headers = headers;
   self->num_headers = num_headers;
@@ -492,25 +525,645 @@ Request_get_decoded_path(Request* self, size_t* path_len) {
 }
 
 
-static char*
-Request_get_decoded_qs(Request* self, size_t* qs_len) {
-  if(!self->qs_len) {
-    *qs_len = 0;
+// --- QueryDict ---
+//
+// application/x-www-form-urlencoded fields, of a query string or a form,
+// as parse_qsl reads them: & separated, + for a space, percent-encoded,
+// fields without = or with an empty value left out. Keys are decoded when
+// the fields are split, values on first access. A key given more than once
+// keeps all its values, the last one is the value of the key as it was in
+// the dict of parse_qsl.
+
+typedef struct {
+  size_t key;
+  size_t key_len;
+  size_t value;
+  size_t value_len;
+  bool unquoted;
+} QueryField;
+
+typedef struct {
+  PyObject_HEAD
+
+  char* buffer;
+  QueryField* fields;
+  PyObject** values;
+  Py_ssize_t length;
+  PyObject* encoding;
+  PyObject* index;
+} QueryDict;
+
+static PyTypeObject QueryDictType;
+
+
+#define hex_value(x) \
+  ((x) <= '9' ? (x) - '0' : ((x) | 0x20) - 'a' + 10)
+
+// + and %XX decoded in place, returns the new length
+static size_t
+form_decode(char* data, size_t len)
+{
+  char* out = data;
+  char* end = data + len;
+
+  for(char* c = data; c < end; c++) {
+    if(*c == '+')
+      *out++ = ' ';
+    else if(*c == '%' && end - c > 2 && isxdigit((unsigned char)c[1]) && isxdigit((unsigned char)c[2])) {
+      *out++ = (char)(hex_value(c[1]) << 4 | hex_value(c[2]));
+      c += 2;
+    } else
+      *out++ = *c;
+  }
+
+  return out - data;
+}
+
+#undef hex_value
+
+
+static PyObject*
+QueryDict_decode(QueryDict* self, size_t offset, size_t len)
+{
+  if(!self->encoding)
+    return PyUnicode_DecodeUTF8(self->buffer + offset, len, "replace");
+
+  return PyUnicode_Decode(
+    self->buffer + offset, len, PyUnicode_AsUTF8(self->encoding), "replace");
+}
+
+
+static PyObject* QueryDict_get_index(QueryDict* self);
+
+
+static PyObject*
+QueryDict_value(QueryDict* self, Py_ssize_t i)
+{
+  QueryField* field = &self->fields[i];
+
+  if(!self->values[i]) {
+    // in place and only once, a retry after a failed decode reuses it
+    if(!field->unquoted) {
+      field->value_len = form_decode(self->buffer + field->value, field->value_len);
+      field->unquoted = true;
+    }
+    if(!(self->values[i] = QueryDict_decode(self, field->value, field->value_len)))
+      return NULL;
+  }
+
+  Py_INCREF(self->values[i]);
+  return self->values[i];
+}
+
+
+// Split data into a new QueryDict, FieldsLimitError past the limits of
+// configure_fields. encoding NULL is UTF-8.
+static PyObject*
+QueryDict_parse(const char* data, size_t len, PyObject* encoding)
+{
+  QueryDict* self = NULL;
+  size_t count = 1;
+
+  if((Py_ssize_t)len > fields_max_size) {
+    PyErr_Format(FieldsLimitError, "fields longer than %zd bytes", fields_max_size);
+    return NULL;
+  }
+
+  if(!(self = PyObject_New(QueryDict, &QueryDictType)))
+    return NULL;
+  self->buffer = NULL;
+  self->fields = NULL;
+  self->values = NULL;
+  self->length = 0;
+  self->encoding = encoding;
+  Py_XINCREF(encoding);
+  self->index = NULL;
+
+  for(const char* c = data; c && (c = memchr(c, '&', data + len - c)); c++)
+    count++;
+  if(count > (size_t)fields_max + 1)
+    count = fields_max + 1;
+
+  if(!(self->buffer = malloc(len ? len : 1))
+     || !(self->fields = malloc(sizeof(QueryField) * count))
+     || !(self->values = calloc(count, sizeof(PyObject*)))) {
+    PyErr_NoMemory();
+    goto error;
+  }
+  if(len)
+    memcpy(self->buffer, data, len);
+
+  char* end = self->buffer + len;
+  for(char* chunk = self->buffer; chunk < end;) {
+    char* chunk_end = memchr(chunk, '&', end - chunk);
+    if(!chunk_end)
+      chunk_end = end;
+
+    char* eq = memchr(chunk, '=', chunk_end - chunk);
+    if(eq && eq + 1 < chunk_end) {
+      if(self->length == fields_max) {
+        PyErr_Format(FieldsLimitError, "more than %zd fields", fields_max);
+        goto error;
+      }
+
+      QueryField* field = &self->fields[self->length++];
+      field->key = chunk - self->buffer;
+      field->key_len = form_decode(chunk, eq - chunk);
+      field->value = eq + 1 - self->buffer;
+      field->value_len = chunk_end - eq - 1;
+      field->unquoted = false;
+    }
+
+    chunk = chunk_end + 1;
+  }
+
+  return (PyObject*)self;
+
+  error:
+  Py_DECREF(self);
+  return NULL;
+}
+
+
+// The index of the last field called key, -1 if there is none and -2 on
+// an error
+static Py_ssize_t
+QueryDict_find(QueryDict* self, PyObject* key)
+{
+  const char* name;
+  Py_ssize_t name_len;
+  PyObject* i;
+
+  if(!PyUnicode_Check(key))
+    return -1;
+
+  // Before the index is built the UTF-8 of key is compared with the raw
+  // bytes of each field, which finds what the index would: bytes equal to
+  // it decode to key, any others to another string or one with U+FFFD.
+  // Other codecs and keys with U+FFFD go through the index.
+  if(!self->index && !self->encoding) {
+    Py_ssize_t replaced = PyUnicode_FindChar(
+      key, 0xFFFD, 0, PyUnicode_GET_LENGTH(key), 1);
+    if(replaced == -2)
+      return -2;
+
+    if(replaced == -1) {
+      if(!(name = PyUnicode_AsUTF8AndSize(key, &name_len))) {
+        // a lone surrogate, no field decodes to one
+        PyErr_Clear();
+        return -1;
+      }
+
+      for(Py_ssize_t n = self->length - 1; n >= 0; n--) {
+        QueryField* field = &self->fields[n];
+        if(field->key_len == (size_t)name_len
+           && memcmp(self->buffer + field->key, name, name_len) == 0)
+          return n;
+      }
+
+      return -1;
+    }
+  }
+
+  if(!QueryDict_get_index(self))
+    return -2;
+
+  if(!(i = PyDict_GetItemWithError(self->index, key)))
+    return PyErr_Occurred() ? -2 : -1;
+
+  return PyLong_AsSsize_t(i);
+}
+
+
+// {key: index of its last field} in the order the keys first appear, for
+// iteration and the length
+static PyObject*
+QueryDict_get_index(QueryDict* self)
+{
+  PyObject* index = NULL;
+  PyObject* key = NULL;
+  PyObject* i = NULL;
+
+  if(self->index)
+    return self->index;
+
+  if(!(index = PyDict_New()))
+    goto error;
+
+  for(Py_ssize_t n = 0; n < self->length; n++) {
+    QueryField* field = &self->fields[n];
+    if(!(key = QueryDict_decode(self, field->key, field->key_len)))
+      goto error;
+    if(!(i = PyLong_FromSsize_t(n)))
+      goto error;
+    if(PyDict_SetItem(index, key, i) == -1)
+      goto error;
+    Py_CLEAR(key);
+    Py_CLEAR(i);
+  }
+
+  self->index = index;
+  return index;
+
+  error:
+  Py_XDECREF(key);
+  Py_XDECREF(i);
+  Py_XDECREF(index);
+  return NULL;
+}
+
+
+static PyObject*
+QueryDict_new(PyTypeObject* type, PyObject* args, PyObject* kw)
+{
+  static char* kwlist[] = {"data", "encoding", NULL};
+  PyObject* data = NULL;
+  PyObject* encoding = Py_None;
+  Py_buffer view;
+  PyObject* result;
+
+  if(!PyArg_ParseTupleAndKeywords(args, kw, "|OO", kwlist, &data, &encoding))
+    return NULL;
+
+  if(encoding != Py_None && !PyUnicode_Check(encoding)) {
+    PyErr_SetString(PyExc_TypeError, "encoding must be a str or None");
+    return NULL;
+  }
+  if(encoding != Py_None) {
+    const char* name = PyUnicode_AsUTF8(encoding);
+    if(!name)
+      return NULL;
+    if(strcasecmp(name, "utf-8") == 0 || strcasecmp(name, "utf8") == 0)
+      encoding = Py_None;
+    else {
+      // LookupError here rather than a KeyError on every lookup
+      PyObject* decoder = PyCodec_Decoder(name);
+      if(!decoder)
+        return NULL;
+      Py_DECREF(decoder);
+    }
+  }
+
+  if(!data)
+    return QueryDict_parse(NULL, 0, NULL);
+
+  if(PyUnicode_Check(data)) {
+    Py_ssize_t len;
+    const char* str;
+    if(encoding == Py_None) {
+      if(!(str = PyUnicode_AsUTF8AndSize(data, &len)))
+        return NULL;
+      return QueryDict_parse(str, len, NULL);
+    }
+
+    // the characters as the encoding has them, %XX are its bytes too
+    PyObject* encoded = PyUnicode_AsEncodedString(
+      data, PyUnicode_AsUTF8(encoding), "strict");
+    if(!encoded)
+      return NULL;
+    result = QueryDict_parse(
+      PyBytes_AS_STRING(encoded), PyBytes_GET_SIZE(encoded), encoding);
+    Py_DECREF(encoded);
+    return result;
+  }
+
+  if(PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) == -1)
+    return NULL;
+  result = QueryDict_parse(
+    view.buf, view.len, encoding == Py_None ? NULL : encoding);
+  PyBuffer_Release(&view);
+
+  return result;
+}
+
+
+static void
+QueryDict_dealloc(QueryDict* self)
+{
+  if(self->values) {
+    for(Py_ssize_t i = 0; i < self->length; i++)
+      Py_XDECREF(self->values[i]);
+    free(self->values);
+  }
+  free(self->fields);
+  free(self->buffer);
+  Py_XDECREF(self->encoding);
+  Py_XDECREF(self->index);
+
+  PyObject_Free(self);
+}
+
+
+static Py_ssize_t
+QueryDict_length(QueryDict* self)
+{
+  PyObject* index = QueryDict_get_index(self);
+  if(!index)
+    return -1;
+
+  return PyDict_GET_SIZE(index);
+}
+
+
+static PyObject*
+QueryDict_subscript(QueryDict* self, PyObject* key)
+{
+  Py_ssize_t i = QueryDict_find(self, key);
+
+  if(i == -2)
+    return NULL;
+  if(i == -1) {
+    PyErr_SetObject(PyExc_KeyError, key);
+    return NULL;
+  }
+
+  return QueryDict_value(self, i);
+}
+
+
+static int
+QueryDict_contains(QueryDict* self, PyObject* key)
+{
+  Py_ssize_t i = QueryDict_find(self, key);
+
+  return i == -2 ? -1 : i >= 0;
+}
+
+
+static PyObject*
+QueryDict_iter(QueryDict* self)
+{
+  PyObject* index = QueryDict_get_index(self);
+  if(!index)
+    return NULL;
+
+  return PyObject_GetIter(index);
+}
+
+
+static PyObject*
+QueryDict_get(QueryDict* self, PyObject* args)
+{
+  PyObject* key;
+  PyObject* default_value = Py_None;
+  Py_ssize_t i;
+
+  if(!PyArg_UnpackTuple(args, "get", 1, 2, &key, &default_value))
     return NULL;
+
+  if((i = QueryDict_find(self, key)) == -2)
+    return NULL;
+  if(i == -1) {
+    Py_INCREF(default_value);
+    return default_value;
   }
 
-  char* qs = self->path + self->path_len;
+  return QueryDict_value(self, i);
+}
+
+
+static PyObject*
+QueryDict_getall(QueryDict* self, PyObject* key)
+{
+  PyObject* result = NULL;
+  PyObject* value = NULL;
+  Py_ssize_t last = QueryDict_find(self, key);
+
+  if(last == -2)
+    return NULL;
+  if(!(result = PyList_New(0)))
+    return NULL;
+  if(last == -1)
+    return result;
 
-  if(!self->qs_decoded) {
-    self->qs_len = percent_decode(qs, self->qs_len, NULL, NULL);
-    self->qs_decoded = true;
+  // the fields before the last one with the same decoded key
+  QueryField* found = &self->fields[last];
+  for(Py_ssize_t i = 0; i <= last; i++) {
+    QueryField* field = &self->fields[i];
+    if(field->key_len != found->key_len || memcmp(
+        self->buffer + field->key, self->buffer + found->key, field->key_len))
+      continue;
+
+    if(!(value = QueryDict_value(self, i)))
+      goto error;
+    if(PyList_Append(result, value) == -1)
+      goto error;
+    Py_CLEAR(value);
   }
 
-  *qs_len = self->qs_len;
-  return qs;
+  return result;
+
+  error:
+  Py_XDECREF(value);
+  Py_DECREF(result);
+  return NULL;
 }
 
 
+// kind: 0 keys, 1 values, 2 items
+static PyObject*
+QueryDict_list(QueryDict* self, int kind)
+{
+  PyObject* index = QueryDict_get_index(self);
+  PyObject* result = NULL;
+  PyObject* key;
+  PyObject* i;
+  Py_ssize_t pos = 0, n = 0;
+
+  if(!index || !(result = PyList_New(PyDict_GET_SIZE(index))))
+    return NULL;
+
+  while(PyDict_Next(index, &pos, &key, &i)) {
+    PyObject* item;
+    PyObject* value = NULL;
+
+    if(kind != 0 && !(value = QueryDict_value(self, PyLong_AsSsize_t(i))))
+      goto error;
+
+    if(kind == 0) {
+      Py_INCREF(key);
+      item = key;
+    } else if(kind == 1)
+      item = value;
+    else {
+      item = PyTuple_Pack(2, key, value);
+      Py_DECREF(value);
+      if(!item)
+        goto error;
+    }
+    PyList_SET_ITEM(result, n++, item);
+  }
+
+  return result;
+
+  error:
+  Py_DECREF(result);
+  return NULL;
+}
+
+
+static PyObject*
+QueryDict_keys(QueryDict* self, PyObject* unused)
+{
+  return QueryDict_list(self, 0);
+}
+
+
+static PyObject*
+QueryDict_values(QueryDict* self, PyObject* unused)
+{
+  return QueryDict_list(self, 1);
+}
+
+
+static PyObject*
+QueryDict_items(QueryDict* self, PyObject* unused)
+{
+  return QueryDict_list(self, 2);
+}
+
+
+static PyObject*
+QueryDict_multi_items(QueryDict* self, PyObject* unused)
+{
+  PyObject* result = NULL;
+  PyObject* key = NULL;
+  PyObject* value = NULL;
+  PyObject* item;
+
+  if(!(result = PyList_New(self->length)))
+    return NULL;
+
+  for(Py_ssize_t i = 0; i < self->length; i++) {
+    QueryField* field = &self->fields[i];
+    if(!(key = QueryDict_decode(self, field->key, field->key_len)))
+      goto error;
+    if(!(value = QueryDict_value(self, i)))
+      goto error;
+    if(!(item = PyTuple_Pack(2, key, value)))
+      goto error;
+    PyList_SET_ITEM(result, i, item);
+    Py_CLEAR(key);
+    Py_CLEAR(value);
+  }
+
+  return result;
+
+  error:
+  Py_XDECREF(key);
+  Py_XDECREF(value);
+  Py_DECREF(result);
+  return NULL;
+}
+
+
+static PyObject*
+QueryDict_to_dict(QueryDict* self)
+{
+  PyObject* items = QueryDict_list(self, 2);
+  PyObject* result;
+
+  if(!items)
+    return NULL;
+
+  if((result = PyDict_New()) && PyDict_MergeFromSeq2(result, items, 1) == -1)
+    Py_CLEAR(result);
+  Py_DECREF(items);
+
+  return result;
+}
+
+
+// compares as the dict of parse_qsl did
+static PyObject*
+QueryDict_richcompare(QueryDict* self, PyObject* other, int op)
+{
+  PyObject* mine = NULL;
+  PyObject* theirs = NULL;
+  PyObject* result = NULL;
+
+  if(op != Py_EQ && op != Py_NE)
+    Py_RETURN_NOTIMPLEMENTED;
+
+  if(!(mine = QueryDict_to_dict(self)))
+    goto finally;
+
+  if(Py_TYPE(other) == &QueryDictType) {
+    if(!(theirs = QueryDict_to_dict((QueryDict*)other)))
+      goto finally;
+  } else if(PyDict_Check(other)) {
+    theirs = other;
+    Py_INCREF(theirs);
+  } else {
+    result = Py_NotImplemented;
+    Py_INCREF(result);
+    goto finally;
+  }
+
+  result = PyObject_RichCompare(mine, theirs, op);
+
+  finally:
+  Py_XDECREF(mine);
+  Py_XDECREF(theirs);
+  return result;
+}
+
+
+static PyObject*
+QueryDict_repr(QueryDict* self)
+{
+  PyObject* items = QueryDict_multi_items(self, NULL);
+  PyObject* result;
+
+  if(!items)
+    return NULL;
+
+  result = PyUnicode_FromFormat("QueryDict(%R)", items);
+  Py_DECREF(items);
+  return result;
+}
+
+
+static PyMappingMethods QueryDict_as_mapping = {
+  (lenfunc)QueryDict_length,
+  (binaryfunc)QueryDict_subscript,
+  0
+};
+
+
+static PySequenceMethods QueryDict_as_sequence = {
+  .sq_contains = (objobjproc)QueryDict_contains
+};
+
+
+static PyMethodDef QueryDict_methods[] = {
+  {"get", (PyCFunction)QueryDict_get, METH_VARARGS, ""},
+  {"getall", (PyCFunction)QueryDict_getall, METH_O, ""},
+  {"keys", (PyCFunction)QueryDict_keys, METH_NOARGS, ""},
+  {"values", (PyCFunction)QueryDict_values, METH_NOARGS, ""},
+  {"items", (PyCFunction)QueryDict_items, METH_NOARGS, ""},
+  {"multi_items", (PyCFunction)QueryDict_multi_items, METH_NOARGS, ""},
+  {NULL}
+};
+
+
+static PyTypeObject QueryDictType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  .tp_name = "crequest.QueryDict",
+  .tp_basicsize = sizeof(QueryDict),
+  .tp_dealloc = (destructor)QueryDict_dealloc,
+  .tp_repr = (reprfunc)QueryDict_repr,
+  .tp_as_sequence = &QueryDict_as_sequence,
+  .tp_as_mapping = &QueryDict_as_mapping,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_doc = "QueryDict",
+  .tp_richcompare = (richcmpfunc)QueryDict_richcompare,
+  .tp_iter = (getiterfunc)QueryDict_iter,
+  .tp_methods = QueryDict_methods,
+  .tp_new = QueryDict_new,
+};
+
+
 static inline void title_case(char* data, size_t len)
 {
   bool prev_alpha = false;
@@ -529,6 +1182,43 @@ static inline void title_case(char* data, size_t len)
 }
 
 
+// Names most requests send, as title_case leaves them: the headers dict
+// shares one interned str for each instead of creating it per request
+static const char* const common_header_names[] = {
+  "Host", "User-Agent", "Accept", "Accept-Encoding", "Accept-Language",
+  "Accept-Charset", "Connection", "Keep-Alive", "Content-Type",
+  "Content-Length", "Cookie", "Referer", "Origin", "Authorization",
+  "Cache-Control", "Pragma", "Upgrade", "Upgrade-Insecure-Requests",
+  "If-None-Match", "If-Modified-Since", "Range", "Te", "Dnt", "Priority",
+  "X-Forwarded-For", "X-Forwarded-Proto", "X-Forwarded-Host", "X-Real-Ip",
+  "X-Requested-With", "Sec-Websocket-Key", "Sec-Websocket-Version",
+  "Sec-Websocket-Extensions", "Sec-Websocket-Protocol", "Sec-Fetch-Site",
+  "Sec-Fetch-Mode", "Sec-Fetch-Dest", "Sec-Fetch-User", "Sec-Ch-Ua",
+  "Sec-Ch-Ua-Mobile", "Sec-Ch-Ua-Platform"
+};
+
+#define COMMON_HEADERS_LEN \
+  (sizeof(common_header_names) / sizeof(common_header_names[0]))
+
+static PyObject* common_headers[COMMON_HEADERS_LEN];
+static size_t common_header_lens[COMMON_HEADERS_LEN];
+
+
+static inline PyObject*
+common_header(const char* name, size_t name_len)
+{
+  for(size_t i = 0; i < COMMON_HEADERS_LEN; i++) {
+    if(common_header_lens[i] == name_len && *common_header_names[i] == *name
+       && memcmp(common_header_names[i], name, name_len) == 0) {
+      Py_INCREF(common_headers[i]);
+      return common_headers[i];
+    }
+  }
+
+  return PyUnicode_FromStringAndSize(name, name_len);
+}
+
+
 static inline PyObject*
 Request_decode_headers(Request* self)
 {
@@ -547,7 +1237,7 @@ Request_decode_headers(Request* self)
 
       title_case((char*)header->name, header->name_len);
 
-      name = PyUnicode_FromStringAndSize(header->name, header->name_len);
+      name = common_header(header->name, header->name_len);
       if(!name)
         goto loop_error;
 
@@ -609,16 +1299,25 @@ Request_get_path(Request* self, void* closure)
 }
 
 
+// Decoded into a copy: request.query parses the raw query string, where
+// an encoded & or = is still data
 static PyObject*
 Request_get_qs(Request* self, void* closure)
 {
   if(!self->py_qs) {
-    size_t qs_len;
-    char* qs = Request_get_decoded_qs(self, &qs_len);
-    if(!qs)
+    size_t path_len;
+    char* qs;
+
+    Request_get_decoded_path(self, &path_len);
+    if(!self->qs_len)
       Py_RETURN_NONE;
 
-    self->py_qs = PyUnicode_FromStringAndSize(qs + 1, qs_len - 1);
+    if(!(qs = malloc(self->qs_len - 1)))
+      return PyErr_NoMemory();
+    memcpy(qs, self->path + self->path_len + 1, self->qs_len - 1);
+    self->py_qs = PyUnicode_FromStringAndSize(
+      qs, percent_decode(qs, self->qs_len - 1, NULL, NULL));
+    free(qs);
   }
 
   Py_XINCREF(self->py_qs);
@@ -626,6 +1325,25 @@ Request_get_qs(Request* self, void* closure)
 }
 
 
+static PyObject*
+Request_get_query(Request* self, void* closure)
+{
+  if(!self->py_query) {
+    size_t path_len;
+
+    Request_get_decoded_path(self, &path_len);
+    if(self->qs_len)
+      self->py_query = QueryDict_parse(
+        self->path + self->path_len + 1, self->qs_len - 1, NULL);
+    else
+      self->py_query = QueryDict_parse(NULL, 0, NULL);
+  }
+
+  Py_XINCREF(self->py_query);
+  return self->py_query;
+}
+
+
 static PyObject*
 Request_get_version(Request* self, void* closure) {
   PyObject* result = self->minor_version ? HTTP11 : HTTP10;
@@ -645,6 +1363,222 @@ Request_get_headers(Request* self, void* closure) {
 }
 
 
+// The last header called name, as in the headers dict, matched without
+// regard to case
+static struct phr_header*
+Request_find_header(Request* self, const char* name, size_t name_len)
+{
+  for(struct phr_header* header = self->headers + self->num_headers;
+      header-- > self->headers;) {
+    if(header->name_len == name_len
+       && strncasecmp(header->name, name, name_len) == 0)
+      return header;
+  }
+
+  return NULL;
+}
+
+
+static PyObject*
+Request_get_header(Request* self, PyObject* args, PyObject* kw)
+{
+  static char* kwlist[] = {"name", "default", NULL};
+  PyObject* py_name;
+  const char* name;
+  Py_ssize_t name_len;
+  PyObject* default_value = Py_None;
+  struct phr_header* header;
+
+  if(!PyArg_ParseTupleAndKeywords(
+      args, kw, "U|O", kwlist, &py_name, &default_value))
+    return NULL;
+
+  if(!(name = PyUnicode_AsUTF8AndSize(py_name, &name_len)))
+    return NULL;
+
+  if(!(header = Request_find_header(self, name, name_len))) {
+    Py_INCREF(default_value);
+    return default_value;
+  }
+
+  return PyUnicode_DecodeLatin1(header->value, header->value_len, NULL);
+}
+
+
+static inline bool
+cookie_space(char c)
+{
+  // what str.strip removes from a Latin-1 decoded header
+  return Py_UNICODE_ISSPACE((unsigned char)c);
+}
+
+
+// Parse a Cookie header the way fpy3.request.parse_cookie does. Plain
+// values are decoded here, quoted or percent-encoded ones go through
+// fpy3.request.decode_cookie. Any error gives no cookies at all, as it
+// always did.
+static PyObject*
+parse_cookies(const char* data, size_t len)
+{
+  PyObject* result = NULL;
+  PyObject* key = NULL;
+  PyObject* value = NULL;
+  const char* end = data + len;
+
+  if(!(result = PyDict_New()))
+    goto error;
+
+  for(const char* chunk = data; chunk <= end;) {
+    const char* chunk_end = memchr(chunk, ';', end - chunk);
+    if(!chunk_end)
+      chunk_end = end;
+
+    const char* key_start = chunk;
+    const char* key_end = chunk;
+    const char* val_start = chunk;
+    const char* val_end = chunk_end;
+    const char* eq = memchr(chunk, '=', chunk_end - chunk);
+    if(eq) {
+      key_end = eq;
+      val_start = eq + 1;
+    }
+
+    while(key_start < key_end && cookie_space(*key_start)) key_start++;
+    while(key_end > key_start && cookie_space(*(key_end - 1))) key_end--;
+    while(val_start < val_end && cookie_space(*val_start)) val_start++;
+    while(val_end > val_start && cookie_space(*(val_end - 1))) val_end--;
+
+    chunk = chunk_end + 1;
+    if(key_start == key_end && val_start == val_end)
+      continue;
+
+    if(!(key = PyUnicode_DecodeLatin1(key_start, key_end - key_start, NULL)))
+      goto error;
+    if(!(value = PyUnicode_DecodeLatin1(val_start, val_end - val_start, NULL)))
+      goto error;
+
+    if(memchr(val_start, '%', val_end - val_start)
+       || (val_end - val_start >= 2 && *val_start == '"' && *(val_end - 1) == '"')) {
+      PyObject* decoded = PyObject_CallMethod(request, "decode_cookie", "O", value);
+      if(!decoded) {
+        PyErr_Clear();
+        Py_DECREF(result);
+        result = PyDict_New();
+        goto finally;
+      }
+      Py_SETREF(value, decoded);
+    }
+
+    if(PyDict_SetItem(result, key, value) == -1)
+      goto error;
+
+    Py_CLEAR(key);
+    Py_CLEAR(value);
+  }
+
+  goto finally;
+
+  error:
+  Py_CLEAR(result);
+
+  finally:
+  Py_XDECREF(key);
+  Py_XDECREF(value);
+  return result;
+}
+
+
+// The parsed cookies, a dict that is shared and must not be changed: a
+// connection's requests mostly send the same Cookie header, whose parse
+// is kept in cookie_cache, a [header bytes, dict] list of the connection
+static PyObject*
+Request_parse_cookies(Request* self)
+{
+  struct phr_header* header;
+  PyObject* raw;
+  PyObject* result = NULL;
+
+  if(!(header = Request_find_header(self, "Cookie", strlen("Cookie"))))
+    return PyDict_New();
+
+  if(self->cookie_cache) {
+    raw = PyList_GET_ITEM(self->cookie_cache, 0);
+    if(PyBytes_Check(raw) && (size_t)PyBytes_GET_SIZE(raw) == header->value_len
+       && memcmp(PyBytes_AS_STRING(raw), header->value, header->value_len) == 0) {
+      result = PyList_GET_ITEM(self->cookie_cache, 1);
+      Py_INCREF(result);
+      return result;
+    }
+  }
+
+  if(!(result = parse_cookies(header->value, header->value_len)))
+    return NULL;
+
+  if(self->cookie_cache) {
+    if(!(raw = PyBytes_FromStringAndSize(header->value, header->value_len))) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyList_SetItem(self->cookie_cache, 0, raw);
+    Py_INCREF(result);
+    PyList_SetItem(self->cookie_cache, 1, result);
+  }
+
+  return result;
+}
+
+
+static PyObject*
+Request_get_cookies(Request* self, void* closure)
+{
+  if(!self->py_cookies) {
+    PyObject* cookies = Request_parse_cookies(self);
+    if(!cookies)
+      return NULL;
+
+    self->py_cookies = PyDict_Copy(cookies);
+    Py_DECREF(cookies);
+  }
+
+  Py_XINCREF(self->py_cookies);
+  return self->py_cookies;
+}
+
+
+static PyObject*
+Request_get_cookie(Request* self, PyObject* args, PyObject* kw)
+{
+  static char* kwlist[] = {"name", "default", NULL};
+  PyObject* name;
+  PyObject* default_value = Py_None;
+  PyObject* cookies;
+  PyObject* result;
+
+  if(!PyArg_ParseTupleAndKeywords(
+      args, kw, "U|O", kwlist, &name, &default_value))
+    return NULL;
+
+  // request.cookies once built, it may have been changed
+  if(self->py_cookies) {
+    cookies = self->py_cookies;
+    Py_INCREF(cookies);
+  } else if(!(cookies = Request_parse_cookies(self)))
+    return NULL;
+
+  if(!(result = PyDict_GetItemWithError(cookies, name))) {
+    if(PyErr_Occurred()) {
+      Py_DECREF(cookies);
+      return NULL;
+    }
+    result = default_value;
+  }
+
+  Py_INCREF(result);
+  Py_DECREF(cookies);
+  return result;
+}
+
+
 static PyObject*
 Request_get_match_dict(Request* self, void* closure)
 {
@@ -785,6 +1719,7 @@ static PyGetSetDef Request_getset[] = {
   {"method", (getter)Request_get_method, NULL, "", NULL},
   {"path", (getter)Request_get_path, NULL, "", NULL},
   {"query_string", (getter)Request_get_qs, NULL, "", NULL},
+  {"query", (getter)Request_get_query, NULL, "", NULL},
   {"version", (getter)Request_get_version, NULL, "", NULL},
   {"headers", (getter)Request_get_headers, NULL, "", NULL},
   {"match_dict", (getter)Request_get_match_dict, NULL, "", NULL},
@@ -794,9 +1729,9 @@ static PyGetSetDef Request_getset[] = {
   {"route", (getter)Request_get_route, NULL, "", NULL},
   {"extra", (getter)Request_get_extra, NULL, "", NULL},
   {"app", (getter)Request_get_app, NULL, "", NULL},
+  {"cookies", (getter)Request_get_cookies, NULL, "", NULL},
   PROXY(text),
   PROXY(json),
-  PROXY(query),
   PROXY(mime_type),
   PROXY(encoding),
   PROXY(form),
@@ -804,7 +1739,7 @@ static PyGetSetDef Request_getset[] = {
   PROXY(remote_addr),
   PROXY(hostname),
   PROXY(port),
-  PROXY(cookies),
+  PROXY(websocket),
   {NULL}
 };
 
@@ -818,6 +1753,10 @@ Request_getattro(Request* self, PyObject* name)
   if((result = PyObject_GenericGetAttr((PyObject*)self, name)))
     return result;
 
+  // a getter that failed, as opposed to a name only an extension has
+  if(!PyErr_ExceptionMatches(PyExc_AttributeError))
+    return NULL;
+
   PyObject* extensions = NULL;
   if(!(extensions = PyObject_GetAttrString(self->app, "_request_extensions")))
     goto error;
@@ -872,6 +1811,8 @@ Request_add_done_callback(Request* self, PyObject* callback)
 static PyMethodDef Request_methods[] = {
   {"Response", (PyCFunction)Request_Response, METH_VARARGS | METH_KEYWORDS, ""},
   {"add_done_callback", (PyCFunction)Request_add_done_callback, METH_O, ""},
+  {"get_header", (PyCFunction)Request_get_header, METH_VARARGS | METH_KEYWORDS, ""},
+  {"get_cookie", (PyCFunction)Request_get_cookie, METH_VARARGS | METH_KEYWORDS, ""},
   {NULL}
 };
 
@@ -921,6 +1862,8 @@ static PyTypeObject RequestType = {
 static PyMethodDef crequest_methods[] = {
   {"configure_pool", (PyCFunction)Request_configure_pool, METH_VARARGS | METH_KEYWORDS,
    "Configure the request memory pool size."},
+  {"configure_fields", (PyCFunction)Request_configure_fields, METH_VARARGS | METH_KEYWORDS,
+   "Configure the limits of request.query and request.form."},
   {NULL, NULL, 0, NULL}
 };
 
@@ -966,6 +1909,12 @@ crequest_init(void)
   alloc_static2(HTTP10, "1.0")
   alloc_static2(HTTP11, "1.1")
 
+  for(size_t i = 0; i < COMMON_HEADERS_LEN; i++) {
+    if(!(common_headers[i] = PyUnicode_InternFromString(common_header_names[i])))
+      goto error;
+    common_header_lens[i] = strlen(common_header_names[i]);
+  }
+
   m = PyModule_Create(&crequest);
   if(!m)
     goto error;
@@ -993,6 +1942,17 @@ crequest_init(void)
   Py_INCREF(&RequestType);
   PyModule_AddObject(m, "Request", (PyObject*)&RequestType);
 
+  if (PyType_Ready(&QueryDictType) < 0)
+    goto error;
+  Py_INCREF(&QueryDictType);
+  PyModule_AddObject(m, "QueryDict", (PyObject*)&QueryDictType);
+
+  if(!(FieldsLimitError = PyErr_NewException(
+      "fpy3.request.crequest.FieldsLimitError", PyExc_ValueError, NULL)))
+    goto error;
+  Py_INCREF(FieldsLimitError);
+  PyModule_AddObject(m, "FieldsLimitError", FieldsLimitError);
+
   static Request_CAPI capi = {
     &RequestType,
     Request_clone,
@@ -17,7 +17,6 @@ typedef struct {
   char* path;
   bool path_decoded;
   size_t path_len;
-  bool qs_decoded;
   size_t qs_len;
   int minor_version;
   struct phr_header* headers;
@@ -36,13 +35,16 @@ typedef struct {
   PyObject* exception;
 
   PyObject* transport;
+  PyObject* cookie_cache;
   PyObject* app;
   PyObject* py_method;
   PyObject* py_path;
   PyObject* py_qs;
+  PyObject* py_query;
   PyObject* py_headers;
   PyObject* py_match_dict;
   PyObject* py_body;
+  PyObject* py_cookies;
   PyObject* extra;
   PyObject* done_callbacks;
   Response response;
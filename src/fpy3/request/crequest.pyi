@@ -1,11 +1,28 @@
-from typing import Any, Dict, List, Optional, Protocol, Tuple, Union
+from typing import Any, Dict, Iterator, List, Optional, Protocol, Tuple, Union
+
+class FieldsLimitError(ValueError): ...
+
+class QueryDict:
+    def __init__(self, data: Union[bytes, str] = b'', encoding: Optional[str] = None) -> None: ...
+    def __getitem__(self, key: str) -> str: ...
+    def __contains__(self, key: object) -> bool: ...
+    def __iter__(self) -> Iterator[str]: ...
+    def __len__(self) -> int: ...
+    def get(self, key: str, default: Any = None) -> Any: ...
+    def getall(self, key: str) -> List[str]: ...
+    def keys(self) -> List[str]: ...
+    def values(self) -> List[str]: ...
+    def items(self) -> List[Tuple[str, str]]: ...
+    def multi_items(self) -> List[Tuple[str, str]]: ...
 
 class Request:
     method: str
     path: str
     query_string: Optional[str]
+    query: QueryDict
     version: str
     headers: Dict[str, str]
+    cookies: Dict[str, str]
     body: Optional[bytes]
     match_dict: Optional[Dict[str, str]]
     transport: Any
@@ -20,4 +37,10 @@ class Request:
                  
     def add_done_callback(self, callback: Any) -> None: ...
 
+    def get_header(self, name: str, default: Any = None) -> Optional[str]: ...
+
+    def get_cookie(self, name: str, default: Any = None) -> Optional[str]: ...
+
 def configure_pool(max_size: int = 1024) -> None: ...
+
+def configure_fields(max_fields: int = 1000, max_size: int = 2097152) -> None: ...
@@ -0,0 +1,147 @@
+import random
+import socket
+import urllib.parse
+
+import pytest
+
+crequest = pytest.importorskip('fpy3.request.crequest')
+cprotocol = pytest.importorskip('fpy3.protocol.cprotocol')
+
+import fpy3.request  # noqa: E402
+from fpy3 import Application  # noqa: E402
+from fpy3.request import parse_cookie  # noqa: E402
+
+
+def expected(cookie):
+    # what request.cookies was before it moved to C
+    try:
+        cookies = parse_cookie(cookie.decode('latin-1'))
+    except Exception:
+        return {}
+    return {k: urllib.parse.unquote(v) for k, v in cookies.items()}
+
+
+class Transport:
+    def __init__(self, sock):
+        self.sock = sock
+        self.data = []
+
+    def get_extra_info(self, name, default=None):
+        return self.sock if name == 'socket' else default
+
+    def write(self, data):
+        self.data.append(data)
+
+    def writelines(self, data):
+        self.data.extend(data)
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def connection():
+    """Feed requests to a Protocol one at a time, as a keep-alive client
+    does, and return what the handler saw."""
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return request.Response(text='ok')
+
+    app = Application()
+    app.router.add_route('/', handler)
+    app._Application__finalize()
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+
+    protocol = cprotocol.Protocol(app)
+    protocol.connection_made(Transport(server))
+
+    def get(cookie=None, headers=b''):
+        data = b'GET / HTTP/1.1\r\nHost: x\r\n' + headers
+        if cookie is not None:
+            data += b'Cookie: ' + cookie + b'\r\n'
+        protocol.data_received(data + b'\r\n')
+        return seen.pop()
+
+    yield get
+
+    for sock in (client, server, listener):
+        sock.close()
+    app.loop.close()
+
+
+@pytest.mark.parametrize('cookie', [
+    b'sid=abc; q="a\\"b"; p=%E2%82%AC; ;=x', b'', b';;', b'a', b' a = 1 ; b=2;',
+    b'x="\\101\\102"', b'k=v=w; k=z', b'\xe9=\xe9', b'c="unterminated',
+    b'e=%zz', b'=only', b'a=\xa0b\xa0', b'a="%41"', b'a=1; a=2; a=3',
+])
+def test_cookies(connection, cookie):
+    request = connection(cookie)
+    assert request.cookies == expected(cookie)
+    for name, value in expected(cookie).items():
+        assert request.get_cookie(name) == value
+
+
+def test_random_cookies(connection):
+    rng = random.Random(7)
+    alphabet = 'ab= ;"\\%4F2\xe9\xa0+'
+    for _ in range(500):
+        cookie = ''.join(rng.choice(alphabet) for _ in range(rng.randrange(12)))
+        cookie = cookie.strip().encode('latin-1')
+        request = connection(cookie)
+        assert request.cookies == expected(cookie), cookie
+
+
+def test_no_cookie(connection):
+    request = connection()
+    assert request.cookies == {}
+    assert request.get_cookie('a') is None
+    assert request.get_cookie('a', 'x') == 'x'
+
+
+def test_get_header(connection):
+    request = connection(headers=b'x-dup: a\r\nX-Dup: b\r\nUser-Agent: t/1\r\n')
+    # the last one, as in request.headers
+    assert request.get_header('X-DUP') == 'b' == request.headers['X-Dup']
+    assert request.get_header('user-agent') == 't/1'
+    assert request.get_header('missing') is None
+    assert request.get_header('missing', 'default') == 'default'
+    assert request.get_header('Content-Length', 0) == 0
+
+
+def test_cache(connection, monkeypatch):
+    decoded = []
+
+    def decode_cookie(value):
+        decoded.append(value)
+        return urllib.parse.unquote(value.strip('"'))
+
+    monkeypatch.setattr(fpy3.request, 'decode_cookie', decode_cookie)
+
+    first, second = b'a="1"; b=2', b'a="3"'
+    for cookie in (first, first, second, second, first):
+        request = connection(cookie)
+        assert request.get_cookie('a') == expected(cookie)['a']
+
+    # parsed again only when the header changed from the last request
+    assert decoded == ['"1"', '"3"', '"1"']
+
+
+def test_mutation(connection):
+    cookie = b'a=1; b=2'
+    request = connection(cookie)
+    request.cookies['a'] = 'changed'
+    del request.cookies['b']
+    assert request.get_cookie('a') == 'changed'
+
+    # the next request with the same header gets the parse, not the changes
+    request = connection(cookie)
+    assert request.cookies == {'a': '1', 'b': '2'}
+    assert request.get_cookie('b') == '2'
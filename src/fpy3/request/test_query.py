@@ -0,0 +1,105 @@
+import codecs
+import urllib.parse
+
+import pytest
+
+crequest = pytest.importorskip('fpy3.request.crequest')
+
+from fpy3.request import FieldsLimitError, QueryDict  # noqa: E402
+
+
+@pytest.mark.parametrize('qs', [
+    '', 'a=1', 'a=1&b=2&a=3', 'a=&b', '&&a=1&', '=x&=',
+    'q=hello+world&f=%E2%82%AC&g=%e2%82%ac', 'bad=%zz%4&trail=%',
+    'k%3Dx=v%26w', 'u=%FF', 'a+b=c+d', 'x=1=2',
+])
+def test_parse_qsl(qs):
+    fields = QueryDict(qs.encode())
+    assert fields == dict(urllib.parse.parse_qsl(qs))
+    assert list(fields.items()) == list(dict(urllib.parse.parse_qsl(qs)).items())
+    assert fields.multi_items() == urllib.parse.parse_qsl(qs)
+
+
+def test_multi():
+    fields = QueryDict(b'tag=a&page=1&tag=b&tag=c')
+    assert fields['tag'] == 'c' and fields.get('page') == '1'
+    assert fields.getall('tag') == ['a', 'b', 'c']
+    assert fields.getall('missing') == []
+    assert fields.get('missing', 0) == 0 and 'missing' not in fields
+    assert 'tag' in fields and 1 not in fields
+    assert len(fields) == 2 and list(fields) == ['tag', 'page']
+    assert fields.keys() == ['tag', 'page'] and fields.values() == ['c', '1']
+    with pytest.raises(KeyError):
+        fields['missing']
+
+
+def test_encoding():
+    fields = QueryDict('name=J%F6rg&%E9=1'.encode(), 'latin-1')
+    assert fields['name'] == 'Jörg' and fields['é'] == '1'
+    assert fields.get('☃') is None
+
+
+def test_limits():
+    try:
+        crequest.configure_fields(max_fields=3, max_size=20)
+        assert len(QueryDict(b'a=1&b=2&c=3&d=&e')) == 3
+        with pytest.raises(FieldsLimitError):
+            QueryDict(b'a=1&b=2&c=3&d=4')
+        with pytest.raises(FieldsLimitError):
+            QueryDict(b'a=' + b'x' * 20)
+    finally:
+        crequest.configure_fields(max_fields=1000, max_size=2 * 1024 * 1024)
+
+
+def test_unknown_encoding():
+    with pytest.raises(LookupError):
+        QueryDict(b'a=1', 'no-such-encoding')
+
+
+def test_retry():
+    calls = []
+
+    def decode(data, errors='strict'):
+        if bytes(data) != b'a':
+            calls.append(bytes(data))
+            if len(calls) == 1:
+                raise MemoryError
+        return bytes(data).decode('latin-1'), len(data)
+
+    def search(name):
+        if name == 'flaky_test':
+            return codecs.CodecInfo(codecs.latin_1_encode, decode, name=name)
+
+    codecs.register(search)
+    try:
+        fields = QueryDict(b'a=%2541', 'flaky-test')
+        with pytest.raises(MemoryError):
+            fields['a']
+        # unquoted once, not again on the retry
+        assert fields['a'] == '%41'
+        assert calls == [b'%41', b'%41']
+    finally:
+        codecs.unregister(search)
+
+
+@pytest.mark.parametrize('encoding', [None, 'latin-1', 'cp1252'])
+def test_replaced_key(encoding):
+    # the same answer before and after iteration builds the key index
+    data = b'a%FF=1&a%FE=2&b=3' if encoding is None else b'a%81=1&b=3'
+    expected = dict(urllib.parse.parse_qsl(
+        data.decode(), encoding=encoding or 'utf-8', errors='replace'))
+    for key, value in expected.items():
+        fields = QueryDict(data, encoding)
+        assert fields.get(key) == value and key in fields
+        list(fields)
+        assert fields.get(key) == value and key in fields
+
+    fields = QueryDict(data, encoding)
+    assert fields.get('a') is None and 'a' not in fields
+
+
+def test_str_encoding():
+    fields = QueryDict('name=J%F6rg&n=Jörg', 'latin-1')
+    assert fields == {'name': 'Jörg', 'n': 'Jörg'}
+    with pytest.raises(UnicodeEncodeError):
+        QueryDict('n=☃', 'latin-1')
@@ -1,5 +1,6 @@
 #include <Python.h>
 #include <sys/param.h>
+#include <strings.h>
 
 #include "cresponse.h"
 #include "capsule.h"
@@ -16,6 +17,12 @@ static const size_t minor_offset = 7;
 static const char header[] = "HTTP/1.1 200 OK\r\n"
   "Content-Length: ";
 
+/*
+  Header lines every HTTP/1.x response carries, rendered once by
+  set_default_headers, e.g. Alt-Svc of a listener that also serves HTTP/3.
+*/
+static PyObject* default_headers = NULL;
+
 
 #ifdef RESPONSE_OPAQUE
 static PyObject *
@@ -259,6 +266,19 @@ Response_from_cache(PyObject* body)
 }
 
 
+static inline void
+Response_cache_clear(void)
+{
+  for(CacheEntry* entry = cache.entries; entry < cache.entries + cache.end;
+      entry++) {
+    Py_DECREF(entry->body);
+    Py_DECREF(entry->response_bytes);
+  }
+
+  cache.end = 0;
+}
+
+
 static inline void
 Response_cache(PyObject* body, PyObject* response_bytes)
 {
@@ -358,6 +378,11 @@ Response_render(Response* self, bool simple)
     buffer_offset += strlen("Connection: keep-alive\r\n");
   }
 
+  if(default_headers) {
+    bfrcpy(PyBytes_AS_STRING(default_headers),
+           (size_t)PyBytes_GET_SIZE(default_headers))
+  }
+
   if(!self->body)
     goto headers;
 
@@ -498,6 +523,271 @@ Response_render(Response* self, bool simple)
 }
 
 
+#define ROUNDTO8(v) (((v) + 7) & ~7)
+
+
+static inline bool
+Response_reserve(Response* self, size_t len)
+{
+  if(len <= self->buffer_len)
+    return true;
+
+  size_t buffer_len = MAX(self->buffer_len * 2, len);
+  char* buffer;
+
+  if(self->buffer == self->inline_buffer) {
+    if(!(buffer = malloc(buffer_len)))
+      return false;
+    memcpy(buffer, self->inline_buffer, strlen(header));
+  } else {
+    if(!(buffer = realloc(self->buffer, buffer_len)))
+      return false;
+  }
+
+  self->buffer = buffer;
+  self->buffer_len = buffer_len;
+
+  return true;
+}
+
+
+static inline bool
+Response_h3_forbidden(const char* name, size_t name_len)
+{
+#define is(v) \
+  (name_len == strlen(v) && strncasecmp(name, v, name_len) == 0)
+
+  return is("connection") || is("keep-alive") || is("transfer-encoding")
+    || is("upgrade") || is("proxy-connection");
+
+#undef is
+}
+
+
+/*
+  Render the response as a list of HTTP/3 field lines instead of an
+  HTTP/1.x head. The returned array and the strings it points to live in
+  the response buffer past the HTTP/1.x prefix and stay valid until the
+  response is rendered again or deallocated.
+*/
+ResponseField*
+Response_render_fields(
+  Response* self, size_t* fields_len, const char** body, size_t* body_len)
+{
+  ResponseField* fields = NULL;
+  PyObject* cookies_str = NULL;
+  PyObject* cookies_bytes = NULL;
+
+  unsigned long code = 200;
+  Py_ssize_t cbody_len = 0;
+  const char* cbody = NULL;
+  Py_ssize_t mime_type_len = strlen(text_plain);
+  const char* mime_type = text_plain;
+  Py_ssize_t encoding_len = strlen(utf8);
+  const char* encoding = utf8;
+  bool with_charset = false;
+  Py_ssize_t headers_len = 0;
+  size_t names_len = 0;
+  char* ccookies = NULL;
+  Py_ssize_t ccookies_len = 0;
+  size_t cookies_count = 0;
+
+  if(self->code) {
+    code = PyLong_AsUnsignedLong(self->code);
+
+    if(code < 100 || code > 599) {
+      PyErr_SetString(PyExc_ValueError, "Invalid status code");
+      goto error;
+    }
+
+    if(code % 100 > reason_ranges[code / 100 - 1].maximum) {
+      PyErr_SetString(PyExc_ValueError, "Invalid status code");
+      goto error;
+    }
+  }
+
+  if(self->body) {
+    if(PyBytes_AsStringAndSize(self->body, (char**)&cbody, &cbody_len) == -1)
+      goto error;
+
+    if(self->mime_type) {
+      mime_type = PyUnicode_AsUTF8AndSize(self->mime_type, &mime_type_len);
+      if(!mime_type)
+        goto error;
+    }
+
+    if(self->encoding) {
+      encoding = PyUnicode_AsUTF8AndSize(self->encoding, &encoding_len);
+      if(!encoding)
+        goto error;
+    }
+
+    with_charset = self->encoding || text_or_json;
+  }
+
+  PyObject *name, *value;
+  Py_ssize_t pos = 0;
+
+  if(self->headers) {
+    if((headers_len = PyDict_Size(self->headers)) < 0)
+      goto error;
+
+    while (PyDict_Next(self->headers, &pos, &name, &value)) {
+      Py_ssize_t name_len;
+
+      if(!PyUnicode_AsUTF8AndSize(name, &name_len))
+        goto error;
+
+      names_len += (size_t)name_len;
+    }
+  }
+
+  if(self->cookies) {
+    Py_ssize_t cookies_len;
+    if((cookies_len = PyObject_Size(self->cookies)) < 0)
+      goto error;
+
+    if(cookies_len) {
+      if(!(cookies_str = PyObject_Str(self->cookies)))
+        goto error;
+
+      if(!(cookies_bytes = PyUnicode_AsASCIIString(cookies_str)))
+        goto error;
+
+      if(PyBytes_AsStringAndSize(cookies_bytes, &ccookies, &ccookies_len) == -1)
+        goto error;
+
+      cookies_count = 1;
+      for(char* c = ccookies; c < ccookies + ccookies_len; c++)
+        if(*c == '\n')
+          cookies_count++;
+    }
+  }
+
+  size_t count = 3 + (size_t)headers_len + cookies_count;
+  size_t fields_offset = ROUNDTO8(strlen(header));
+  size_t strings_offset = fields_offset + count * sizeof(ResponseField);
+  size_t strings_len = 3 + 20 + 1 + (size_t)mime_type_len
+    + strlen(charset) + (size_t)encoding_len + names_len
+    + (size_t)ccookies_len;
+
+  if(!Response_reserve(self, strings_offset + strings_len)) {
+    PyErr_NoMemory();
+    goto error;
+  }
+
+  fields = (ResponseField*)(self->buffer + fields_offset);
+  char* strings = self->buffer + strings_offset;
+  ResponseField* field = fields;
+
+#define field_add(n, n_len, v, v_len) \
+  field->name = n; \
+  field->name_len = n_len; \
+  field->value = v; \
+  field->value_len = v_len; \
+  field++;
+
+  snprintf(strings, 4, "%03lu", code);
+  field_add(":status", strlen(":status"), strings, 3)
+  strings += 3;
+
+  // RFC 9110 8.6: none on a response that can't have content
+  if(code >= 200 && code != 204 && code != 304) {
+    int result = sprintf(strings, "%lu", (unsigned long)cbody_len);
+    field_add("content-length", strlen("content-length"), strings, (size_t)result)
+    strings += result;
+  }
+
+  if(cbody) {
+    char* content_type = strings;
+
+    memcpy(strings, mime_type, (size_t)mime_type_len);
+    strings += mime_type_len;
+
+    if(with_charset) {
+      memcpy(strings, charset, strlen(charset));
+      strings += strlen(charset);
+      memcpy(strings, encoding, (size_t)encoding_len);
+      strings += encoding_len;
+    }
+
+    field_add("content-type", strlen("content-type"),
+              content_type, (size_t)(strings - content_type))
+  }
+
+  pos = 0;
+  while (self->headers && PyDict_Next(self->headers, &pos, &name, &value)) {
+    const char* cname;
+    Py_ssize_t name_len;
+    const char* cvalue;
+    Py_ssize_t value_len;
+
+    if(!(cname = PyUnicode_AsUTF8AndSize(name, &name_len)))
+      goto error;
+
+    if(!(cvalue = PyUnicode_AsUTF8AndSize(value, &value_len)))
+      goto error;
+
+    // the length is ours, as the connection is the transport's
+    if(Response_h3_forbidden(cname, (size_t)name_len)
+       || (name_len == strlen("content-length")
+           && strncasecmp(cname, "content-length", (size_t)name_len) == 0))
+      continue;
+
+    for(Py_ssize_t i = 0; i < name_len; i++)
+      strings[i] = cname[i] >= 'A' && cname[i] <= 'Z' ? cname[i] | 0x20 : cname[i];
+
+    field_add(strings, (size_t)name_len, cvalue, (size_t)value_len)
+    strings += name_len;
+  }
+
+  if(ccookies_len) {
+    memcpy(strings, ccookies, (size_t)ccookies_len);
+
+    char* line = strings;
+    char* end = strings + ccookies_len;
+    while(line < end) {
+      char* line_end = memchr(line, '\n', (size_t)(end - line));
+      if(!line_end)
+        line_end = end;
+
+      char* cvalue = memchr(line, ':', (size_t)(line_end - line));
+      cvalue = cvalue ? cvalue + 1 : line;
+      while(cvalue < line_end && *cvalue == ' ')
+        cvalue++;
+
+      size_t value_len = (size_t)(line_end - cvalue);
+      if(value_len && cvalue[value_len - 1] == '\r')
+        value_len--;
+
+      if(value_len) {
+        field_add("set-cookie", strlen("set-cookie"), cvalue, value_len)
+      }
+
+      line = line_end + 1;
+    }
+  }
+
+#undef field_add
+#undef text_or_json
+
+  *fields_len = (size_t)(field - fields);
+  *body = cbody;
+  *body_len = (size_t)cbody_len;
+
+  goto finally;
+
+  error:
+  fields = NULL;
+
+  finally:
+  Py_XDECREF(cookies_str);
+  Py_XDECREF(cookies_bytes);
+
+  return fields;
+}
+
+
 static PyMethodDef Response_methods[] = {
   {NULL}
 };
@@ -545,12 +835,99 @@ static PyTypeObject ResponseType = {
 };
 
 
+static PyObject*
+set_default_headers(PyObject* self, PyObject* headers)
+{
+  PyObject* result = NULL;
+  PyObject* rendered = NULL;
+  PyObject* items = NULL;
+  PyObject* lines = NULL;
+
+  if(headers == Py_None)
+    goto done;
+
+  if(!(items = PyMapping_Items(headers)))
+    goto error;
+
+  if(!(lines = PyList_New(0)))
+    goto error;
+
+  for(Py_ssize_t i = 0; i < PyList_GET_SIZE(items); i++) {
+    PyObject* line;
+    PyObject* item = PyList_GET_ITEM(items, i);
+
+    if(!(line = PyUnicode_FromFormat(
+        "%S: %S\r\n", PyTuple_GET_ITEM(item, 0), PyTuple_GET_ITEM(item, 1))))
+      goto error;
+
+    const char* cline = PyUnicode_AsUTF8(line);
+    if(!cline || PyList_Append(lines, line) == -1) {
+      Py_DECREF(line);
+      goto error;
+    }
+    Py_DECREF(line);
+
+    /* no header injection through a name or value */
+    if(strpbrk(cline, "\r\n") != cline + strlen(cline) - 2) {
+      PyErr_SetString(PyExc_ValueError, "Header name or value contains CR or LF");
+      goto error;
+    }
+  }
+
+  PyObject* empty;
+  PyObject* joined;
+  if(!(empty = PyUnicode_FromString("")))
+    goto error;
+
+  joined = PyUnicode_Join(empty, lines);
+  Py_DECREF(empty);
+  if(!joined)
+    goto error;
+
+  rendered = PyUnicode_AsUTF8String(joined);
+  Py_DECREF(joined);
+  if(!rendered)
+    goto error;
+
+  if(!PyBytes_GET_SIZE(rendered))
+    Py_CLEAR(rendered);
+
+  done:
+  Py_XSETREF(default_headers, rendered);
+  rendered = NULL;
+#ifdef RESPONSE_CACHE
+  /* cached responses were rendered with the old lines */
+  Response_cache_clear();
+#endif
+
+  result = Py_None;
+  Py_INCREF(result);
+  goto finally;
+
+  error:
+  result = NULL;
+
+  finally:
+  Py_XDECREF(rendered);
+  Py_XDECREF(items);
+  Py_XDECREF(lines);
+  return result;
+}
+
+
+static PyMethodDef cresponse_methods[] = {
+  {"set_default_headers", (PyCFunction)set_default_headers, METH_O,
+   "Add headers, a dict or None, to every HTTP/1.x response"},
+  {NULL}
+};
+
+
 static PyModuleDef cresponse = {
   PyModuleDef_HEAD_INIT,
   "cresponse",
   "cresponse",
   -1,
-  NULL, NULL, NULL, NULL, NULL
+  cresponse_methods, NULL, NULL, NULL, NULL
 };
 
 
@@ -586,7 +963,8 @@ PyInit_cresponse(void)
   static Response_CAPI capi = {
     &ResponseType,
     Response_render,
-    Response_init
+    Response_init,
+    Response_render_fields
   };
   api_capsule = export_capi(m, "fpy3.response.cresponse", &capi);
   if(!api_capsule)
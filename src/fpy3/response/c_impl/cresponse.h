@@ -27,10 +27,20 @@ typedef struct {
 } Response;
 
 
+typedef struct {
+  const char* name;
+  size_t name_len;
+  const char* value;
+  size_t value_len;
+} ResponseField;
+
+
 typedef struct {
   PyTypeObject* ResponseType;
   PyObject* (*Response_render)(Response*, bool);
   int (*Response_init)(Response* self, PyObject *args, PyObject *kw);
+  ResponseField* (*Response_render_fields)(
+    Response* self, size_t* fields_len, const char** body, size_t* body_len);
 } Response_CAPI;
 
 #ifndef RESPONSE_OPAQUE
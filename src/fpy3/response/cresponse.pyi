@@ -10,3 +10,6 @@ class Response:
     def __init__(self, code: int = 200, text: Optional[str] = None,
                  body: Optional[bytes] = None, mime_type: str = 'text/plain; charset=utf-8',
                  headers: Optional[Dict[str, str]] = None) -> None: ...
+
+
+def set_default_headers(headers: Optional[Dict[str, str]]) -> None: ...
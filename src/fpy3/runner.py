@@ -22,6 +22,38 @@ def get_parser():
     parser.add_argument(
         '--reload', dest='reload', action='store_const',
         const=True, default=False)
+    parser.add_argument(
+        '--asgi', dest='asgi', action='store_const',
+        const=True, default=False,
+        help='serve an ASGI application with fpy3.asgi.ASGIServer')
+    parser.add_argument(
+        '--ssl', dest='ssl', action='store_const', const=True, default=False,
+        help='serve an Application over TLS with --certfile and --keyfile')
+    parser.add_argument('--certfile', dest='certfile', type=str, default='cert.pem')
+    parser.add_argument('--keyfile', dest='keyfile', type=str, default='key.pem')
+    parser.add_argument(
+        '--lifespan', dest='lifespan', choices=('auto', 'on', 'off'),
+        default='auto', help='ASGI lifespan protocol')
+    parser.add_argument(
+        '--warmup', dest='warmup', action='append', metavar='PATH',
+        help='GET PATH in every ASGI worker before it accepts connections')
+    parser.add_argument(
+        '--tls-curves', dest='tls_curves', metavar='CURVES',
+        help='ECDHE groups of the ASGI TCP/TLS listener, e.g. X25519:P-256')
+    parser.add_argument(
+        '--tls-session-cache', dest='tls_session_cache', type=int,
+        metavar='SIZE', help='TLS session cache size per worker')
+    parser.add_argument(
+        '--tls-session-timeout', dest='tls_session_timeout', type=int,
+        metavar='SECONDS', help='TLS session and ticket lifetime')
+    parser.add_argument(
+        '--tls-ticket-rotation', dest='tls_ticket_rotation', type=int,
+        default=3600, metavar='SECONDS',
+        help='session ticket key rotation period, 0 turns tickets off')
+    parser.add_argument(
+        '--tls-ticket-secret', dest='tls_ticket_secret', metavar='FILE',
+        help='file with the secret session ticket keys are derived from, '
+             'random otherwise')
 
     parser.add_argument(
         '--reloader-pid', dest='reloader_pid', type=int, help=SUPPRESS)
@@ -44,7 +76,10 @@ def verify(args):
         return script
     else:
         try:
-            module, attribute = args.application.rsplit('.', 1)
+            if args.asgi and ':' in args.application:
+                module, attribute = args.application.split(':', 1)
+            else:
+                module, attribute = args.application.rsplit('.', 1)
         except ValueError:
             print(
                 "Application specificer must contain at least one '.'," +
@@ -65,17 +100,47 @@ def verify(args):
                 .format(module.__name__, attribute))
             return False
 
-        if not isinstance(attribute, Application):
+        if args.asgi:
+            if not callable(attribute):
+                print("{} is not an ASGI application.".format(args.application))
+                return False
+        elif not isinstance(attribute, Application):
             print("{} is not an instance of 'fpy3.Application'.")
             return False
 
         return attribute
 
 
+def tls_settings(args):
+    from .protocol.tls import TicketKeys, TlsSettings
+
+    ticket_keys = None
+    if args.tls_ticket_rotation:
+        secret = None
+        if args.tls_ticket_secret:
+            with open(args.tls_ticket_secret, 'rb') as f:
+                secret = f.read()
+        ticket_keys = TicketKeys(secret, args.tls_ticket_rotation)
+
+    return TlsSettings(
+        session_tickets=bool(args.tls_ticket_rotation),
+        ticket_keys=ticket_keys, session_cache_size=args.tls_session_cache,
+        session_timeout=args.tls_session_timeout, curves=args.tls_curves)
+
+
 def run(attribute, args):
     if args.script:
         runpy.run_path(attribute)
+    elif args.asgi:
+        from . import asgi
+        asgi.run(
+            attribute, host=args.host, port=args.port,
+            worker_num=args.worker_num, certfile=args.certfile,
+            keyfile=args.keyfile, reloader_pid=args.reloader_pid,
+            lifespan=args.lifespan, warmup=args.warmup,
+            tls_settings=tls_settings(args))
     else:
         attribute._run(
             host=args.host, port=args.port,
-            worker_num=args.worker_num, reloader_pid=args.reloader_pid)
+            worker_num=args.worker_num, reloader_pid=args.reloader_pid,
+            ssl=(args.certfile, args.keyfile) if args.ssl else None)